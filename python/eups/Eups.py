@@ -1,7 +1,7 @@
 """
 The Eups class 
 """
-import glob, re, os, pwd, shutil, sys, time
+import copy, glob, re, os, pwd, shutil, sys, time
 import filecmp
 import fnmatch
 import tempfile
@@ -9,12 +9,14 @@ import zlib
 
 import utils
 from stack      import ProductStack, CacheOutOfSync
-from db         import Database
+from db         import Database, Transaction
 from tags       import Tags, Tag, TagNotRecognized
 from exceptions import ProductNotFound, EupsException, TableError, TableFileNotFound
-from table      import Table, Action
+from table      import Table, Action, TablePrefetcher
 from Product    import Product
-from Uses       import Uses
+from Uses       import Uses, UsesIndex, usesIndexFile
+from VersionCompare import versionSortKey, sortKeyIsExact
+from SetupPlan  import SetupPlan, SetupPlanCache
 import hooks
 
 class Eups(object):
@@ -108,7 +110,7 @@ class Eups(object):
                  keep=False, max_depth=-1, preferredTags=None,
                  # above is the backward compatible signature
                  userDataDir=None, asAdmin=False, setupType=[], validSetupTypes=None, vro={},
-                 exact_version=None, cmdName=None
+                 exact_version=None, cmdName=None, stackCache=None
                  ):
         """
         @param path             the colon-delimited list of product stack 
@@ -137,6 +139,12 @@ class Eups(object):
         @param preferredTags      List of tags to process in order; None will be intepreted as the default
         @param exact_version      Where possible, use the exact versions that were previously declared
         @param cmdName            The command being run, if known (used for diagnostics)
+        @param stackCache         if not None, a dictionary in which to keep the product
+                                    stacks and tags that are read, so that later instances
+                                    with the same configuration (e.g. in the eups daemon)
+                                    needn't read them again; the product caches are read even
+                                    if readCache is False.  The owner must clear it when the
+                                    databases change
         """
 
         self.verbose = verbose
@@ -180,6 +188,17 @@ class Eups(object):
         utils.Color.colorize(hooks.config.Eups.colorize)
 
         self.oldEnviron = os.environ.copy() # the initial version of the environment
+        #
+        # A snapshot of the products that are setup, kept up to date by setEnv and unsetEnv
+        # (see _getSetupVars()), and the Products they resolve to (see findSetupProduct())
+        #
+        self._setupEnviron = None       # the os.environ that _setupVars describes
+        self._setupVars = {}            # SETUP_* variable -> product name (None if malformed)
+        self._setupVarsUpper = {}       # upper-cased SETUP_* variable -> variable
+        self._setupProducts = {}        # product name -> (environment values, Product or exception)
+
+        self._transaction = None        # the open database Transaction (see beginTransaction())
+        self._unsavedStacks = {}        # eupsPathDir -> flavors whose cache must be saved at commit
 
         self.aliases = {}               # aliases that we should set
         self.oldAliases = {}            # initial value of aliases.  This is a bit of a fake, as we
@@ -197,6 +216,8 @@ class Eups(object):
         self.root = root
 
         self.version_cmp = hooks.version_cmp
+        self._versionKeyFor = None      # the version_cmp that _versionKeyFunc was made for
+        self._versionKeyFunc = None
         self.quiet = quiet
         self.keep = keep
         self.cmdName = cmdName
@@ -233,6 +254,7 @@ class Eups(object):
         # of this instance.  Used by setup().
         #
         self.alreadySetupProducts = {}
+        self._setupPlan = None          # the SetupPlan being recorded by setup(), if any
 
         self.noaction = noaction
         self.force = force
@@ -308,9 +330,14 @@ class Eups(object):
         #   * read the cached version of product info
         #
         self.versions = {}
+        self._stackCache = stackCache
         neededFlavors = utils.Flavor().getFallbackFlavors(self.flavor, True)
-        if readCache:
+        if readCache or stackCache is not None:
           for p in self.path:
+            stackKey = ("stack", p, tuple(neededFlavors))
+            if stackCache is not None and stackCache.has_key(stackKey):
+                self.versions[p] = stackCache[stackKey]
+                continue
 
             # the product cache.  If cache is non-existent or out of date,
             # the product info will be refreshed from the database
@@ -325,7 +352,11 @@ class Eups(object):
                                                       userTagDir=userCacheDir,
                                                       updateCache=True, 
                                                       autosave=False,
-                                                      verbose=self.verbose)
+                                                      verbose=self.verbose,
+                                                      lazy=hooks.config.Eups.lazyLoading)
+            self.versions[p].syncInterval = hooks.config.Eups.cacheSyncInterval
+            if stackCache is not None:
+                stackCache[stackKey] = self.versions[p]
         #
         # 
         fallbackList = hooks.config.Eups.fallbackFlavors
@@ -343,26 +374,34 @@ class Eups(object):
            hooks.config.Eups.globalTags.count(user) == 0:
             hooks.config.Eups.userTags.append(user)
 
-        self.tags = Tags()
         self.commandLineTagNames = []   # names of tags specified on the command line; set in selectVRO
 
-        for tags, group in [
-            (hooks.config.Eups.globalTags, None), # None => global
-            (["latest",], None),
-            (hooks.config.Eups.userTags, Tags.user),
-            (["commandLine", "keep", "path", "setup", "type",
-              "version", "version!", "versionExpr", "warn",], Tags.pseudo),
-            ]:
-            if isinstance(tags, str):
-                tags = tags.split()
-            for tag in tags:
-                try:
-                    self.tags.registerTag(tag, group)
-                except RuntimeError, e:
-                    raise RuntimeError("Unable to process tag %s: %s" % (tag, e))
+        tagsKey = ("tags", tuple(self.path), tuple(neededFlavors))
+        if stackCache is not None and stackCache.has_key(tagsKey):
+            self.tags = copy.deepcopy(stackCache[tagsKey]) # we may register more tags
+        else:
+            self.tags = Tags()
+
+            for tags, group in [
+                (hooks.config.Eups.globalTags, None), # None => global
+                (["latest",], None),
+                (hooks.config.Eups.userTags, Tags.user),
+                (["commandLine", "keep", "path", "setup", "type",
+                  "version", "version!", "versionExpr", "warn",], Tags.pseudo),
+                ]:
+                if isinstance(tags, str):
+                    tags = tags.split()
+                for tag in tags:
+                    try:
+                        self.tags.registerTag(tag, group)
+                    except RuntimeError, e:
+                        raise RuntimeError("Unable to process tag %s: %s" % (tag, e))
+
+            self._loadServerTags()
+            self._loadUserTags()
 
-        self._loadServerTags()
-        self._loadUserTags()
+            if stackCache is not None:
+                stackCache[tagsKey] = copy.deepcopy(self.tags)
         #
         # Handle preferred tags; this is a list where None means hooks.config.Eups.preferredTags
         #
@@ -565,9 +604,9 @@ The what argument tells us what sort of state is expected (allowed values are de
                     if self.verbose:
                         if tagUsedInProducts is None:
                             tagUsedInProducts = {}
-                            db = Database(self.getUpsDB(path))
-                            for pname in db.findProductNames():
-                                for tag, v, f in db.getTagAssignments(pname):
+                            db = self._databaseFor(path)
+                            for pname, assignments in db.getAllTagAssignments().items():
+                                for tag, v, f in assignments:
                                     tagNames.add(tag)
                                     if not tagUsedInProducts.has_key(tag):
                                         tagUsedInProducts[tag] = []
@@ -613,10 +652,10 @@ The what argument tells us what sort of state is expected (allowed values are de
                         tags.registerUserTag(t.name)
 
             else:
-                # consult the individual User tag Chain files (via Database)
+                # consult the tag registry, which will read the User tag Chain files if needs be
                 db = Database(self.getUpsDB(path), dirName)
-                for pname in db.findProductNames():
-                    for tag, v, f in db.getTagAssignments(pname):
+                for pname, assignments in db.getAllTagAssignments().items():
+                    for tag, v, f in assignments:
                         t = Tag.parse(tag)
                         if not t.isUser() and self.tags.isRecognized(t.name):
                             tags.registerTag(t.name, t.group)
@@ -643,8 +682,8 @@ The what argument tells us what sort of state is expected (allowed values are de
                 if not self.versions.has_key(p):
                     continue
 
-                for productName in extraDb.findProductNames():
-                    for etag, versionName, flavor in extraDb.getTagAssignments(productName, glob=False):
+                for productName, assignments in extraDb.getAllTagAssignments(glob=False, userId=owner).items():
+                    for etag, versionName, flavor in assignments:
                         if Tag(etag) != tag:
                             continue
 
@@ -793,7 +832,48 @@ The what argument tells us what sort of state is expected (allowed values are de
 
     def _envarSetupName(self, productName):
         # Return the name of the product's how-I-was-setup environment variable
-        return utils.setupEnvNameFor(productName)
+        # (c.f. utils.setupEnvNameFor, but without searching all of os.environ)
+        name = utils.setupEnvPrefix() + productName
+        if os.environ.has_key(name):
+            return name                 # exact match
+
+        self._getSetupVars()
+        return self._setupVarsUpper.get(name.upper(), name.upper())
+
+    def _getSetupVars(self):
+        """Return a dictionary mapping the SETUP_* environment variables to the names of the products
+        that they describe.  The environment is only parsed when os.environ has been replaced (e.g. by
+        popStack); setEnv and unsetEnv keep the dictionary up to date"""
+        if self._setupEnviron is not os.environ:
+            self._setupVars = {}
+            self._setupVarsUpper = {}
+            for key, val in os.environ.items():
+                self._noteSetupVar(key, val)
+            self._setupEnviron = os.environ
+
+        return self._setupVars
+
+    _re_setup = re.compile(r"^%s(\w+)$" % utils.setupEnvPrefix())
+
+    def _noteSetupVar(self, key, val):
+        """Update the snapshot of the SETUP_* variables for a change in an environment variable
+        (val is None if it was unset)"""
+        if not key.upper().startswith(utils.setupEnvPrefix()):
+            return
+
+        if val is None:
+            if self._setupVars.has_key(key):
+                del self._setupVars[key]
+            if self._setupVarsUpper.get(key.upper()) == key:
+                del self._setupVarsUpper[key.upper()]
+        else:
+            if self._re_setup.search(key):
+                productInfo = val.split()
+                if productInfo:
+                    self._setupVars[key] = productInfo[0]
+                else:                   # Oh dear;  "$setupEnvPrefix()_productName" must be malformed
+                    self._setupVars[key] = None
+            self._setupVarsUpper[key.upper()] = key
 
     def _envarDirName(self, productName):
         # Return the name of the product directory's environment variable
@@ -1295,6 +1375,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         # find the latest version of a product.  If minver is not None, 
         # the product must have a version matching this or newer.  
         out = None
+        versionKey = self._versionKey()
 
         for root in eupsPathDirs:
             if noCache or not self.versions.has_key(root) or not self.versions[root]:
@@ -1313,27 +1394,24 @@ The what argument tells us what sort of state is expected (allowed values are de
                 if minver and self.version_cmp(latest.version, minver) < 0:
                     continue
 
-                if out == None or self.version_cmp(latest.version, 
-                                                    out.version) > 0:
+                if out == None or self.version_cmp(latest.version, out.version) > 0:
                     # latest one in this stack is latest one seen
                     out = latest
 
             else:
                 # consult the cache
                 try: 
-                    vers = self.versions[root].getVersions(name, flavor)
-                    vers.sort(self.version_cmp)
-                    if len(vers) == 0:
+                    latest = self.versions[root].getLatestVersion(name, flavor, versionKey)
+                    if latest is None:
                         continue
 
                     # is latest version in this stack newer than minimum version?
-                    if minver and self.version_cmp(vers[-1], minver) < 0:
+                    if minver and self.version_cmp(latest, minver) < 0:
                         continue
 
-                    if out == None or self.version_cmp(vers[-1], 
-                                                        out.version) > 0:
+                    if out == None or self.version_cmp(latest, out.version) > 0:
                         # latest one in this stack is latest one seen
-                        out = self.versions[root].getProduct(name, vers[-1], flavor)
+                        out = self.versions[root].getProduct(name, latest, flavor)
 
                 except ProductNotFound:
                     continue
@@ -1370,8 +1448,7 @@ The what argument tells us what sort of state is expected (allowed values are de
             else:
                 # consult the cache
                 try: 
-                    vers = self.versions[root].getVersions(name, flavor)
-                    vers = filter(lambda z: self.version_match(z, expr), vers)
+                    vers = self._versionsMatching(self.versions[root], name, flavor, expr)
                     if len(vers) == 0:
                         continue
                     for ver in vers:
@@ -1398,15 +1475,18 @@ The what argument tells us what sort of state is expected (allowed values are de
         for tag in preferredTags:
             tag = self.tags.getTag(tag)  # should not fail
             if tag.name == "latest":
-                # find the latest version; first order the versions
-                vers = map(lambda p: p.version, products)
-                vers.sort(self.version_cmp)
+                # find the latest version (the last of any that sort equal)
+                versionKey = self._versionKey()
+                latest = None
+                for p in products:
+                    key = versionKey(p.version)
+                    if latest is None or not key < latestKey:
+                        latest, latestKey = p.version, key
 
                 # select the product with the latest version
-                if len(vers) > 0:
-                    for p in products:
-                        if p.version == vers[-1]:
-                            return p
+                for p in products:
+                    if p.version == latest:
+                        return p
             elif tag.name == "setup":
                 for p in products:
                     if self.isSetup(p.name, p.version, p.stackRoot()):
@@ -1486,33 +1566,36 @@ The what argument tells us what sort of state is expected (allowed values are de
         if os.path.isdir(self.getUpsDB(dataDir)):
             if self.path.count(dataDir) == 0:
                 self.path.append(dataDir)
+
+                stackKey = ("stack", dataDir, (self.flavor,))
+                if self._stackCache is not None and self._stackCache.has_key(stackKey):
+                    self.versions[dataDir] = self._stackCache[stackKey]
+                    return
                 
                 self.versions[dataDir] = ProductStack.fromCache(self.getUpsDB(dataDir), [self.flavor],
                                                                 updateCache=True, autosave=False,
                                                                 verbose=self.verbose)
+                self.versions[dataDir].syncInterval = hooks.config.Eups.cacheSyncInterval
+                if self._stackCache is not None:
+                    self._stackCache[stackKey] = self.versions[dataDir]
 
     def getSetupProducts(self, requestedProductName=None):
         """Return a list of all Products that are currently setup (or just the specified product)"""
 
-        re_setup = re.compile(r"^%s(\w+)$" % utils.setupEnvPrefix())
-
         productList = []
 
-        for key in filter(lambda k: re.search(re_setup, k), os.environ.keys()):
-            try:
-                productInfo = os.environ[key].split()
-                productName = productInfo[0]
-            except IndexError:          # Oh dear;  "$setupEnvPrefix()_productName" must be malformed
+        for key, productName in self._getSetupVars().items():
+            if productName is None:     # Oh dear;  "$setupEnvPrefix()_productName" must be malformed
+                continue
+
+            if requestedProductName and productName != requestedProductName:
                 continue
 
             try:
-                versionName = productInfo[1]
+                versionName = os.environ[key].split()[1]
             except IndexError:
                 versionName = None
 
-            if requestedProductName and productName != requestedProductName:
-                continue
-
             try:
                 try:
                     product = self.findSetupProduct(productName)
@@ -1542,7 +1625,37 @@ The what argument tells us what sort of state is expected (allowed values are de
         """
         return a Product instance for a currently setup product.  None is 
         returned if a product with the given name is not currently setup.
+
+        The answers for os.environ are remembered until the product's
+        environment variables change, or a product is (un)declared or
+        (un)tagged.
         """
+        if environ is not None and environ is not os.environ:
+            return self._findSetupProduct(productName, environ)
+
+        key = (os.environ.get(self._envarSetupName(productName)),
+               os.environ.get(self._envarDirName(productName)))
+        if productName == "eups":
+            key += (os.environ.get("EUPS_DIR"),)
+
+        cached = self._setupProducts.get(productName)
+        if not cached or cached[0] != key:
+            try:
+                product = self._findSetupProduct(productName)
+            except Exception, e:
+                product = e
+            cached = (key, product)
+            self._setupProducts[productName] = cached
+
+        product = cached[1]
+        if isinstance(product, Exception):
+            raise product
+        elif product:
+            product = product.clone()
+        return product
+
+    def _findSetupProduct(self, productName, environ=None):
+        # The work of findSetupProduct, without looking in the cache
         versionName, eupsPathDir, productDir, tablefile, flavor = \
             self.findSetupVersion(productName, environ)
         if versionName is None:
@@ -1564,12 +1677,16 @@ The what argument tells us what sort of state is expected (allowed values are de
         if val == None:
             val = ""
         os.environ[key] = val
+        if self._setupEnviron is os.environ:
+            self._noteSetupVar(key, val)
 
     def unsetEnv(self, key):
         """Unset an environmental variable"""
 
         if os.environ.has_key(key):
             del os.environ[key]
+        if self._setupEnviron is os.environ:
+            self._noteSetupVar(key, None)
 
     def setAlias(self, key, val):
         """Set an alias.  The value is in sh syntax --- we'll mangle it for csh later"""
@@ -1659,6 +1776,8 @@ The what argument tells us what sort of state is expected (allowed values are de
     # Permitted relational operators
     _relop_re = re.compile(r"<=?|>=?|==")
     _bad_relop_re = re.compile(r"^\s*=\s+\S+")
+    # Version expressions, as compiled by _compileVersionExpr()
+    _versionExprs = utils.LRUCache(256)
 
     def isLegalRelativeVersion(self, versionName):
         if versionName is None:
@@ -1670,35 +1789,145 @@ The what argument tells us what sort of state is expected (allowed values are de
                                 versionName)
         return False
 
+    def _versionKey(self):
+        """
+        return a function mapping a version to a key that sorts in the order
+        given by self.version_cmp.  The same function is returned until 
+        version_cmp is changed, so that ProductFamily can reuse the order 
+        it found with it.
+        """
+        if self._versionKeyFor is not self.version_cmp:
+            self._versionKeyFunc = versionSortKey(self.version_cmp)
+            self._versionKeyFor = self.version_cmp
+        return self._versionKeyFunc
+
+    def _versionsMatching(self, stack, name, flavor, expr):
+        """
+        return the versions of a product in a ProductStack that satisfy a 
+        version expression (see version_match()).  If the expression can 
+        be translated into ranges of versions (see _versionExprRanges()) 
+        only the versions in those ranges, found by bisection, are checked.
+        """
+        ranges = self._versionExprRanges(expr)
+        if ranges is None:
+            vers = stack.getVersions(name, flavor)
+        else:
+            versionKey = self._versionKey()
+            vers = []
+            seen = {}
+            for lower, includeLower, upper, includeUpper in ranges:
+                for v in stack.getVersionsBetween(name, flavor, versionKey, lower, upper,
+                                                  includeLower, includeUpper):
+                    if not seen.has_key(v):
+                        seen[v] = True
+                        vers.append(v)
+
+        return filter(lambda z: self.version_match(z, expr), vers)
+
+    def _versionExprRanges(self, expr):
+        """
+        return a list of ranges of versions, (lower, includeLower, upper,
+        includeUpper) as accepted by ProductFamily.getVersionsBetween(), 
+        that include every version that satisfies a version expression 
+        (see version_match()), or None if the expression cannot be so 
+        translated.  The ranges may include versions that don't satisfy
+        the expression.  Expressions that mention versions whose sort keys 
+        may not order them exactly (see VersionCompare.sortKeyIsExact()) 
+        are not translated.
+        """
+        ranges = None                   # the ranges satisfying the terms seen so far
+        accepted = []                   # ranges that short-circuit the rest of the expression
+        logop = None
+        for what, relop, v in self._compileVersionExpr(expr):
+            if what in ("or", "and") and ranges is not None and not logop:
+                logop = what
+                continue
+            elif what != "term":
+                return None
+
+            if not sortKeyIsExact(self._versionKey(), v):
+                return None
+
+            if relop == "==":
+                r = (v, True, v, True)
+            elif relop == "<":
+                r = (None, True, v, False)
+            elif relop == "<=":
+                r = (None, True, v, True)
+            elif relop == ">":
+                r = (v, False, None, True)
+            elif relop == ">=":
+                r = (v, True, None, True)
+            else:
+                return None
+
+            if ranges is None:
+                ranges = [r]
+            elif logop == "or":
+                ranges = ranges + [r]
+                accepted += ranges      # version_match() stops at the first true "or"
+            elif logop == "and":
+                ranges = filter(None, [self._intersectVersionRanges(a, r) for a in ranges])
+            else:
+                return None             # version_match() will complain
+            logop = None
+
+        if ranges is None or logop:
+            return None
+
+        out = []
+        for r in accepted + ranges:
+            if r not in out:
+                out.append(r)
+        return out
+
+    def _intersectVersionRanges(self, a, b):
+        # return the intersection of two ranges of versions, or None if it's empty
+        versionKey = self._versionKey()
+
+        lower, includeLower = a[0], a[1]
+        if b[0] is not None:
+            if lower is None or versionKey(b[0]) > versionKey(lower):
+                lower, includeLower = b[0], b[1]
+            elif versionKey(b[0]) == versionKey(lower):
+                includeLower = includeLower and b[1]
+
+        upper, includeUpper = a[2], a[3]
+        if b[2] is not None:
+            if upper is None or versionKey(b[2]) < versionKey(upper):
+                upper, includeUpper = b[2], b[3]
+            elif versionKey(b[2]) == versionKey(upper):
+                includeUpper = includeUpper and b[3]
+
+        if lower is not None and upper is not None:
+            if versionKey(lower) > versionKey(upper) or \
+               (versionKey(lower) == versionKey(upper) and not (includeLower and includeUpper)):
+                return None
+
+        return (lower, includeLower, upper, includeUpper)
+
     def version_match(self, vname, expr):
         """Return vname if it matches the logical expression expr"""
 
         expr0 = expr
-        expr = filter(lambda x: not re.search(r"^\s*$", x), re.split(r"\s*(%s|\|\||\s)\s*" % self._relop_re.pattern, expr0))
 
         logop = None                    # the next logical operation to process
         value = None                    # the value of the current term (e.g. ">= 2.0.0")
-        i = -1
-        while i < len(expr) - 1:
-            i += 1
-
-            if self._relop_re.search(expr[i]):
-                relop = expr[i]; i += 1
-                v = expr[i]
-            elif re.search(r"^[-+.:/\w]+$", expr[i]) and expr[i] not in ("and", "or"):
-                relop = "=="
-                v = expr[i]
-            elif expr[i] == "||" or expr[i] == "or":
+        for what, relop, v in self._compileVersionExpr(expr0):
+            if what == "or":
                 logop = "or"
                 continue
-            elif expr[i] == "&&" or expr[i] == "and":
+            elif what == "and":
                 if not value:
                     return False        # short circuit
                 
                 logop = "and"
                 continue
-            else:
-                print >> utils.stdwarn, "Unexpected operator %s in \"%s\"" % (expr[i], expr0)
+            elif what == "missing":
+                raise EupsException("Relational operator %s without a version in expression \"%s\"" %
+                                    (relop, expr0))
+            elif what == "unexpected":
+                print >> utils.stdwarn, "Unexpected operator %s in \"%s\"" % (relop, expr0)
                 break
 
             if not logop and value is not None:
@@ -1726,6 +1955,47 @@ The what argument tells us what sort of state is expected (allowed values are de
         else:
             return None
 
+    def _compileVersionExpr(self, expr):
+        """
+        return a version expression (see version_match()) as a tuple of
+        steps (what, relop, version), where what is one of:
+            "term"        compare the version using relop (e.g. ">=")
+            "or", "and"   a logical operator
+            "unexpected"  an unrecognised token, given as relop
+            "missing"     relop isn't followed by a version
+        The steps are cached, keyed by the expression.
+        """
+        steps = self._versionExprs.get(expr)
+        if steps is not None:
+            return steps
+
+        tokens = filter(lambda x: not re.search(r"^\s*$", x),
+                        re.split(r"\s*(%s|\|\||\s)\s*" % self._relop_re.pattern, expr))
+        steps = []
+        i = 0
+        while i < len(tokens):
+            tok = tokens[i]
+            if self._relop_re.search(tok):
+                if i + 1 == len(tokens):
+                    steps.append(("missing", tok, None))
+                    break
+                i += 1
+                steps.append(("term", tok, tokens[i]))
+            elif re.search(r"^[-+.:/\w]+$", tok) and tok not in ("and", "or"):
+                steps.append(("term", "==", tok))
+            elif tok == "||" or tok == "or":
+                steps.append(("or", None, None))
+            elif tok == "&&" or tok == "and":
+                steps.append(("and", None, None))
+            else:
+                steps.append(("unexpected", tok, None))
+                break
+            i += 1
+
+        steps = tuple(steps)
+        self._versionExprs.set(expr, steps)
+        return steps
+
     def version_match_prim(self, op, v1, v2):
         """
     Compare two version strings, using the specified operator (< <= == >= >), returning
@@ -1795,8 +2065,51 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param tablefile        use this table file to setup the product
         @param versionExpr      An expression specifying the desired version
         @param implicitProduct  True iff product is setup due to being specified in implicitProducts
+
+        If hooks.config.Eups.cacheSetupPlans is True, the changes made by a toplevel setup are 
+        cached (see SetupPlan), and replayed if the same request is made in the same environment.
         """
 
+        planCache = None
+        if fwd and recursionDepth == 0 and self._setupPlan is None and \
+               self.verbose <= 0 and not self.noaction:
+            planCache = SetupPlanCache.get()
+
+        if planCache:
+            state = planCache.state(self)
+            if state is None:
+                planCache = None
+
+        if not planCache:
+            return self._setup(productName, versionName, fwd, recursionDepth, setupToplevel, noRecursion,
+                               productRoot, tablefile, versionExpr, optional, implicitProduct)
+
+        key = planCache.makeKey(self, (productName, versionName, setupToplevel, noRecursion,
+                                       productRoot, tablefile, versionExpr, optional, implicitProduct))
+        plan = planCache.lookup(key, self)
+        if plan:
+            plan.replay(self)
+            return True, plan.version, None
+
+        self._setupPlan = SetupPlan(self, state)
+        try:
+            ok, version, reason = self._setup(productName, versionName, fwd, recursionDepth, setupToplevel,
+                                              noRecursion, productRoot, tablefile, versionExpr, optional,
+                                              implicitProduct)
+            plan = self._setupPlan
+        finally:
+            self._setupPlan = None
+
+        if ok:
+            plan.finish(self, version)
+            planCache.save(key, plan)
+
+        return ok, version, reason
+
+    def _setup(self, productName, versionName, fwd, recursionDepth, setupToplevel, noRecursion,
+               productRoot, tablefile, versionExpr, optional, implicitProduct):
+        """The body of setup(), without the use of cached setup plans"""
+
         if isinstance(versionName, str) and versionName.startswith(Product.LocalVersionPrefix):
             productRoot = versionName[len(Product.LocalVersionPrefix):]
 
@@ -1939,6 +2252,8 @@ The what argument tells us what sort of state is expected (allowed values are de
 
                 self.alreadySetupProducts[product.name] = (product, vroReason)
 
+        if self._setupPlan is not None:
+            self._setupPlan.addTable(product.tableFileName())
         try:
             table = product.getTable(quiet=not fwd, verbose=self.verbose)
         except TableFileNotFound, e:
@@ -2055,6 +2370,8 @@ The what argument tells us what sort of state is expected (allowed values are de
             # Remember that we've set this up in case we want to keep it later
             #
             self.alreadySetupProducts[product.name] = (product, vroReason)
+            if self._setupPlan is not None:
+                self._setupPlan.addProduct(product.name, product.version, productRoot)
         elif fwd:
             assert not setupToplevel
         else:
@@ -2067,6 +2384,11 @@ The what argument tells us what sort of state is expected (allowed values are de
         #
         # Process table file
         #
+        if fwd and not noRecursion:
+            prefetcher = TablePrefetcher.get()
+            if prefetcher:
+                prefetcher.prefetchDependencies(self, actions)
+
         for a in actions:
             if localProduct:    # we'll set e.g. PATH from localProduct
                 if a.cmd not in (Action.setupOptional,   Action.setupRequired,
@@ -2079,6 +2401,8 @@ The what argument tells us what sort of state is expected (allowed values are de
         # Did we want to use the dependencies from an installed table, but use a different directory?
         #
         if localProduct:
+            if self._setupPlan is not None:
+                self._setupPlan.addTable(localProduct.tableFileName())
             localTable = localProduct.getTable(quiet=True)
             if localTable:
                 localActions = localTable.actions(setupFlavor, setupType=self.setupType, verbose=verbose)
@@ -2108,6 +2432,85 @@ The what argument tells us what sort of state is expected (allowed values are de
         return self.setup(productName, versionName, fwd=False, optional=optional,
                           recursionDepth=recursionDepth, noRecursion=noRecursion)
 
+    def _saveStack(self, eupsPathDir, flavor):
+        """
+        save the cache of a stack's products for a flavor after it has been
+        changed.  If a transaction is open the save is put off until it is
+        committed, so that a batch of changes only saves each cache once.
+        """
+        if self._transaction:
+            flavors = self._unsavedStacks.setdefault(eupsPathDir, [])
+            if flavor not in flavors:
+                flavors.append(flavor)
+            return
+
+        try:
+            self.versions[eupsPathDir].save(flavor)
+        except CacheOutOfSync, e:
+            if self.quiet <= 0:
+                print >> utils.stdwarn, "Warning: " + str(e)
+                print >> utils.stdwarn, "Correcting..."
+            self.versions[eupsPathDir].refreshFromDatabase()
+
+    def beginTransaction(self):
+        """
+        start a batch of declarations, undeclarations and tag assignments.
+        The changes are written to the databases as they are made, but the
+        product caches are only saved when the batch is finished with 
+        commitTransaction(); if rollbackTransaction() is called instead
+        (e.g. because one of the changes failed) the databases and caches 
+        are restored to their state when the batch was begun.  Use as
+        
+           eupsenv.beginTransaction()
+           try:
+               ...
+           except:
+               eupsenv.rollbackTransaction()
+               raise
+           eupsenv.commitTransaction()
+        """
+        if self._transaction:
+            raise EupsException("A transaction is already open")
+        self._transaction = Transaction.begin()
+        self._unsavedStacks = {}
+
+    def commitTransaction(self):
+        """
+        keep the changes made since beginTransaction(), saving each changed
+        product cache once
+        """
+        if not self._transaction:
+            raise EupsException("No transaction is open")
+        self._transaction.commit()
+        self._transaction = None
+
+        unsaved, self._unsavedStacks = self._unsavedStacks, {}
+        for eupsPathDir, flavors in unsaved.items():
+            if self.versions.get(eupsPathDir):
+                for flavor in flavors:
+                    self._saveStack(eupsPathDir, flavor)
+
+    def rollbackTransaction(self):
+        """
+        undo the changes made since beginTransaction()
+        """
+        if not self._transaction:
+            raise EupsException("No transaction is open")
+        self._transaction.rollback()
+        self._transaction = None
+        self._setupProducts = {}
+
+        # the in-memory caches hold the undone changes, but the saved ones don't
+        unsaved, self._unsavedStacks = self._unsavedStacks, {}
+        for eupsPathDir, flavors in unsaved.items():
+            stack = self.versions.get(eupsPathDir)
+            if not stack:
+                continue
+            try:
+                stack.reload(flavors)
+            except (RuntimeError, OSError, IOError):
+                stack.refreshFromDatabase()
+
     def assignTag(self, tag, productName, versionName, eupsPathDir=None, eupsPathDirForRead=None):
         """
         assign the given tag to a product.  The product that it will be
@@ -2119,6 +2522,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param productName   the name of the product to tag
         @param versionName   the version of the product
         """
+        self._setupProducts = {}        # the versions that are setup may change
         # convert tag name to a Tag instance; may raise TagNotRecognized
         tag = self.tags.getTag(tag)
 
@@ -2140,13 +2544,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         if self.versions.has_key(root) and self.versions[root]:
             self.versions[root].ensureInSync(verbose=self.verbose)
             self.versions[root].assignTag(tag, productName, versionName, self.flavor)
-            try:
-                self.versions[root].save(self.flavor)
-            except CacheOutOfSync, e:
-                if self.quiet <= 0:
-                    print >> utils.stdwarn, "Warning: " + str(e)
-                    print >> utils.stdwarn, "Correcting..."
-                self.versions[root].refreshFromDatabase()
+            self._saveStack(root, self.flavor)
 
     def unassignTag(self, tag, productName, versionName=None, eupsPathDir=None, eupsPathDirForRead=None):
         """
@@ -2159,6 +2557,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                                  the first product in the stack with that tag
                                  will be chosen.
         """
+        self._setupProducts = {}        # the versions that are setup may change
         # convert tag name to a Tag instance; may raise TagNotRecognized
         tag = self.tags.getTag(tag)
 
@@ -2231,13 +2630,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         if self.versions.has_key(eupsPathDir) and self.versions[eupsPathDir]:
             self.versions[eupsPathDir].ensureInSync(verbose=self.verbose)
             if self.versions[eupsPathDir].unassignTag(str(tag), productName, self.flavor):
-                try:
-                    self.versions[eupsPathDir].save(self.flavor)
-                except CacheOutOfSync, e:
-                    if self.quiet <= 0:
-                        print >> utils.stdwarn, "Warning: " + str(e)
-                        print >> utils.stdwarn, "Correcting..."
-                    self.versions[eupsPathDir].refreshFromDatabase()
+                self._saveStack(eupsPathDir, self.flavor)
 
             elif self.verbose:
                 print >> utils.stdwarn, "Tag %s not assigned to %s %s" % \
@@ -2298,6 +2691,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param declareCurrent  DEPRECATED, if True and tag=None, it is 
                                equivalent to tag="current".  
         """
+        self._setupProducts = {}        # the versions that are setup may change
         if re.search(r"[^a-zA-Z_0-9]", productName):
             raise EupsException("Product names may only include the characters [a-zA-Z_0-9]: saw %s" % productName)
 
@@ -2620,14 +3014,7 @@ The what argument tells us what sort of state is expected (allowed values are de
 
                     self.versions[eupsPathDir].ensureInSync(verbose=self.verbose)
                     self.versions[eupsPathDir].addProduct(product)
-
-                    try:
-                        self.versions[eupsPathDir].save(self.flavor)
-                    except CacheOutOfSync, e:
-                        if self.quiet <= 0:
-                            print >> utils.stdwarn, "Note: " + str(e)
-                            print >> utils.stdwarn, "Correcting..."
-                        self.versions[eupsPathDir].refreshFromDatabase()
+                    self._saveStack(eupsPathDir, self.flavor)
                 
         if tag:
             # we just want to update the tag
@@ -2668,11 +3055,14 @@ The what argument tells us what sort of state is expected (allowed values are de
                 else:
                     if self.verbose > 1:
                         print >> utils.stdinfo, "mkdir -p %s" % (dirName)
-                    os.makedirs(dirName)
+                    Transaction.makeDirs(dirName) # so a rollback removes them
 
             if self.noaction:
                 print "cp %s %s" % (fileNameIn, pathOut)
             else:
+                transaction = Transaction.current()
+                if transaction:
+                    transaction.saveFile(pathOut)
                 utils.copyfile(fileNameIn, pathOut)
             if self.verbose > 1:
                 print >> utils.stdinfo, "Copying %s to %s" % (fileNameIn, pathOut)
@@ -2711,6 +3101,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param undeclareCurrent  DEPRECATED; if True, and tag is None, this
                                 is equivalent to tag="current".  
         """
+        self._setupProducts = {}        # the versions that are setup may change
         # this is for backward compatibility
         if isinstance(tag, bool) or (tag is None and undeclareCurrent):
             tag = "current"
@@ -2776,14 +3167,7 @@ The what argument tells us what sort of state is expected (allowed values are de
             self.versions[eupsPathDir].removeProduct(product.name, 
                                                      product.flavor,
                                                      product.version)
-
-            try:
-                self.versions[eupsPathDir].save(product.flavor)
-            except CacheOutOfSync, e:
-                if self.quiet <= 0:
-                    print >> utils.stdwarn, "Warning: " + str(e)
-                    print >> utils.stdwarn, "Correcting..."
-                self.versions[eupsPathDir].refreshFromDatabase()
+            self._saveStack(eupsPathDir, product.flavor)
 
         return True
 
@@ -2848,6 +3232,12 @@ The what argument tells us what sort of state is expected (allowed values are de
         out = []
         latest = None
 
+        # If we only want versions assigned recognized tags, we need only
+        # consider the products that have been assigned them
+        taggedNames = None
+        if tags and not bad and "latest" not in tags and "setup" not in tags:
+            taggedNames = self._findTaggedNames(tagset)
+
         # first get all the currently setup products.  We will integrate these
         # into the list
         setup = {}
@@ -2891,10 +3281,13 @@ The what argument tells us what sort of state is expected (allowed values are de
                     continue
 
                 # match the product name
-                prodnames = stack.getProductNames(flavor)
-                if name:
-                    prodnames = fnmatch.filter(prodnames, name)
-                prodnames.sort()
+                index = stack.getIndex(flavor)
+                prodnames = index.getProductNames(name)
+                if taggedNames is not None:
+                    rawTags = tagset.filter(index.getTagNames())
+                    candidates = index.getTaggedNames(rawTags)
+                    prodnames = [p for p in prodnames
+                                 if candidates.has_key(p) or taggedNames.has_key(p)]
 
                 for pname in prodnames:
                     if tags:
@@ -2907,13 +3300,16 @@ The what argument tells us what sort of state is expected (allowed values are de
                                     out.append(prod)
 
                     # select out matched versions
-                    vers = stack.getVersions(pname, flavor)
+                    if taggedNames is not None:
+                        vers = index.getTaggedVersions(pname, rawTags)
+                    else:
+                        vers = index.getVersions(pname)
                     if version:
                         if self.isLegalRelativeVersion(version): # version is actually an expression
                             vers = [v for v in vers if self.version_match(v, version)]
                         else:
                             vers = fnmatch.filter(vers, version)
-                    vers.sort(self.version_cmp)
+                    vers.sort(key=versionSortKey(self.version_cmp))
 
                     # only include latest if it passes the version constraint
                     if latest is not None and latest.version not in vers:
@@ -2993,6 +3389,27 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         return productList                
 
+    def _findTaggedNames(self, tagset):
+        """
+        return a dictionary whose keys are the names of the products that
+        findTaggedProduct() could find with one of a set of tags, or None
+        if that would require searching a stack's database.
+        @param tagset   the tags, as a _TagSet
+        """
+        out = {}
+        for root in self.path:
+            if not self.versions.has_key(root) or not self.versions[root]:
+                return None
+            stack = self.versions[root]
+            stack.ensureInSync(verbose=self.verbose)
+            if self.flavor not in stack.getFlavors():
+                continue
+
+            index = stack.getIndex(self.flavor)
+            out.update(index.getTaggedNames(tagset.filter(index.getTagNames())))
+
+        return out
+
     def dependencies_from_table(self, tablefile, eupsPathDirs=None):
         """Return self's dependencies as a list of (Product, optional, recursionDepth) tuples
 
@@ -3171,11 +3588,11 @@ The what argument tells us what sort of state is expected (allowed values are de
         this product depends on; if checkRecursive is True, you won't be able to remove any
         product that's in use elsewhere unless force is also True.
 
-        N.b. The checkRecursive option is quite slow (it has to parse
-        every table file on the system).  If you're calling remove
-        repeatedly, you can pass in a userInfo object (returned by
-        self.uses(None)) to save remove() having to processing those
-        table files on every call."""
+        N.b. The checkRecursive option has to know the dependencies of
+        every product on the system.  These are saved between calls (see
+        UsesIndex), but if you're calling remove repeatedly, you can pass
+        in a userInfo object (returned by self.uses(None)) to save remove()
+        having to gather them on every call."""
         #
         # Gather the required information
         #
@@ -3248,6 +3665,13 @@ The what argument tells us what sort of state is expected (allowed values are de
                         shutil.rmtree(dir)
                     except OSError, e:
                         raise RuntimeError, e
+                    #
+                    # Free the product's files in the store of chunked packages (if any)
+                    #
+                    if product.stackRoot() and product.flavor:
+                        import distrib.chunked
+                        distrib.chunked.removeProduct(product.stackRoot(), product.flavor,
+                                                      product.name, product.version)
 
             removedDirs[dir] = 1
 
@@ -3322,6 +3746,13 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         if not usesInfo:
             usesInfo = Uses()
+            #
+            # The dependencies of declared products are saved in an index
+            # for each stack, so that we only need resolve those that have
+            # changed since we were last called
+            #
+            indexes = {}
+            databases = None
 
             for pi in productList:          # for every known product
                 if False:
@@ -3341,19 +3772,40 @@ The what argument tells us what sort of state is expected (allowed values are de
                             print >> utils.stdwarn, ("Warning: %s" % (e))
                         continue
 
-                try:
-                    deps = self.getDependentProducts(pi, shouldRaise=False, followExact=None, topological=True)
-                except TableError, e:
-                    if not self.quiet:
-                        print >> utils.stdwarn, ("Warning: %s" % (e))
-                    continue
+                root = pi.stackRoot()
+                if not indexes.has_key(root):
+                    if databases is None:
+                        databases = self._usesDatabases()
+                    indexes[root] = self._getUsesIndex(root, databases)
+                index = indexes[root]
+
+                deps = None
+                if index:
+                    deps = index.get(pi)
 
-                for dep_product, dep_optional, dep_depth in deps:
-                    assert not (pi.name == dep_product.name and pi.version == dep_product.version)
+                if deps is None:
+                    try:
+                        depProducts = self.getDependentProducts(pi, shouldRaise=False, followExact=None,
+                                                                topological=True)
+                    except TableError, e:
+                        if not self.quiet:
+                            print >> utils.stdwarn, ("Warning: %s" % (e))
+                        continue
+
+                    if index:
+                        index.set(pi, depProducts)
+                    deps = [(p.name, p.version, o, d) for p, o, d in depProducts]
 
-                    usesInfo.remember(pi.name, pi.version, (dep_product.name, dep_product.version,
+                for dep_name, dep_version, dep_optional, dep_depth in deps:
+                    assert not (pi.name == dep_name and pi.version == dep_version)
+
+                    usesInfo.remember(pi.name, pi.version, (dep_name, dep_version,
                                                             dep_optional, dep_depth))
 
+            for index in indexes.values():
+                if index:
+                    index.save()
+
             usesInfo.invert(depth)
 
         self.exact_version = old_exact_version
@@ -3365,6 +3817,48 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         return usesInfo.users(productName, versionName)
 
+    def _usesDatabases(self):
+        """
+        return the (Database, dbroot, needJournal) for each database directory
+        on the EUPS path, as needed by UsesIndex.load()
+        """
+        databases = []
+        for d in self.path:
+            db = self._databaseFor(d)
+            databases.append((db, db.dbpath, True))
+            userdb = db._getUserTagDb()
+            if userdb:
+                # only changed by eups, which always keeps a journal
+                databases.append((db, userdb, False))
+        return databases
+
+    def _getUsesIndex(self, eupsPathDir, databases):
+        """
+        return the UsesIndex of the products declared in a stack on the 
+        EUPS path, or None if it cannot be used
+        @param eupsPathDir   the stack
+        @param databases     the databases on the EUPS path, as returned by
+                               _usesDatabases()
+        """
+        if eupsPathDir not in self.path:
+            return None             # e.g. a LOCAL setup
+
+        cachedir = self._userStackCache(eupsPathDir)
+        if not cachedir:
+            return None
+
+        vro = self._vro
+        if vro is not None:
+            vro = tuple(vro)
+        context = (tuple(self.path), self.flavor, tuple(self.setupType), vro,
+                   hooks.config.Eups.defaultProduct["name"])
+
+        index = UsesIndex.load(os.path.join(cachedir, usesIndexFile), context, databases,
+                               eupsPathDir)
+        if not index.usable:
+            return None
+        return index
+
     def supportServerTags(self, tags, eupsPathDir=None):
         """
         support the list of tags provided by a server.  This function will
@@ -3790,6 +4284,9 @@ class _TagSet(object):
             if self.lu.has_key(tag):
                 return True
         return False
+    def filter(self, tags):
+        """return the members of a list of tag names that are in the set"""
+        return [t for t in tags if self.intersects([t])]
 
 def _set(iterable):
     """
@@ -0,0 +1,272 @@
+"""
+a cache of the results of setting up products.
+
+For a given request (product, version or tag, flavor, setup type, VRO,
+EUPS_PATH, ...) and initial environment, setup always makes the same changes
+to the environment and aliases.  A SetupPlan records those changes, and the
+SetupPlanCache saves them in the user data directory so that the next
+identical request can replay them without looking for products or reading
+table files.  Plans are keyed by the environment variables that setup uses 
+(SETUP_*, EUPS_*, *_DIR and *PATH), rather than the whole environment, so
+that they may be shared by e.g. batch jobs; a plan is only used while the
+other variables that it changed or that its table files refer to have the
+same values, and while the databases' change journals (see 
+Database.lastChanged()), the table files that were read, and the user's
+customisations are unchanged.
+"""
+import os, re, glob
+try:
+    import hashlib
+    _md5 = hashlib.md5
+except ImportError:                     # python < 2.5
+    import md5
+    _md5 = md5.new
+
+import utils
+import hooks
+from db import Database
+from tags import Tag
+
+# the environment variables that a setup plan is keyed by
+_setupEnvironRe = re.compile(r"^(SETUP_|EUPS_)|(_DIR|_DIR_EXTRA|PATH)$", re.IGNORECASE)
+# references to environment variables in table files
+_environRefRe = re.compile(r"\$\{?([A-Za-z_]\w*)")
+
+class SetupPlan(object):
+    """
+    the changes made to the environment and aliases by setting up a product
+    """
+
+    def __init__(self, Eups, state):
+        """
+        start recording a setup
+        @param Eups    the Eups instance doing the setup
+        @param state   the state of the databases etc. before the setup (see SetupPlanCache.state())
+        """
+        self.state = state
+        self.tables = {}                # the table files read, and their modification times
+        self.version = None             # the version that was setup
+        self.products = []              # the (name, version, dir) of each product setup, in order
+        self.alreadySetupProducts = {}  # Eups.alreadySetupProducts after the setup
+
+        self.setEnv = {}                # the environment variables that were set
+        self.unsetEnv = []              # the environment variables that were unset
+        self.setAliases = {}            # the aliases that were set
+        self.unsetAliases = []          # the aliases that were unset
+        self.environ = {}               # the initial values (or None) of the variables that were
+                                        # changed or that the table files refer to
+
+        self._environ0 = os.environ.copy()
+        self._aliases0 = Eups.aliases.copy()
+        self._oldAliases0 = Eups.oldAliases.copy()
+
+    def addTable(self, tableFile):
+        """
+        note that a table file was read
+        """
+        if tableFile and not self.tables.has_key(tableFile):
+            try:
+                self.tables[tableFile] = os.stat(tableFile).st_mtime
+            except OSError:
+                self.tables[tableFile] = None
+
+    def addProduct(self, productName, version, productDir):
+        """
+        note that a product was setup
+        """
+        self.products.append((productName, version, productDir))
+
+    def finish(self, Eups, version):
+        """
+        record the changes made by the setup
+        @param Eups      the Eups instance that did the setup
+        @param version   the version that was setup
+        """
+        self.version = version
+
+        for key, val in os.environ.items():
+            if self._environ0.get(key) != val:
+                self.setEnv[key] = val
+        self.unsetEnv = [k for k in self._environ0.keys() if not os.environ.has_key(k)]
+
+        names = self.setEnv.keys() + self.unsetEnv
+        for tableFile in self.tables.keys():
+            try:
+                fd = open(tableFile)
+                try:
+                    names += _environRefRe.findall(fd.read())
+                finally:
+                    fd.close()
+            except IOError:
+                pass
+        for key in names:
+            self.environ[key] = self._environ0.get(key)
+
+        for key, val in Eups.aliases.items():
+            if self._aliases0.get(key) != val:
+                self.setAliases[key] = val
+        self.unsetAliases = [k for k in self._aliases0.keys() if not Eups.aliases.has_key(k)]
+        for key in Eups.oldAliases.keys():
+            if not self._oldAliases0.has_key(key) and not Eups.aliases.has_key(key) and \
+                   key not in self.unsetAliases:
+                self.unsetAliases.append(key)
+
+        for name, (product, vroReason) in Eups.alreadySetupProducts.items():
+            product = product.clone()
+            product._table = None       # it'll be reread if needed
+            self.alreadySetupProducts[name] = (product, vroReason)
+
+        del self._environ0, self._aliases0, self._oldAliases0
+
+    def isValid(self):
+        """
+        return True if the table files that were read and the values of the
+        environment variables in self.environ are unchanged
+        """
+        for key, val in self.environ.items():
+            if os.environ.get(key) != val:
+                return False
+
+        for tableFile, mtime in self.tables.items():
+            try:
+                if os.stat(tableFile).st_mtime != mtime:
+                    return False
+            except OSError:
+                if mtime is not None:
+                    return False
+
+        return True
+
+    def replay(self, Eups):
+        """
+        make the recorded changes to the environment and aliases, and note
+        the products that are setup
+        """
+        for key, val in self.setEnv.items():
+            Eups.setEnv(key, val)
+        for key in self.unsetEnv:
+            Eups.unsetEnv(key)
+
+        for key, val in self.setAliases.items():
+            Eups.setAlias(key, val)
+        for key in self.unsetAliases:
+            Eups.unsetAlias(key)
+
+        Eups.alreadySetupProducts = self.alreadySetupProducts.copy()
+
+    def __getstate__(self):
+        return dict([(k, v) for k, v in self.__dict__.items() if not k.startswith("_")])
+
+class SetupPlanCache(utils.FileCache):
+    """
+    an on-disk cache of SetupPlans, keyed by the request and the initial environment.
+    When the cache grows beyond hooks.config.Eups.setupPlanCacheSize megabytes, the
+    least recently used plans are removed.
+    """
+
+    # the format of the cache entries; bump this if SetupPlan changes
+    formatVersion = 3
+
+    # @staticmethod   # requires python 2.4
+    def get():
+        """
+        return the SetupPlanCache for the user's data directory, or None if
+        caching is disabled (see hooks.config.Eups.cacheSetupPlans)
+        """
+        if not hooks.config.Eups.cacheSetupPlans:
+            return None
+
+        cacheDir = utils.userSetupPlanDir()
+        if not cacheDir:
+            return None
+
+        maxSize = hooks.config.Eups.setupPlanCacheSize
+        if maxSize:
+            maxSize = int(maxSize*1024*1024)
+        else:
+            maxSize = None
+
+        return SetupPlanCache._getInstance(cacheDir, maxSize)
+    get = staticmethod(get)
+
+    def makeKey(self, Eups, request):
+        """
+        return the key for a setup request
+        @param Eups      the Eups instance that will do the setup
+        @param request   a tuple of the arguments passed to Eups.setup()
+        """
+        request = [isinstance(r, Tag) and "tag:%s" % r.name or r for r in request]
+
+        key = (self.formatVersion, request, Eups.flavor, Eups.path, Eups.root, Eups.userDataDir,
+               Eups.setupType, [str(t) for t in Eups.getPreferredTags()],
+               Eups.keep, Eups.force, Eups.ignore_versions, Eups.exact_version, Eups.max_depth,
+               sorted([(k, v) for k, v in os.environ.items() if _setupEnvironRe.search(k)]),
+               sorted(Eups.aliases.items()), sorted(Eups.oldAliases.items()))
+
+        return _md5(repr(key)).hexdigest()
+
+    def state(self, Eups):
+        """
+        return the state of everything other than the table files that a setup
+        depends on, or None if it cannot be determined (in which case the setup
+        should not be cached)
+        """
+        databases = []
+        for p in Eups.path:
+            dbpath = Eups.getUpsDB(p)
+            dbroots = [dbpath]
+            userTagDir = Eups._userStackCache(p)
+            if userTagDir and os.path.isdir(userTagDir):
+                dbroots.append(userTagDir)
+
+            db = Database(dbpath)
+            for dbroot in dbroots:
+                changed = db.lastChanged(dbroot)
+                if changed is None and dbroot == dbpath:
+                    if db.findProductNames():
+                        return None     # no journal, so we can't tell if it changes
+                    changed = "empty"   # declaring a product will make it non-empty
+                databases.append((dbroot, changed))
+        #
+        # The user's customisations and eups itself could change the result too
+        #
+        files = list(hooks.customisationFiles or []) + \
+            glob.glob(os.path.join(os.path.dirname(__file__), "*.py"))
+        mtimes = []
+        for f in files:
+            try:
+                mtimes.append((f, os.stat(f).st_mtime))
+            except OSError:
+                mtimes.append((f, None))
+
+        return (databases, mtimes)
+
+    def _entryFile(self, key):
+        return os.path.join(self.cacheDir, key)
+
+    def lookup(self, key, Eups):
+        """
+        return the valid SetupPlan for a key, or None
+        """
+        entry = self._entryFile(key)
+        plan = self._readEntry(entry)
+        if not plan or plan.state != self.state(Eups) or not plan.isValid():
+            return None
+
+        try:
+            os.utime(entry, None)       # it's been used
+        except OSError:
+            pass
+
+        return plan
+
+    def save(self, key, plan):
+        """
+        save a SetupPlan, and prune the cache to its maximum size.  Failure 
+        to do so is silently ignored.
+        """
+        try:
+            self._writeEntry(self._entryFile(key), plan)
+            self.prune()
+        except (IOError, OSError):
+            pass
@@ -1,8 +1,12 @@
 """
 the Uses class -- a class for tracking product dependencies (used by the remove() 
-function).  
+function), and the UsesIndex class that saves the dependencies of the products
+in a stack between calls to Eups.uses().
 """
-import re
+import os, re, cPickle
+import lock
+
+usesIndexFile = "_uses_.pickle"
 
 #
 # Cache for the Uses tree
@@ -107,3 +111,196 @@ class Uses(object):
         
         return consumerList
         
+
+class UsesIndex(object):
+    """
+    a saved record of the dependencies of each product declared in a stack,
+    as found by Eups.getDependentProducts(), so that Eups.uses() need not
+    resolve the table files of every product each time it is called.
+
+    An entry is only used while the table files of the product and of all
+    its dependencies are unchanged, and no product that it depends on (or
+    the product itself) has been declared, undeclared or retagged; nor any
+    product that those table files name but which wasn't found.  The
+    latter is checked by reading the changes recorded since the entries
+    were made in the journals (see Database.lastChanged()) of the databases
+    on the EUPS path, so only the entries affected by a change are
+    recomputed.  If a stack's database has no journal, the entries cannot
+    be trusted and are not saved.
+    """
+
+    # the format of the saved index; bump this if it changes
+    formatVersion = 2
+
+    def __init__(self, filename, context=None, stack=None):
+        """
+        @param filename   the file to save the index in
+        @param context    a description of the configuration (e.g. the 
+                            EUPS path and flavor) that the dependencies 
+                            depend on; saved entries made with a different
+                            context are not used
+        @param stack      the product stack whose products are indexed; 
+                            the index is saved under its write lock
+        """
+        self.filename = filename
+        self.context = context
+        self.stack = stack
+        self.journals = {}              # database directory -> size of its journal
+        self.entries = {}               # (flavor, name, version) -> (table stamps, dependencies, names)
+        self.usable = True              # false if changes to the databases can't be tracked
+        self._modified = False
+        self._mtimes = {}               # table file -> modification time, as checked by this process
+
+    # @staticmethod   # requires python 2.4
+    def load(filename, context, databases, stack=None):
+        """
+        return the index saved in the given file, with any entries that
+        have been invalidated by changes to the databases removed
+        @param filename    the file the index is saved in
+        @param context     see __init__()
+        @param databases   a list of (Database, dbroot, needJournal) for each 
+                              database directory whose changes can affect 
+                              the dependencies.  If needJournal is false, 
+                              a directory without a journal is assumed not 
+                              to have changed.
+        @param stack       see __init__()
+        """
+        index = UsesIndex(filename, context, stack)
+        try:
+            fd = open(filename, "rb")
+            try:
+                version, context, journals, entries = cPickle.load(fd)
+            finally:
+                fd.close()
+            if version == UsesIndex.formatVersion and context == index.context:
+                index.journals = journals
+                index.entries = entries
+        except Exception:
+            pass
+
+        index.update(databases)
+        return index
+    load = staticmethod(load)
+
+    def update(self, databases):
+        """
+        forget the entries that depend on products that have changed since
+        the databases' journals were last read.
+        @param databases   see load()
+        """
+        journals = {}
+        changed = {}
+        for db, dbroot, needJournal in databases:
+            size, names = db.changesSince(self.journals.get(dbroot, 0), dbroot)
+            if size is None:
+                if needJournal or self.journals.has_key(dbroot):
+                    self.usable = False
+                continue
+            journals[dbroot] = size
+            for name in names:
+                changed[name] = True
+
+        if not self.usable:
+            self.entries = {}
+            self.journals = {}
+            return
+
+        if changed:
+            for key, (stamps, deps, names) in self.entries.items():
+                if filter(lambda n: changed.has_key(n), names):
+                    del self.entries[key]
+            self._modified = True
+
+        if journals != self.journals:
+            self.journals = journals
+            self._modified = True
+
+    def get(self, product):
+        """
+        return the saved dependencies of a product as a list of 
+        (name, version, optional, depth), or None if there is no valid entry
+        """
+        key = (product.flavor, product.name, product.version)
+        if not self.entries.has_key(key):
+            return None
+
+        stamps, deps, names = self.entries[key]
+        for tablefile, mtime in stamps:
+            if self._mtime(tablefile) != mtime:
+                del self.entries[key]
+                self._modified = True
+                return None
+
+        return deps
+
+    def set(self, product, dependencies):
+        """
+        save the dependencies of a product
+        @param product       the product
+        @param dependencies  its dependencies, as a list of (Product, 
+                               optional, depth) as returned by 
+                               Eups.getDependentProducts()
+        """
+        if not self.usable:
+            return
+
+        stamps = []
+        names = {}                      # every product the entry depends on, found or not
+        for p in [product] + [d[0] for d in dependencies]:
+            names[p.name] = True
+            tablefile = p.tableFileName()
+            if tablefile:
+                stamps.append((tablefile, self._mtime(tablefile)))
+                try:
+                    table = p.getTable(quiet=True)
+                except Exception:
+                    table = None
+                if table:
+                    for name in table.productNames():
+                        names[name] = True
+
+        deps = [(p.name, p.version, optional, depth) for p, optional, depth in dependencies]
+        self.entries[(product.flavor, product.name, product.version)] = (stamps, deps, names.keys())
+        self._modified = True
+
+    def _mtime(self, tablefile):
+        try:
+            return self._mtimes[tablefile]
+        except KeyError:
+            pass
+
+        try:
+            mtime = os.stat(tablefile).st_mtime
+        except OSError:
+            mtime = None
+        self._mtimes[tablefile] = mtime
+        return mtime
+
+    def save(self):
+        """
+        save the index if it has changed.  Failure to do so is silently 
+        ignored.
+        """
+        if not self.usable or not self._modified:
+            return
+
+        locks = []
+        try:
+            dir = os.path.dirname(self.filename)
+            if not os.path.isdir(dir):
+                os.makedirs(dir)
+
+            if self.stack:
+                locks = lock.takeWriteLock(self.stack)
+            tmpfile = "%s.tmp%d" % (self.filename, os.getpid())
+            fd = open(tmpfile, "wb")
+            try:
+                cPickle.dump((self.formatVersion, self.context, self.journals, self.entries),
+                             fd, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+            os.rename(tmpfile, self.filename)
+            self._modified = False
+        except (IOError, OSError):
+            pass
+        lock.giveLocks(locks)
@@ -1,9 +1,20 @@
 import re
 
+_componentSplitRe = re.compile(r"[._]")
+_prefixedNumberRe = re.compile(r"^([^\d]+)(\d+)$")
+_leadingNumberRe = re.compile(r"^(\d+)(.*)$")
+# components whose keys are known to order them as stdCompare() does (see hasExactSortKey())
+_exactComponentRe = re.compile(r"^(0|[1-9]\d*|[a-zA-Z]+(0|[1-9]\d*)?)?$")
+
 class VersionCompare(object):
     """
     A comparison function class that compares two product versions.
     """
+
+    _sortKeys = {}                      # cache of sort keys, keyed by version
+    _exactSortKeys = {}                 # cache of hasExactSortKey(), keyed by version
+    _maxSortKeys = 10000                # maximum size of _sortKeys and _exactSortKeys
+
     def compare(self, v1, v2, mustReturnInt=True):
         """Compare two versions.
 
@@ -137,9 +148,161 @@ If mustReturnInt is False and you don't want to allow the versions to be sorted,
 
         return vvv, eee, fff
 
+    def sortKey(self, version):
+        """
+        Return a key for version that sorts in the same order as stdCompare(), so that
+        versions may be sorted with e.g. vers.sort(key=vc.sortKey) rather than by
+        comparing them pairwise.  Keys are cached, so a version is only parsed once.
+
+        stdCompare() compares a component that starts with a digit but isn't a number
+        (e.g. the 0rc1 in 3.0rc1) with a number as strings, so it isn't transitive
+        (10 < 2a < 3 < 10) and no key can agree with it for every version.  Such
+        components are keyed by their leading number and then the rest, which agrees
+        with stdCompare() when the numbers have the same number of digits (so 3.0rc1
+        sorts between 3.0 and 3.1).  The versions for which the ordering is exact are
+        those for which hasExactSortKey() is True.
+        """
+        try:
+            return self._sortKeys[version]
+        except KeyError:
+            pass
+
+        if len(self._sortKeys) >= self._maxSortKeys:
+            self._sortKeys.clear()
+
+        key = self._makeSortKey(version)
+        self._sortKeys[version] = key
+        return key
+
+    def _makeSortKey(self, version):
+        prim, sec, ter = self._splitVersion(version)
+        #
+        # The primary component is compared component by component; then versions
+        # with a decrementing annotation (e.g. -2) come before those without, and
+        # finally the incrementing annotations (e.g. +svn1039) are compared
+        #
+        primKey = tuple([self._componentKey(c) for c in _componentSplitRe.split(prim)])
+        if sec:
+            secKey = (0, self.sortKey(sec))
+        else:
+            secKey = (1,)
+        if ter:
+            terKey = self.sortKey(ter)
+        else:
+            terKey = ()
+
+        return (primKey, secKey, terKey)
+
+    def hasExactSortKey(self, version):
+        """
+        Return True if sortKey() orders version exactly as stdCompare() does with
+        respect to every other version for which this is True: its components are
+        separated by dots and are numbers without leading zeros or letters followed
+        by such a number (e.g. 1.2.3, 1.2.rc1 and 1.2-b2+svn123)
+        """
+        try:
+            return self._exactSortKeys[version]
+        except KeyError:
+            pass
+
+        if len(self._exactSortKeys) >= self._maxSortKeys:
+            self._exactSortKeys.clear()
+
+        prim, sec, ter = self._splitVersion(version)
+        exact = True
+        for c in prim.split("."):
+            if not _exactComponentRe.search(c):
+                exact = False
+                break
+        for v in (sec, ter):
+            if exact and v:
+                exact = self.hasExactSortKey(v)
+
+        self._exactSortKeys[version] = exact
+        return exact
+
+    def _componentKey(self, c):
+        # numbers sort before strings, as digits come before letters
+        if not c:
+            return (-1,)
+        try:
+            return (0, int(c))
+        except ValueError:
+            pass
+
+        mat = _leadingNumberRe.search(c) # e.g. 0rc1; stdCompare() compares it with numbers as a string
+        if mat:
+            return (0, int(mat.group(1)), mat.group(2))
+
+        mat = _prefixedNumberRe.search(c) # e.g. rc1; compare the numbers if the prefixes agree
+        if mat:
+            return (1, mat.group(1), int(mat.group(2)))
+
+        return (1, c)
+
+    def usesStdCompare(self):
+        """
+        Return True if this object's ordering is that of stdCompare(), and may thus
+        be replaced by sortKey()
+        """
+        cls = type(self)
+        for name in ("__call__", "compare", "stdCompare", "_splitVersion"):
+            if getattr(cls, name).im_func is not getattr(VersionCompare, name).im_func:
+                return False
+
+        return True
+
     def __call__(self, v1, v2, mustReturnInt=True):
         """
         make an instance behave like a callable function
         """
         return self.compare(v1, v2, mustReturnInt)
 
+class _CmpKey(object):
+    """
+    A sort key that orders versions using a comparison function
+    """
+    __slots__ = ("version", "version_cmp")
+
+    def __init__(self, version, version_cmp):
+        self.version = version
+        self.version_cmp = version_cmp
+
+    def __cmp__(self, other):
+        return self.version_cmp(self.version, other.version)
+
+def versionSortKey(version_cmp):
+    """
+    Return a function that maps a version to a key that sorts in the order
+    defined by version_cmp (e.g. hooks.version_cmp).  If version_cmp is a
+    VersionCompare using the standard ordering this is its (cached) sortKey;
+    otherwise the keys fall back to calling version_cmp.
+    """
+    if isinstance(version_cmp, VersionCompare) and version_cmp.usesStdCompare():
+        return version_cmp.sortKey
+
+    return lambda v: _CmpKey(v, version_cmp)
+
+def sortKeyIsExact(key, version):
+    """
+    Return True if key, as returned by versionSortKey(), orders version exactly as
+    the comparison function that it was made from does, so that versions may be 
+    found by bisecting a list sorted by key.  This is False for versions that the
+    standard ordering can't key exactly (see VersionCompare.hasExactSortKey()).
+    """
+    vc = getattr(key, "im_self", None)
+    if isinstance(vc, VersionCompare):
+        return vc.hasExactSortKey(version)
+
+    return True                         # the key calls the comparison function
+
+def sortKeyCompare(key):
+    """
+    Return the comparison function that key, as returned by versionSortKey(), was
+    made from
+    """
+    vc = getattr(key, "im_self", None)
+    if isinstance(vc, VersionCompare):
+        return vc
+
+    return lambda v1, v2: cmp(key(v1), key(v2))
@@ -1,6 +1,7 @@
 """A simple recursive descent parser for logical expressions"""
 
 import os, re
+import utils
 
 class VersionParser(object):
     """Evaluate a logical expression, returning a Bool.  The grammar is:
@@ -24,24 +25,25 @@ class VersionParser(object):
                ( expr )
 
 names are declared using VersionParser.define()
+
+An expression is parsed once (see _compile()), and the result is shared by
+all VersionParsers for that expression; eval() only looks up the names.
         """
     def __init__(self, exprStr):
-        exprStr = re.sub(r"['\"]([^'\"]+)['\"]", r"\1", exprStr)
-        self._tokens = re.split(r"(\$\??{[^}]+}|[\w.+]+|\s+|==|!=|<=|>=|[()<>])", exprStr)
-        self._tokens = filter(lambda p: p and not re.search(r"^\s*$", p), self._tokens)
-        
+        self._program = _compile(exprStr)
+
         self._symbols = {}
         self._caseSensitive = False
 
     def define(self, key, value):
         """Define a symbol, which may be substituted using _lookup"""
-        
+
         self._symbols[key] = value
 
     def _lookup(self, key):
         """Attempt to lookup a key in the symbol table"""
         key0 = key
-        
+
         try:
             envVar, modifier, value = re.search(r"^\${([^:}]*)(:-([^\}*]*))?}", key).groups()
 
@@ -65,15 +67,12 @@ names are declared using VersionParser.define()
         try:
             return self._symbols[key]
         except KeyError:
-            return key0        
+            return key0
 
-    def _peek(self):
-        """Return the next terminal symbol, but don't pop it off the lookahead stack"""
-        
-        if not self._tokens:
-            return "EOF"
+    def _value(self, tok):
+        """Return the value of a terminal symbol"""
 
-        tok = self._lookup(self._tokens[0])
+        tok = self._lookup(tok)
 
         try:                            # maybe it's an int
             tok = int(tok)
@@ -87,80 +86,140 @@ names are declared using VersionParser.define()
 
         return tok
 
-    def _push(self, tok):
-        """Push a token back onto the lookahead stack"""
-
-        if tok != "EOF":
-            self._tokens = [tok] + self._tokens
-    
-    def _next(self):
-        """Return the next terminal symbol, popping it off the lookahead stack"""
-        
-        tok = self._peek()
-        if tok != "EOF":
-            self._tokens.pop(0)
-
-        return tok
-    
     def eval(self):
         """Evaluate the logical expression, returning a Bool"""
 
-        if isinstance(self._tokens, bool):
-            return self._tokens
-
-        val = self._expr()              # n.b. may not have consumed all tokens as || and && short circuit
+        val, resume = self._program(self)
 
         if val == "EOF":
             return False
         else:
             return val
 
+#
+# Expressions are compiled into functions of a VersionParser (which
+# provides the values of the names) returning a pair (value, resume).  If
+# resume isn't None a || or && short circuited:  the parser stopped reading
+# tokens at index resume, so the rest of the expression isn't evaluated.
+#
+_logicalOps = {"||" : True, "or" : True, "&&" : False, "and" : False} # value: is it an "or"?
+
+def _equal(lhs, rhs):
+    if isinstance(lhs, list):
+        return rhs in lhs
+    else:
+        return lhs == rhs
+
+def _notEqual(lhs, rhs):
+    if isinstance(lhs, list):
+        return not (rhs in lhs)
+    else:
+        return lhs != rhs
+
+_comparisons = {
+    "==" : _equal,
+    "=~" : lambda lhs, rhs: re.search(rhs, lhs),
+    "!=" : _notEqual,
+    "!~" : lambda lhs, rhs: not re.search(rhs, lhs),
+    "<"  : lambda lhs, rhs: lhs < rhs,
+    "<=" : lambda lhs, rhs: lhs <= rhs,
+    ">"  : lambda lhs, rhs: lhs > rhs,
+    ">=" : lambda lhs, rhs: lhs >= rhs,
+    }
+
+# compiled expressions, shared by all VersionParsers
+_programs = utils.LRUCache(256)
+
+def _compile(exprStr):
+    """
+    return the function evaluating a logical expression (see VersionParser)
+    """
+    program = _programs.get(exprStr)
+    if program is None:
+        program = _Compiler(exprStr).compile()
+        _programs.set(exprStr, program)
+
+    return program
+
+class _Compiler(object):
+    """Parse a logical expression, returning the function that evaluates it"""
+
+    def __init__(self, exprStr):
+        exprStr = re.sub(r"['\"]([^'\"]+)['\"]", r"\1", exprStr)
+        self._tokens = re.split(r"(\$\??{[^}]+}|[\w.+]+|\s+|==|!=|<=|>=|[()<>])", exprStr)
+        self._tokens = filter(lambda p: p and not re.search(r"^\s*$", p), self._tokens)
+        self._pos = 0
+
+    def _peek(self):
+        """Return the next token, but don't consume it"""
+
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        else:
+            return "EOF"
+
+    def _next(self):
+        """Return the next token, consuming it"""
+
+        tok = self._peek()
+        if tok != "EOF":
+            self._pos += 1
+
+        return tok
+
+    def compile(self):
+        return self._expr()             # n.b. may not consume all tokens
+
     def _expr(self):
         lhs = self._term()
 
-        while True:
-            op = self._next()
+        terms = []                      # (isOr, index of first token, term)
+        while _logicalOps.has_key(self._peek()):
+            isOr = _logicalOps[self._next()]
+            terms.append((isOr, self._pos, self._term()))
 
-            if op == "||" or op == "or":
-                lhs = lhs or self._term()
-            elif op == "&&" or op == "and":
-                lhs = lhs and self._term()
-            else:
-                self._push(op)
-                return lhs
+        if not terms:
+            return lhs
+
+        tokens = self._tokens
+
+        def expr(parser):
+            val, resume = lhs(parser)
+            for isOr, start, term in terms:
+                if resume is not None:
+                    break
+
+                if (isOr and val) or (not isOr and not val):
+                    if start < len(tokens):
+                        parser._lookup(tokens[start]) # the parser peeks at the next token
+                    return val, start
+
+                val, resume = term(parser)
+
+            return val, resume
+
+        return expr
 
     def _term(self):
         lhs = self._prim()
-        op = self._next()
 
-        if op == "EOF":
+        op = self._peek()
+        if not _comparisons.has_key(op):
             return lhs
+        self._next()
 
-        if op == "==":
-            if isinstance(lhs, list):
-                return self._prim() in lhs
-            else:
-                return lhs == self._prim()
-        elif op == "=~":
-            return re.search(self._prim(), lhs)
-        elif op == "!=":
-            if isinstance(lhs, list):
-                return not (self._prim() in lhs)
-            else:
-                return lhs != self._prim()
-        elif op == "!~":
-            return not re.search(self._prim(), lhs)
-        elif op == "<":
-            return lhs < self._prim()
-        elif op == "<=":
-            return lhs <= self._prim()
-        elif op == ">":
-            return lhs > self._prim()
-        elif op == ">=":
-            return lhs >= self._prim()
-        else:
-            self._push(op)
-            return lhs
+        compare = _comparisons[op]
+        rhs = self._prim()
+
+        def term(parser):
+            val, resume = lhs(parser)
+            if resume is not None:
+                return val, resume
+
+            rval, resume = rhs(parser)
+            return compare(val, rval), resume
+
+        return term
 
     def _prim(self):
         next = self._peek()
@@ -169,14 +228,37 @@ names are declared using VersionParser.define()
             self._next()
 
             term = self._expr()
-            
+
             if next == "!" or next == "not":
-                term = not term
-            elif next == "(":
-                next = self._next()
-                if next != ")":
-                    raise RuntimeError, ("Saw next = \"%s\" in prim" % next)
+                def negate(parser):
+                    val, resume = term(parser)
+                    return not val, resume
+
+                return negate
+
+            tokens = self._tokens
+            close = self._pos
+            self._next()
+
+            def paren(parser):
+                val, resume = term(parser)
+                if resume is None:
+                    resume = close
+
+                if resume < len(tokens) and tokens[resume] == ")":
+                    return val, None
+
+                if resume < len(tokens):
+                    next = parser._value(tokens[resume])
+                else:
+                    next = "EOF"
+                raise RuntimeError, ("Saw next = \"%s\" in prim" % next)
+
+            return paren
+
+        self._next()
 
-            return term
+        def prim(parser):
+            return parser._value(next), None
 
-        return self._next()
+        return prim
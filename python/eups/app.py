@@ -9,6 +9,7 @@ from exceptions     import ProductNotFound
 from tags           import Tags, Tag, TagNotRecognized, checkTagsList
 import Product
 from VersionParser  import VersionParser
+from VersionCompare import versionSortKey
 from stack          import ProductStack, persistVersionName as cacheVersion
 from distrib.server import ServerConf
 import utils, table, distrib.builder, hooks
@@ -128,9 +129,10 @@ def printProducts(ostrm, productName=None, versionName=None, eupsenv=None,
         if not re.search(r"depth", depth): 
             depth = "depth" + depth 
          
+    depthExpr = VersionParser(depth)
+
     def includeProduct(recursionDepth): 
         """Should we include a product at this recursionDepth in the listing?""" 
-        depthExpr = VersionParser(depth)
         depthExpr.define("depth", recursionDepth) 
         return depthExpr.eval() 
 
@@ -575,6 +577,60 @@ def clearCache(path=None, flavors=None, inUserDir=False, verbose=0):
         ProductStack.fromCache(dbpath, flavs, persistDir=persistDir,
                                autosave=False).clearCache(verbose=verbose)
 
+def verifyCache(path=None, flavors=None, noaction=False, verbose=0):
+    """
+    check the product caches for the given stacks against the full contents
+    of their databases (rather than just the databases' change journals),
+    removing any that are out of date.  Returned is the number of stale 
+    caches found.
+    @param path     the stacks to check caches for.  This can be given either
+                        as a python list or a colon-delimited string.  If 
+                        None (default), EUPS_PATH will be used.
+    @param flavors  the flavors to check the cache for.  This can either 
+                        be a python list or space-delimited string.  If None,
+                        check caches for all flavors.
+    @param noaction   if True, just report the stale caches
+    @params verbose   chattiness
+    """
+    if path is None:
+        path = os.environ["EUPS_PATH"]
+    if isinstance(path, str):
+        path = path.split(":")
+
+    if isinstance(flavors, str):
+        flavors = flavors.split()
+
+    userDataDir = utils.defaultUserDataDir()
+
+    nstale = 0
+    for p in path:
+        dbpath = os.path.join(p, Eups.ups_db)
+        if not os.path.isdir(dbpath):
+            continue
+
+        for persistDir in (dbpath, utils.userStackCacheFor(p, userDataDir)):
+            if not os.path.isdir(persistDir):
+                continue
+
+            flavs = flavors
+            if flavs is None:
+                flavs = ProductStack.findCachedFlavors(persistDir)
+
+            stack = ProductStack(dbpath, persistDir, autosave=False)
+            for flavor in flavs:
+                if not os.path.exists(stack._persistPath(flavor, persistDir)) or \
+                   stack.cacheIsUpToDate(flavor, persistDir, verify=True):
+                    if verbose > 1:
+                        print >> utils.stdinfo, "Cache for %s in %s is up to date" % (flavor, persistDir)
+                    continue
+
+                nstale += 1
+                print >> utils.stdwarn, "Cache for %s in %s is out of date" % (flavor, persistDir)
+                if not noaction:
+                    stack.clearCache(flavor, persistDir, verbose=verbose)
+
+    return nstale
+
 def listCache(path=None, verbose=0, flavor=None):
     if path is None:
         path = os.environ["EUPS_PATH"]
@@ -608,7 +664,7 @@ def listCache(path=None, verbose=0, flavor=None):
 
         for productName in productNames:
             versionNames = cache.getVersions(productName)
-            versionNames.sort(hooks.version_cmp)
+            versionNames.sort(key=versionSortKey(hooks.version_cmp))
 
             print "  %-20s %s" % (productName, " ".join(versionNames))
 
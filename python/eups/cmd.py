@@ -32,13 +32,14 @@ The output of run() is a status code appropriate for passing to sys.exit().
 ########################################################################
 
 import glob, re, os, shutil, sys, time, copy
+import shlex
 import optparse
 import eups, lock
 import tags
 import utils
 import distrib
 import hooks
-from distrib.server import ServerConf, Mapping, importClass
+from distrib.server import ServerConf, Mapping, DownloadCache, importClass
 
 _errstrm = utils.stderr
 
@@ -66,6 +67,7 @@ class EupsCmd(object):
 
 Supported commands are:
 	admin		Administer the eups system
+	daemon		Start or stop a daemon to handle setup requests
 	declare		Declare a product
 	distrib		Install a product from a remote distribution,
 			or create such a distribution 
@@ -161,7 +163,7 @@ Common"""
 
         locks = lock.takeLocks(ecmd.cmd, eups.Eups.setEupsPath(ecmd.opts.path, ecmd.opts.dbz),
                                ecmd.lockType, nolocks=ecmd.opts.nolocks,
-                               verbose=ecmd.opts.verbose - ecmd.opts.quiet)
+                               verbose=ecmd.opts.verbose - ecmd.opts.quiet, products=ecmd.lockedProducts())
 
         try:
             return ecmd.run()
@@ -243,6 +245,14 @@ Common"""
         print >> strm, "EUPS Version:", eups.version()
         return 0
 
+    def lockedProducts(self):
+        """
+        return the names of the products that this command changes, if it's 
+        enough to lock just them (see lock.takeLocks()) rather than the 
+        whole of each product stack; None means lock the stacks.
+        """
+        return None
+
     def _issubclass(self):
         return isinstance(self, EupsCmd) and type(self) != EupsCmd
 
@@ -1139,7 +1149,7 @@ For example, the make target in a ups directory might contain the line:
 
 class DeclareCmd(EupsCmd):
 
-    usage = "%prog declare [-h|--help] [options] product version"
+    usage = "%prog declare [-h|--help] [options] product version\n       %prog declare [-h|--help] [options] --from-file file"
 
     # set this to True if the description is preformatted.  If false, it 
     # will be automatically reformatted to fit the screen
@@ -1156,8 +1166,17 @@ If there is no table file, give "none" to the -m option.  If the product is
 already declared, attempts to redeclare will fail unless -F is used.  If you 
 only wish to assign a tag, you should use the -t option but not include 
 -r.  
+
+With --from-file, each line of the file gives the options and arguments for 
+one declaration (e.g. "-r /path/to/foo/1.0 -t stable foo 1.0"; blank lines 
+and lines starting with # are ignored).  The declarations are made as a single 
+transaction:  if any of them fails, none of them take effect.  
 """
 
+    # the options that may be given on each line of a --from-file file
+    perLineOptions = ["productDir", "externalFileList", "externalTablefile", "tablefile",
+                      "tag", "currentTag"]
+
     def addOptions(self):
         # these are specific to this command
         self.clo.add_option("-r", "--root", dest="productDir", action="store", 
@@ -1171,6 +1190,9 @@ only wish to assign a tag, you should use the -t option but not include
                             help='table file location (may be "none" for no table file)')
         self.clo.add_option("-t", "--tag", dest="tag", action="append", 
                             help="assign TAG to the specified product")
+        self.clo.add_option("--from-file", dest="fromFile", action="store", metavar="FILE",
+                            help="declare the products listed in FILE, one per line " +
+                            "(may be \"-\" for stdin)")
         
         # these options are used to configure the Eups instance
         self.addEupsOptions()
@@ -1188,42 +1210,133 @@ only wish to assign a tag, you should use the -t option but not include
             e.status = 9
             raise
 
+        if self.opts.fromFile:
+            return self.declareFromFile(myeups, self.opts.fromFile)
+
+        return self.declareOne(myeups, self.opts, self.args)
+
+    def lockedProducts(self):
+        if self.opts.fromFile or not self.args:
+            return None
+        return self.args[:1]
+
+    def declareFromFile(self, myeups, filename):
+        """
+        make the declarations listed in a file as a single transaction
+        @param myeups     the Eups instance to use
+        @param filename   the file listing the declarations, or "-" for stdin
+        """
+        if self.args:
+            self.err("You may not specify a product as well as --from-file")
+            return 2
+
+        if filename == "-":
+            lines = sys.stdin.readlines()
+        else:
+            try:
+                fd = open(filename)
+                lines = fd.readlines()
+                fd.close()
+            except IOError, e:
+                self.err("Error reading %s: %s" % (filename, e))
+                return 4
+
+        defaults = self.clo.get_default_values()
+
+        status = 0
+        myeups.beginTransaction()
+        try:
+            lineno = 0
+            for line in lines:
+                lineno += 1
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                #
+                # Only the options describing a particular declaration may be given on the
+                # line; the others are as on the command line
+                #
+                lineOpts, args = self.clo.parse_args(shlex.split(line), copy.deepcopy(defaults))
+                badOpts = []
+                for option in self.clo.option_list:
+                    if option.dest and option.dest not in self.perLineOptions and \
+                           getattr(lineOpts, option.dest) != getattr(defaults, option.dest):
+                        badOpts.append(option.get_opt_string())
+                if badOpts:
+                    self.err("%s:%d: %s may not be used in a declaration file; no products were declared" %
+                             (filename, lineno, ", ".join(badOpts)))
+                    status = 2
+                    break
+
+                opts = copy.deepcopy(self.opts)
+                for dest in self.perLineOptions:
+                    setattr(opts, dest, getattr(lineOpts, dest))
+
+                try:
+                    status = self.declareOne(myeups, opts, args)
+                except eups.EupsException:
+                    self.err("%s:%d: failed to declare \"%s\"; no products were declared" %
+                             (filename, lineno, line))
+                    raise
+
+                if status != 0:
+                    self.err("%s:%d: failed to declare \"%s\"; no products were declared" %
+                             (filename, lineno, line))
+                    break
+        except:
+            myeups.rollbackTransaction()
+            raise
+
+        if status != 0:
+            myeups.rollbackTransaction()
+        else:
+            myeups.commitTransaction()
+
+        return status
+
+    def declareOne(self, myeups, opts, args):
+        """
+        make a single declaration
+        @param myeups     the Eups instance to use
+        @param opts       the command's options
+        @param args       the command's arguments (product and version)
+        """
         externalFileList = []
         product, version = None, None
-        if len(self.args) > 0:
-            product = self.args[0]
-        if len(self.args) > 1:
-            version = self.args[1]
-
-        if self.opts.currentTag:
-            if not self.opts.tag:
-                self.opts.tag = []
-            self.opts.tag.append("current")
-        if self.opts.tag:
-            if len(self.opts.tag) > 1:
-                self.err("You may only set one tag at a time: %s" % ", ".join(self.opts.tag))
+        if len(args) > 0:
+            product = args[0]
+        if len(args) > 1:
+            version = args[1]
+
+        if opts.currentTag:
+            if not opts.tag:
+                opts.tag = []
+            opts.tag.append("current")
+        if opts.tag:
+            if len(opts.tag) > 1:
+                self.err("You may only set one tag at a time: %s" % ", ".join(opts.tag))
                 return 4
 
-            self.opts.tag = self.opts.tag[0]
+            opts.tag = opts.tag[0]
 
         if not product:
-            if self.opts.tablefile == "none":
-                self.err("Unable to guess product name from table file name %s" % self.opts.tablefile)
+            if opts.tablefile == "none":
+                self.err("Unable to guess product name from table file name %s" % opts.tablefile)
                 return 2
-            if self.opts.externalTablefile != None:
+            if opts.externalTablefile != None:
                 self.err("Unable to guess product name from external table file \"%s\"" %
-                         self.opts.externalTablefile)
+                         opts.externalTablefile)
                 return 2
 
-            if not self.opts.productDir:
+            if not opts.productDir:
                 self.err("Unable to guess product name as you didn't specify a directory")
                 return 2
-            if self.opts.productDir == "none":
+            if opts.productDir == "none":
                 self.err("Unable to guess product name as product has no directory")
                 return 2
 
             try:
-                ups_dir = os.path.join(self.opts.productDir,"ups")
+                ups_dir = os.path.join(opts.productDir,"ups")
                 if not os.path.isdir(ups_dir):
                     self.err("Unable to guess product name as product has no ups directory")
                     return 2
@@ -1231,19 +1344,19 @@ only wish to assign a tag, you should use the -t option but not include
             except RuntimeError, msg:
                 self.err(msg)
                 return 2
-            base, v = os.path.split(os.path.abspath(self.opts.productDir))
+            base, v = os.path.split(os.path.abspath(opts.productDir))
             base, p = os.path.split(base)
 
             if product == p:
                 if not version:
                     version = v
             else:
-                if not (version or self.opts.tag):
+                if not (version or opts.tag):
                     self.err("Guessed product %s from ups directory, but %s from path" % (product, p))
                     return 2
 
-        if not version and self.opts.tag:
-            version = "tag:%s" % self.opts.tag # We're declaring a tagged version so we don't need a name
+        if not version and opts.tag:
+            version = "tag:%s" % opts.tag # We're declaring a tagged version so we don't need a name
 
         if not product:
             self.err("Please specify a product name and version")
@@ -1252,25 +1365,25 @@ only wish to assign a tag, you should use the -t option but not include
             self.err("Please also specify a product version")
             return 2
 
-        if self.opts.tablefile and self.opts.externalTablefile:
+        if opts.tablefile and opts.externalTablefile:
             self.err("You may not specify both -m and -M")
             return 3
 
-        tablefile = self.opts.tablefile
-        if self.opts.externalTablefile:
-            if self.opts.externalTablefile == "-":
+        tablefile = opts.tablefile
+        if opts.externalTablefile:
+            if opts.externalTablefile == "-":
                 tablefile = sys.stdin
             else:
                 try:
-                    tablefile = open(self.opts.externalTablefile, "r")
+                    tablefile = open(opts.externalTablefile, "r")
                 except IOError, e:
-                    self.err("Error opening %s: %s" % (self.opts.externalTablefile, e))
+                    self.err("Error opening %s: %s" % (opts.externalTablefile, e))
                     return 4
 
-        if self.opts.verbose:
+        if opts.verbose:
             print >> utils.stdinfo, "Declaring %s %s" % (product, version)
 
-        for f0 in self.opts.externalFileList:
+        for f0 in opts.externalFileList:
             if f0 == "-":
                 print >> _errstrm, \
                     "eups declare --import-file does not interpret \"-\" as stdin; ask RHL nicely"
@@ -1301,27 +1414,27 @@ only wish to assign a tag, you should use the -t option but not include
 
             externalFileList.append((fileNameIn, os.path.join(dirName, fileName),))
 
-        if self.opts.tag:
+        if opts.tag:
             try:
-                tag = myeups.tags.getTag(self.opts.tag)
+                tag = myeups.tags.getTag(opts.tag)
 
                 if myeups.isReservedTag(tag):
-                    if self.opts.force:
-                        self.err("%s is a reserved tag, but proceeding anyway)" % self.opts.tag)
+                    if opts.force:
+                        self.err("%s is a reserved tag, but proceeding anyway)" % opts.tag)
                     else:
-                        self.err("%s is a reserved tag (use --force to set)" % self.opts.tag)
+                        self.err("%s is a reserved tag (use --force to set)" % opts.tag)
                         return 1
             except eups.TagNotRecognized:
-                self.err("%s: Unsupported tag name" % self.opts.tag)
+                self.err("%s: Unsupported tag name" % opts.tag)
                 return 1
             except eups.EupsException, e:
                 e.status = 9
                 raise
 
         try:
-            eups.declare(product, version, self.opts.productDir, 
+            eups.declare(product, version, opts.productDir, 
                          tablefile=tablefile, externalFileList=externalFileList,
-                         tag=self.opts.tag, eupsenv=myeups)
+                         tag=opts.tag, eupsenv=myeups)
         except eups.EupsException, e:
             e.status = 2
             raise
@@ -1361,6 +1474,9 @@ version currently declared.
         self.clo.add_option("-c", "--current", dest="tag", action="store_const", const="current",
                             help="same as --tag=current")
 
+    def lockedProducts(self):
+        return self.args[:1] or None
+
     def execute(self):
         if len(self.args) == 0:
             self.err("Please specify a product name")
@@ -1430,6 +1546,11 @@ where it is installed.
         # always call the super-version so that the core options are set
         EupsCmd.addOptions(self)
 
+    def lockedProducts(self):
+        if self.opts.recursive:
+            return None
+        return self.args[:1] or None
+
     def execute(self):
         try:
             myeups = self.createEups()
@@ -1499,7 +1620,7 @@ where it is installed.
 
 class AdminCmd(EupsCmd):
 
-    usage = "%prog admin [buildCache|clearCache|listCache|clearLocks|listLocks|clearServerCache|info|show] [-h|--help] [-r root]"
+    usage = "%prog admin [buildCache|clearCache|listCache|verify|clearLocks|listLocks|clearServerCache|info|show] [-h|--help] [-r root]"
 
     # set this to True if the description is preformatted.  If false, it 
     # will be automatically reformatted to fit the screen
@@ -1537,10 +1658,14 @@ that are writable by the user.
             self.err("Unrecognized admin subcommand: %s" % subcmd)
             return 10
 
-        lock.takeLocks(ecmd.cmd, eups.Eups.setEupsPath(ecmd.opts.path, ecmd.opts.dbz),
-                       ecmd.lockType, nolocks=ecmd.opts.nolocks, verbose=ecmd.opts.verbose - ecmd.opts.quiet)
+        locks = lock.takeLocks(ecmd.cmd, eups.Eups.setEupsPath(ecmd.opts.path, ecmd.opts.dbz),
+                               ecmd.lockType, nolocks=ecmd.opts.nolocks,
+                               verbose=ecmd.opts.verbose - ecmd.opts.quiet, products=ecmd.lockedProducts())
 
-        return ecmd.run()
+        try:
+            return ecmd.run()
+        finally:
+            lock.giveLocks(locks, ecmd.opts.verbose)
 
         return 0
 
@@ -1613,7 +1738,9 @@ class AdminClearLocksCmd(EupsCmd):
     noDescriptionFormatting = False
 
     description = \
-"""Clear all locks held by eups
+"""Clear the records of the holders of eups's locks left behind by processes
+that didn't tidy up after themselves.  The locks themselves are given up
+when the processes holding them exit.
 """
     def addOptions(self):
         # always call the super-version so that the core options are set
@@ -1667,7 +1794,8 @@ class AdminClearServerCacheCmd(EupsCmd):
     noDescriptionFormatting = False
 
     description = \
-"""Clear all distrib server cache files"""
+"""Clear all distrib server cache files, including the files in the download cache (see
+hooks.config.site.downloadCacheSize)"""
 
     def addOptions(self):
         # always call the super-version so that the core options are set
@@ -1692,6 +1820,12 @@ class AdminClearServerCacheCmd(EupsCmd):
         # FIXME: this is not clearing caches in the user's .eups dir.
         ServerConf.clearConfigCache(myeups, pkgroots, self.opts.verbose)
 
+        cache = DownloadCache.get()
+        if cache:
+            if pkgroots is not None:
+                pkgroots = pkgroots.split("|")
+            cache.clear(pkgroots)
+
         return 0
 
 class AdminInfoCmd(EupsCmd):
@@ -1857,6 +1991,38 @@ class AdminListCacheCmd(EupsCmd):
 
         return 0
 
+class AdminVerifyCmd(EupsCmd):
+
+    usage = "%prog admin verify [-h|--help] [options]"
+
+    # set this to True if the description is preformatted.  If false, it 
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = False
+
+    description = \
+"""Check all cache files against every product in the databases, removing any
+that are out of date.  Normally eups only checks each database's change journal;
+this is only needed if a database was modified by an older version of eups.
+"""
+
+    def addOptions(self):
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+    def execute(self):
+        self.args.pop(0)                # remove the "admin"
+
+        if len(self.args) > 0:
+            self.err("Unexpected arguments: %s" % " ".join(self.args))
+            return 1
+
+        path = eups.Eups.setEupsPath(self.opts.path, self.opts.dbz)
+        nstale = eups.verifyCache(path, noaction=self.opts.noaction, verbose=self.opts.verbose)
+        if nstale and self.opts.noaction:
+            return 1
+
+        return 0
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 class DistribCmd(EupsCmd):
@@ -1915,10 +2081,14 @@ Common """
             self.err("Unrecognized distrib subcommand: %s" % subcmd)
             return 10
 
-        lock.takeLocks(ecmd.cmd, eups.Eups.setEupsPath(ecmd.opts.path, ecmd.opts.dbz),
-                       ecmd.lockType, nolocks=ecmd.opts.nolocks, verbose=ecmd.opts.verbose - ecmd.opts.quiet)
+        locks = lock.takeLocks(ecmd.cmd, eups.Eups.setEupsPath(ecmd.opts.path, ecmd.opts.dbz),
+                               ecmd.lockType, nolocks=ecmd.opts.nolocks,
+                               verbose=ecmd.opts.verbose - ecmd.opts.quiet, products=ecmd.lockedProducts())
 
-        return ecmd.run()
+        try:
+            return ecmd.run()
+        finally:
+            lock.giveLocks(locks, ecmd.opts.verbose)
 
 class DistribDeclareCmd(EupsCmd):
 
@@ -2160,6 +2330,11 @@ tag will be installed.
                             help="Build products in this directory")
         self.clo.add_option("--nobuild", dest="nobuild", action="store_true", default=False,
                             help="Don't attempt to build the product; just declare it")
+        self.clo.add_option("--prefetch", dest="prefetch", action="store", type="int", default=4,
+                            metavar="N",
+                            help="Download the needed files from web servers, N at a time, before installing (0: don't)")
+        self.clo.add_option("-J", "--jobs", dest="jobs", action="store", type="int", default=1, metavar="N",
+                            help="Build up to N products at once, each once its dependencies are installed")
 
         # these options are used to configure the Eups instance
         self.addEupsOptions()
@@ -2184,6 +2359,10 @@ tag will be installed.
         self.clo.add_option("-c", "--current", dest="current", action="store_true", default=False, 
                             help="Make top level product current (equivalent to --tag current)")
 
+    def lockedProducts(self):
+        # the products it depends on are locked as they're installed
+        return self.args[1:2] or None   # args[0] is the sub-command
+
     def execute(self):
         try:
             _opts = copy.deepcopy(self.opts)
@@ -2274,6 +2453,8 @@ tag will be installed.
         dopts['noclean']  = self.opts.noclean
         dopts["installCurrent"] = self.opts.installCurrent
         dopts['flavor']   = myeups.flavor
+        dopts['prefetch'] = self.opts.prefetch
+        dopts['jobs']     = self.opts.jobs
 
         if self.opts.serverOpts:
             for opt in self.opts.serverOpts:
@@ -2884,6 +3065,69 @@ same arguments.
 
         return 0
 
+class DaemonCmd(EupsCmd):
+
+    usage = "%prog daemon [start|stop|status] [-h|--help] [options]"
+
+    # set this to True if the description is preformatted.  If false, it
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = False
+
+    description = \
+"""Start, stop, or report on a per-user eups daemon.  While it is running, setup
+requests are handled by the daemon, which keeps eups loaded between them, rather
+than by a new process each time.  The daemon only handles requests made with the
+same EUPS_PATH (and other eups configuration) as it was started with.
+"""
+
+    def addOptions(self):
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+        self.clo.add_option("--foreground", dest="foreground", action="store_true", default=False,
+                            help="Run the daemon in the foreground")
+        self.clo.add_option("--timeout", dest="timeout", action="store", type="int", default=3600,
+                            help="Exit after this many seconds without a request (0: never). Default: %default")
+
+    def execute(self):
+        import daemon
+
+        if len(self.args) < 1:
+            self.err("Please specify start, stop or status")
+            return 2
+        subcmd = self.args[0]
+
+        if subcmd == "start":
+            timeout = self.opts.timeout
+            if timeout <= 0:
+                timeout = None
+            try:
+                pid = daemon.start(timeout=timeout, foreground=self.opts.foreground,
+                                   verbose=self.opts.verbose)
+            except RuntimeError, e:
+                self.err(e)
+                return 1
+            if pid and self.opts.verbose > 0:
+                print >> utils.stdinfo, "Started eups daemon (pid %d) listening on %s" % \
+                    (pid, daemon.socketPath())
+        elif subcmd == "stop":
+            if daemon.sendRequest({"command" : "stop"}) is None:
+                self.err("No eups daemon is running")
+                return 1
+        elif subcmd == "status":
+            status = daemon.sendRequest({"command" : "status"})
+            if status is None:
+                print "No eups daemon is running"
+                return 1
+            print "eups daemon (pid %d) listening on %s since %s; %d setup requests" % \
+                (status["pid"], daemon.socketPath(), utils.ctimeTZ(time.localtime(status["started"])),
+                 status["nrequest"])
+        else:
+            self.err("Unrecognized daemon subcommand: %s" % subcmd)
+            return 2
+
+        return 0
+
 class HelpCmd(EupsCmd):
 
     usage = "%prog help [-h|--help]"
@@ -3010,16 +3254,18 @@ register("admin clearServerCache", AdminClearServerCacheCmd)
 register("admin clearLocks",       AdminClearLocksCmd, lockType=None)
 register("admin listLocks",        AdminListLocksCmd, lockType=None)
 register("admin listCache",        AdminListCacheCmd, lockType=lock.LOCK_SH)
+register("admin verify",           AdminVerifyCmd)
 register("admin info",             AdminInfoCmd, lockType=lock.LOCK_SH)
 register("admin show",             AdminShowCmd, lockType=None)
 register("distrib",         DistribCmd, lockType=None) # must be None, as subcommands take locks
 register("distrib clean",   DistribCleanCmd)
-register("distrib create",  DistribCreateCmd)
+register("distrib create",  DistribCreateCmd, lockType=lock.LOCK_SH)
 register("distrib declare", DistribDeclareCmd)
 register("distrib install", DistribInstallCmd)
 register("distrib list",    DistribListCmd, lockType=lock.LOCK_SH)
 register("distrib path",   DistribPathCmd)
 register("tags",         TagsCmd, lockType=lock.LOCK_SH)
 register("vro",          VroCmd, lockType=None)
+register("daemon",       DaemonCmd, lockType=None)
 register("help",         HelpCmd, lockType=None)
     
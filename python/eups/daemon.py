@@ -0,0 +1,368 @@
+"""
+a per-user server ("eupsd") that runs setup requests in a long-lived process,
+so that the cost of starting python, importing eups and loading the user's
+customisations is paid once rather than by every setup.
+
+The server listens on a Unix socket in the user data directory (see
+socketPath()).  A request is a dictionary with the setup command's arguments
+("argv"), environment ("environ") and working directory ("cwd"); the reply
+is a dictionary with the exit status ("status") and the text written to
+standard output and standard error ("stdout", "stderr").  A status of None
+means that the server declined the request, and the client should run setup
+itself.  Each message is marshalled and preceded by its length as a 4-byte
+big-endian integer.
+
+The client side of this protocol is in bin/eups_setup_impl.py, which talks
+to the server before importing eups (that being the cost we're avoiding).
+
+The server declines requests made with a different configuration (e.g.
+$EUPS_PATH) to the one it was started with, and exits if any of the
+customisation files it loaded have changed.  The product stacks and tags
+read by setup, and other caches held in memory, are kept between requests
+and dropped whenever a database in $EUPS_PATH, or the user's tags for it,
+records a change or a file listing the known tags changes.  If a database 
+has no change journal (see Database.lastChanged()) they are dropped before
+every request.
+"""
+import os, sys, socket, struct, marshal, time
+import SocketServer
+from cStringIO import StringIO
+
+import utils
+import hooks
+import setupcmd
+from db import Database
+from table import TableCache
+from tags import tagListFileRe
+
+socketName = "_eupsd_"
+
+# environment variables that determine the configuration that a server
+# loaded when it started; requests with other values are declined
+configVariables = ("EUPS_DIR", "EUPS_PATH", "EUPS_SITEDATA", "EUPS_USERDATA", "EUPS_STARTUP", "HOME")
+
+_length = struct.Struct(">I")
+
+def socketPath(userDataDir=None):
+    """
+    return the path to the socket of the user's eups daemon
+    @param userDataDir   the user data directory (default: utils.defaultUserDataDir())
+    """
+    if not userDataDir:
+        userDataDir = utils.defaultUserDataDir()
+    return os.path.join(userDataDir, socketName)
+
+def _tagFileTimes(dir):
+    # return the modification times of the files listing the known tags in a directory
+    times = {}
+    for f in os.listdir(dir):
+        if tagListFileRe.match(f):
+            try:
+                times[f] = os.stat(os.path.join(dir, f)).st_mtime
+            except OSError:
+                pass
+    return times
+
+def sendMessage(sock, message):
+    """
+    send a message (a dictionary of simple python types) over a socket
+    """
+    data = marshal.dumps(message)
+    sock.sendall(_length.pack(len(data)) + data)
+
+def recvMessage(sock):
+    """
+    receive a message sent by sendMessage()
+    @throws EOFError   if the connection is closed before the whole message is read
+    """
+    def recvAll(n):
+        data = []
+        while n > 0:
+            chunk = sock.recv(n)
+            if not chunk:
+                raise EOFError("connection closed")
+            data.append(chunk)
+            n -= len(chunk)
+        return "".join(data)
+
+    n = _length.unpack(recvAll(_length.size))[0]
+    return marshal.loads(recvAll(n))
+
+def sendRequest(request, path=None, timeout=None):
+    """
+    send a request to the user's eups daemon and return the reply, or None
+    if no daemon is listening
+    @param request   the request dictionary; "command" may be "setup" (the default),
+                       "status" or "stop"
+    @param path      the daemon's socket (default: socketPath())
+    """
+    if not path:
+        path = socketPath()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            if timeout is not None:
+                sock.settimeout(timeout)
+            sock.connect(path)
+            sendMessage(sock, request)
+            return recvMessage(sock)
+        except (socket.error, EOFError):
+            return None
+    finally:
+        sock.close()
+
+def _configKey(environ):
+    return tuple([environ.get(k) for k in configVariables])
+
+class _RequestHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        try:
+            request = recvMessage(self.request)
+        except (socket.error, EOFError, ValueError):
+            return
+
+        try:
+            reply = self.server.processRequest(request)
+        except Exception, e:
+            reply = {"status" : None, "stdout" : "", "stderr" : "eupsd: %s\n" % e}
+
+        try:
+            sendMessage(self.request, reply)
+        except socket.error:
+            pass
+
+class SetupServer(SocketServer.UnixStreamServer):
+    """
+    a server that runs setup requests.  Requests are handled one at a time, as
+    each is run with the client's environment in os.environ.
+    """
+
+    def __init__(self, path=None, timeout=3600, verbose=0):
+        """
+        create a server listening on a Unix socket.  The current environment
+        defines the configuration that requests must match.
+        @param path      the socket (default: socketPath())
+        @param timeout   shut down after this many seconds without a request;
+                           if None, never shut down
+        @param verbose   the verbosity level for the server's own messages
+        """
+        if not path:
+            path = socketPath()
+        if os.path.exists(path):
+            if sendRequest({"command" : "status"}, path, timeout=5):
+                raise RuntimeError("An eups daemon is already listening on %s" % path)
+            os.remove(path)
+
+        umask = os.umask(077)           # only this user may talk to the server
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, _RequestHandler)
+        finally:
+            os.umask(umask)
+
+        self.path = path
+        self.timeout = timeout
+        self.verbose = verbose
+        self.started = time.time()
+        self.nrequest = 0
+        self._done = False
+
+        self._configKey = _configKey(os.environ)
+        hooks.loadCustomization(verbose, path=_eupsPath())
+        self._customisations = self._customisationTimes()
+        self._dbChanged = self._databaseTimes()
+        self._stackCache = {}           # the product stacks and tags kept between requests
+
+    def _customisationTimes(self):
+        times = {}
+        for f in hooks.customisationFiles or []:
+            try:
+                times[f] = os.stat(f).st_mtime
+            except OSError:
+                times[f] = None
+        return times
+
+    def _databaseTimes(self):
+        """
+        return the state of the databases in $EUPS_PATH and of the user's tags
+        for them, or None if it cannot be determined as a database has no 
+        change journal
+        """
+        userDataDir = utils.defaultUserDataDir()
+        times = {}
+        for p in _eupsPath():
+            dbpath = os.path.join(p, "ups_db")
+            if not os.path.isdir(dbpath):
+                continue
+
+            db = Database(dbpath)
+            changed = db.lastChanged()
+            if changed is None and db.findProductNames():
+                return None
+            times[dbpath] = (changed, _tagFileTimes(dbpath))
+
+            userDir = utils.userStackCacheFor(p, userDataDir)
+            if userDir and os.path.isdir(userDir):
+                changed = db.lastChanged(userDir)
+                if changed is None and \
+                       filter(lambda f: os.path.isdir(os.path.join(userDir, f)), os.listdir(userDir)):
+                    return None         # there are user tag assignments, but no journal
+                times[userDir] = (changed, _tagFileTimes(userDir))
+
+        return times
+
+    def serve(self):
+        """
+        handle requests until asked to stop, or until timeout seconds pass
+        without a request
+        """
+        try:
+            while not self._done:
+                self.handle_request()
+        finally:
+            self.server_close()
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def handle_timeout(self):
+        if self.verbose:
+            print >> utils.stdinfo, "eupsd: no requests for %ss; exiting" % self.timeout
+        self._done = True
+
+    def processRequest(self, request):
+        """
+        process a request, returning the reply
+        """
+        command = request.get("command", "setup")
+        if command == "stop":
+            self._done = True
+            return {"status" : 0}
+        elif command == "status":
+            return {"status" : 0, "pid" : os.getpid(), "started" : self.started,
+                    "nrequest" : self.nrequest}
+        elif command != "setup":
+            return {"status" : None, "stdout" : "", "stderr" : "eupsd: unknown command %s\n" % command}
+
+        self.nrequest += 1
+        declined = {"status" : None, "stdout" : "", "stderr" : ""}
+
+        if self._customisationTimes() != self._customisations:
+            if self.verbose:
+                print >> utils.stdinfo, "eupsd: customisations have changed; exiting"
+            self._done = True
+            return declined
+
+        if _configKey(request["environ"]) != self._configKey:
+            return declined
+
+        dbChanged = self._databaseTimes()
+        if dbChanged is None or dbChanged != self._dbChanged:
+            self._dbChanged = dbChanged
+            self.forget()
+
+        return self.runSetup(request["argv"], request["environ"], request["cwd"])
+
+    def forget(self):
+        """
+        drop the information held in memory about the databases and table files
+        """
+        self._stackCache.clear()
+
+        tableCache = TableCache.get()
+        if tableCache:
+            tableCache.forget()
+
+    def runSetup(self, argv, environ, cwd):
+        """
+        run setup with the client's arguments, environment and working directory, returning
+        the reply for the client
+        """
+        environ0 = os.environ.copy()
+        cwd0 = os.getcwd()
+        stdout0, stderr0 = sys.stdout, sys.stderr
+        streams = [utils.stderr, utils.stdinfo, utils.stdwarn, utils.stdok]
+        fileObjs0 = [s._fileObj for s in streams]
+
+        out, err = StringIO(), StringIO()
+        try:
+            os.environ.clear()
+            os.environ.update(environ)
+            os.chdir(cwd)
+
+            sys.stdout, sys.stderr = out, err
+            for s in streams:
+                s._fileObj = err
+
+            status = self._runSetup(argv)
+        finally:
+            sys.stdout, sys.stderr = stdout0, stderr0
+            for s, fileObj in zip(streams, fileObjs0):
+                s._fileObj = fileObj
+
+            os.chdir(cwd0)
+            os.environ.clear()
+            os.environ.update(environ0)
+
+        if status is None:
+            return {"status" : None, "stdout" : "", "stderr" : ""}
+        return {"status" : status, "stdout" : out.getvalue(), "stderr" : err.getvalue()}
+
+    def _runSetup(self, argv):
+        # this is the body of bin/eups_setup_impl.py
+        try:
+            setup = setupcmd.EupsSetup(args=argv)
+        except SystemExit, e:           # e.g. a bad option
+            return e.code
+
+        if setup.opts.debug or setup.opts.path or setup.opts.dbz:
+            return None                 # these change the process's configuration; run it locally
+        setup.stackCache = self._stackCache
+
+        try:
+            status = setup.run()
+        except SystemExit, e:
+            status = e.code
+        except Exception, e:
+            setup.err(utils.Color(e, utils.Color.classes["ERROR"]))
+            if hasattr(e, "status"):
+                status = e.status
+            else:
+                status = 9
+            print("false")
+
+        return status
+
+def _eupsPath():
+    import Eups                         # avoid a circular import
+    return Eups.Eups.setEupsPath()
+
+def start(path=None, timeout=3600, foreground=False, verbose=0):
+    """
+    start an eups daemon, returning its process ID
+    @param path        the socket (default: socketPath())
+    @param timeout     shut down after this many seconds without a request
+    @param foreground  if True, serve requests in this process (and return 0 when done)
+    """
+    server = SetupServer(path, timeout=timeout, verbose=verbose)
+    if foreground:
+        server.serve()
+        return 0
+
+    pid = os.fork()
+    if pid:
+        server.socket.close()           # the child is listening
+        return pid
+
+    try:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+        server.serve()
+    finally:
+        os._exit(0)
@@ -137,7 +137,10 @@ class ChainFile(object):
             if os.path.exists(file):  os.remove(file)
             return
 
-        fd = open(file, "w")
+        # write to a temporary file and rename it, so that the file is never
+        # seen half-written
+        tmpfile = "%s.tmp%d" % (file, os.getpid())
+        fd = open(tmpfile, "w")
 
         # Should really be "FILE = chain", but eups checks for version.  I've changed it to allow 
  	# chain, but let's not break backward compatibility with old eups versions 
@@ -174,6 +177,14 @@ CHAIN = %s
             print >> fd, "#End:"
 
         fd.close()
+        if os.path.exists(file):        # keep the file's group and permissions
+            st = os.stat(file)
+            try:
+                os.chown(tmpfile, -1, st.st_gid) # before chmod, as chown may clear setgid
+            except OSError:             # e.g. we aren't in the group
+                pass
+            os.chmod(tmpfile, st.st_mode & 07777)
+        os.rename(tmpfile, file)
 
     def _read(self, file=None, verbosity=0):
         """
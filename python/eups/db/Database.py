@@ -1,6 +1,8 @@
-import os, sys, re
+import os, sys, re, time, pwd
 from VersionFile import VersionFile
 from ChainFile import ChainFile
+from TagRegistry import TagRegistry, registryFile, journalFile
+from Transaction import Transaction
 from eups.utils import isRealFilename, isDbWritable
 import eups.tags
 from eups.Product import Product
@@ -14,6 +16,8 @@ tagFileExt = "chain"
 tagFileTmpl = "%s." + tagFileExt
 tagFileRe = re.compile(r'^(\w.*)\.%s$' % tagFileExt)
 
+who = pwd.getpwuid(os.geteuid())[0]
+
 try:
     _databases
 except NameError:
@@ -382,6 +386,50 @@ class _Database(object):
 
         return out
 
+    def getAllTagAssignments(self, glob=True, user=True, userId=None):
+        """
+        return a dictionary mapping the names of products to lists of tuples
+        of the form (tag, version, flavor), as returned by 
+        getTagAssignments(), for every product with tags assigned.  This uses 
+        the stack's TagRegistry (see getTagRegistry()) if it is available, 
+        so that the chain files need not be read.
+        @param glob            if true (default), include the global tags
+        @param user            if true (default), include the user tags
+        @param userId          the user whose user tags are wanted (see 
+                                 addUserTagDb()); None means me
+        """
+        registry = self.getTagRegistry()
+
+        dbroots = []
+        if glob:
+            dbroots.append((self.dbpath, ""))
+        if user and self._getUserTagDb(userId):
+            dbroots.append((self._getUserTagDb(userId), "user:"))
+
+        out = {}
+        for dbroot, tgroup in dbroots:
+            if registry:
+                assignments = registry.getAssignments(dbroot)
+            else:
+                assignments = TagRegistry.readAll(dbroot)
+
+            for productName, tags in assignments.items():
+                if not out.has_key(productName):
+                    out[productName] = []
+                out[productName] += [(tgroup + tag, vers, flavor) for tag, vers, flavor in tags]
+
+        return out
+
+    def getTagRegistry(self):
+        """
+        return the TagRegistry for this database's stack, which is kept in 
+        my user tag directory, or None if I don't have one
+        """
+        userdb = self._getUserTagDb()
+        if not userdb:
+            return None
+        return TagRegistry.get(os.path.join(userdb, registryFile), os.path.dirname(self.dbpath))
+
     def isDeclared(self, productName, version=None, flavor=None):
         """
         return true if a product is declared.
@@ -457,15 +505,16 @@ class _Database(object):
         versionFile.addFlavor(prod.flavor, prod.dir, tablefile, prod.ups_dir)
 
         # seal the deal
-        if not os.path.exists(pdir):
-            os.mkdir(pdir)
+        self._makeDir(pdir)
 
         if prod.dir:
             trimDir = prod.stackRoot()
             if trimDir and not os.path.exists(trimDir):
                 trimDir = None
                 
+        self._saveForRollback(vfile, prod.name)
         versionFile.write(trimDir)
+        self._recordChange("declare", prod.name, prod.version)
 
         # now assign any tags
         for tag in prod.tags:
@@ -505,7 +554,10 @@ class _Database(object):
                 self.unassignTag(tag, product.name, product.flavor)
 
         changed = versionFile.removeFlavor(product.flavor)
-        if changed:  versionFile.write()
+        if changed:
+            self._saveForRollback(vfile, product.name)
+            versionFile.write()
+            self._recordChange("undeclare", product.name, product.version)
 
         # do a little clean up: if we got rid of the version file, try 
         # deleting the directory
@@ -609,17 +661,20 @@ class _Database(object):
             if not self._getUserTagDb():
                 raise RuntimeError("Unable to assign user tags (user db not available)")
 
-            pdir = self._productDir(productName, self._getUserTagDb())
-            if not os.path.exists(pdir):
-                os.makedirs(pdir)
+            dbroot = self._getUserTagDb()
+            pdir = self._productDir(productName, dbroot)
+            self._makeDir(pdir)
         else:
+            dbroot = self.dbpath
             pdir = self._productDir(productName)
         
         tfile = self._tagFileInDir(pdir, tag.name)
         tagFile = ChainFile(tfile, productName, tag.name)
 
         tagFile.setVersion(version, flavors)
+        self._saveForRollback(tfile, productName, dbroot)
         tagFile.write()
+        self._recordChange("assignTag", productName, tag.name, dbroot)
             
 
     def unassignTag(self, tag, productNames, flavors=None):
@@ -659,7 +714,9 @@ class _Database(object):
 
             if flavors is None:
                 # remove all flavors
+                self._saveForRollback(tfile, prod, dbroot)
                 os.remove(tfile)
+                self._recordChange("unassignTag", prod, tag, dbroot)
                 unassigned = True
                 continue
 
@@ -670,24 +727,156 @@ class _Database(object):
                     changed = True
 
             if changed:
+                self._saveForRollback(tfile, prod, dbroot)
                 tf.write()
+                self._recordChange("unassignTag", prod, tag, dbroot)
                 unassigned = True
 
         return unassigned
 
-    def isNewerThan(self, timestamp, dbrootdir=None):
+    def _saveForRollback(self, filename, productName, dbrootdir=None):
+        """
+        if a transaction is open (see Transaction.begin()), save the 
+        contents of a version or chain file that is about to be changed 
+        so that the change can be rolled back
+        @param filename     the file about to be written or removed
+        @param productName  the name of the product it describes
+        @param dbrootdir    the database directory containing it.  If None,
+                               defaults to database root.
+        """
+        transaction = Transaction.current()
+        if transaction:
+            if not dbrootdir:  dbrootdir = self.dbpath
+            transaction.saveFile(filename, self, dbrootdir, productName)
+
+    def _makeDir(self, dirname):
+        """
+        create a directory (and any missing parents) if it doesn't already
+        exist, noting what was created in any open transaction
+        """
+        Transaction.makeDirs(dirname)
+
+    def _journalFile(self, dbrootdir=None):
+        if not dbrootdir:  dbrootdir = self.dbpath
+        return os.path.join(dbrootdir, journalFile)
+
+    def _recordChange(self, what, productName, label, dbrootdir=None):
+        """
+        append a record of a change to the database to its journal file.  
+        The journal is only ever appended to, so its modification time 
+        tells us when the database last changed without having to look 
+        at every product directory.
+        @param what         the name of the operation (e.g. "declare")
+        @param productName  the name of the product that was changed
+        @param label        the version or tag that was changed
+        @param dbrootdir    the database directory that was updated.  If None,
+                               defaults to database root.
+        """
+        if not dbrootdir:  dbrootdir = self.dbpath
+        oldStamp = TagRegistry.journalStamp(dbrootdir)
+        try:
+            fd = open(self._journalFile(dbrootdir), "a")
+            try:
+                print >> fd, "%d %s %s %s %s" % \
+                      (time.time(), what, productName, label, who)
+            finally:
+                fd.close()
+        except IOError:
+            # the journal is only an optimisation; isNewerThan() will fall
+            # back to scanning the database if the journal is missing
+            pass
+
+        registry = self.getTagRegistry()
+        if registry:
+            registry.updateProduct(dbrootdir, productName, oldStamp)
+
+    def lastChanged(self, dbrootdir=None):
+        """
+        return the time (as given by os.stat()) of the last change recorded 
+        in the database's journal, or None if no journal is available
+        @param dbrootdir    the database directory to check.  If None,
+                               defaults to database root.  
+        """
+        try:
+            return os.stat(self._journalFile(dbrootdir)).st_mtime
+        except OSError:
+            return None
+
+    def changesSince(self, offset, dbrootdir=None):
+        """
+        return the size of the database's journal (see lastChanged()) and 
+        a list of the names of the products whose changes were recorded in 
+        it after it was the given size.  (None, None) is returned if there 
+        is no journal, or if it is smaller than the given size (so it must 
+        have been replaced).
+        @param offset       the size of the journal when it was last read
+        @param dbrootdir    the database directory to check.  If None,
+                               defaults to database root.  
+        """
+        try:
+            fd = open(self._journalFile(dbrootdir))
+        except IOError:
+            return (None, None)
+
+        try:
+            fd.seek(0, 2)
+            if fd.tell() < offset:
+                return (None, None)
+            fd.seek(offset)
+            data = fd.read()
+        finally:
+            fd.close()
+
+        # ignore a record that is still being written
+        data = data[:data.rfind("\n") + 1]
+
+        names = []
+        for line in data.splitlines():
+            fields = line.split()
+            if len(fields) > 2 and fields[2] not in names:
+                names.append(fields[2])
+
+        return (offset + len(data), names)
+
+    def isNewerThan(self, timestamp, dbrootdir=None, verify=False):
         """
         return true if the state of this database is newer than a given time
         NOTE: file timestamps only have a resolution of 1 second!
+
+        If the database has a journal of changes (see lastChanged()) only
+        the journal is checked; otherwise, or if verify is True, every 
+        product directory and version and chain file is examined.
         @param timestamp    the epoch time, as given by os.stat()
         @param dbrootdir    directory where to look for file times.  If None,
                                defaults to database root.  
+        @param verify       if True, ignore the journal and check every file
         """
         if not dbrootdir:
             dbrootdir = self.dbpath
-        proddirs = map(lambda d: os.path.join(self.dbpath, d), self.findProductNames())
 
-        for prod in proddirs:
+        if not verify:
+            changed = self.lastChanged(dbrootdir)
+            if changed is not None:
+                return changed > timestamp
+
+        for prod in self.findProductNames():
+            if self.productIsNewerThan(prod, timestamp):
+                return True
+
+        return False
+
+    def productIsNewerThan(self, productName, timestamp, dbrootdir=None):
+        """
+        return true if the files describing a product are newer than a 
+        given time (or if the product is no longer declared).  Unlike 
+        isNewerThan(), this always checks the files themselves.
+        @param productName  the name of the product
+        @param timestamp    the epoch time, as given by os.stat()
+        @param dbrootdir    the database directory to check.  If None,
+                               defaults to database root.  
+        """
+        prod = self._productDir(productName, dbrootdir)
+        try:
             # check the directory mod-time: this will catch recent removal
             # of files from the directory
             if os.stat(prod).st_mtime > timestamp:
@@ -701,6 +890,8 @@ class _Database(object):
                 file = os.path.join(prod, file)
                 if os.stat(file).st_mtime > timestamp:
                     return True
+        except OSError:
+            return True
 
         return False
         
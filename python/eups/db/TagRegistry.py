@@ -0,0 +1,182 @@
+import os, re, cPickle
+from ChainFile import ChainFile
+from eups import lock
+
+registryFile = "_tags_.pickle"
+journalFile = "_journal_"
+
+tagFileRe = re.compile(r'^(\w.*)\.chain$')
+
+class TagRegistry(object):
+    """
+    a record of every tag assignment in a set of databases: a product
+    stack's ups_db, and the directories holding the user tags of this and
+    other users for that stack.  It is saved in a single file so that
+    the tags can be found without reading any chain files.
+
+    The assignments in each database directory are only trusted while the
+    directory's journal (see Database.lastChanged()) is as it was when they
+    were read; Database updates the registry as it makes changes, so that
+    eups's own changes don't invalidate it.  A directory without a journal
+    is read every time.
+    """
+
+    # the format of the saved registry; bump this if it changes
+    formatVersion = 1
+
+    _registries = {}
+
+    def __init__(self, filename, stack=None):
+        """
+        @param filename   the file to save the registry in
+        @param stack      the product stack whose tags are recorded; the
+                            registry is saved under its write lock
+        """
+        self.filename = filename
+        self.stack = stack
+        self.dbroots = {}               # dbroot -> (journal stamp, {product : [(tag, version, flavor)]})
+
+    # @staticmethod   # requires python 2.4
+    def get(filename, stack=None):
+        """
+        return the (singleton) registry saved in the given file
+        @param filename   the file the registry is saved in
+        @param stack      the product stack whose tags are recorded
+        """
+        if not TagRegistry._registries.has_key(filename):
+            registry = TagRegistry(filename, stack)
+            try:
+                fd = open(filename, "rb")
+                try:
+                    version, dbroots = cPickle.load(fd)
+                finally:
+                    fd.close()
+                if version == TagRegistry.formatVersion:
+                    registry.dbroots = dbroots
+            except Exception:
+                pass
+
+            TagRegistry._registries[filename] = registry
+
+        return TagRegistry._registries[filename]
+    get = staticmethod(get)
+
+    # @staticmethod   # requires python 2.4
+    def journalStamp(dbroot):
+        """
+        return a stamp identifying the state of a database directory's
+        journal, or None if it doesn't have one
+        """
+        try:
+            st = os.stat(os.path.join(dbroot, journalFile))
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime)
+    journalStamp = staticmethod(journalStamp)
+
+    # @staticmethod   # requires python 2.4
+    def readProduct(dbroot, productName):
+        """
+        return the (tag, version, flavor) assignments recorded in a product's
+        chain files in a database directory
+        """
+        out = []
+        pdir = os.path.join(dbroot, productName)
+        try:
+            files = os.listdir(pdir)
+        except OSError:
+            return out
+
+        for file in files:
+            mat = tagFileRe.match(file)
+            if mat:
+                tag = mat.group(1)
+                chain = ChainFile(os.path.join(pdir, file), productName, tag)
+                for flavor in chain.getFlavors():
+                    out.append((tag, chain.getVersion(flavor), flavor))
+
+        return out
+    readProduct = staticmethod(readProduct)
+
+    # @staticmethod   # requires python 2.4
+    def readAll(dbroot):
+        """
+        return a dictionary mapping the names of the products in a database
+        directory to lists of their (tag, version, flavor) assignments, read
+        from their chain files
+        """
+        out = {}
+        if os.path.isdir(dbroot):
+            for productName in os.listdir(dbroot):
+                tags = TagRegistry.readProduct(dbroot, productName)
+                if tags:
+                    out[productName] = tags
+
+        return out
+    readAll = staticmethod(readAll)
+
+    def getAssignments(self, dbroot):
+        """
+        return a dictionary mapping the names of the products in a database
+        directory to lists of their (tag, version, flavor) assignments.  The
+        chain files are only read if the saved assignments are out of date.
+        """
+        stamp = self.journalStamp(dbroot)
+        if stamp is not None and self.dbroots.has_key(dbroot) and \
+               self.dbroots[dbroot][0] == stamp:
+            return self.dbroots[dbroot][1]
+
+        assignments = self.readAll(dbroot)
+        if stamp is not None:
+            self.dbroots[dbroot] = (stamp, assignments)
+            self.save()
+
+        return assignments
+
+    def updateProduct(self, dbroot, productName, oldStamp):
+        """
+        note that a product's tags in a database directory were changed, and
+        its journal updated, by this process
+        @param dbroot       the database directory
+        @param productName  the product whose chain files were changed
+        @param oldStamp     the journal's stamp (see journalStamp()) before
+                              the change was recorded
+        """
+        if not self.dbroots.has_key(dbroot):
+            return
+
+        stamp, assignments = self.dbroots[dbroot]
+        if stamp != oldStamp:           # someone else changed the database too
+            del self.dbroots[dbroot]
+        else:
+            tags = self.readProduct(dbroot, productName)
+            if tags:
+                assignments[productName] = tags
+            elif assignments.has_key(productName):
+                del assignments[productName]
+            self.dbroots[dbroot] = (self.journalStamp(dbroot), assignments)
+
+        self.save()
+
+    def save(self):
+        """
+        save the registry.  Failure to do so is silently ignored.
+        """
+        locks = []
+        try:
+            dir = os.path.dirname(self.filename)
+            if not os.path.isdir(dir):
+                os.makedirs(dir)
+
+            if self.stack:
+                locks = lock.takeWriteLock(self.stack)
+            tmpfile = "%s.tmp%d" % (self.filename, os.getpid())
+            fd = open(tmpfile, "wb")
+            try:
+                cPickle.dump((self.formatVersion, self.dbroots), fd, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+            os.rename(tmpfile, self.filename)
+        except (IOError, OSError):
+            pass
+        lock.giveLocks(locks)
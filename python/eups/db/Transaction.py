@@ -0,0 +1,149 @@
+import os
+
+_current = None                         # the open Transaction, if any
+
+class Transaction(object):
+    """
+    a batch of changes to one or more databases (declarations,
+    undeclarations and tag assignments) that either all take effect or, if
+    the batch is rolled back, none do.
+
+    While a transaction is open every Database saves the original contents
+    of each version or chain file before it first changes it, and notes
+    the directories it creates, so that rollback() can put them back; so
+    does a declaration for the files (e.g. table files) that it copies into
+    the database.  Only one transaction may be open at a time.
+    """
+
+    def __init__(self):
+        self.files = {}                 # filename -> original contents (None if it didn't exist)
+        self.order = []                 # the saved files, in the order they were first changed
+        self.dirs = []                  # directories created during the transaction
+        self.products = []              # the (Database, dbroot, productName) that were changed
+
+    # @staticmethod   # requires python 2.4
+    def begin():
+        """
+        open and return a new transaction
+        """
+        global _current
+        if _current is not None:
+            raise RuntimeError("A database transaction is already open")
+        _current = Transaction()
+        return _current
+    begin = staticmethod(begin)
+
+    # @staticmethod   # requires python 2.4
+    def current():
+        """
+        return the open transaction, or None if there isn't one
+        """
+        return _current
+    current = staticmethod(current)
+
+    def saveFile(self, filename, db=None, dbroot=None, productName=None):
+        """
+        remember a file's contents before it is changed for the first time
+        in this transaction
+        @param filename     the version or chain file about to be changed
+        @param db           the Database making the change, or None if the
+                              file isn't a version or chain file (e.g. a
+                              table file copied into the database)
+        @param dbroot       the database directory containing the file
+        @param productName  the product that the file describes
+        """
+        if self.files.has_key(filename):
+            return
+
+        try:
+            fd = open(filename)
+            try:
+                contents = fd.read()
+            finally:
+                fd.close()
+        except IOError:
+            contents = None
+
+        self.files[filename] = contents
+        self.order.append(filename)
+
+        key = (db, dbroot, productName)
+        if db is not None and key not in self.products:
+            self.products.append(key)
+
+    def madeDir(self, dirname):
+        """
+        note that a directory was created during this transaction
+        """
+        if dirname not in self.dirs:
+            self.dirs.append(dirname)
+
+    # @staticmethod   # requires python 2.4
+    def makeDirs(dirname):
+        """
+        create a directory (and any missing parents) if it doesn't already
+        exist, noting what was created in the open transaction (if any)
+        """
+        missing = []
+        d = dirname
+        while d and not os.path.exists(d):
+            missing.append(d)
+            d = os.path.dirname(d)
+        if not missing:
+            return
+
+        os.makedirs(dirname)
+
+        if _current:
+            missing.reverse()
+            for d in missing:
+                _current.madeDir(d)
+    makeDirs = staticmethod(makeDirs)
+
+    def commit(self):
+        """
+        keep all the changes made during this transaction, and close it
+        """
+        self._close()
+
+    def rollback(self):
+        """
+        undo all the changes made during this transaction, and close it.
+        Each restored file is written atomically.
+        """
+        self._close()
+
+        for filename in reversed(self.order):
+            contents = self.files[filename]
+            if contents is None:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                continue
+
+            dirname = os.path.dirname(filename)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+            tmpfile = "%s.tmp%d" % (filename, os.getpid())
+            fd = open(tmpfile, "w")
+            try:
+                fd.write(contents)
+            finally:
+                fd.close()
+            os.rename(tmpfile, filename)
+
+        for dirname in reversed(self.dirs):
+            try:
+                os.rmdir(dirname)       # only succeeds if we left it empty
+            except OSError:
+                pass
+
+        # record the restorations, so that caches of the databases are updated
+        for db, dbroot, productName in self.products:
+            db._recordChange("rollback", productName, "-", dbroot)
+
+    def _close(self):
+        global _current
+        if _current is not self:
+            raise RuntimeError("This database transaction is not open")
+        _current = None
@@ -453,7 +453,10 @@ class VersionFile(object):
             if os.path.exists(file):  os.remove(file)
             return
 
-        fd = open(file, "w")
+        # write to a temporary file and rename it, so that the file is never
+        # seen half-written
+        tmpfile = "%s.tmp%d" % (file, os.getpid())
+        fd = open(tmpfile, "w")
 
         print >> fd, """FILE = version
 PRODUCT = %s
@@ -530,6 +533,14 @@ Group:
         print >> fd, "End:"
 
         fd.close()
+        if os.path.exists(file):        # keep the file's group and permissions
+            st = os.stat(file)
+            try:
+                os.chown(tmpfile, -1, st.st_gid) # before chmod, as chown may clear setgid
+            except OSError:             # e.g. we aren't in the group
+                pass
+            os.chmod(tmpfile, st.st_mode & 07777)
+        os.rename(tmpfile, file)
 
 
 
@@ -12,8 +12,14 @@ The main classes in this module are:
    ChainFile    an interface into the data about the assignment of a 
                  specific tag to a product, which is stored in a single 
                  file in the database.
+   TagRegistry  a saved record of all the tag assignments in a stack's 
+                 databases, so that they can be found without reading 
+                 every chain file.
+   Transaction  a batch of changes to the databases that can be rolled 
+                 back as a whole if any of them fails.
 """
 from VersionFile import VersionFile 
 from ChainFile import ChainFile
 from Database import Database
+from Transaction import Transaction
 
@@ -4,12 +4,12 @@
 # Export a product and its dependencies as a package, or install a
 # product from a package
 #
-import sys, os, re, atexit, shutil
+import sys, os, re, atexit, shutil, glob
 import eups
 import eups.hooks as hooks
 import eups.table
 import server
-from server import RemoteFileNotFound, Manifest, TaggedProductList
+from server import RemoteFileNotFound, Manifest, TaggedProductList, PackageIndex
 from eups.VersionParser import VersionParser
 from eups.exceptions import EupsException
 
@@ -238,6 +238,23 @@ class Distrib(object):
         """
         self.unimplemented("installPackage");
 
+    def getPrefetchFiles(self, location, product, version):
+        """return the files that installPackage() will retrieve from the 
+        server, so that they may be downloaded ahead of time (see 
+        DistribServer.prefetch()).  
+
+        This implementation returns an empty list; subclasses should override
+        it if they retrieve files via getFileForProduct().
+
+        @param location     the location of the package on the server (see
+                               installPackage())
+        @param product      the name of the product installed by the package.
+        @param version      the name of the product version.  
+        @returns list   a list of (path, product, version, flavor, ftype) 
+                           tuples, as passed to getFileForProduct()
+        """
+        return []
+
     def cleanPackage(self, product, version, productRoot, location):
         """remove any distribution-specific remnants of a package installation.
         Some distrib mechanisms (namely, Pacman) maintain some of their own 
@@ -637,6 +654,12 @@ class DefaultDistrib(Distrib):
             convention is captured in the function getTaggedReleasePath()
             (which subclasses may override).
        o  Table files have the form "<product>.table"
+       o  A summary of the manifests and tagged releases is kept in a 
+            PackageIndex (see eups.server.PackageIndex) directly below the
+            server directory, called "packages.index".  It is updated 
+            whenever a manifest or tagged release is written; if it is
+            missing, it is recreated from the manifests and tagged releases
+            in the server directory.
     """
 
     def initServerTree(self, serverDir):
@@ -712,6 +735,11 @@ class DefaultDistrib(Distrib):
 
         products.write(out, flavor, self.Eups.noaction)
 
+        if not self.Eups.noaction:
+            index = self.getPackageIndex(serverDir)
+            index.setTag(tag, [(p[0], p[2], flavor or p[1]) for p in products.getProducts()])
+            self.writePackageIndex(serverDir, index)
+
     def getManifestPath(self, serverDir, product, version, flavor=None):
         """return the path where the manifest for a particular product will
         be deployed on the server.  In this implementation, all manifest 
@@ -826,6 +854,87 @@ class DefaultDistrib(Distrib):
         #
         man.write(out, flavor=flavor, noOptional=False)
         self.setGroupPerms(out)
+
+        if not self.Eups.noaction:
+            indexFlavor = self.flavor
+            if out == self.getManifestPath(serverDir, product, version, None):
+                indexFlavor = None      # this Distrib's manifests are generic
+            index = self.getPackageIndex(serverDir)
+            self._indexManifest(index, out, product, version, indexFlavor, productDeps)
+            self.writePackageIndex(serverDir, index)
+
+    def getPackageIndex(self, serverDir):
+        """return the PackageIndex describing a server distribution tree.  If
+        the tree doesn't have an index yet, one is created from the manifests 
+        and tagged releases found there.
+        @param serverDir      a local directory representing the root of the 
+                                  package distribution tree
+        """
+        file = os.path.join(serverDir, server.packageIndexFilename)
+        if os.path.exists(file):
+            return PackageIndex.fromFile(file, self.verbose-1, self.log)
+
+        if self.verbose > 0:
+            print >> self.log, "Creating package index for", serverDir
+        index = PackageIndex(self.verbose-1, self.log)
+
+        for file, flavor in self.findManifests(serverDir):
+            try:
+                man = Manifest.fromFile(file, self.Eups, verbosity=self.verbose-1, log=self.log)
+            except RuntimeError, e:
+                print >> self.log, "Not indexing %s: %s" % (file, e)
+                continue
+            self._indexManifest(index, file, man.product, man.version, flavor, man.getProducts())
+
+        suffix = self.getTaggedReleasePath("")
+        for file in glob.glob(os.path.join(serverDir, self.getTaggedReleasePath("*"))):
+            tag = os.path.basename(file)[:-len(os.path.basename(suffix))]
+            try:
+                products = TaggedProductList.fromFile(file, tag)
+            except RuntimeError, e:
+                print >> self.log, "Not indexing %s: %s" % (file, e)
+                continue
+            index.setTag(tag, [(p[0], p[2], p[1]) for p in products.getProducts()])
+
+        return index
+
+    def findManifests(self, serverDir):
+        """return a list of (filename, flavor) for the manifests deployed in
+        a server distribution tree, where the flavor is None for generic 
+        manifests.  See getManifestPath() for where manifests are deployed.
+        @param serverDir      a local directory representing the root of the 
+                                  package distribution tree
+        """
+        out = []
+        mandir = os.path.join(serverDir, "manifests")
+        for dir, subdirs, files in os.walk(mandir):
+            flavor = None
+            if dir != mandir:
+                flavor = os.path.basename(dir)
+
+            for file in filter(lambda f: f.endswith(".manifest"), files):
+                out.append((os.path.join(dir, file), flavor))
+
+        return out
+
+    def writePackageIndex(self, serverDir, index):
+        """write the PackageIndex for a server distribution tree
+        @param serverDir      a local directory representing the root of the 
+                                  package distribution tree
+        @param index          the PackageIndex to write
+        """
+        file = os.path.join(serverDir, server.packageIndexFilename)
+        index.write(file, self.Eups.noaction)
+        self.setGroupPerms(file)
+
+    def _indexManifest(self, index, file, product, version, flavor, productDeps):
+        """add a manifest file to a PackageIndex"""
+        distId = None
+        for dep in productDeps:
+            if dep.product == product and dep.version == version:
+                distId = dep.distId
+
+        index.addPackage(product, version, flavor, distId, PackageIndex.checksum(file))
         
     def createDependencies(self, product, version, flavor=None, tag=None, recursive=False, exact=False,
                            mapping=server.Mapping()):
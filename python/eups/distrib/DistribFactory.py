@@ -13,6 +13,7 @@ import tarball
 import pacman
 import builder
 import eupspkg
+import chunked
 
 class DistribFactory:
     """a factory class for creating Distrib instances
@@ -115,6 +116,7 @@ class DistribFactory:
         self.register(pacman.Distrib)
         self.register(builder.Distrib)
         self.register(eupspkg.Distrib)
+        self.register(chunked.Distrib)
 
     def _registerCustomDistribs(self):
         if self.distServer:
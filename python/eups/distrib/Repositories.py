@@ -15,6 +15,80 @@ from DistribFactory import DistribFactory
 from server         import ServerConf, Manifest, ServerError
 import server
 import eups.hooks as hooks
+import eups.lock as lock
+from eups.stack import resetSync
+
+def runJobs(jobs, njob, build, finish, start=None, log=sys.stderr):
+    """
+    run a set of jobs, up to njob at once, each in a child process and only once 
+    the jobs that it depends on have finished.  If a job fails no more are started,
+    but those that are running are allowed to finish.
+    @param jobs     a list of (name, dependencies) pairs, in the order that they should 
+                      be started (when ready).  Dependencies that aren't in the list are
+                      ignored; if the rest are circular, the first waiting job is started 
+                      when nothing else is running.
+    @param njob     the maximum number of jobs to run at once
+    @param build    a function called, in a child process, with the name of a job.  
+                      The job fails if it raises an exception.
+    @param finish   a function called (in this process) with the name of each job that 
+                      succeeds.  It is called before any job that depends on it is started.
+    @param start    a function called with the name of each job as it is started
+    @param log      the stream to flush before starting a child process
+    @return a tuple of the lists of the names of the jobs that failed and of those 
+                      that weren't started
+    """
+    names = dict(jobs)
+    pending = [name for name, deps in jobs]
+    running = {}                        # the jobs being run, by process ID
+    done = {}                           # the jobs that have finished successfully
+    failed = []
+
+    while pending or running:
+        while pending and not failed and len(running) < njob:
+            for name in pending:
+                if not [d for d in names[name] if names.has_key(d) and not done.has_key(d)]:
+                    break
+            else:
+                if running:
+                    break
+                name = pending[0]       # a circular dependency; just run the first one
+
+            pending.remove(name)
+            if start:
+                start(name)
+
+            log.flush()
+            sys.stdout.flush()
+            server.prepareToFork()
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    server.afterFork()
+                    build(name)
+                    status = 0
+                finally:                # n.b. os._exit() discards any exception
+                    log.flush()
+                    os._exit(status)
+
+            running[pid] = name
+
+        if not running:
+            break
+
+        pid, status = os.waitpid(-1, 0)
+        if not running.has_key(pid):
+            continue
+        name = running.pop(pid)
+
+        if status != 0:
+            failed.append(name)
+            continue
+
+        finish(name)
+        done[name] = True
+
+    return failed, pending
 
 class Repositories(object):
 
@@ -350,10 +424,74 @@ class Repositories(object):
             raise EupsException("You asked to install %s %s but it is not in the manifest\nCheck manifest.remap (see \"eups startup\") and/or increase the verbosity" % (product, version))
 
         self._msgs = {}
-        self._recursiveInstall(0, man, product, version, flavor, pkgroot, 
-                               productRoot, updateTags, alsoTag, options, 
-                               depends, noclean, noeups)
-        
+        try:
+            if options and options.get("prefetch", 0) > 0 and not self.eups.noaction:
+                self._prefetch(man, product, version, flavor, options, depends, noeups)
+
+            njob = options and options.get("jobs", 1) or 1
+            if njob > 1 and not self.eups.noaction and \
+                   self._canInstallInParallel(man, product, version, flavor, pkgroot, options):
+                self._parallelInstall(man, product, version, flavor, productRoot, updateTags,
+                                      alsoTag, options, depends, noclean, noeups, njob)
+            else:
+                self._recursiveInstall(0, man, product, version, flavor, pkgroot, 
+                                       productRoot, updateTags, alsoTag, options, 
+                                       depends, noclean, noeups)
+        finally:
+            for repos in self.repos.values():
+                if repos.distServer:
+                    repos.distServer.clearPrefetched()
+
+    def _prefetch(self, manifest, product, version, flavor, opts, depends, noeups):
+        """
+        download, in parallel, the manifests, packages and table files that
+        installing the products listed in a manifest will need, so that the
+        (serial) installation doesn't wait on the network for each in turn.
+        The number of simultaneous downloads is given by opts["prefetch"]
+        """
+        instflavor = flavor
+        if instflavor == "generic":
+            instflavor = self.eups.flavor
+
+        defaultProduct = hooks.config.Eups.defaultProduct["name"]
+
+        files = {}                      # the files to fetch from each repository
+        for prod in manifest.getProducts():
+            is_product = (prod.product == product and prod.version == version)
+            if depends == self.DEPS_NONE and not is_product:
+                continue
+            elif depends == self.DEPS_ONLY and is_product:
+                continue
+
+            if prod.product == defaultProduct or prod.version == "dummy":
+                continue
+            if not noeups and self.eups.findProduct(prod.product, prod.version, flavor=instflavor):
+                continue
+
+            pkg = self.findPackage(prod.product, prod.version, prod.flavor)
+            if not pkg:
+                continue
+            pkgroot = pkg[3]
+
+            if not files.has_key(pkgroot):
+                files[pkgroot] = []
+            files[pkgroot].append(("", pkg[0], pkg[1], pkg[2], "manifest"))
+
+            if prod.distId:
+                try:
+                    distrib = self.repos[pkgroot].getDistribFor(prod.distId, opts, instflavor)
+                    files[pkgroot] += distrib.getPrefetchFiles(distrib.parseDistID(prod.distId),
+                                                               prod.product, prod.version)
+                except RuntimeError:
+                    pass
+            if prod.tablefile and prod.tablefile != "none":
+                files[pkgroot].append((prod.tablefile, prod.product, prod.version, self.eups.flavor, None))
+
+        for pkgroot in files.keys():
+            if self.verbose > 0:
+                print >> self.log, "Prefetching %d files from %s" % (len(files[pkgroot]), pkgroot)
+            self.repos[pkgroot].distServer.prefetch(files[pkgroot], opts["prefetch"])
+
     def _recursiveInstall(self, recursionLevel, manifest, product, version, 
                           flavor, pkgroot, productRoot, updateTags=False, 
                           alsoTag=None, opts=None, depends=DEPS_ALL,
@@ -556,29 +694,172 @@ class Repositories(object):
             setups.append("setup --just --type=build %s %s" % (prod.product, prod.version))
 
             # ...update the tags
-            if updateTags:
-                self._updateServerTags(prod, productRoot, instflavor, installCurrent=opts["installCurrent"])
-            if alsoTag:
-                if self.verbose > 1:
-                    print >> self.log, "Assigning Tags to %s %s: %s" % \
-                          (prod.product, prod.version, ", ".join([str(t) for t in alsoTag]))
-                for tag in alsoTag:
-                    try:
-                        self.eups.assignTag(tag, prod.product, prod.version, productRoot)
-                    except Exception, e:
-                        msg = str(e)
-                        if not self._msgs.has_key(msg):
-                            print >> self.log, msg
-                        self._msgs[msg] = 1
+            self._assignTags(prod, productRoot, instflavor, updateTags, alsoTag, opts)
 
             # ...note that this package is now installed
             installed.append(pver)
 
         return True
 
+    def _assignTags(self, prod, productRoot, instflavor, updateTags, alsoTag, opts):
+        """assign the server tags (if updateTags) and the tags in alsoTag to an installed product"""
+        if updateTags:
+            self._updateServerTags(prod, productRoot, instflavor, installCurrent=opts["installCurrent"])
+        if alsoTag:
+            if self.verbose > 1:
+                print >> self.log, "Assigning Tags to %s %s: %s" % \
+                      (prod.product, prod.version, ", ".join([str(t) for t in alsoTag]))
+            for tag in alsoTag:
+                try:
+                    self.eups.assignTag(tag, prod.product, prod.version, productRoot)
+                except Exception, e:
+                    msg = str(e)
+                    if not self._msgs.has_key(msg):
+                        print >> self.log, msg
+                    self._msgs[msg] = 1
+
+    def _canInstallInParallel(self, manifest, product, version, flavor, pkgroot, opts):
+        """return True if every product that installing from a manifest would build is 
+        listed, with its distribution ID, in the manifest (i.e. no recursive search for 
+        dependencies is needed).  See _recursiveInstall()"""
+        prod = manifest.getDependency(product, version, flavor)
+        if prod and self.repos[pkgroot].getDistribFor(prod.distId, opts, flavor).PRUNE:
+            return True
+
+        for prod in manifest.getProducts():
+            if not prod.distId or prod.shouldRecurse:
+                return False
+        return True
+
+    def _parallelInstall(self, manifest, product, version, flavor, productRoot, updateTags=False, 
+                         alsoTag=None, opts=None, depends=DEPS_ALL, noclean=False, noeups=False,
+                         njob=2):
+        """
+        install the products listed in a manifest, building up to njob of them at once.
+        The dependencies of a product are read from its own manifest, and it's built once
+        they have been installed.  Builds run in child processes, but products are declared 
+        and tagged by this process in the order that their builds finish, and never before 
+        the products that they depend on.  If a build fails, no more are started; we wait 
+        for those that are running before raising an exception.
+        """
+        instflavor = flavor
+        if instflavor == "generic":
+            instflavor = self.eups.flavor
+        if alsoTag is None:
+            alsoTag = []
+
+        defaultProduct = hooks.config.Eups.defaultProduct["name"]
+
+        products = manifest.getProducts()
+        nprods = len(products)
+        #
+        # Find the products that need to be built, and the dependencies of each
+        #
+        setupCmd = {}                   # the setup command for each product, by name
+        order = []                      # the names of the products, in the manifest's order
+        toBuild = {}                    # the products to build, by name
+        for at, prod in enumerate(products):
+            is_product = (prod.product == product and prod.version == version)
+            if depends == self.DEPS_NONE and not is_product:
+                continue
+            elif depends == self.DEPS_ONLY and is_product:
+                continue
+            if setupCmd.has_key(prod.product):
+                continue
+
+            thisinstalled = None
+            if not noeups:
+                thisinstalled = self.eups.findProduct(prod.product, prod.version, flavor=instflavor)
+
+            if thisinstalled:
+                if prod.product == defaultProduct or prod.version == "dummy":
+                    continue
+                msg = "  [ %2d/%-2s ]  %s %s" % (at+1, nprods, prod.product, prod.version)
+                if manifest.mapping and manifest.mapping.noReinstall(prod.product, prod.version, flavor):
+                    if self.verbose >= 0:
+                        print >> self.log, msg + "; manifest.remap specified no reinstall"
+                    continue
+
+                if not self.eups.force:
+                    if self.verbose >= 0:
+                        print >> self.log, msg, "(already installed)"
+                    self._assignTags(prod, thisinstalled.stackRoot(), instflavor, updateTags, alsoTag, opts)
+
+            if not thisinstalled or self.eups.force:
+                pkg = self.findPackage(prod.product, prod.version, prod.flavor)
+                if not pkg:
+                    msg = "Can't find a package for %s %s" % (prod.product, prod.version)
+                    if prod.flavor:
+                        msg += " (%s)" % prod.flavor
+                    raise ServerError(msg)
+
+                pkgroot = pkg[3]
+                dman = self.repos[pkgroot].getManifest(pkg[0], pkg[1], pkg[2])
+                nprod = dman.getDependency(prod.product)
+                if nprod:
+                    prod = nprod
+                deps = [p.product for p in dman.getProducts() if p.product != prod.product]
+
+                toBuild[prod.product] = (at, prod, pkgroot, deps)
+
+            order.append(prod.product)
+            setupCmd[prod.product] = "setup --just --type=build %s %s" % (prod.product, prod.version)
+        #
+        # Build them.  The product's setups are those of the dependencies listed in
+        # the manifest, in its order
+        #
+        def setupsFor(name):
+            deps = toBuild[name][3]
+            return [setupCmd[p] for p in order if p in deps]
+
+        def start(name):
+            at, prod = toBuild[name][:2]
+            if self.verbose >= 0:
+                print >> self.log, "  [ %2d/%-2s ]  %s %s ..." % (at+1, nprods, prod.product, prod.version)
+
+        def build(name):
+            at, prod, pkgroot, deps = toBuild[name]
+            try:
+                self._buildPackage(pkgroot, prod, productRoot, instflavor, opts, setupsFor(name))
+            except Exception, e:
+                print >> self.log, "Failed to build %s %s: %s" % (prod.product, prod.version, e)
+                raise
+
+        def finish(name):
+            at, prod, pkgroot, deps = toBuild[name]
+            self._declarePackage(pkgroot, prod, productRoot, instflavor, opts, noclean, setupsFor(name))
+            self._assignTags(prod, productRoot, instflavor, updateTags, alsoTag, opts)
+            if self.verbose >= 0:
+                print >> self.log, "  [ %2d/%-2s ]  %s %s done." % (at+1, nprods, prod.product, prod.version)
+
+        jobs = [(name, toBuild[name][3]) for name in order if toBuild.has_key(name)]
+        locks = lock.takeProductLocks(productRoot, [name for name, deps in jobs], self.verbose)
+        try:
+            failed, notStarted = runJobs(jobs, njob, build, finish, start, self.log)
+        finally:
+            lock.giveLocks(locks, self.verbose)
+
+        if failed:
+            msg = "Failed to install %s" % ", ".join(["%s %s" % (toBuild[p][1].product, toBuild[p][1].version)
+                                                      for p in failed])
+            if notStarted:
+                msg += "; didn't try to install %s" % ", ".join(notStarted)
+            raise EupsException(msg)
+
     def _doInstall(self, pkgroot, prod, productRoot, instflavor, opts, 
                    noclean, setups, tag):
 
+        # other products in the stack may be installed at the same time
+        locks = lock.takeProductLocks(productRoot, [prod.product], self.verbose)
+        try:
+            self._buildPackage(pkgroot, prod, productRoot, instflavor, opts, setups, tag)
+            self._declarePackage(pkgroot, prod, productRoot, instflavor, opts, noclean, setups)
+        finally:
+            lock.giveLocks(locks, self.verbose)
+
+    def _buildPackage(self, pkgroot, prod, productRoot, instflavor, opts, setups, tag=None):
+        """retrieve and build (or unpack) a product, ready for it to be declared"""
+
         if prod.instDir:
             installdir = prod.instDir
             if not os.path.isabs(installdir):
@@ -620,6 +901,9 @@ class Repositories(object):
         except RuntimeError, e:
             raise e
 
+    def _declarePackage(self, pkgroot, prod, productRoot, instflavor, opts, noclean, setups):
+        """declare a product built by _buildPackage(), and clean up after it"""
+
         # declare the newly installed package, if necessary
         if not instflavor:
             instflavor = opts["flavor"]
@@ -743,6 +1027,7 @@ class Repositories(object):
 
         flavor = self.eups.flavor
 
+        resetSync()                     # the build, maybe in a child process, may have declared it
         prod = self.eups.findProduct(mprod.product, mprod.version, flavor=flavor)
         if prod:
             return
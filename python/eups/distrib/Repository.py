@@ -7,6 +7,7 @@ import eups
 import server 
 from eups.tags      import Tag, TagNotRecognized
 from eups.utils     import Flavor, Quiet, isDbWritable
+from eups.VersionCompare import versionSortKey
 from server         import ServerConf, Manifest, Mapping, TaggedProductList
 from server         import RemoteFileNotFound, LocalTransporter
 from DistribFactory import DistribFactory
@@ -125,12 +126,16 @@ class Repository(object):
         if not self.distServer:
             return dict(_sortOrder=[])
 
-        # Look for both generic and flavor-specific packages
-        pkgs = self.distServer.listAvailableProducts(flavor=self.flavor)
-        if self.flavor != None:
-            for p in self.distServer.listAvailableProducts(flavor=None):
-                if not pkgs.count(p):
-                    pkgs.append(p)
+        # Look for both generic and flavor-specific packages; a package 
+        # index lists every flavor, so one query is enough
+        if self.distServer.getPackageIndex() is not None:
+            pkgs = self.distServer.listAvailableProducts(flavor=None)
+        else:
+            pkgs = self.distServer.listAvailableProducts(flavor=self.flavor)
+            if self.flavor != None:
+                for p in self.distServer.listAvailableProducts(flavor=None):
+                    if not pkgs.count(p):
+                        pkgs.append(p)
         #
         # arrange into a hierarchical lookup
         #
@@ -147,6 +152,7 @@ class Repository(object):
         keys.sort()
         lookup["_sortOrder"] = keys
 
+        versionKey = versionSortKey(self.eups.version_cmp)
         for prod in lookup["_sortOrder"]:
             keys = filter(lambda f: f != "generic", lookup[prod].keys())
             keys.sort()
@@ -155,7 +161,7 @@ class Repository(object):
             lookup[prod]["_sortOrder"] = keys
 
             for flav in lookup[prod]["_sortOrder"]:
-                lookup[prod][flav].sort(self.eups.version_cmp)
+                lookup[prod][flav].sort(key=versionKey)
 
         return lookup
 
@@ -343,10 +349,11 @@ class Repository(object):
         flavors.sort()
         flavors.insert(0, "generic")
         
+        versionKey = versionSortKey(self.eups.version_cmp)
         for name in names:
             for flav in flavors:
                 latest = filter(lambda p: p[0] == name and p[2] == flav, prods)
-                latest.sort(lambda a,b: self.eups.version_cmp(a[1],b[1]))
+                latest.sort(key=lambda p: versionKey(p[1]))
                 out.extend(latest)
 
         return out
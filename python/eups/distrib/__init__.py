@@ -16,6 +16,9 @@ The following Distrib implementations are supported:
   tarball          For products that can be installed by simply un-tarring 
                      a tar-ball file from the server; no compiling or other 
                      "building" required.
+  chunked          Like tarball, but products are stored as files split into
+                     checksummed chunks that are shared between packages, so
+                     only new chunks are uploaded or downloaded.
   pacman           For Pacman distributions (see 
                      http://atlas.bu.edu/~youssef/pacman/.
   builder          Products are built via a download-able Bourne scripts 
@@ -293,6 +293,12 @@ DIST_URL = %%(base)s/builds/%%(path)s
                                                              flavor))
         return os.path.exists(os.path.join(serverDir, "builds", location))
 
+    def getPrefetchFiles(self, location, product, version):
+        """return the files that installPackage() will retrieve from the 
+        server (see Distrib.getPrefetchFiles())
+        """
+        return [(location, product, version, self.Eups.flavor, "build")]
+
     def installPackage(self, location, product, version, productRoot, 
                        installDir, setups=None, buildDir=None):
         """Install a package with a given server location into a given
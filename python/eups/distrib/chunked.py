@@ -0,0 +1,737 @@
+#!/usr/bin/env python
+# -*- python -*-
+#
+# Export a product and its dependencies as a package, or install a
+# product from a package: a specialization for binary packages that are
+# stored as deduplicated, hash-verified chunks
+#
+import sys, os, re, shutil, zlib
+try:
+    import hashlib
+    _sha1 = hashlib.sha1
+except ImportError:                     # python < 2.5
+    import sha
+    _sha1 = sha.new
+
+import eups
+import Distrib as eupsDistrib
+import server as eupsServer
+
+# the size of the pieces that files are split into
+chunkSize = 1024*1024
+
+class FileList(object):
+    """the contents of a product's directory, as stored on a chunked server.
+
+    Each entry is a tuple (type, mode, size, chunks, path) where type is "d"
+    (a directory), "f" (a file) or "l" (a symbolic link); mode is the
+    permission bits (or None for links); size is the size of a file (or None);
+    chunks is the list of the SHA-1 checksums of the chunkSize pieces of a
+    file, or the target of a link; and path is relative to the directory that
+    the product directory is installed into.
+    """
+
+    header = "EUPS chunked package file list. Version 1.0"
+
+    def __init__(self):
+        self.entries = []
+
+    def addDir(self, path, mode):
+        self.entries.append(("d", mode, None, None, path))
+
+    def addFile(self, path, mode, size, chunks):
+        self.entries.append(("f", mode, size, chunks, path))
+
+    def addLink(self, path, target):
+        self.entries.append(("l", None, None, target, path))
+
+    def getChunks(self):
+        """return the checksums of all the chunks needed by the files"""
+        out = []
+        seen = {}
+        for type, mode, size, chunks, path in self.entries:
+            if type == "f":
+                for chunk in chunks:
+                    if not seen.has_key(chunk):
+                        seen[chunk] = 1
+                        out.append(chunk)
+        return out
+
+    # @staticmethod   # requires python 2.4
+    def fileKey(mode, chunks):
+        """return the name that identifies a file with the given mode and
+        contents in an installation's file store"""
+        return _sha1("%o:%s" % (mode, ",".join(chunks))).hexdigest()
+    fileKey = staticmethod(fileKey)
+
+    def write(self, filename):
+        """write the list to a file"""
+        tmpfile = "%s.tmp%d" % (filename, os.getpid())
+        fd = open(tmpfile, "w")
+        try:
+            print >> fd, self.header
+            for type, mode, size, chunks, path in self.entries:
+                if mode is None:
+                    mode = "-"
+                else:
+                    mode = "%04o" % mode
+                if size is None:
+                    size = "-"
+                if chunks is None:
+                    chunks = "-"
+                elif type == "f":
+                    chunks = ",".join(chunks) or "-"
+                print >> fd, "\t".join([type, mode, str(size), chunks, path])
+        finally:
+            fd.close()
+        os.rename(tmpfile, filename)
+
+    # @staticmethod   # requires python 2.4
+    def fromFile(filename):
+        """read a FileList from a file"""
+        fd = open(filename)
+        try:
+            line = fd.readline()
+            if line.strip() != FileList.header:
+                raise RuntimeError("%s is not a chunked package file list" % filename)
+
+            out = FileList()
+            lineno = 1
+            for line in fd:
+                lineno += 1
+                line = line.rstrip("\n")
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    type, mode, size, chunks, path = line.split("\t", 4)
+                except ValueError:
+                    raise RuntimeError("%s:%d: badly formed line" % (filename, lineno))
+
+                if type == "d":
+                    out.addDir(path, int(mode, 8))
+                elif type == "f":
+                    if chunks == "-":
+                        chunks = []
+                    else:
+                        chunks = chunks.split(",")
+                    out.addFile(path, int(mode, 8), int(size), chunks)
+                elif type == "l":
+                    out.addLink(path, chunks)
+                else:
+                    raise RuntimeError("%s:%d: unknown entry type \"%s\"" % (filename, lineno, type))
+        finally:
+            fd.close()
+
+        return out
+    fromFile = staticmethod(fromFile)
+
+class Distrib(eupsDistrib.DefaultDistrib):
+    """A class to encapsulate product distribution as deduplicated chunks
+
+    A product is stored on the server as a file list (see FileList) giving
+    the SHA-1 checksums of the (chunkSize) pieces of each of its files; the
+    pieces themselves are stored, compressed, in a single chunk store below
+    the server directory that is shared by every product and version, so a
+    piece is only uploaded once however many packages contain it.
+
+    When installing, every chunk is verified against its checksum.  The
+    files of installed products are kept in a store below the flavor
+    directory of the product root ("_chunked_"), and installed files are
+    hard links into it; so a file that is identical to one that is already
+    installed is neither downloaded nor copied, and only the chunks that
+    aren't present in some installed file are fetched from the server.
+    Installed files should therefore be treated as read-only.  When a
+    product is removed (e.g. by "eups remove") its file list is dropped from
+    the store, along with the files that no installed product still uses.
+
+    OPTIONS:
+    The behavior of a Distrib class is fine-tuned via options (a dictionary
+    of named values) that are passed in at construction time.  The options
+    supported are:
+       noeups           do not use the local EUPS database for information
+                          while creating packages.
+       obeyGroups       when creating files (other on the user side or the
+                          server side), set group ownership and make group
+                          writable
+       groupowner       when obeyGroups is true, change the group owner of
+                          to this value
+       buildDir         a directory to use to build a package during install.
+                          If this is a relative path, the full path will be
+                          relative to the product root for the installation.
+       linkFiles        if False, copy files out of the installation's file
+                          store rather than making hard links (default: True)
+    """
+
+    NAME = "chunked"
+    PREFIX = "chunked:"
+
+    def __init__(self, Eups, distServ, flavor, tag="current", options=None,
+                 verbosity=0, log=sys.stderr):
+        eupsDistrib.Distrib.__init__(self, Eups, distServ, flavor, tag, options,
+                                     verbosity, log)
+
+    # @staticmethod   # requires python 2.4
+    def parseDistID(distID):
+        """Return a valid package location if and only if we recognize the
+        given distribution identifier
+
+        This implementation return a location if it starts with "chunked:"
+        """
+        if distID:
+            distID = distID.strip()
+            if distID.startswith(Distrib.PREFIX):
+                return distID[len(Distrib.PREFIX):]
+
+        return None
+
+    parseDistID = staticmethod(parseDistID)  # should work as of python 2.2
+
+    def initServerTree(self, serverDir):
+        """initialize the given directory to serve as a package distribution
+        tree.
+        @param serverDir    the directory to initialize
+        """
+        eupsDistrib.DefaultDistrib.initServerTree(self, serverDir)
+
+        for dir in "filelists chunks".split():
+            dir = os.path.join(serverDir, dir)
+            if not os.path.exists(dir):
+                os.makedirs(dir)
+                self.setGroupPerms(dir)
+
+    # @staticmethod   # requires python 2.4
+    def getChunkPath(chunk):
+        """return the path of a chunk, relative to the root of the server"""
+        return "chunks/%s/%s" % (chunk[:2], chunk)
+    getChunkPath = staticmethod(getChunkPath)
+
+    def createPackage(self, serverDir, product, version, flavor=None,
+                      overwrite=False):
+        """Write a package distribution into server directory tree and
+        return the distribution ID
+        @param serverDir      a local directory representing the root of the
+                                  package distribution tree
+        @param product        the name of the product to create the package
+                                distribution for
+        @param version        the name of the product version
+        @param flavor         the flavor of the target platform; this may
+                                be ignored by the implentation
+        @param overwrite      if True, this package will overwrite any
+                                previously existing distribution files even if Eups.force is false
+        """
+        if flavor is None:  flavor = self.Eups.flavor
+        distId = self.getDistIdForPackage(product, version, flavor)
+        location = self.parseDistID(distId)
+        (baseDir, productDir) = self.getProductInstDir(product, version, flavor)
+        if not baseDir:
+            msg = "I don't know how to write a package for %s %s as it has no directory" % (product, version)
+            if self.verbose > 1:
+                print >> self.log, msg
+            return None
+
+        if os.access(os.path.join(serverDir, location), os.R_OK) and not (self.Eups.force or overwrite):
+            if self.verbose > 0:
+                print >> self.log, "Not recreating", location
+            return distId
+
+        if self.verbose > 0:
+            print >> self.log, "Writing", location
+        if self.Eups.noaction:
+            return distId
+
+        self.writeFileList(baseDir, productDir, serverDir, location)
+        self.setGroupPerms(os.path.join(serverDir, location))
+
+        return distId
+
+    def writeFileList(self, baseDir, productDir, serverDir, location):
+        """write the file list for a directory into a server directory, adding
+        any of its chunks that aren't already there to the chunk store.
+        Return the number of chunks that were added.
+        @param baseDir     the directory containing productDir
+        @param productDir  the directory below baseDir to package
+        @param serverDir   the root of the package distribution tree
+        @param location    the path of the file list, relative to serverDir
+        """
+        files = FileList()
+        nnew = 0
+        for dir, dirs, filenames in os.walk(os.path.join(baseDir, productDir)):
+            dirs.sort()
+            filenames.sort()
+            rdir = dir[len(baseDir):].lstrip("/")
+            files.addDir(rdir, os.stat(dir).st_mode & 07777)
+
+            for name in dirs[:]:
+                if os.path.islink(os.path.join(dir, name)):
+                    dirs.remove(name)   # os.walk won't descend into it
+                    filenames.append(name)
+
+            for name in filenames:
+                path = os.path.join(dir, name)
+                rpath = os.path.join(rdir, name)
+                if os.path.islink(path):
+                    files.addLink(rpath, os.readlink(path))
+                    continue
+
+                chunks = []
+                fd = open(path, "rb")
+                try:
+                    while True:
+                        data = fd.read(chunkSize)
+                        if not data:
+                            break
+                        chunk = _sha1(data).hexdigest()
+                        chunks.append(chunk)
+                        if self.writeChunk(serverDir, chunk, data):
+                            nnew += 1
+                finally:
+                    fd.close()
+
+                st = os.stat(path)
+                files.addFile(rpath, st.st_mode & 07777, st.st_size, chunks)
+
+        filename = os.path.join(serverDir, location)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        files.write(filename)
+
+        if self.verbose > 1:
+            print >> self.log, "Added %d new chunks for %s" % (nnew, location)
+
+        return nnew
+
+    def writeChunk(self, serverDir, chunk, data):
+        """add a chunk to the server's chunk store if it isn't already there,
+        returning True if it was added"""
+        filename = os.path.join(serverDir, self.getChunkPath(chunk))
+        if os.path.exists(filename):
+            return False
+
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        tmpfile = "%s.tmp%d" % (filename, os.getpid())
+        fd = open(tmpfile, "wb")
+        try:
+            fd.write(zlib.compress(data))
+        finally:
+            fd.close()
+        os.rename(tmpfile, filename)
+        self.setGroupPerms(filename)
+
+        return True
+
+    def packageCreated(self, serverDir, product, version, flavor=None):
+        """return True if a distribution package for a given product has
+        apparently been deployed into the given server directory.
+        @param serverDir      a local directory representing the root of the
+                                  package distribution tree
+        @param product        the name of the product to create the package
+                                distribution for
+        @param version        the name of the product version
+        @param flavor         the flavor of the target platform; this may
+                                be ignored by the implentation.  None means
+                                that the status of a non-flavor-specific package
+                                is of interest, if supported.
+        """
+        location = self.parseDistID(self.getDistIdForPackage(product, version, flavor))
+        return os.path.exists(os.path.join(serverDir, location))
+
+    def getDistIdForPackage(self, product, version, flavor=None):
+        """return the distribution ID that for a package distribution created
+        by this Distrib class (via createPackage())
+        @param product        the name of the product to create the package
+                                distribution for
+        @param version        the name of the product version
+        @param flavor         the flavor of the target platform; this may
+                                be ignored by the implentation
+        """
+        if not flavor:  flavor = self.flavor
+        return "%sfilelists/%s-%s@%s.files" % (self.PREFIX, product, version, flavor)
+
+    def getPrefetchFiles(self, location, product, version):
+        """return the files that installPackage() will retrieve from the
+        server (see Distrib.getPrefetchFiles()).  The chunks aren't included
+        as we don't know which are needed until we've read the file list.
+        """
+        return [(location, product, version, self.Eups.flavor, "dist")]
+
+    def installPackage(self, location, product, version, productRoot,
+                       installDir=None, setups=None, buildDir=None):
+        """Install a package with a given server location into a given
+        product directory tree.
+        @param location     the location of the package on the server.  This
+                               value is a distribution ID (distID) that has
+                               been stripped of its build type prefix.
+        @param product      the name of the product installed by the package.
+        @param version      the name of the product version.
+        @param productRoot  the product directory tree under which the
+                               product should be installed
+        @param installDir   the preferred sub-directory under the productRoot
+                               to install the directory.  This value, which
+                               should be a relative path name, may be
+                               ignored or over-ridden
+        @param setups       a list of EUPS setup commands that should be run
+                               to properly build this package.  This is
+                               ignored.
+        """
+        if not location:
+            raise RuntimeError, ("Expected a file list name; saw \"%s\"" % location)
+
+        if not buildDir:
+            buildDir = self.getOption('buildDir', 'EupsBuildDir')
+
+        unpackDir = os.path.join(productRoot, self.Eups.flavor)
+        if installDir and installDir != "none":
+            try:
+                (baseDir, pdir, vdir) = re.search(r"^(\S+)/([^/]+)/([^/]+)$",
+                                                  installDir).groups()
+                unpackDir = os.path.join(unpackDir,baseDir)
+            except AttributeError, e:
+                pass
+
+        if self.verbose > 0:
+            print >> self.log, "installing %s into %s" % (location, unpackDir)
+        if self.Eups.noaction:
+            return
+
+        if not os.path.exists(buildDir):
+            os.makedirs(buildDir)
+        lfile = self.distServer.getFileForProduct(location, product, version, self.Eups.flavor,
+                                                  ftype="dist",
+                                                  filename=os.path.join(buildDir, os.path.basename(location)))
+        files = FileList.fromFile(lfile)
+
+        store = FileStore(os.path.join(productRoot, self.Eups.flavor, "_chunked_"))
+        self.installFiles(files, store, unpackDir, product, version, buildDir)
+        store.addFileList(lfile, os.path.basename(location))
+
+        if installDir and installDir != "none":
+            installDir = os.path.join(productRoot, self.Eups.flavor, installDir)
+        else:
+            installDir = os.path.join(unpackDir, product, version)
+        if os.path.exists(installDir):
+            self.setGroupPerms(installDir)
+
+    def installFiles(self, files, store, unpackDir, product, version, buildDir):
+        """install the contents of a FileList into a directory, via a FileStore
+        @param files       the FileList to install
+        @param store       the FileStore for the installation
+        @param unpackDir   the directory that the files' paths are relative to
+        @param product     the product that the files belong to
+        @param version     the product's version
+        @param buildDir    a directory to download chunks into
+        """
+        if not os.path.exists(unpackDir):
+            os.makedirs(unpackDir)
+        #
+        # Find the chunks that aren't available locally, and fetch them in parallel
+        #
+        local = store.findChunks(product)
+        needed = []
+        for type, mode, size, chunks, path in files.entries:
+            if type == "f" and not store.hasFile(FileList.fileKey(mode, chunks)):
+                needed += [c for c in chunks if not local.has_key(c)]
+        needed = dict([(c, 1) for c in needed]).keys()
+
+        if self.verbose > 0:
+            print >> self.log, "Fetching %d of the %d chunks of %s %s" % \
+                (len(needed), len(files.getChunks()), product, version)
+        self.distServer.prefetch([(self.getChunkPath(c), product, version, self.Eups.flavor, "dist")
+                                  for c in needed])
+
+        def getChunk(chunk):
+            if local.has_key(chunk):
+                data = store.readChunk(chunk, *local[chunk])
+                if data is not None:
+                    return data
+            return self.fetchChunk(chunk, product, version, os.path.join(buildDir, chunk))
+
+        linkFiles = self.getOption("linkFiles", True)
+        realUnpackDir = os.path.realpath(unpackDir)
+        for type, mode, size, chunks, path in files.entries:
+            dest = self.getInstallPath(type, path, unpackDir, realUnpackDir)
+            if type == "d":
+                if not os.path.isdir(dest):
+                    os.makedirs(dest)
+                os.chmod(dest, mode)
+                continue
+
+            if os.path.islink(dest) or os.path.exists(dest):
+                os.unlink(dest)
+            if type == "l":
+                os.symlink(chunks, dest)
+                continue
+
+            key = FileList.fileKey(mode, chunks)
+            if not store.verifyFile(key, chunks):
+                contents = {}
+                for c in chunks:
+                    if not contents.has_key(c):
+                        contents[c] = getChunk(c)
+                store.addFile(key, mode, [contents[c] for c in chunks])
+            store.installFile(key, dest, linkFiles)
+
+    def getInstallPath(self, type, path, unpackDir, realUnpackDir):
+        """return where to install a FileList entry, raising RuntimeError if
+        its path (which comes from the server) would put it outside unpackDir:
+        if it is absolute, contains "..", or leads through a symbolic link
+        (e.g. one installed by an earlier entry) to outside unpackDir.
+        @param type           the entry's type ("d", "f", or "l")
+        @param path           the entry's path
+        @param unpackDir      the directory that the paths are relative to
+        @param realUnpackDir  os.path.realpath(unpackDir)
+        """
+        npath = os.path.normpath(path)
+        if os.path.isabs(npath) or npath == os.pardir or npath.startswith(os.pardir + os.sep):
+            raise RuntimeError("Refusing to install %s outside %s" % (path, unpackDir))
+
+        dest = os.path.join(unpackDir, npath)
+        if type == "d":
+            real = os.path.realpath(dest)
+        else:                           # a link at dest itself is replaced, not written through
+            real = os.path.join(os.path.realpath(os.path.dirname(dest)), os.path.basename(dest))
+        if real != realUnpackDir and not real.startswith(realUnpackDir + os.sep):
+            raise RuntimeError("Refusing to install %s via a symbolic link to %s" % (path, real))
+
+        return dest
+
+    def fetchChunk(self, chunk, product, version, tmpfile):
+        """retrieve a chunk from the server and return its (verified) contents
+        @param tmpfile   the file to download the chunk to; it's deleted
+                           once it's been read
+        """
+        tmpfile = self.distServer.getFileForProduct(self.getChunkPath(chunk), product, version,
+                                                    self.Eups.flavor, ftype="dist", filename=tmpfile)
+        try:
+            fd = open(tmpfile, "rb")
+            try:
+                data = zlib.decompress(fd.read())
+            finally:
+                fd.close()
+        finally:
+            try:
+                os.unlink(tmpfile)
+            except OSError:
+                pass
+
+        if _sha1(data).hexdigest() != chunk:
+            raise RuntimeError("Chunk %s from server is corrupted" % chunk)
+
+        return data
+
+class FileStore(object):
+    """the files installed from chunked packages into a product root.
+
+    The store's directory contains the files themselves, named by
+    FileList.fileKey() (files/ab/abcd...), and a copy of the file list of
+    each installed package (lists/), used to find chunks that can be read
+    from installed files rather than downloaded.  As the installed files are
+    hard links to the store's, shared by every product version containing
+    them, they are read-only.
+
+    When a product version is removed its file list should be dropped
+    (removeFileList()) and the store pruned (prune()), which deletes the
+    files that are no longer installed anywhere; removeProduct() does both.
+    """
+
+    def __init__(self, storeDir):
+        self.storeDir = storeDir
+
+    def _filePath(self, key):
+        return os.path.join(self.storeDir, "files", key[:2], key)
+
+    def hasFile(self, key):
+        return os.path.exists(self._filePath(key))
+
+    def verifyFile(self, key, chunks):
+        """return True if the store has a file with the given key and
+        contents; a corrupted file is removed"""
+        filename = self._filePath(key)
+        try:
+            fd = open(filename, "rb")
+        except IOError:
+            return False
+        try:
+            ok = True
+            for chunk in chunks:
+                if _sha1(fd.read(chunkSize)).hexdigest() != chunk:
+                    ok = False
+                    break
+            if ok and fd.read(1):
+                ok = False
+        finally:
+            fd.close()
+
+        if not ok:
+            os.unlink(filename)
+        return ok
+
+    def addFile(self, key, mode, data):
+        """add a file to the store
+        @param key     the file's key (see FileList.fileKey())
+        @param mode    the file's permissions
+        @param data    a list of the file's chunks
+        """
+        filename = self._filePath(key)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        tmpfile = "%s.tmp%d" % (filename, os.getpid())
+        fd = open(tmpfile, "wb")
+        try:
+            for d in data:
+                fd.write(d)
+        finally:
+            fd.close()
+        os.chmod(tmpfile, mode & ~0222)
+        os.rename(tmpfile, filename)
+
+    def installFile(self, key, dest, link=True):
+        """make a file in the store appear at dest, as a hard link if
+        possible (and requested), otherwise as a copy"""
+        filename = self._filePath(key)
+        mode = os.stat(filename).st_mode
+        if mode & 0222:                 # e.g. made before files were read-only
+            os.chmod(filename, mode & ~0222)
+        if link:
+            try:
+                os.link(filename, dest)
+                return
+            except OSError:             # e.g. on a different filesystem
+                pass
+        shutil.copy2(filename, dest)
+
+    def addFileList(self, filename, name):
+        """save a copy of an installed package's file list"""
+        listDir = os.path.join(self.storeDir, "lists")
+        if not os.path.isdir(listDir):
+            os.makedirs(listDir)
+        shutil.copyfile(filename, os.path.join(listDir, name))
+
+    def removeFileList(self, product, version):
+        """drop the file list(s) of an installed product version; return
+        True if there were any"""
+        listDir = os.path.join(self.storeDir, "lists")
+        if not os.path.isdir(listDir):
+            return False
+
+        found = False
+        prefix = "%s-%s@" % (product, version)
+        for name in os.listdir(listDir):
+            if name.startswith(prefix) and name.endswith(".files"):
+                os.unlink(os.path.join(listDir, name))
+                found = True
+        return found
+
+    def prune(self):
+        """delete the files in the store that aren't installed anywhere:
+        those with no other hard links, or that no file list mentions.
+        Return the number of files deleted.
+
+        N.b. this shouldn't be run while packages are being installed into
+        the store, as a file may be added a moment before it's linked
+        """
+        filesDir = os.path.join(self.storeDir, "files")
+        if not os.path.isdir(filesDir):
+            return 0
+
+        mentioned = {}
+        listDir = os.path.join(self.storeDir, "lists")
+        if os.path.isdir(listDir):
+            for name in os.listdir(listDir):
+                try:
+                    files = FileList.fromFile(os.path.join(listDir, name))
+                except (IOError, RuntimeError):
+                    continue
+                for type, mode, size, chunks, path in files.entries:
+                    if type == "f":
+                        mentioned[FileList.fileKey(mode, chunks)] = 1
+
+        nremoved = 0
+        for subdir in os.listdir(filesDir):
+            subdir = os.path.join(filesDir, subdir)
+            for key in os.listdir(subdir):
+                filename = os.path.join(subdir, key)
+                if re.search(r"\.tmp\d+$", key): # being written by addFile()
+                    continue
+                try:
+                    if os.stat(filename).st_nlink > 1 and mentioned.has_key(key):
+                        continue
+                    os.unlink(filename)
+                    nremoved += 1
+                except OSError:
+                    pass
+            try:
+                os.rmdir(subdir)        # only succeeds if it's now empty
+            except OSError:
+                pass
+
+        return nremoved
+
+    def findChunks(self, product=None):
+        """return a dictionary mapping the checksums of the chunks of the
+        files in the store to (key, offset, size) for one of the files that
+        contain them
+        @param product   only look at the file lists of versions of this
+                           product
+        """
+        listDir = os.path.join(self.storeDir, "lists")
+        if not os.path.isdir(listDir):
+            return {}
+
+        out = {}
+        for name in os.listdir(listDir):
+            if product and not name.startswith(product + "-"):
+                continue
+            try:
+                files = FileList.fromFile(os.path.join(listDir, name))
+            except (IOError, RuntimeError):
+                continue
+
+            for type, mode, size, chunks, path in files.entries:
+                if type != "f":
+                    continue
+                key = FileList.fileKey(mode, chunks)
+                if not self.hasFile(key):
+                    continue
+                for i, chunk in enumerate(chunks):
+                    if not out.has_key(chunk):
+                        out[chunk] = (key, i*chunkSize, min(chunkSize, size - i*chunkSize))
+
+        return out
+
+    def readChunk(self, chunk, key, offset, size):
+        """return a chunk read from a file in the store, or None if the file
+        doesn't contain it"""
+        try:
+            fd = open(self._filePath(key), "rb")
+        except IOError:
+            return None
+        try:
+            fd.seek(offset)
+            data = fd.read(size)
+        finally:
+            fd.close()
+
+        if _sha1(data).hexdigest() != chunk:
+            return None
+        return data
+
+def removeProduct(productRoot, flavor, product, version):
+    """forget an installed product version in the chunked file store of a
+    product root (if there is one), deleting the files that are no longer
+    used by any installed product; this should be called when the product
+    has been removed.  Return the number of files deleted.
+    @param productRoot  the product root (stack) the product was installed in
+    @param flavor       the flavor the product was installed for
+    @param product      the name of the product
+    @param version      the name of the product version
+    """
+    storeDir = os.path.join(productRoot, flavor, "_chunked_")
+    if not os.path.isdir(storeDir):
+        return 0
+
+    store = FileStore(storeDir)
+    store.removeFileList(product, version)
+    return store.prune()
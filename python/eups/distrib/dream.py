@@ -85,6 +85,10 @@ class DreamServer(DistribServer):
     def getTaggedProductList(self, tag="current", flavor=None, noaction=False):
         return list()
 
+    def getPackageIndex(self, noaction=False):
+        # We can't index products that we've yet to dream about
+        return None
+
     def listAvailableProducts(self, product=None, version=None, flavor=None,
                               tag=None, noaction=False):
         products = list()
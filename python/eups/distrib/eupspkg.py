@@ -883,6 +883,12 @@ TAGLIST_DIR = tags
         location = self.parseDistID(self.getDistIdForPackage(product, version, flavor))
         return os.path.exists(os.path.join(serverDir, "products", location))
 
+    def getPrefetchFiles(self, location, product, version):
+        """return the files that installPackage() will retrieve from the 
+        server (see Distrib.getPrefetchFiles())
+        """
+        return [(location, product, version, self.Eups.flavor, "eupspkg")]
+
     def installPackage(self, location, product, version, productRoot, 
                        installDir, setups=None, buildDir=None):
         """Install a package with a given server location into a given
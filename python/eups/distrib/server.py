@@ -6,14 +6,25 @@ classes for communicating with a remote package server
 import sys, os, re, atexit, shutil
 import fnmatch
 import tempfile
-import urllib2
+import threading
+import thread
+import httplib, socket, urllib, urllib2, urlparse
+import email.Utils
+try:
+    import hashlib
+    _md5 = hashlib.md5
+except ImportError:                     # python < 2.5
+    import md5
+    _md5 = md5.new
 import eups
 import eups.hooks as hooks
 import eups.utils as utils
 
 from eups.exceptions import EupsException
+from eups.stack import resetSync
 
 serverConfigFilename = "config.txt"
+packageIndexFilename = "packages.index"
 BASH = "/bin/bash"    # see end of this module where we look for bash
 
 class DistribServer(object):
@@ -39,6 +50,15 @@ class DistribServer(object):
     """
     NOCACHE = False
 
+    # files downloaded by prefetch(), looked up by source URL.  The values
+    # are the local copies or, for files that weren't found, the exception
+    _prefetched = {}
+    _prefetching = False
+
+    # the server's PackageIndex; None if not yet retrieved, False if the
+    # server doesn't provide one
+    _packageIndex = None
+
     def __init__(self, packageBase, config=None, verbosity=0, log=sys.stderr):
         """create a server communicator
         @param packageBase   the base URL for the server
@@ -233,7 +253,8 @@ class DistribServer(object):
         If they differ, it will be in that the getTaggedProductList() results
         contains additional information for one or more products.  
 
-        This implementation will end up reading every manifest file available
+        Unless the server provides a package index (see getPackageIndex()),
+        this implementation will end up reading every manifest file available
         on the server.  Sub-classes should do something more efficient.
 
         @param product     the desired product name
@@ -252,6 +273,8 @@ class DistribServer(object):
                         out += [(val[0], val[2], val[1])]
             except ServerNotResponding, e:
                 print >> self.log, e
+        elif self.getPackageIndex(noaction) is not None:
+            out = self.getPackageIndex().getProducts(product, version, flavor, tag)
         else:
             files = self.listFiles("manifests", flavor, tag)
             for file in files:
@@ -271,6 +294,53 @@ class DistribServer(object):
 
         return out
 
+    def getPackageIndex(self, noaction=False):
+        """return the server's PackageIndex, or None if it doesn't provide 
+        one.  The index is retrieved at most once by each DistribServer, and
+        a copy is kept in the user's data directory so that it is only 
+        downloaded again when it has changed.
+        @param noaction    if True, don't retrieve the index
+        """
+        if self._packageIndex is None and not noaction:
+            self._packageIndex = False
+
+            src = self.getPackageIndexURL()
+            cached = utils.userServerCacheDir()
+            if cached:
+                cached = os.path.join(cached, re.sub(r"^\w+://", "", src).lstrip("/"))
+            try:
+                trx = makeTransporter(src, self.verbose-1, self.log)
+                if cached:
+                    if not os.path.isdir(os.path.dirname(cached)):
+                        os.makedirs(os.path.dirname(cached))
+                    if trx.updateFile(cached) and self.verbose > 1:
+                        print >> self.log, "Updated cached package index", cached
+                    filename = cached
+                else:
+                    filename = self.makeTempFile("index_")
+                    trx.cacheToFile(filename)
+
+                self._packageIndex = PackageIndex.fromFile(filename, self.verbose-1, self.log)
+            except RemoteFileNotFound:
+                if cached and os.path.exists(cached):
+                    os.remove(cached)
+            except (TransporterError, OSError, IOError), e:
+                if self.verbose > 0:
+                    print >> self.log, "Unable to retrieve package index from %s: %s" % (src, e)
+            except RuntimeError, e:
+                print >> self.log, "Ignoring package index from %s: %s" % (src, e)
+
+        return self._packageIndex or None
+
+    def getPackageIndexURL(self):
+        """return the location of the server's package index (see 
+        PackageIndex).  This is given by the PACKAGE_INDEX_URL configuration
+        property, defaulting to "%(base)s/packages.index".
+        """
+        tmpl = self.getConfigProperty("PACKAGE_INDEX_URL",
+                                      "%(base)s/" + packageIndexFilename)
+        return tmpl % { "base": self.base }
+
     def getFile(self, path, flavor=None, tag=None, ftype=None, 
                 filename=None, noaction=False):
         """return a copy of a file with a given path on the server.  The 
@@ -354,16 +424,94 @@ class DistribServer(object):
         @param source      the name of the remote file to obtain a copy of 
         @param noaction    if True, simulate the retrieval
         """
-        trx = makeTransporter(source, self.verbose-1, self.log)
-
         # make sure we can write to destination
         parent = os.path.dirname(filename)
         if parent and not os.path.isdir(parent):
             os.makedirs(parent)
 
-        trx.cacheToFile(filename, noaction=noaction)
+        if not self._prefetching and not noaction and self._prefetched.has_key(source):
+            prefetched = self._prefetched[source]
+            if isinstance(prefetched, Exception):
+                raise prefetched
+            copyfile(prefetched, filename)
+            return filename
+
+        trx = makeTransporter(source, self.verbose-1, self.log)
+
+        cache = None
+        if not noaction and not self.NOCACHE:
+            cache = DownloadCache.get()
+
+        try:
+            if cache:
+                try:
+                    cache.cacheToFile(trx, filename)
+                except (IOError, OSError), e:
+                    if self.verbose > 0:
+                        print >> self.log, "Unable to use download cache for %s: %s" % (source, e)
+                    trx.cacheToFile(filename)
+            else:
+                trx.cacheToFile(filename, noaction=noaction)
+        except RemoteFileNotFound, e:
+            if self._prefetching:
+                self._prefetched[source] = e
+            raise
+
+        if self._prefetching:
+            self._prefetched[source] = filename
         return filename
 
+    def prefetch(self, files, nthread=4):
+        """download a set of files in parallel, so that later requests for 
+        them (via getFileForProduct()) are satisfied without contacting the
+        server.  Only files on web servers are prefetched, and failures are 
+        ignored (they will be reported when the file is requested).  
+        @param files     a list of (path, product, version, flavor, ftype) 
+                           tuples, giving the arguments to getFileForProduct()
+        @param nthread   the maximum number of simultaneous downloads
+        """
+        if not WebTransporter.canHandle(self.base) or nthread < 1:
+            return
+
+        files = list(files)
+        lock = threading.Lock()
+        self._prefetched = self._prefetched.copy()
+
+        def fetch():
+            while True:
+                lock.acquire()
+                try:
+                    if not files:
+                        return
+                    path, product, version, flavor, ftype = files.pop(0)
+                finally:
+                    lock.release()
+
+                try:
+                    self.getFileForProduct(path, product, version, flavor, ftype,
+                                           filename=self.makeTempFile("prefetch_"))
+                except Exception, e:
+                    if self.verbose > 1:
+                        print >> self.log, "Failed to prefetch %s %s %s: %s" % \
+                            (product, version, path or ftype, e)
+
+        self._prefetching = True
+        try:
+            threads = [threading.Thread(target=fetch) for i in range(min(nthread, len(files)))]
+            for t in threads:
+                t.setDaemon(True)
+                t.start()
+                _prefetchThreads.append(t)
+            for t in threads:
+                while t.isAlive():
+                    t.join(1)           # allow ^C to interrupt us
+        finally:
+            self._prefetching = False
+
+    def clearPrefetched(self):
+        """forget the files downloaded by prefetch()"""
+        self._prefetched = {}
+
     def getConfigFile(self, filename=None, noaction=False):
         """return a file that is a copy of the Distrib configuration retrieved
         from the server.
@@ -473,7 +621,7 @@ class ConfigurableDistribServer(DistribServer):
                        "BUILD_URL", "EUPSPKG_URL", "MANIFEST_URL", "TABLE_URL", "LIST_URL",
                        "PRODUCT_FILE_URL", "FILE_URL", "DIST_URL",
                        "MANIFEST_DIR_URL", "MANIFEST_FILE_RE", "TARBALL_URL",
-                       "PREFER_GENERIC", ]
+                       "PACKAGE_INDEX_URL", "TARBALL_COMPRESSION", "PREFER_GENERIC", ]
 
     def _initConfig_(self):
         DistribServer._initConfig_(self)
@@ -755,7 +903,7 @@ class ConfigurableDistribServer(DistribServer):
         If they differ, it will be in that the getTaggedProductList() results
         contains additional information for one or more records.  
 
-        This implementation has three possible ways of retrieving this 
+        This implementation has four possible ways of retrieving this 
         information; each is tried in order until success:
           1) if both flavor and tag are specified, this function will 
                call getTaggedProductInfo()
@@ -764,7 +912,9 @@ class ConfigurableDistribServer(DistribServer):
                text file (MIME type: text/plain) in which line gives an 
                available product's name, version, and flavor (delimited by
                spaces).  This is parsed and returned.
-          3) if the MANIFEST_DIR config parameter is set, it will be 
+          3) if the server provides a package index (see getPackageIndex()),
+               the products are looked up in it.
+          4) if the MANIFEST_DIR config parameter is set, it will be 
                be used as a template to create a path to a directory on 
                the server containing all manifest files.  A file listing
                is obtained by calling self.listFiles(path, None, None).
@@ -813,6 +963,10 @@ class ConfigurableDistribServer(DistribServer):
             except TransporterError:
                 pass
 
+        index = self.getPackageIndex(noaction)
+        if index is not None:
+            return index.getProducts(product, version, flavor, tag)
+
         filere = self.getConfigProperty("MANIFEST_FILE_RE")
         if filere is not None:
             filere = re.compile(filere)
@@ -926,6 +1080,43 @@ class Transporter(object):
         """
         self.unimplemented("cacheToFile");
 
+    def updateFile(self, filename, noaction=False):
+        """bring a local copy of the source up to date, returning True if 
+        the file was (re)written or False if it was already current.  
+
+        This implementation always copies the source; subclasses that can
+        tell whether the source has changed should override it.
+        @param filename      the name of the local copy
+        @param noaction      if True, simulate the result (default: False)
+        """
+        self.cacheToFile(filename, noaction)
+        return True
+
+    def getValidators(self):
+        """return a dictionary of values that change whenever the source 
+        does (e.g. its size and modification time), or None if they cannot
+        be determined.  
+
+        This implementation returns None.
+        """
+        return None
+
+    def cacheToFileIfChanged(self, filename, validators=None):
+        """cache the source to a local file unless it is unchanged since 
+        a copy with the given validators was made.  Returns the source's 
+        current validators (see getValidators()), and whether the file was 
+        written.  
+        @param filename      the name of the file to cache to
+        @param validators    the validators of an existing copy of the 
+                               source, or None
+        """
+        current = self.getValidators()
+        if current and current == validators:
+            return validators, False
+
+        self.cacheToFile(filename)
+        return current, True
+
     def listDir(self, noaction=False):
         """interpret the source as a directory and return a list of files
         it contains
@@ -948,6 +1139,12 @@ class WebTransporter(Transporter):
 
     canHandle = staticmethod(canHandle)  # should work as of python 2.2
 
+    # the size of the blocks in which files are copied to disk
+    chunkSize = 64*1024
+
+    # the maximum number of redirections to follow
+    maxRedirects = 5
+
     def cacheToFile(self, filename, noaction=False):
         """cache the source to a local file
         @param filename      the name of the file to cache to
@@ -960,23 +1157,186 @@ class WebTransporter(Transporter):
             if self.verbose > 0:
                 system("touch " + filename)
                 print >> self.log, "Simulated web retrieval from", self.loc
-        else:
-            url = None
-            out = None
+            return
+
+        try:
+            if self._canUsePool():
+                self._httpToFile(self.loc, filename, self.maxRedirects)
+            else:
+                self._urlToFile(self.loc, filename)
+        except KeyboardInterrupt:
+            raise EupsException("^C")
+
+    def updateFile(self, filename, noaction=False):
+        """bring a local copy of the source up to date, returning True if 
+        the file was (re)written or False if it was already current.  For 
+        http URLs the file is only downloaded if the server's copy has been
+        modified since the local one was written.  
+        @param filename      the name of the local copy
+        @param noaction      if True, simulate the result (default: False)
+        """
+        if noaction or not self._canUsePool():
+            self.cacheToFile(filename, noaction)
+            return True
+
+        modified = None
+        if os.path.exists(filename):
+            modified = os.stat(filename).st_mtime
+
+        tmpfile = "%s.tmp%d" % (filename, os.getpid())
+        try:
             try:
-                try:                               # for python 2.4 compat
-                    url = urllib2.urlopen(self.loc)
-                    out = open(filename, 'w')
-                    out.write(url.read())
-                except urllib2.HTTPError:
-                    raise RemoteFileNotFound("Failed to open URL %s" % self.loc)
-                except urllib2.URLError:
-                    raise ServerNotResponding("Failed to contact URL %s" % self.loc)
-                except KeyboardInterrupt:
-                    raise EupsException("^C")
-            finally: 
-                if url is not None: url.close()
-                if out is not None: out.close()
+                updated = self._httpToFile(self.loc, tmpfile, self.maxRedirects, modified)
+                if updated:
+                    os.rename(tmpfile, filename)
+            except KeyboardInterrupt:
+                raise EupsException("^C")
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+        return updated
+
+    def cacheToFileIfChanged(self, filename, validators=None):
+        """cache the source to a local file unless it is unchanged since 
+        a copy with the given validators was made.  Returns the source's 
+        current validators (its ETag and Last-Modified time), and whether 
+        the file was written.  For http URLs the check and the download 
+        are made with a single conditional request.
+        @param filename      the name of the file to cache to
+        @param validators    the validators of an existing copy of the 
+                               source, or None
+        """
+        if not self._canUsePool():
+            return Transporter.cacheToFileIfChanged(self, filename, validators)
+
+        if validators is None:
+            validators = {}
+        try:
+            updated = self._httpToFile(self.loc, filename, self.maxRedirects,
+                                       validators.get("lastModified"), validators.get("etag"))
+        except KeyboardInterrupt:
+            raise EupsException("^C")
+
+        if not updated:
+            return validators, False
+        return self.validators, True
+
+    def _canUsePool(self):
+        """return True if we can fetch the source over a pooled connection"""
+        return self.loc.startswith("http://") and not urllib.getproxies().has_key("http")
+
+    def _urlToFile(self, loc, filename):
+        """copy a URL to a file using urllib2 (so honouring any proxy settings)"""
+        url = None
+        try:
+            try:                               # for python 2.4 compat
+                url = urllib2.urlopen(loc)
+            except urllib2.HTTPError:
+                raise RemoteFileNotFound("Failed to open URL %s" % loc)
+            except urllib2.URLError:
+                raise ServerNotResponding("Failed to contact URL %s" % loc)
+
+            self._copyToFile(url, filename, loc)
+        finally: 
+            if url is not None: url.close()
+
+        return True
+
+    def _httpToFile(self, loc, filename, maxRedirects, modified=None, etag=None):
+        """copy an http URL to a file over a pooled (keep-alive) connection, 
+        returning True if it was copied.  If modified or etag is provided, it
+        is the modification time or ETag of an existing copy; the URL is then
+        only copied if it has changed.  The file is given the URL's 
+        modification time, if the server reports it.  The server's validators
+        for the URL are saved in self.validators (see getValidators()).
+        """
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(loc)
+        if query:
+            path += "?" + query
+        self.validators = {}
+
+        headers = {"Connection" : "keep-alive"}
+        if modified is not None:
+            headers["If-Modified-Since"] = email.Utils.formatdate(modified, usegmt=True)
+        if etag is not None:
+            headers["If-None-Match"] = etag
+
+        while True:
+            conn, reused = _connectionPool.get(netloc)
+            try:
+                conn.request("GET", path or "/", headers=headers)
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if not reused:  # a kept-alive connection may have been closed by the server; retry
+                    raise ServerNotResponding("Failed to contact URL %s" % loc, e)
+
+        try:
+            if response.status in (301, 302, 303, 307) and response.getheader("location"):
+                response.read()
+                _connectionPool.release(netloc, conn, response)
+                conn = None
+
+                if maxRedirects <= 0:
+                    raise RemoteFileNotFound("Too many redirections for URL %s" % self.loc)
+                loc = urlparse.urljoin(loc, response.getheader("location"))
+                if loc.startswith("http://"):
+                    return self._httpToFile(loc, filename, maxRedirects - 1, modified, etag)
+                return self._urlToFile(loc, filename)
+
+            if (modified is not None or etag is not None) and response.status == 304:
+                response.read()
+                _connectionPool.release(netloc, conn, response)
+                conn = None
+                return False
+
+            if response.status != 200:
+                response.read()
+                _connectionPool.release(netloc, conn, response)
+                conn = None
+                raise RemoteFileNotFound("Failed to open URL %s (%s %s)" %
+                                         (loc, response.status, response.reason))
+
+            if response.getheader("etag"):
+                self.validators["etag"] = response.getheader("etag")
+            lastModified = response.getheader("last-modified")
+            if lastModified:
+                lastModified = email.Utils.parsedate_tz(lastModified)
+            if lastModified:
+                lastModified = email.Utils.mktime_tz(lastModified)
+                self.validators["lastModified"] = lastModified
+
+            if (etag is not None and self.validators.get("etag") == etag) or \
+               (modified is not None and lastModified == int(modified)):
+                return False    # the server ignored our conditions; drop the connection
+
+            self._copyToFile(response, filename, loc)
+            _connectionPool.release(netloc, conn, response)
+            conn = None
+
+            if lastModified:
+                os.utime(filename, (lastModified, lastModified))
+        finally:
+            if conn is not None: conn.close()
+
+        return True
+
+    def _copyToFile(self, fd, filename, loc):
+        """copy an open URL to a file in chunks, rather than reading it all into memory"""
+        out = open(filename, 'w')
+        try:
+            try:
+                while True:
+                    chunk = fd.read(self.chunkSize)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+            except (httplib.HTTPException, socket.error), e:
+                raise ServerNotResponding("Failed to read URL %s" % loc, e)
+        finally:
+            out.close()
 
     def listDir(self, noaction=False):
         """interpret the source as a directory and return a list of files
@@ -1060,6 +1420,89 @@ class WebTransporter(Transporter):
         
         
 
+class _ConnectionPool(object):
+    """
+    a pool of open (keep-alive) http connections, so that fetching many files 
+    from a server doesn't pay for a new connection each time.  The pool may
+    be used from several threads.
+    """
+
+    # the maximum number of idle connections kept open to each server
+    maxIdle = 8
+
+    def __init__(self):
+        self._idle = {}                 # idle connections, looked up by host:port
+        self._lock = threading.Lock()
+
+    def get(self, netloc):
+        """
+        return a tuple of an http connection to netloc and whether it has been used before
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(netloc)
+            if idle:
+                return idle.pop(), True
+        finally:
+            self._lock.release()
+
+        return httplib.HTTPConnection(netloc), False
+
+    def release(self, netloc, conn, response):
+        """
+        return a connection to the pool, once its response has been read
+        """
+        if response.will_close:
+            conn.close()
+            return
+
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(netloc, [])
+            if len(idle) < self.maxIdle:
+                idle.append(conn)
+                conn = None
+        finally:
+            self._lock.release()
+
+        if conn is not None:
+            conn.close()
+
+    def clear(self):
+        """close all idle connections"""
+        self._lock.acquire()
+        try:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+_connectionPool = _ConnectionPool()
+
+# the threads started by DistribServer.prefetch(), which may still be running if it was interrupted
+_prefetchThreads = []
+
+def prepareToFork():
+    """
+    wait for any prefetch threads to finish, so that a child process 
+    doesn't inherit a lock that one of them holds
+    """
+    while _prefetchThreads:
+        t = _prefetchThreads.pop()
+        while t.isAlive():
+            t.join(1)                   # allow ^C to interrupt us
+
+def afterFork():
+    """
+    call in a child process just after it was forked, so that it doesn't 
+    share the parent's idle http connections.  The inherited connections 
+    are dropped without sending anything on them.
+    """
+    global _connectionPool
+    _connectionPool = _ConnectionPool()
+
 class SshTransporter(Transporter):
 
     def __init__(self, source, verbosity=0, log=sys.stderr):
@@ -1103,6 +1546,31 @@ class SshTransporter(Transporter):
             else:
                 print >> self.log, "scp from", self.remfile
 
+    def getValidators(self):
+        """return the size and modification time of the remote file, or None
+        if they cannot be determined (e.g. because the remote stat command
+        isn't GNU's)
+        """
+        if re.search(r'[;,&\|"\']', self.remfile):
+            return None
+
+        (remmach, path) = self.remfile.split(':', 1)
+        cmd = "ssh %s stat -L -c \"'%%s %%Y'\" %s 2>/dev/null" % (remmach, path)
+
+        pd = os.popen(cmd)
+        try:
+            out = pd.read()
+        finally:
+            stat = pd.close()
+        if stat is not None:
+            return None
+
+        try:
+            size, mtime = map(int, out.split())
+        except ValueError:
+            return None
+        return { "size": size, "mtime": mtime }
+
     def listDir(self, noaction=False):
         """interpret the source as a directory and return a list of files
         it contains
@@ -1180,6 +1648,49 @@ class LocalTransporter(Transporter):
                 raise TransporterError("Failed to retrieve %s: %s" % 
                                        (self.loc, str(e)))
 
+    def getValidators(self):
+        """return the size and modification time of the source, or None if
+        it doesn't exist"""
+        try:
+            src = os.stat(self.loc)
+        except OSError:
+            return None
+        return { "size": src.st_size, "mtime": int(src.st_mtime) }
+
+    def updateFile(self, filename, noaction=False):
+        """bring a local copy of the source up to date, returning True if 
+        the file was (re)written or False if it already has the source's 
+        size and modification time.  
+        @param filename      the name of the local copy
+        @param noaction      if True, simulate the result (default: False)
+        """
+        if noaction:
+            return Transporter.updateFile(self, filename, noaction)
+
+        try:
+            src = os.stat(self.loc)
+        except OSError:
+            raise RemoteFileNotFound("%s: file not found" % self.loc)
+        try:
+            dest = os.stat(filename)
+            if dest.st_size == src.st_size and int(dest.st_mtime) == int(src.st_mtime):
+                return False
+        except OSError:
+            pass
+
+        tmpfile = "%s.tmp%d" % (filename, os.getpid())
+        try:
+            shutil.copy2(self.loc, tmpfile)
+            os.rename(tmpfile, filename)
+        except (IOError, OSError), e:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise TransporterError("Failed to copy %s: %s" % (self.loc, str(e)))
+
+        if self.verbose > 0:
+            print >> self.log, "cp from", self.loc
+        return True
+
     def listDir(self, noaction=False):
         """interpret the source as a directory and return a list of files
         it contains
@@ -1278,6 +1789,134 @@ def defaultMakeTransporter(source, verbosity, log):
 
 makeTransporter = defaultMakeTransporter
 
+class DownloadCache(utils.FileCache):
+    """
+    a cache of the files retrieved from distribution servers, shared by all
+    the stacks on a machine (and, if hooks.config.site.downloadCacheDir is 
+    set to a shared directory, by all its users).  Files are looked up by 
+    their location on the server.  A cached copy is only used if the 
+    Transporter confirms that the server's copy hasn't changed (by its ETag 
+    or Last-Modified time for web servers, or its size and modification time
+    for local and ssh servers).  When the cache grows beyond 
+    hooks.config.site.downloadCacheSize megabytes, the least recently used 
+    files are removed.
+    """
+
+    def __init__(self, cacheDir, maxSize, verbosity=0, log=sys.stderr):
+        """
+        @param cacheDir   the directory to hold the cached files
+        @param maxSize    the maximum total size of the cached files, in bytes
+        """
+        super(DownloadCache, self).__init__(cacheDir, maxSize)
+        self.verbose = verbosity
+        self.log = log
+
+    # @staticmethod   # requires python 2.4
+    def get():
+        """
+        return the DownloadCache configured by hooks.config.site, or None if
+        caching is disabled
+        """
+        maxSize = hooks.config.site.downloadCacheSize
+        if not maxSize or maxSize <= 0:
+            return None
+        maxSize = int(maxSize*1024*1024)
+
+        cacheDir = hooks.config.site.downloadCacheDir or utils.userDownloadCacheDir()
+        if not cacheDir:
+            return None
+
+        return DownloadCache._getInstance(cacheDir, maxSize)
+    get = staticmethod(get)
+
+    def _entryFile(self, source):
+        key = _md5(source).hexdigest()
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def cacheToFile(self, trx, filename):
+        """copy the source of a Transporter to a file by way of the cache, 
+        returning True if it was retrieved from the server or False if the 
+        cached copy was used.
+        @param trx         the Transporter for the file
+        @param filename    the name of the file to write
+        """
+        entry = self._entryFile(trx.loc)
+        if not os.path.isdir(os.path.dirname(entry)):
+            os.makedirs(os.path.dirname(entry))
+
+        validators = None
+        info = self._readEntry(entry + ".info")
+        if info and info["source"] == trx.loc:
+            try:
+                st = os.stat(entry)
+                if (st.st_size, int(st.st_mtime)) == (info["size"], info["mtime"]):
+                    validators = info["validators"]
+            except OSError:
+                pass
+
+        tmpfile = "%s.tmp%d.%d" % (entry, os.getpid(), thread.get_ident())
+        try:
+            validators, updated = trx.cacheToFileIfChanged(tmpfile, validators)
+            if updated:
+                os.rename(tmpfile, entry)
+                st = os.stat(entry)
+                self._writeEntry(entry + ".info", { "source": trx.loc, "validators": validators,
+                                         "size": st.st_size, "mtime": int(st.st_mtime) })
+            else:
+                os.utime(entry + ".info", None) # it's been used
+                if self.verbose > 1:
+                    print >> self.log, "Using cached copy of", trx.loc
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+        copyfile(entry, filename)
+        if updated:
+            self.prune()
+
+        return updated
+
+    def _listEntries(self):
+        """
+        return a list of (time last used, size, files) for the cached files.
+        A file's entry is the file itself and its .info file, which is 
+        touched whenever the file is used.
+        """
+        entries = []
+        if not os.path.isdir(self.cacheDir):
+            return entries
+
+        for dir in os.listdir(self.cacheDir):
+            dir = os.path.join(self.cacheDir, dir)
+            if not os.path.isdir(dir):
+                continue
+            for file in filter(lambda f: f.endswith(".info"), os.listdir(dir)):
+                entry = os.path.join(dir, file[:-len(".info")])
+                try:
+                    entries.append((os.stat(entry + ".info").st_mtime, os.stat(entry).st_size,
+                                    [entry + ".info", entry]))
+                except OSError:
+                    pass
+
+        return entries
+
+    def _removeEntry(self, files):
+        if self.verbose > 1:
+            print >> self.log, "Removing", files[-1], "from the download cache"
+        super(DownloadCache, self)._removeEntry(files)
+
+    def clear(self, servers=None):
+        """remove files from the cache
+        @param servers    a list of server base URLs; if given, only files
+                             from these servers are removed
+        """
+        for used, size, files in self._listEntries():
+            if servers is not None:
+                info = self._readEntry(files[0])
+                if not info or not filter(lambda s: info["source"].startswith(s), servers):
+                    continue
+
+            self._removeEntry(files)
 
 class TaggedProductList(object):
     """
@@ -1446,6 +2085,190 @@ EUPS distribution %s version list. Version %s
 
     fromFile = staticmethod(fromFile)  # should work as of python 2.2
 
+class PackageIndex(object):
+    """
+    a summary of all the packages available from a server.  For each 
+    manifest on the server it records the product, version, and flavor, 
+    the distribution ID of the product, the tags assigned to it, and a 
+    checksum of the manifest file.  It is maintained by "eups distrib 
+    create" so that clients can learn what a server provides by retrieving
+    a single file rather than reading every manifest.
+    """
+
+    def __init__(self, verbosity=0, log=sys.stderr):
+        """create an empty index
+        @param verbosity     if > 0, print status messages; the higher the 
+                               number, the more messages that are printed
+                               (default=0).
+        @param log           the destination for status messages (default:
+                               sys.stderr)
+        """
+        self.verbose = verbosity
+        self.log = log
+        self.fmtversion = "1.0"
+
+        # the packages, looked up by (product, version, flavor).  Each value
+        # is a list of the form [distId, checksum, tags]
+        self.packages = {}
+
+    def addPackage(self, product, version, flavor=None, distId=None, 
+                   checksum=None, tags=None):
+        """add (or update) a package in the index
+        @param product     the name of the product
+        @param version     the version of the product
+        @param flavor      the flavor of the package (default: "generic")
+        @param distId      the distribution ID for the product 
+        @param checksum    the checksum of the package's manifest file
+        @param tags        the names of the tags assigned to the package.  If
+                             None, any tags already assigned are retained.
+        """
+        key = (product, version, flavor or "generic")
+        if tags is None:
+            tags = self.packages.get(key, [None, None, []])[2]
+
+        self.packages[key] = [distId or "none", checksum or "none", list(tags)]
+
+    def deletePackage(self, product, version, flavor=None):
+        """remove a package from the index"""
+        key = (product, version, flavor or "generic")
+        if self.packages.has_key(key):
+            del self.packages[key]
+
+    def getPackageInfo(self, product, version, flavor=None):
+        """return the [distId, checksum, tags] recorded for a package, or
+        None if it is not in the index"""
+        return self.packages.get((product, version, flavor or "generic"))
+
+    def setTag(self, tag, products):
+        """assign a tag to exactly the given packages, removing it from
+        all others.  
+        @param tag        the name of the tag
+        @param products   a list of (product, version, flavor) for the 
+                            tagged packages.  A generic flavor matches 
+                            packages of any flavor (and vice versa).
+        """
+        tagged = {}
+        for product, version, flavor in products:
+            if not tagged.has_key((product, version)):
+                tagged[(product, version)] = []
+            tagged[(product, version)].append(flavor or "generic")
+
+        for key, info in self.packages.items():
+            product, version, flavor = key
+            tags = filter(lambda t: t != tag, info[2])
+
+            flavors = tagged.get((product, version), [])
+            if flavor in flavors or (flavors and (flavor == "generic" or "generic" in flavors)):
+                tags.append(tag)
+            info[2] = tags
+
+    def getProducts(self, product=None, version=None, flavor=None, tag=None):
+        """return the matching packages as a sorted list of [product, version,
+        flavor] lists.  
+        @param product     the product name, which may contain glob 
+                             wildcards; if None, all products match
+        @param version     the version, which may contain glob wildcards;
+                             if None, all versions match
+        @param flavor      the flavor; if None, all flavors match
+        @param tag         if not None, only return packages with this tag
+        """
+        out = []
+        for key, info in self.packages.items():
+            if product and not fnmatch.fnmatchcase(key[0], product):
+                continue
+            if version and not fnmatch.fnmatchcase(key[1], version):
+                continue
+            if flavor and key[2] != flavor:
+                continue
+            if tag and tag not in info[2]:
+                continue
+            out.append(list(key))
+
+        out.sort()
+        return out
+
+    def read(self, filename):
+        """read the packages from an index file, adding them to this index"""
+        fd = open(filename, "r")
+        try:
+            line = fd.readline()
+            mat = re.search(r"^EUPS distribution package index. Version (\S+)\s*$", line)
+            if not mat:
+                raise RuntimeError("First line of package index %s is corrupted:\n\t%s" % 
+                                   (filename, line))
+            version = mat.groups()[0]
+            if version != self.fmtversion and self.verbose >= 0:
+                print >> self.log, \
+                    "WARNING. Saw version %s; expected %s" % (version, self.fmtversion)
+
+            commre = re.compile(r"^\s*#")
+            for line in fd:
+                line = commre.split(line)[0].strip()
+                if len(line) == 0:
+                    continue
+
+                info = line.split()
+                if len(info) < 6:
+                    raise RuntimeError("Failed to parse line in %s: %s" % (filename, line))
+
+                tags = []
+                if info[4] != "-":
+                    tags = info[4].split(",")
+                self.addPackage(info[0], info[1], info[2], " ".join(info[5:]), info[3], tags)
+        finally:
+            fd.close()
+
+    def write(self, filename, noaction=False):
+        """write the index to a file.  The file is replaced atomically, so 
+        that clients never see a partially written index.
+        @param filename    the file to write the index to
+        @param noaction    if True, don't actually write anything
+        """
+        if self.verbose > 0:
+            print >> self.log, "Writing package index to", filename
+        if noaction:
+            return
+
+        tmpfile = "%s.tmp%d" % (filename, os.getpid())
+        ofd = open(tmpfile, "w")
+        try:
+            print >> ofd, """\
+EUPS distribution package index. Version %s
+#
+# product        version      flavor     manifest_checksum                 tags     distId
+#--------------------------------------------------------------------------------------------\
+""" % self.fmtversion
+
+            for key in sorted(self.packages.keys()):
+                distId, checksum, tags = self.packages[key]
+                print >> ofd, "%-15s %-12s %-10s %-33s %-8s %s" % \
+                    (key[0], key[1], key[2], checksum, ",".join(tags) or "-", distId)
+        finally:
+            ofd.close()
+        os.rename(tmpfile, filename)
+
+    # @staticmethod   # requires python 2.4
+    def checksum(filename):
+        """return the checksum of a file, as recorded in an index"""
+        fd = open(filename, "rb")
+        try:
+            return _md5(fd.read()).hexdigest()
+        finally:
+            fd.close()
+
+    checksum = staticmethod(checksum)  # should work as of python 2.2
+
+    # @staticmethod   # requires python 2.4
+    def fromFile(filename, verbosity=0, log=sys.stderr):
+        """create a PackageIndex from the contents of an index file
+        @param filename   the file to read
+        """
+        out = PackageIndex(verbosity=verbosity, log=log)
+        out.read(filename)
+        return out
+
+    fromFile = staticmethod(fromFile)  # should work as of python 2.2
+
 class Dependency(object):
     """a container for information about a product required by another product.
     Users should use the attribute data directly.
@@ -1606,6 +2429,8 @@ class Manifest(object):
     """a list of product dependencies that must be installed in order to 
     install a particular product."""
 
+    _headerRe = re.compile(r"^EUPS distribution manifest for (\S+) \((\S+)\). Version (\S+)\s*$")
+
     def __init__(self, product=None, version=None, eupsenv=None, 
                  verbosity=0, log=sys.stderr):
         self.products = []
@@ -1621,9 +2446,32 @@ class Manifest(object):
         self.shouldRecurse = False
         self.mapping = None
 
+        self._index = None              # product name -> positions in self.products
+        self._indexed = None            # (self.products, its length) when _index was built
+
     def __str__(self):
         return "Manifest: %s %s" % (self.product, self.version)
 
+    def _indexIsCurrent(self):
+        """return True if the index describes self.products.  Callers may
+        append to or replace the list returned by getProducts(), so we check
+        that the list is the same one, of the same length.  Entries replaced
+        in place are fine, as the index only records their positions."""
+        return self._indexed is not None and self._indexed[0] is self.products and \
+            self._indexed[1] == len(self.products)
+
+    def _reindex(self):
+        """build the index of the positions of each product's entries"""
+        index = {}
+        for i, dep in enumerate(self.products):
+            if index.has_key(dep.product):
+                index[dep.product].append(i)
+            else:
+                index[dep.product] = [i]
+
+        self._index = index
+        self._indexed = (self.products, len(self.products))
+
     def getDependency(self, product, version=None, flavor=None, which=-1):
         """Return the last product dependency in this manifest that matches
         the given product info.  Typically only one version of a product will
@@ -1638,11 +2486,20 @@ class Manifest(object):
                               matching products.  Default is the last matching
                               product.
         """
-        out = filter(lambda x: x.product == product, self.products)
-        if version is not None:
-            out = filter(lambda x: x.version == version, out)
-        if flavor is not None:
-            out = filter(lambda x: x.flavor == flavor, out)
+        if not self._indexIsCurrent():
+            self._reindex()
+        #
+        # The versions and flavors of entries may be changed in place (e.g.
+        # by Distrib.updateDependencies()), so we only index the product
+        # names and check the rest here; there's usually only one entry.
+        #
+        out = []
+        for i in self._index.get(product, []):
+            dep = self.products[i]
+            if dep.product == product and \
+                   (version is None or dep.version == version) and \
+                   (flavor is None or dep.flavor == flavor):
+                out.append(dep)
         if len(out) == 0 or which >= len(out) or which < -len(out):
             return None
         return out[which]
@@ -1658,6 +2515,13 @@ class Manifest(object):
         if not isinstance(dep, Dependency):
             raise TypeError("not a Dependency instance: " + str(dep))
 
+        if self._indexIsCurrent():
+            if self._index.has_key(dep.product):
+                self._index[dep.product].append(len(self.products))
+            else:
+                self._index[dep.product] = [len(self.products)]
+            self._indexed = (self.products, len(self.products) + 1)
+
         self.products.append(dep)
 
     def getProducts(self):
@@ -1668,19 +2532,16 @@ class Manifest(object):
         product dependencies in the order opposite from the order one needs
         to install them"""
         self.products.reverse()
+        self._index = self._indexed = None
 
     def roll(self, n=1):
         """Roll the list of products by n (n=1: [a, b, c, d] -> [b, c, d, a]"""
         if len(self.products) == 0:
             return
 
-        if n < 0:
-            n = -n
-            for i in range(n):
-                self.products.insert(0, self.products.pop())
-        else:
-            for i in range(n):
-                self.products.append(self.products.pop(0))
+        n %= len(self.products)
+        self.products[:] = self.products[n:] + self.products[:n]
+        self._index = self._indexed = None
 
     def read(self, file, setproduct=True, shouldRecurse=None):
         """load the dependencies listed in a file"""
@@ -1691,7 +2552,7 @@ class Manifest(object):
         fd = open(file)
     
         line = fd.readline()
-        mat = re.search(r"^EUPS distribution manifest for (\S+) \((\S+)\). Version (\S+)\s*$", line)
+        mat = self._headerRe.search(line)
         if not mat:
             raise RuntimeError, ("First line of manifest file %s is corrupted:\n\t%s" % (file, line))
         manifest_product, manifest_product_version, version = mat.groups()
@@ -1710,45 +2571,49 @@ class Manifest(object):
         TRUE = "TRUE"
         REQ = "REQUIRED"
         OPT = "OPTIONAL"
-        for line in fd:
-            line = line.split("\n")[0]
-            if re.search(r"^\s*(#.*)?$", line):
-                continue
-
-            try:
-                info = re.findall(r"\S+", line)
+        #
+        # This is a single pass over each line, as manifests may list thousands of products;
+        # str.split() splits on the same whitespace as the regexp \s
+        #
+        try:
+            products = []
+            for line in fd:
+                info = line.split()
+                if not info or info[0].startswith("#"):
+                    continue
 
-                # make sure we have at least 5 elements
-                info[4]
+                try:
+                    # make sure we have at least 5 elements
+                    info[4]
 
-                # set a default for the distrib ID
-                if len(info) < 6:
-                    info.append(None)
-                elif info[5] == "search":
-                    info[5] = None
-
-                # set a whether this is optional or required
-                if len(info) < 7:
-                    info.append(False)
-                elif OPT.startswith(info[6]):
-                    info[6] = True
-                else:
-                    info[6] = False
-
-                if len(info) < 8:
-                    info.append(shouldRecurse)
-                elif TRUE.startswith(info[7]):
-                    info[7] = True
-                elif FALSE.startswith(info[7]):
-                    info[7] = False
-                else:
-                    info[7] = shouldRecurse
+                    # set a default for the distrib ID
+                    if len(info) < 6:
+                        distId = None
+                    else:
+                        distId = info[5]
+                        if distId == "search":
+                            distId = None
+
+                    # set a whether this is optional or required
+                    isOptional = len(info) >= 7 and OPT.startswith(info[6])
+
+                    recurse = shouldRecurse
+                    if len(info) >= 8:
+                        if TRUE.startswith(info[7]):
+                            recurse = True
+                        elif FALSE.startswith(info[7]):
+                            recurse = False
+
+                    products.append(Dependency(info[0], info[2], info[1], info[3], 
+                                               info[4], distId, isOptional, recurse, info[8:]))
+                except Exception, e:
+                    raise RuntimeError("Failed to parse line: (%s): %s" % 
+                                       (str(e), line.split("\n")[0]))
+        finally:
+            fd.close()
 
-                self.addDependency(info[0], info[2], info[1], info[3], 
-                                   info[4], info[5], info[6], info[7], info[8:])
-            except Exception, e:
-                raise RuntimeError("Failed to parse line: (%s): %s" % 
-                                   (str(e), line))
+        for dep in products:
+            self.addDepInst(dep)
 
 
     def write(self, filename, noOptional=True, flavor=None, noaction=False):
@@ -1898,6 +2763,7 @@ Additional mappings can be provided.
             products.append(p)
 
         self.products = products
+        self._reindex()
 
     def _readRemapFile(self, dirname, mapping=Mapping(), overwrite=True, mode=None, filename="manifest.remap"):
         """Read a product mapping from dirname/filename"""
@@ -2306,7 +3172,10 @@ def system(cmd, noaction=False, verbosity=0, log=sys.stderr):
         if verbosity < 0:
             cmd += "> /dev/null 2>&1"
 
-        errno = os.spawnle(os.P_WAIT, BASH, BASH, "-c", cmd, environ)
+        try:
+            errno = os.spawnle(os.P_WAIT, BASH, BASH, "-c", cmd, environ)
+        finally:
+            resetSync()                 # the command may have declared products
 
         if errno != 0:
             raise OSError("\n\t".join(("Command:\n" + cmd).split("\n")) + ("\nexited with code %d" % (errno)))
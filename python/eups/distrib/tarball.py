@@ -4,20 +4,127 @@
 # Export a product and its dependencies as a package, or install a
 # product from a package: : a specialization for binary tar-balls
 #
-import sys, os, re
+import sys, os, re, shutil, tempfile, time
+import subprocess, threading
 import eups
 import Distrib as eupsDistrib
 import server as eupsServer
 
+# The formats that tarballs may be compressed with.  For each, we give the 
+# suffix used in the tarballs' names (and thus their distIDs), and the 
+# commands that compress and decompress the format, in order of preference;
+# the programs that can use several cores come first.
+compressors = {
+    "gzip"  : (".tar.gz",  [["pigz"], ["gzip"]],
+                           [["pigz", "-dc"], ["gzip", "-dc"]]),
+    "bzip2" : (".tar.bz2", [["lbzip2"], ["pbzip2"], ["bzip2"]],
+                           [["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]]),
+    "xz"    : (".tar.xz",  [["xz", "-T0"]],
+                           [["xz", "-dc"]]),
+    "zstd"  : (".tar.zst", [["zstd", "-q", "-T0"]],
+                           [["zstd", "-dcq"]]),
+    }
+
+def compressionFor(tarball):
+    """return the name of the compression format used by a tarball, based on
+    its name, or None if it isn't recognised"""
+    for name, info in compressors.items():
+        if tarball.endswith(info[0]):
+            return name
+    return None
+
+def findCompressor(compression, decompress=False):
+    """return the command (as a list of arguments) to use to compress (or 
+    decompress) data in the given format
+    @param compression   the name of the format (see compressors)
+    @param decompress    if True, return the command to decompress data
+    """
+    if not compressors.has_key(compression):
+        raise RuntimeError("Unknown tarball compression \"%s\" (known formats are %s)" %
+                           (compression, ", ".join(sorted(compressors.keys()))))
+
+    for cmd in compressors[compression][decompress and 2 or 1]:
+        if eupsServer.findInPath(cmd[0], os.environ.get("PATH", "")):
+            return cmd
+
+    raise RuntimeError("No program to %scompress %s files is available" %
+                       (decompress and "de" or "", compression))
+
+def _moveInto(srcDir, destDir):
+    """move the contents of srcDir into destDir, merging them with any
+    directories of the same names that are already there (replacing other
+    files) as tar would"""
+    for name in os.listdir(srcDir):
+        src = os.path.join(srcDir, name)
+        dest = os.path.join(destDir, name)
+        if os.path.isdir(dest) and not os.path.islink(dest) and \
+               os.path.isdir(src) and not os.path.islink(src):
+            _moveInto(src, dest)
+            continue
+
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            shutil.rmtree(dest)
+        elif os.path.lexists(dest):
+            os.unlink(dest)
+        os.rename(src, dest)
+
+class _GrowingFile(object):
+    """a file that may still be being written by another thread, read in 
+    chunks as it grows"""
+
+    def __init__(self, filename, writer=None, chunkSize=64*1024, interval=0.05):
+        """
+        @param filename   the file to read
+        @param writer     the Thread writing the file, or None if it's complete
+        """
+        self.filename = filename
+        self.writer = writer
+        self.chunkSize = chunkSize
+        self.interval = interval
+        self.fd = None
+
+    def read(self):
+        """return the next chunk of the file, or "" once it's complete and
+        has all been read"""
+        while True:
+            done = self.writer is None or not self.writer.isAlive()
+
+            if self.fd is None:
+                try:
+                    self.fd = open(self.filename, "rb")
+                except IOError:
+                    if done:
+                        return ""
+                    time.sleep(self.interval)
+                    continue
+
+            chunk = self.fd.read(self.chunkSize)
+            if chunk or done:
+                return chunk
+            time.sleep(self.interval)
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
 class Distrib(eupsDistrib.DefaultDistrib):
     """A class to encapsulate tarball-based product distribution
 
+    Tarballs are compressed with gzip unless the server's configuration 
+    sets TARBALL_COMPRESSION to another of the formats in compressors (e.g.
+    xz or zstd); the format is recorded in the tarball's name, and hence its
+    distID.  If a parallel compressor such as pigz is available it is used.
+    When installing, the tarball is unpacked as it is downloaded.  
+
     OPTIONS:
     The behavior of a Distrib class is fine-tuned via options (a dictionary
     of named values) that are passed in at construction time.  The options 
     supported are:
        noeups           do not use the local EUPS database for information  
                           while creating packages.       
+       compression      the format to compress new tarballs with, overriding
+                          the server's TARBALL_COMPRESSION
        obeyGroups       when creating files (other on the user side or the 
                           server side), set group ownership and make group
                           writable
@@ -41,12 +148,12 @@ class Distrib(eupsDistrib.DefaultDistrib):
         """Return a valid package location if and only if we recognize the 
         given distribution identifier
 
-        This implementation return a location if it ends with ".tar.gz"
+        This implementation return a location if it ends with the suffix
+        of one of the compression formats (e.g. ".tar.gz")
         """
         if distID:
-            suffix = ".tar.gz"
             distID = distID.strip()
-            if distID.endswith(suffix):
+            if compressionFor(distID):
                 return distID
 
         return None
@@ -67,6 +174,7 @@ MANIFEST_FILE_RE = ^(?P<product>[^-]+)-(?P<version>[^@]+)@(?P<flavor>.*)\.manife
 MANIFEST_URL = %(base)s/manifests/%(product)s-%(version)s@%(flavor)s.manifest
 TARBALL_URL = %(base)s/%(path)s
 DIST_URL = %(base)s/%(path)s
+# TARBALL_COMPRESSION = gzip
 """
             cf = open(config, 'a')
             try:
@@ -124,9 +232,7 @@ DIST_URL = %(base)s/%(path)s
 
         fullTarball = os.path.join(serverDir, tarball)
         try:
-            eupsServer.system("(cd %s && tar -cf - %s) | gzip > %s" % 
-                              (baseDir, productDir, fullTarball),
-                              self.Eups.noaction, self.verbose-1, self.log)
+            self.writeTarball(baseDir, productDir, fullTarball)
         except Exception, e:
             try:
                 os.unlink(pwdFile)
@@ -149,6 +255,155 @@ DIST_URL = %(base)s/%(path)s
 
         return tarball
 
+    def getCompression(self):
+        """return the name of the format to compress new tarballs with"""
+        compression = self.getOption("compression")
+        if not compression and self.distServer:
+            compression = self.distServer.getConfigProperty("TARBALL_COMPRESSION")
+        if not compression:
+            compression = "gzip"
+
+        if not compressors.has_key(compression):
+            raise RuntimeError("Unknown tarball compression \"%s\" (known formats are %s)" %
+                               (compression, ", ".join(sorted(compressors.keys()))))
+        return compression
+
+    def writeTarball(self, baseDir, productDir, tarball):
+        """write a tarball of a directory, compressed according to its name
+        @param baseDir     the directory to make the tarball from
+        @param productDir  the directory below baseDir to put in the tarball
+        @param tarball     the name of the tarball to write
+        """
+        compress = findCompressor(compressionFor(tarball) or "gzip")
+
+        if self.Eups.noaction or self.verbose > 1:
+            print >> self.log, "(cd %s && tar -cf - %s) | %s > %s" % \
+                (baseDir, productDir, " ".join(compress), tarball)
+        if self.Eups.noaction:
+            return
+
+        tmpfile = "%s.tmp%d" % (tarball, os.getpid())
+        out = open(tmpfile, "wb")
+        try:
+            tar = subprocess.Popen(["tar", "-cf", "-", productDir], cwd=baseDir,
+                                   stdout=subprocess.PIPE)
+            comp = subprocess.Popen(compress, stdin=tar.stdout, stdout=out)
+            tar.stdout.close()          # so tar sees SIGPIPE if the compressor fails
+            compStatus = comp.wait()
+            tarStatus = tar.wait()
+        finally:
+            out.close()
+
+        if tarStatus != 0 or compStatus != 0:
+            os.unlink(tmpfile)
+            raise OSError("tar exited with status %d, %s with status %d" % 
+                          (tarStatus, compress[0], compStatus))
+        os.rename(tmpfile, tarball)
+
+    def unpackTarball(self, tarball, unpackDir, compression="gzip"):
+        """unpack a compressed tarball into a directory, returning True if 
+        successful.  
+        @param tarball     the tarball; either a filename, or an object whose
+                             read() method returns the next chunk of it (or 
+                             "" at its end)
+        @param unpackDir   the directory to unpack into
+        @param compression the format that the tarball is compressed with
+        """
+        decompress = findCompressor(compression, True)
+        if isinstance(tarball, str):
+            tarball = _GrowingFile(tarball)
+
+        comp = subprocess.Popen(decompress, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        tar = subprocess.Popen(["tar", "-xmf", "-"], cwd=unpackDir, stdin=comp.stdout)
+        comp.stdout.close()
+        try:
+            try:
+                while True:
+                    chunk = tarball.read()
+                    if not chunk:
+                        break
+                    comp.stdin.write(chunk)
+            except IOError:             # the decompressor has given up
+                pass
+        finally:
+            try:
+                comp.stdin.close()
+            except IOError:
+                pass
+            compStatus = comp.wait()
+            tarStatus = tar.wait()
+
+        return compStatus == 0 and tarStatus == 0
+
+    def fetchAndUnpack(self, location, product, version, tfile, unpackDir):
+        """retrieve a tarball from the server and unpack it, unpacking what
+        has arrived while the rest is still being downloaded.  Return the 
+        name of the downloaded tarball.  The tarball is unpacked into a
+        temporary directory and only moved into unpackDir once it's complete,
+        so a failure doesn't leave a partly unpacked product behind.
+        @param location     the location of the tarball on the server
+        @param product      the name of the product in the tarball
+        @param version      the product's version
+        @param tfile        the file to download the tarball to
+        @param unpackDir    the directory to unpack it into
+        """
+        compression = compressionFor(location) or "gzip"
+
+        if os.path.exists(tfile):
+            os.unlink(tfile)
+        if not os.path.isdir(os.path.dirname(tfile)):
+            os.makedirs(os.path.dirname(tfile))
+
+        result = {}
+        def download():
+            try:
+                result["file"] = self.distServer.getFileForProduct(location, product, version,
+                                                                   self.Eups.flavor, ftype="dist",
+                                                                   filename=tfile)
+            except Exception, e:
+                result["error"] = e
+
+        # in unpackDir, so that the files can be renamed into place
+        tmpDir = tempfile.mkdtemp(prefix=".unpack-%s-" % product, dir=unpackDir)
+        try:
+            downloader = threading.Thread(target=download)
+            downloader.setDaemon(True)
+            downloader.start()
+
+            growing = _GrowingFile(tfile, downloader)
+            try:
+                try:
+                    unpacked = self.unpackTarball(growing, tmpDir, compression)
+                except OSError, e:
+                    if self.verbose > 0:
+                        print >> self.log, "Failed to unpack %s while downloading it: %s" % (tfile, e)
+                    unpacked = False
+            finally:
+                growing.close()
+                while downloader.isAlive():
+                    downloader.join(1)  # allow ^C to interrupt us
+
+            if result.has_key("error"):
+                raise result["error"]
+            tfile = result["file"]
+            if not os.access(tfile, os.R_OK):
+                raise RuntimeError, ("Unable to read %s" % (tfile))
+
+            if not unpacked:
+                # e.g. the file we were following was replaced rather than written
+                if self.verbose > 1:
+                    print >> self.log, "Unpacking the complete %s" % tfile
+                shutil.rmtree(tmpDir)
+                os.mkdir(tmpDir)
+                if not self.unpackTarball(tfile, tmpDir, compression):
+                    raise RuntimeError, ("Failed to read %s" % (tfile))
+
+            _moveInto(tmpDir, unpackDir)
+        finally:
+            shutil.rmtree(tmpDir, True)
+
+        return tfile
+
     def packageCreated(self, serverDir, product, version, flavor=None):
         """return True if a distribution package for a given product has 
         apparently been deployed into the given server directory.  
@@ -165,6 +420,12 @@ DIST_URL = %(base)s/%(path)s
         location = self.parseDistID(self.getDistIdForPackage(product, version, flavor))
         return os.path.exists(os.path.join(serverDir, location))
 
+    def getPrefetchFiles(self, location, product, version):
+        """return the files that installPackage() will retrieve from the 
+        server (see Distrib.getPrefetchFiles())
+        """
+        return [(location, product, version, self.Eups.flavor, "dist")]
+
     def installPackage(self, location, product, version, productRoot, 
                        installDir=None, setups=None, buildDir=None):
         """Install a package with a given server location into a given
@@ -196,14 +457,6 @@ DIST_URL = %(base)s/%(path)s
         # we will download the tarball to the build directory
         tfile = "%s/%s" % (buildDir, tarball)
 
-        if not self.Eups.noaction:
-            tfile = self.distServer.getFileForProduct(location, product, 
-                                                      version, self.Eups.flavor,
-                                                      ftype="dist",
-                                                      filename=tfile)
-            if not os.access(tfile, os.R_OK):
-                raise RuntimeError, ("Unable to read %s" % (tfile))
-
         unpackDir = os.path.join(productRoot, self.Eups.flavor)
         if installDir and installDir != "none":
             try:
@@ -219,11 +472,14 @@ DIST_URL = %(base)s/%(path)s
         if self.verbose > 0:
             print >> self.log, "installing %s into %s" % (tarball, unpackDir)
 
-        try:
-            eupsServer.system("cd %s && tar -zxmf %s" % (unpackDir, tfile), 
-                              self.Eups.noaction, verbosity=self.verbose-1)
-        except Exception, e:
-            raise RuntimeError, ("Failed to read %s: %s" % (tfile, e))
+        if self.Eups.noaction:
+            print >> self.log, "cd %s && %s < %s | tar -xmf -" % \
+                (unpackDir, " ".join(findCompressor(compressionFor(tarball) or "gzip", True)), tfile)
+        else:
+            try:
+                tfile = self.fetchAndUnpack(location, product, version, tfile, unpackDir)
+            except OSError, e:
+                raise RuntimeError, ("Failed to read %s: %s" % (tfile, e))
 
         if installDir and installDir == "none":
             installDir = None
@@ -263,7 +519,8 @@ DIST_URL = %(base)s/%(path)s
                                 be ignored by the implentation
         """
         if not flavor:  flavor = self.flavor
-        return "%s-%s@%s.tar.gz" % (product, version, flavor)
+        suffix = compressors[self.getCompression()][0]
+        return "%s-%s@%s%s" % (product, version, flavor, suffix)
 
     def writeManifest(self, *args, **kwargs):
         """We want to write flavor-specific manifest files, but without a flavor subdirectory,
@@ -271,6 +528,17 @@ DIST_URL = %(base)s/%(path)s
         kwargs["flavor"] = None
         return eupsDistrib.DefaultDistrib.writeManifest(self, *args, **kwargs)
         
+    def findManifests(self, serverDir):
+        """return a list of (filename, flavor) for the manifests deployed in
+        a server distribution tree (see getManifestPath())"""
+        out = []
+        for file in os.listdir(serverDir):
+            mat = re.search(r"^[^@]+@(.*)\.manifest$", file)
+            if mat:
+                out.append((os.path.join(serverDir, file), mat.group(1)))
+
+        return out
+
     def getManifestPath(self, serverDir, product, version, flavor=None):
         """return the path where the manifest for a particular product will
         be deployed on the server.  In this implementation, all manifest 
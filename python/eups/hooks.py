@@ -32,7 +32,7 @@ def defineProperties(names, parentName=None):
 
 # various configuration properties settable by the user
 config = defineProperties("Eups distrib site user")
-config.Eups = defineProperties("userTags preferredTags globalTags reservedTags defaultTags verbose asAdmin setupTypes setupCmdName VRO fallbackFlavors defaultProduct startupFileName repoVersioner versionIncrementer colorize", "Eups")
+config.Eups = defineProperties("userTags preferredTags globalTags reservedTags defaultTags verbose asAdmin setupTypes setupCmdName VRO fallbackFlavors defaultProduct startupFileName repoVersioner versionIncrementer colorize lazyLoading cacheTables tableCacheSize cacheSetupPlans setupPlanCacheSize cacheSyncInterval prefetchTables", "Eups")
 config.Eups.setType("verbose", int)
 
 config.Eups.userTags = []
@@ -69,12 +69,56 @@ config.Eups.defaultProduct = {"name" : "implicitProducts", "version" : None, "ta
 
 config.Eups.colorize = False
 #
+# Only load products from the stacks' caches when they are needed, checking
+# just those products against the databases (see ProductStack.fromCache)
+#
+config.Eups.lazyLoading = False
+#
+# Cache parsed table files in the user data directory (see table.TableCache)
+#
+config.Eups.cacheTables = True
+#
+# The maximum size of the cache of parsed table files, in megabytes; when it grows larger, the entries
+# written longest ago are removed.  0 or None means no limit
+#
+config.Eups.tableCacheSize = 20
+#
+# Cache the changes made by setting up products in the user data directory, and
+# replay them for identical requests (see SetupPlan.SetupPlanCache).  Warnings
+# issued while setting up a product are not repeated when its plan is replayed
+#
+config.Eups.cacheSetupPlans = False
+#
+# The maximum size of the cache of setup plans, in megabytes; when it grows larger, the least recently
+# used plans are removed.  0 or None means no limit
+#
+config.Eups.setupPlanCacheSize = 20
+#
+# How often (in seconds) to check that the products stacks' caches haven't been updated by another
+# process.  If None, they are checked once per command, and again after this process changes a stack;
+# 0 means check before every lookup (see ProductStack.ensureInSync)
+#
+config.Eups.cacheSyncInterval = None
+#
+# Read the table files of the products that a table requires in up to this many background
+# threads while setting up or listing dependencies; 0 disables (see table.TablePrefetcher)
+#
+config.Eups.prefetchTables = 0
+#
 # Configure things that apply to the entire site
 #
-config.site = defineProperties("lockDirectoryBase", "site")
+config.site = defineProperties("lockDirectoryBase downloadCacheDir downloadCacheSize", "site")
 
 _defaultLockDirectoryBase = "__UPS_DB__";
 config.site.lockDirectoryBase = _defaultLockDirectoryBase
+#
+# Keep copies of the files retrieved from distribution servers, so that installing the same packages
+# into several stacks only downloads them once (see distrib.server.DownloadCache).  The size is the
+# maximum size of the cache in megabytes (0 disables it); the directory defaults to one in the user
+# data directory, but may be shared by all the users at a site
+#
+config.site.downloadCacheDir = None
+config.site.downloadCacheSize = 0
 
 # it is expected that different Distrib classes will have different set-able
 # properties.  The key for looking up Distrib-specific data should be the Distrib
@@ -1,4 +1,27 @@
-import errno, glob, os, shutil, sys, time
+"""
+Locking of eups's internal files.
+
+Locks are kernel advisory locks (see flock(2)) on a file in a lock directory
+(by default .lockDir in each product stack), so a process waiting for a lock
+sleeps until it is given up rather than polling, and a lock is released by
+the kernel if its holder dies.  Each lock directory also holds a file named
+for each holder (e.g. exclusive-rhl.1234) for the benefit of listLocks() and
+of messages about who we're waiting for.
+
+There are two levels of lock:
+  - a lock on a whole product stack, held shared by commands that only read
+    it (e.g. setup or list), and exclusively by commands that change the
+    stack as a whole (e.g. clearing its cache);
+  - a lock on a single product in a stack, held exclusively by commands
+    that change only that product (e.g. declare or distrib install).  Such
+    commands hold a shared lock on the stack, so they don't block readers
+    or each other.
+
+As commands holding only a shared lock on a stack may still rewrite files
+that describe the whole stack (e.g. its product cache), they briefly take
+an exclusive lock on writing them while they do so (see takeWriteLock()).
+"""
+import errno, fcntl, glob, os, sys
 import re
 import hooks
 import utils
@@ -10,6 +33,11 @@ LOCK_SH = 1                             # acquire a shared lock
 LOCK_EX = 2                             # acquire an exclusive lock
 
 _lockDir = ".lockDir"                   # name of lock directory
+_lockFile = "lock"                      # name of the file that's actually locked
+_writeLock = "_write_"                  # name of the lock on rewriting files shared by a stack's users
+_lockerRe = re.compile(r"^(exclusive|shared)-(.*)\.(\d+)$") # names of the files naming the holders
+
+_held = {}                              # lock file -> [fd, lockType, count, holder file], for this process
 
 def getLockPath(dirName, create=False):
     """Get the directory path that should prefix the """
@@ -21,14 +49,14 @@ def getLockPath(dirName, create=False):
 
         if base is None: # no locking
             return None
-        
+
         if not os.path.isabs(base):
             raise RuntimeError("hooks.config.site.lockDirectoryBase must be an absolute path, not \"%s\"" %
                                hooks.config.site.lockDirectoryBase)
 
         if os.path.isabs(dirName):
             dirName = dirName[1:]
-            
+
         dirName = os.path.join(base, dirName)
 
         if create:
@@ -36,8 +64,193 @@ def getLockPath(dirName, create=False):
                 os.makedirs(dirName)
 
         return dirName
-    
-def takeLocks(cmdName, path, lockType, nolocks=False, ntry=10, verbose=0):
+
+def _lockTypeName(lockType):
+    if lockType == LOCK_EX:
+        return "exclusive"
+    else:
+        return "shared"
+
+def _acquire(lockDir, lockType, what, verbose=0):
+    """
+    Take a lock of the given type on a lock directory, waiting until it's available.  Return the
+    name of the locked file (to be passed to _release()), or None if the lock couldn't be taken
+    (e.g. because we don't have permission to create it) or was already held by our parent process
+    @param lockDir   the lock directory
+    @param lockType  LOCK_SH or LOCK_EX
+    @param what      a description of what's being locked, for messages
+    """
+    lockFile = os.path.join(lockDir, _lockFile)
+    flockType = {LOCK_SH : fcntl.LOCK_SH, LOCK_EX : fcntl.LOCK_EX}[lockType]
+
+    held = _held.get(lockFile)
+    if held:                            # we've already got it
+        if lockType == LOCK_EX and held[1] != LOCK_EX:
+            _waitFor(held[0], flockType, lockDir, lockType, what, verbose)
+            held[1] = LOCK_EX
+            _nameHolder(lockDir, held)
+        held[2] += 1
+        return lockFile
+
+    while True:
+        try:
+            if not os.path.isdir(lockDir):
+                os.makedirs(lockDir)
+            try:
+                fd = os.open(lockFile, os.O_RDWR | os.O_CREAT, 0666)
+            except OSError, e:
+                if e.errno != errno.EACCES:
+                    raise
+                fd = os.open(lockFile, os.O_RDONLY) # flock doesn't need write access
+            # don't let commands that we run hold on to the lock after we've given it up
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        except OSError, e:
+            if e.errno in (errno.ENOENT, errno.EEXIST): # someone tidied up or created it as we looked
+                continue
+
+            if lockType == LOCK_EX or verbose > 0:
+                print >> utils.stdinfo, "Unable to take %s lock on %s: %s; your command may fail" % \
+                      (_lockTypeName(lockType), what, e)
+                utils.stdinfo.flush()
+            return None
+
+        try:
+            fcntl.flock(fd, flockType | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                os.close(fd)
+                raise
+            #
+            # It's held by someone else.  If it's our parent (which set EUPS_LOCK_PID), go ahead;
+            # otherwise wait for it.  Holder files left by processes that have died (e.g. of a
+            # SIGKILL) don't count, as they don't hold the lock
+            #
+            lockPids = filter(_isAlive, listLockers(lockDir, getPids=True))
+            if lockPids and lockPids == [os.environ.get("EUPS_LOCK_PID", "-1")]*len(lockPids):
+                if verbose:
+                    print >> utils.stdinfo, "Lock on %s is held by a parent, PID %s" % (what, lockPids[0])
+                os.close(fd)
+                return None
+
+            _waitFor(fd, flockType, lockDir, lockType, what, verbose)
+        #
+        # Check that the file we've locked wasn't removed by its previous owner as we waited
+        #
+        try:
+            if os.fstat(fd).st_ino == os.stat(lockFile).st_ino:
+                break
+        except OSError:
+            pass
+        os.close(fd)
+
+    if not os.environ.has_key("EUPS_LOCK_PID"): # remember the PID of the process taking the lock
+        os.environ["EUPS_LOCK_PID"] = "%d" % os.getpid()
+        os.putenv("EUPS_LOCK_PID", os.environ["EUPS_LOCK_PID"])
+
+    held = [fd, lockType, 1, None]
+    _nameHolder(lockDir, held)
+    _held[lockFile] = held
+
+    if verbose > 3:
+        print >> utils.stdinfo, "Took %s lock %s" % (_lockTypeName(lockType), lockFile)
+
+    return lockFile
+
+def _isAlive(pid):
+    """Return True iff the process with the given PID (a string) is running"""
+    try:
+        os.kill(int(pid), 0)
+    except OSError, e:
+        return e.errno == errno.EPERM   # it exists, but isn't ours
+
+    return True
+
+def _waitFor(fd, flockType, lockDir, lockType, what, verbose):
+    """Wait until we can lock fd, telling the user who we're waiting for"""
+    try:
+        fcntl.flock(fd, flockType | fcntl.LOCK_NB)
+        return
+    except IOError, e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+
+    if verbose >= 0:
+        lockers = listLockers(lockDir)
+        if lockers:
+            lockers = ": locks are held by %s" % " ".join(lockers)
+        else:
+            lockers = ""
+        print >> utils.stdinfo, "Waiting for %s lock on %s%s" % (_lockTypeName(lockType), what, lockers)
+        utils.stdinfo.flush()
+
+    fcntl.flock(fd, flockType)
+
+def _nameHolder(lockDir, held):
+    """Create the file naming us as holding a lock, replacing any previous one"""
+    import pwd
+    who = pwd.getpwuid(os.geteuid())[0]
+
+    holder = os.path.join(lockDir, "%s-%s.%d" % (_lockTypeName(held[1]), who, os.getpid()))
+    if holder == held[3]:
+        return
+
+    try:
+        os.close(os.open(holder, os.O_RDWR | os.O_CREAT))
+    except OSError:
+        holder = None                   # it's only informational
+
+    if held[3]:
+        try:
+            os.remove(held[3])
+        except OSError:
+            pass
+    held[3] = holder
+
+def _release(lockFile, verbose=0):
+    """Give up a lock taken by _acquire()"""
+    held = _held.get(lockFile)
+    if not held:
+        return
+
+    held[2] -= 1
+    if held[2] > 0:
+        return
+    del _held[lockFile]
+
+    fd, lockType, count, holder = held
+    if holder:
+        try:
+            os.remove(holder)
+        except OSError:
+            pass
+    #
+    # If no-one else is using the lock, tidy up.  Anyone who opened the file before we removed it
+    # will notice that it's gone when they lock it, and try again
+    #
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.remove(lockFile)
+        os.rmdir(os.path.dirname(lockFile))
+    except (IOError, OSError):
+        pass
+
+    if verbose > 3:
+        print >> utils.stdinfo, "Gave up %s lock %s" % (_lockTypeName(lockType), lockFile)
+
+    os.close(fd)
+
+def takeLocks(cmdName, path, lockType, nolocks=False, ntry=10, verbose=0, products=None):
+    """
+    Lock the product stacks in path, waiting until the locks are available, and return a
+    list of the locks (to be passed to giveLocks())
+    @param cmdName   the name of the command that wants the locks
+    @param path      the product stacks to lock
+    @param lockType  LOCK_SH, LOCK_EX, or None (don't lock)
+    @param nolocks   if True, don't lock
+    @param ntry      ignored (we wait until locks become available); retained for compatibility
+    @param products  if lockType is LOCK_EX and products is a list of product names, only lock
+                       those products (holding shared locks on the stacks)
+    """
     locks = []
 
     if hooks.config.site.lockDirectoryBase is None:
@@ -46,113 +259,18 @@ def takeLocks(cmdName, path, lockType, nolocks=False, ntry=10, verbose=0):
         nolocks = True
 
     if lockType is not None and not nolocks:
-        if lockType == LOCK_EX:
-            lockTypeName = "exclusive"
-        else:
-            lockTypeName = "shared"
-
         if verbose > 1:
-            print >> utils.stdinfo, "Acquiring %s locks for command \"%s\"" % (lockTypeName, cmdName)
+            msg = "Acquiring %s locks for command \"%s\"" % (_lockTypeName(lockType), cmdName)
+            if lockType == LOCK_EX and products is not None:
+                msg += " on %s" % " ".join(products)
+            print >> utils.stdinfo, msg
 
-        dt = 1.0                        # number of seconds to wait
         for d in path:
-            makeLock = True             # we can make the lock
-            for i in range(1, ntry + 1):
-                try:
-                    lockDir = os.path.join(getLockPath(d), _lockDir)
-                    getLockPath(d, create=True)
-
-                    os.mkdir(lockDir)
-                except OSError, e:
-                    if lockType == LOCK_EX:
-                        lockPids = listLockers(lockDir, getPids=True)
-                        if len(lockPids) == 1 and lockPids[0] == os.environ.get("EUPS_LOCK_PID", "-1"):
-                            pass        # OK, there's a lock but we know about it
-                            if verbose:
-                                print >> utils.stdinfo, "Lock is held by a parent, PID %d" % lockPids[0]
-                        else:
-                            if e.errno == errno.EEXIST:
-                                reason = "locks are held by %s" % " ".join(listLockers(lockDir))
-                            else:
-                                reason = str(e)
-
-                            msg = "Unable to take exclusive lock on %s" % (d)
-                            if e.errno == errno.EACCES:
-                                if verbose >= 0:
-                                    print >> utils.stdinfo, "%s; your command may fail" % (msg)
-                                    utils.stdinfo.flush()
-                                makeLock = False
-                                break
-                                
-                            msg += ": %s" % (reason)
-                            if i == ntry:
-                                raise RuntimeError(msg)
-                            else:
-                                print >> utils.stdinfo, "%s; retrying" % msg
-                                utils.stdinfo.flush()
-
-                                time.sleep(dt)
-                                continue
-                    else:
-                        if not os.path.exists(lockDir):
-                            if verbose:
-                                print >> utils.stdwarn, "Unable to lock %s; proceeding with trepidation" % d
-                            return []
-
-                if not makeLock:
-                    continue
-
-                if verbose > 2:
-                    print >> utils.stdinfo, "Creating lock directory %s" % (lockDir)
-                #
-                # OK, the lock directory exists.
-                #
-                # If we're a shared lock, we need to check that no-one holds an exclusive lock (or, if someone
-                # does hold the lock, that we're the holder's child)
-                #
-                # N.b. the check isn't atomic, but that's conservative (we don't care if the exclusive lock's
-                # dropped while we're pondering its existence)
-                #
-                lockers = listLockers(lockDir, "exclusive*")
-                if len(lockers) > 0:
-                    if len(lockers) == 1 and \
-                       os.environ.get("EUPS_LOCK_PID", "-1") == \
-                       listLockers(lockDir, "exclusive*", getPids=True)[0]:
-                        pass
-                    else:
-                        raise RuntimeError(("Unable to take shared lock on %s: " +
-                                            "an exclusive lock is held by %s") % (d, " ".join(lockers)))
-
-                break                   # got the lock
-
-            if not makeLock:
-                continue
-            
-            if not os.environ.has_key("EUPS_LOCK_PID"): # remember the PID of the process taking the lock
-                os.environ["EUPS_LOCK_PID"] = "%d" % os.getpid()
-                os.putenv("EUPS_LOCK_PID", os.environ["EUPS_LOCK_PID"])
-            #
-            #
-            # Create a file in it
-            #
-            import pwd
-            who = pwd.getpwuid(os.geteuid())[0]
-            pid = os.getpid()
-
-            lockFile = "%s-%s.%d" % (lockTypeName, who, pid)
-
-            try:
-                fd = os.open(os.path.join(lockDir, lockFile), os.O_EXCL | os.O_RDWR | os.O_CREAT)
-                os.close(fd)
-            except OSError, e:
-                if e.errno != errno.EEXIST:
-                    # should not occur
-                    raise
-
-            locks.append((lockDir, lockFile))
-
-            if verbose > 3:
-                print >> utils.stdinfo, "Creating lockfile %s" % (os.path.join(lockDir, lockFile))
+            if lockType == LOCK_EX and products is not None:
+                locks += _takeLock(d, LOCK_SH, verbose)
+                locks += takeProductLocks(d, products, verbose)
+            else:
+                locks += _takeLock(d, lockType, verbose)
     #
     # Cleanup, even in the event of the user being rude enough to use kill
     #
@@ -168,46 +286,103 @@ def takeLocks(cmdName, path, lockType, nolocks=False, ntry=10, verbose=0):
 
     return locks
 
-def giveLocks(locks, verbose=0):
-    """Give up all locks in the provided list of (directory, file)
+def _takeLock(d, lockType, verbose):
+    """Lock the product stack d, returning a list of the locks taken"""
+    lockPath = getLockPath(d)
+    if not lockPath:
+        return []
+    try:
+        getLockPath(d, create=True)
+    except OSError, e:
+        if verbose:
+            print >> utils.stdwarn, "Unable to lock %s; proceeding with trepidation" % d
+        return []
+
+    lockFile = _acquire(os.path.join(lockPath, _lockDir), lockType, d, verbose)
+    if lockFile:
+        return [lockFile]
+    else:
+        return []
 
-    If the directory ends up empty, it is removed
+def takeProductLocks(d, products, verbose=0):
     """
-    for d, f in locks:
-        if not os.path.isdir(d):
-            continue
+    Take exclusive locks on some products in the product stack d, returning a list of the
+    locks (to be passed to giveLocks()).  Nothing is locked unless this process already
+    holds a lock on the stack (see takeLocks()), so this is a no-op if locking is disabled
+    @param d         the product stack
+    @param products  the names of the products
+    """
+    lockPath = getLockPath(d)
+    if not lockPath:
+        return []
+    lockDir = os.path.join(lockPath, _lockDir)
+    if not _held.has_key(os.path.join(lockDir, _lockFile)):
+        return []
+
+    products = list(products)
+    products.sort()                     # always lock in the same order, to avoid deadlocks
 
-        f = os.path.join(d, f)
+    locks = []
+    for p in products:
+        lockFile = _acquire(os.path.join(lockDir, p), LOCK_EX, "%s in %s" % (p, d), verbose)
+        if lockFile:
+            locks.append(lockFile)
+
+    return locks
 
-        if os.path.exists(f):
-            if verbose > 2:
-                print >> utils.stdinfo, "Removing lockfile %s" % (f)
+def takeWriteLock(d, verbose=0):
+    """
+    Take the exclusive lock on rewriting the files that every command using the product stack d
+    may update (e.g. its product cache), returning a list of the locks (to be passed to
+    giveLocks()).  It should be held only while checking and rewriting such a file.  As with
+    takeProductLocks(), nothing is locked unless this process already holds a lock on the stack
+    @param d         the product stack
+    """
+    return takeProductLocks(d, [_writeLock], verbose)
 
-            os.remove(f)
+def giveLocks(locks, verbose=0):
+    """Give up all locks in the provided list, in the reverse of the order they were taken
 
-        nlockFiles = len(os.walk(d).next()[2])
-        if nlockFiles == 0:
-            os.rmdir(d)
+    Once a lock is no longer used by anyone, its directory is removed
+    """
+    toGive = list(locks)
+    del locks[:]                        # so that e.g. the atexit handler doesn't give them up again
+    for lockFile in reversed(toGive):
+        _release(lockFile, verbose)
 
 def clearLocks(path, verbose=0, noaction=False):
-    """Remove all locks found in the directories listed in path"""
-    
+    """Remove the names of lock holders found in the directories listed in path
+
+    The locks themselves vanish when their holders exit, so this only removes the records left by
+    processes that didn't tidy up after themselves
+    """
+
     for d in path:
-        lockDir = os.path.join(getLockPath(d), _lockDir)
+        lockPath = getLockPath(d)
+        if not lockPath:
+            continue
+
+        lockDir = os.path.join(lockPath, _lockDir)
 
         if not os.path.isdir(lockDir):
             continue
 
-        if noaction:
-            print >> sys.stderr, "rm -rf %s" % lockDir
-        else:
-            if verbose:
-                print >> utils.stdinfo, "Removing %s" % lockDir
+        for dirName, subDirs, fileNames in os.walk(lockDir, False):
+            for f in fileNames:
+                if not _lockerRe.search(f):
+                    continue
+                f = os.path.join(dirName, f)
 
-            try:
-                shutil.rmtree(lockDir)
-            except OSError, e:
-                print >> utils.stderr, "Unable to remove %s: %s" % (lockDir, e)                    
+                if noaction:
+                    print >> sys.stderr, "rm -f %s" % f
+                else:
+                    if verbose:
+                        print >> utils.stdinfo, "Removing %s" % f
+
+                    try:
+                        os.remove(f)
+                    except OSError, e:
+                        print >> utils.stderr, "Unable to remove %s: %s" % (f, e)
 
 def listLocks(path, verbose=0, noaction=False):
     """List all locks found in the directories listed in path"""
@@ -222,13 +397,27 @@ def listLocks(path, verbose=0, noaction=False):
         if not os.path.isdir(lockDir):
             continue
 
-        print "%-30s %s" % (d + ":", " ".join(listLockers(lockDir)))
+        lockers = listLockers(lockDir)
+        if lockers:
+            print "%-30s %s" % (d + ":", " ".join(lockers))
+
+        products = os.listdir(lockDir)
+        products.sort()
+        for p in products:
+            pdir = os.path.join(lockDir, p)
+            if os.path.isdir(pdir):
+                lockers = listLockers(pdir)
+                if lockers:
+                    print "%-30s %s" % ("%s [%s]:" % (d, p), " ".join(lockers))
 
 def listLockers(lockDir, globPattern="*", getPids=False):
     """List all the owners of locks in a lockDir"""
     lockers = []
     for f in [os.path.split(f)[1] for f in glob.glob(os.path.join(lockDir, globPattern))]:
-        who, pid = re.split(r"[-.]", f)[1:]
+        mat = _lockerRe.search(f)
+        if not mat:
+            continue
+        who, pid = mat.group(2), mat.group(3)
         if getPids:
             lockers.append(pid)
         else:
@@ -67,6 +67,8 @@ product and all its dependencies into the environment so that it can be used.
         if self.opts.quiet:
             self.opts.verbose = 0
 
+        self.stackCache = None          # passed to Eups; see Eups.__init__()
+
     def run(self):
         if self.opts.help:
             self.clo.print_help()
@@ -234,7 +236,8 @@ product and all its dependencies into the environment so that it can be used.
                                  noaction=self.opts.noaction, keep=self.opts.keep, 
                                  ignore_versions=self.opts.ignoreVer, setupType=self.opts.setupType,
                                  max_depth=self.opts.max_depth, vro=self.opts.vro,
-                                 exact_version=self.opts.exact_version, cmdName="setup")
+                                 exact_version=self.opts.exact_version, cmdName="setup",
+                                 stackCache=self.stackCache)
 
                 Eups._processDefaultTags(self.opts)
 
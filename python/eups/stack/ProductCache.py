@@ -0,0 +1,280 @@
+"""
+a compact, indexed file format for caching the ProductFamily instances that
+a ProductStack holds for a single flavor.
+
+Unlike a pickle of the whole flavor lookup, a cache file in this format can
+be memory-mapped and only the products that are actually asked for are
+decoded.  The layout of the file (all integers are unsigned and big-endian)
+is:
+
+   header    magic string, format version, number of products, offset of
+               the index, offset of the summary
+   records   a pickled ProductFamily for each product
+   index     one fixed-size entry per product, sorted by product name:
+               offset and length of the name, offset and length of the record
+   names     the product names
+   summary   a pickled dictionary giving a summary of each product (see
+               summarize()), used to build a ProductIndex without decoding
+               the records
+
+The index is searched by bisection, so finding a product does not require
+reading the whole index.
+"""
+import os, mmap, struct, cPickle
+from UserDict import DictMixin
+
+# the version of this file format; readers refuse files with another version
+formatVersion = 2
+
+_magic = "EUPSPSC\n"
+_header = struct.Struct(">8sIIQQ")   # magic, version, count, index offset, summary offset
+_entry  = struct.Struct(">QIQI")     # name offset, length; record offset, length
+
+class ProductCache(object):
+    """
+    a read-only view of a product cache file
+    """
+
+    def __init__(self, file):
+        """
+        open a cache file for reading
+        @param file     the path to the cache file
+        @throws IOError if the file is not a product cache of this format
+        """
+        self.file = file
+
+        fd = open(file, "rb")
+        try:
+            try:
+                self._data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                self._data = fd.read()   # e.g. the file is empty
+        finally:
+            fd.close()
+
+        if len(self._data) < _header.size:
+            raise IOError("%s: not a product cache file" % file)
+        magic, version, self._count, self._index, self._summaryOffset = \
+            _header.unpack_from(self._data, 0)
+        if magic != _magic:
+            raise IOError("%s: not a product cache file" % file)
+        if version != formatVersion:
+            raise IOError("%s: unsupported product cache format version: %d" %
+                          (file, version))
+
+        self._summary = None    # decoded when first needed
+
+    def __len__(self):
+        return self._count
+
+    def _getEntry(self, i):
+        return _entry.unpack_from(self._data, self._index + i*_entry.size)
+
+    def _getName(self, i):
+        noff, nlen = self._getEntry(i)[:2]
+        return self._data[noff:noff+nlen]
+
+    def _find(self, name):
+        # return the index of the named product, or None
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._getName(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._getName(lo) == name:
+            return lo
+        return None
+
+    def has_key(self, name):
+        return self._find(name) is not None
+
+    __contains__ = has_key
+
+    def names(self):
+        """
+        return the names of all products in the cache, in sorted order
+        """
+        return [self._getName(i) for i in xrange(self._count)]
+
+    def getRecord(self, name):
+        """
+        return the encoded record for the named product or None if it is
+        not in the cache
+        """
+        i = self._find(name)
+        if i is None:
+            return None
+        roff, rlen = self._getEntry(i)[2:]
+        return self._data[roff:roff+rlen]
+
+    def getFamily(self, name):
+        """
+        return the ProductFamily for the named product, decoding it from
+        the cache.
+        @throws KeyError  if the product is not in the cache
+        """
+        rec = self.getRecord(name)
+        if rec is None:
+            raise KeyError(name)
+        return cPickle.loads(rec)
+
+    def getSummary(self, name):
+        """
+        return the summary (see summarize()) of the named product, or None
+        if it is not in the cache
+        """
+        if self._summary is None:
+            self._summary = cPickle.loads(self._data[self._summaryOffset:])
+        return self._summary.get(name)
+
+class CachedFamilies(DictMixin):
+    """
+    a dictionary of ProductFamily instances, keyed by product name, that is
+    backed by a ProductCache.  Families are only decoded from the cache
+    when first asked for; they may then be updated (or replaced or deleted)
+    just as if this were a normal dictionary.
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+        self._loaded = {}       # families that have been decoded or set
+        self._deleted = {}      # names from the cache that have been deleted
+
+    def __getitem__(self, name):
+        try:
+            return self._loaded[name]
+        except KeyError:
+            pass
+        if self._deleted.has_key(name):
+            raise KeyError(name)
+
+        fam = self._cache.getFamily(name)
+        self._loaded[name] = fam
+        return fam
+
+    def __setitem__(self, name, family):
+        self._loaded[name] = family
+        self._deleted.pop(name, None)
+
+    def __delitem__(self, name):
+        if not self.has_key(name):
+            raise KeyError(name)
+        self._loaded.pop(name, None)
+        if self._cache.has_key(name):
+            self._deleted[name] = True
+
+    def has_key(self, name):
+        return self._loaded.has_key(name) or \
+            (not self._deleted.has_key(name) and self._cache.has_key(name))
+
+    __contains__ = has_key
+
+    def keys(self):
+        out = filter(lambda n: not self._deleted.has_key(n), self._cache.names())
+        out.extend(filter(lambda n: not self._cache.has_key(n), self._loaded.keys()))
+        return out
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def getRecord(self, name):
+        """
+        return the still-encoded record for the named product if it has
+        not been decoded (and so cannot have been modified), else None
+        """
+        if self._loaded.has_key(name) or self._deleted.has_key(name):
+            return None
+        return self._cache.getRecord(name)
+
+    def getSummary(self, name):
+        """
+        return the summary (see summarize()) of the named product if it has
+        not been decoded (and so cannot have been modified), else None
+        """
+        if self._loaded.has_key(name) or self._deleted.has_key(name):
+            return None
+        return self._cache.getSummary(name)
+
+    def __reduce__(self):
+        # pickle as a plain dictionary; the cache file may not outlive us
+        return (dict, (dict(self.items()),))
+
+def summarize(family):
+    """
+    return a summary of a ProductFamily: a tuple of a dictionary giving the
+    installation directory and table file of each version, and a dictionary
+    giving the version assigned each tag
+    """
+    versions = {}
+    for version, info in family.versions.items():
+        versions[version] = info[:2]
+    return (versions, family.tags.copy())
+
+def read(file):
+    """
+    return a dictionary-like object of the ProductFamily instances saved in
+    a cache file by write().
+    @throws IOError if the file is not a product cache of this format
+    """
+    return CachedFamilies(ProductCache(file))
+
+def write(file, families):
+    """
+    save a dictionary of ProductFamily instances, keyed by product name,
+    to a cache file.  The file is replaced atomically so that anyone who
+    has the previous version open (or mapped) is not affected.
+    @param file      the path to the cache file
+    @param families  the ProductFamily instances, keyed by name
+    """
+    names = families.keys()
+    names.sort()
+
+    tmpfile = "%s.tmp%d" % (file, os.getpid())
+    fd = open(tmpfile, "wb")
+    try:
+        try:
+            fd.write(_header.pack(_magic, formatVersion, 0, 0, 0))
+
+            records = []
+            summary = {}
+            offset = _header.size
+            for name in names:
+                rec = None
+                if hasattr(families, "getRecord"):
+                    rec = families.getRecord(name)
+                if rec is None:
+                    fam = families[name]
+                    rec = cPickle.dumps(fam, cPickle.HIGHEST_PROTOCOL)
+                    summary[name] = summarize(fam)
+                else:
+                    summary[name] = families.getSummary(name)
+                    if summary[name] is None:
+                        summary[name] = summarize(cPickle.loads(rec))
+                fd.write(rec)
+                records.append((offset, len(rec)))
+                offset += len(rec)
+
+            index = offset
+            noff = index + len(names)*_entry.size
+            for name, (roff, rlen) in zip(names, records):
+                fd.write(_entry.pack(noff, len(name), roff, rlen))
+                noff += len(name)
+            for name in names:
+                fd.write(name)
+            cPickle.dump(summary, fd, cPickle.HIGHEST_PROTOCOL)
+
+            fd.seek(0)
+            fd.write(_header.pack(_magic, formatVersion, len(names), index, noff))
+        finally:
+            fd.close()
+
+        os.rename(tmpfile, file)
+    except:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
@@ -1,9 +1,11 @@
 import os
+from bisect import bisect_left, bisect_right
 from eups import utils
 from eups.Product import Product
 import eups.tags
 from eups.exceptions import ProductNotFound, TableFileNotFound
 from eups.table import Table
+from eups.VersionCompare import sortKeyIsExact, sortKeyCompare
 
 class ProductFamily(object):
     """
@@ -29,12 +31,119 @@ class ProductFamily(object):
         # value is the version name assigned to the tag.
         self.tags = {}
 
+        # the versions in increasing order, as a tuple of the sort key 
+        # function used, the sorted keys, the versions, and a dictionary of 
+        # the versions whose keys may not order them exactly as the versions'
+        # comparison function does (see VersionCompare.sortKeyIsExact()).  It
+        # is made when first needed (see getSortedVersions()) and then kept 
+        # up to date by addVersion() and removeVersion().
+        self._sorted = None
+
+    def __getstate__(self):
+        # the sort key function may not be picklable
+        state = self.__dict__.copy()
+        state["_sorted"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if not state.has_key("_sorted"):
+            self._sorted = None
+
     def getVersions(self):
         """
         return a list containing the verison names in this product family
         """
         return self.versions.keys()
 
+    def _sortVersions(self, key):
+        if self._sorted is None or self._sorted[0] != key:
+            items = [(key(v), v) for v in self.versions.keys()]
+            items.sort()
+            inexact = {}
+            for k, v in items:
+                if not sortKeyIsExact(key, v):
+                    inexact[v] = True
+            self._sorted = (key, [k for k, v in items], [v for k, v in items], inexact)
+        return self._sorted
+
+    def getSortedVersions(self, key):
+        """
+        return a list of the version names in increasing order.  The order
+        is remembered, so that later calls with the same key are cheap.
+
+        @param key   a function that maps a version name to a key that sorts 
+                       in the desired order (e.g. as returned by 
+                       eups.VersionCompare.versionSortKey())
+        """
+        return self._sortVersions(key)[2][:]
+
+    def getLatestVersion(self, key, minver=None):
+        """
+        return the latest version name, or None if there are no versions 
+        (or none at least as new as minver).  If the sort keys of any of the
+        versions may not order them exactly (see getVersionsBetween()), the 
+        versions are sorted with their comparison function instead.
+
+        @param key     the sort key function (see getSortedVersions())
+        @param minver  if not None, the version must sort no earlier than this
+        """
+        key, keys, versions, inexact = self._sortVersions(key)
+        if not versions:
+            return None
+        if inexact:
+            compare = sortKeyCompare(key)
+            versions = self.versions.keys()
+            versions.sort(compare)
+            if minver is not None and compare(versions[-1], minver) < 0:
+                return None
+            return versions[-1]
+
+        if minver is not None and keys[-1] < key(minver):
+            return None
+        return versions[-1]
+
+    def getVersionsBetween(self, key, lower=None, upper=None, 
+                           includeLower=True, includeUpper=True):
+        """
+        return the version names, in increasing order, that sort between 
+        two versions; these are found by bisection.  As the sort keys of some
+        versions (e.g. 3.0rc1) may not order them exactly as their comparison
+        function does (see VersionCompare.sortKeyIsExact()), such versions 
+        are always included, and if lower or upper is such a version all the 
+        versions are returned
+
+        @param key           the sort key function (see getSortedVersions())
+        @param lower         the earliest version wanted; if None, there is 
+                               no lower limit
+        @param upper         the latest version wanted; if None, there is no
+                               upper limit
+        @param includeLower  if False, exclude versions that sort equal to lower
+        @param includeUpper  if False, exclude versions that sort equal to upper
+        """
+        key, keys, versions, inexact = self._sortVersions(key)
+
+        for v in (lower, upper):
+            if v is not None and not sortKeyIsExact(key, v):
+                return versions[:]
+
+        start, end = 0, len(versions)
+        if lower is not None:
+            if includeLower:
+                start = bisect_left(keys, key(lower))
+            else:
+                start = bisect_right(keys, key(lower))
+        if upper is not None:
+            if includeUpper:
+                end = bisect_right(keys, key(upper))
+            else:
+                end = bisect_left(keys, key(upper))
+
+        if not inexact:
+            return versions[start:end]
+
+        return [v for i, v in enumerate(versions) if (i >= start and i < end) or inexact.has_key(v)]
+
     def getProduct(self, version, dbpath=None, flavor=None):
         """
         return the Product of the requested version or None if not found.
@@ -138,6 +247,18 @@ class ProductFamily(object):
             msg = "Missing version name while registering new version " + \
                 "for product %s: %s"
             raise RuntimeError(msg % (self.name, version))
+
+        if self._sorted is not None and not self.versions.has_key(version):
+            key, keys, versions, inexact = self._sorted
+            k = key(version)
+            i = bisect_right(keys, k)
+            while i > 0 and keys[i-1] == k and versions[i-1] > version:
+                i -= 1                  # keep equal keys ordered by name
+            keys.insert(i, k)
+            versions.insert(i, version)
+            if not sortKeyIsExact(key, version):
+                inexact[version] = True
+
         self.versions[version] = (installdir, tablefile, table)
 
     def hasVersion(self, version):
@@ -162,6 +283,14 @@ class ProductFamily(object):
             for tag in itsTags:
                 self.unassignTag(tag)
             del self.versions[version]
+
+            if self._sorted is not None:
+                key, keys, versions, inexact = self._sorted
+                i = versions.index(version)
+                del keys[i]
+                del versions[i]
+                if inexact.has_key(version):
+                    del inexact[version]
             return True
         else:
             return False
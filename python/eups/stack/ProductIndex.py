@@ -0,0 +1,180 @@
+import re, fnmatch
+from bisect import bisect_left, bisect_right
+import ProductCache
+
+# compiled glob patterns, shared by all indexes
+_patterns = {}
+
+def _compile(pattern):
+    """
+    return a function matching strings against a glob pattern (as used
+    by fnmatch)
+    """
+    try:
+        return _patterns[pattern]
+    except KeyError:
+        match = re.compile(fnmatch.translate(pattern)).match
+        _patterns[pattern] = match
+        return match
+
+class ProductIndex(object):
+    """
+    a read-only, column-oriented index of the products of one flavor of a
+    stack, used to answer queries (such as those made by "eups list")
+    without creating a Product for each declared version.
+
+    Each declared version is a row; the columns hold the product name, the
+    version name, the installation directory and the tags assigned to the
+    version.  The rows are sorted by product name, so the rows of a product
+    are contiguous and found by bisection, and the rows assigned each tag
+    are listed so that tag queries need not look at the other rows.
+
+    An index describes the families it was created from at that moment;
+    ProductStack.getIndex() creates a new one whenever the stack changes.
+    """
+
+    def __init__(self, families):
+        """
+        @param families   the ProductFamily instances, keyed by product name
+                            (e.g. ProductStack.lookup[flavor]).  If it can
+                            provide a summary of a product (see
+                            ProductCache.summarize()) without decoding it,
+                            it will be asked to.
+        """
+        self.names = []
+        self.versions = []
+        self.dirs = []
+        self.tags = []
+
+        # the names of the indexed products, sorted
+        self.productNames = families.keys()
+        self.productNames.sort()
+
+        # the rows (as a slice) describing each product
+        self._rows = {}
+
+        # the rows that have been assigned each tag
+        self._tagged = {}
+
+        for name in self.productNames:
+            summary = None
+            if hasattr(families, "getSummary"):
+                summary = families.getSummary(name)
+            if summary is None:
+                summary = ProductCache.summarize(families[name])
+            versions, tags = summary
+
+            versionTags = {}
+            for tag, version in tags.items():
+                versionTags.setdefault(version, []).append(tag)
+
+            start = len(self.names)
+            vers = versions.keys()
+            vers.sort()
+            for version in vers:
+                row = len(self.names)
+                vtags = tuple(versionTags.get(version, ()))
+                self.names.append(name)
+                self.versions.append(version)
+                self.dirs.append(versions[version][0])
+                self.tags.append(vtags)
+                for tag in vtags:
+                    self._tagged.setdefault(tag, []).append(row)
+
+            self._rows[name] = (start, len(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def getProductNames(self, pattern=None):
+        """
+        return the sorted names of the indexed products
+        @param pattern   if not None, only return the names that match this
+                           glob pattern (as used by fnmatch)
+        """
+        if not pattern:
+            return self.productNames[:]
+
+        if not re.search(r"[*?[]", pattern):
+            if self._rows.has_key(pattern):
+                return [pattern]
+            return []
+        #
+        # A fixed prefix bounds the names that might match
+        #
+        prefix = re.split(r"[*?[]", pattern, 1)[0]
+        start = bisect_left(self.productNames, prefix)
+        if prefix:
+            end = bisect_right(self.productNames, prefix + "\xff", start)
+        else:
+            end = len(self.productNames)
+
+        match = _compile(pattern)
+        return [n for n in self.productNames[start:end] if match(n)]
+
+    def getVersions(self, name):
+        """
+        return the versions of the named product, or an empty list if it
+        is not indexed
+        """
+        start, end = self._rows.get(name, (0, 0))
+        return self.versions[start:end]
+
+    def getTagNames(self):
+        """
+        return the names of the tags assigned to any indexed product
+        """
+        return self._tagged.keys()
+
+    def getTaggedNames(self, tags):
+        """
+        return a dictionary whose keys are the names of the products that
+        have a version assigned at least one of the given tags
+        @param tags   a list of tag names, as stored in the ProductFamily
+        """
+        out = {}
+        for tag in tags:
+            for row in self._tagged.get(tag, []):
+                out[self.names[row]] = True
+        return out
+
+    def getTaggedVersions(self, name, tags):
+        """
+        return the versions of the named product that are assigned at least
+        one of the given tags
+        @param name   the product name
+        @param tags   a list of tag names, as stored in the ProductFamily
+        """
+        start, end = self._rows.get(name, (0, 0))
+        out = []
+        for row in xrange(start, end):
+            for tag in self.tags[row]:
+                if tag in tags:
+                    out.append(self.versions[row])
+                    break
+        return out
+
+    def select(self, name=None, version=None, tags=None):
+        """
+        generate the (name, version, dir, tags) of each row that matches
+        the given criteria
+        @param name      a product name glob pattern, or None to match any
+        @param version   a version glob pattern, or None to match any
+        @param tags      a list of tag names (as stored in the
+                           ProductFamily) at least one of which must be
+                           assigned, or None to match any
+        """
+        if version:
+            matchVersion = _compile(version)
+        for pname in self.getProductNames(name):
+            start, end = self._rows[pname]
+            for row in xrange(start, end):
+                if version and not matchVersion(self.versions[row]):
+                    continue
+                if tags is not None:
+                    for tag in self.tags[row]:
+                        if tag in tags:
+                            break
+                    else:
+                        continue
+                yield (pname, self.versions[row], self.dirs[row], self.tags[row])
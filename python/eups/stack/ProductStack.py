@@ -1,7 +1,11 @@
-import pwd, re, os, cPickle, sys
+import pwd, re, os, cPickle, sys, time
+from UserDict import DictMixin
 from eups import utils
 from eups import Product
+from eups import lock
 from ProductFamily import ProductFamily
+import ProductCache
+from ProductIndex import ProductIndex
 from eups.exceptions import EupsException,ProductNotFound, UnderSpecifiedProduct
 from eups.db import Database
 
@@ -10,7 +14,12 @@ from eups.db import Database
 
 # the version name for the persistence format used by this implementation.
 # It is intended to match the version of EUPS when this format was introduced
-persistVersionName = "1.3.0"
+persistVersionName = "1.5.8"
+
+# the version name for the older format, which simply pickles each flavor's
+# products.  It is still used if ProductStack.persistFileExt is set to 
+# ProductStack.pickleFileExt
+picklePersistVersionName = "1.3.0"
 
 # the prefix to a tag name that labels it as a user tag.  Anything left over is 
 # considered a global tag.
@@ -19,6 +28,19 @@ userPrefix = "user:"
 dotre = re.compile(r'\.')
 who = pwd.getpwuid(os.geteuid())[0]
 
+# bumped whenever a ProductStack in this process is changed, so that the
+# other stacks know to check that their caches are still in sync
+_processGeneration = 0
+
+def resetSync():
+    """
+    make every ProductStack check that its caches are in sync before it is 
+    next used, whatever its syncInterval.  Call this after running a 
+    command (such as a build script) that may have changed a database.
+    """
+    global _processGeneration
+    _processGeneration += 1
+
 class ProductStack(object):
     """
     a lookup for products installed into a software "stack" managed by 
@@ -45,7 +67,10 @@ class ProductStack(object):
     persistVersion = persistVersionName
 
     # static variable: name of file extension to use to persist data
-    persistFileExt = "pickleDB%s" % dotre.sub('_', persistVersionName)
+    persistFileExt = "cacheDB%s" % dotre.sub('_', persistVersionName)
+
+    # static variable: name of file extension used by the pickle format
+    pickleFileExt = "pickleDB%s" % dotre.sub('_', picklePersistVersionName)
 
     # static variable: regexp for cache file names
     persistFileRe = re.compile(r'^(\w\S*)\.%s$' % persistFileExt)
@@ -113,6 +138,21 @@ class ProductStack(object):
         # True if python is new enough to pickle the cache data
         self.canCache = utils.canPickle()
 
+        # a ProductIndex for each flavor, with the lookup and the generation
+        # (see _flavorsUpdated()) that it was made from
+        self._indexes = {}
+        self._generation = 0
+
+        # how often (in seconds) ensureInSync() checks the cache files.  If 
+        # None, they are only checked once, and again after any stack in 
+        # this process is changed
+        self.syncInterval = 0
+
+        # when ensureInSync() last checked the cache files, and the value 
+        # of _processGeneration at the time
+        self._syncedAt = None
+        self._syncedGeneration = None
+
 
     def getDbPath(self):
         """
@@ -165,6 +205,35 @@ class ProductStack(object):
         except KeyError:
           return []
 
+    def getLatestVersion(self, productName, flavor, key):
+        """
+        return the latest version declared for a product, or None if it has
+        no versions of the given flavor
+        @param productName   the name of the product of interest
+        @param flavor        the flavor to search
+        @param key           a function mapping a version to a sort key 
+                               (see ProductFamily.getSortedVersions())
+        """
+        try:
+            return self.lookup[flavor][productName].getLatestVersion(key)
+        except KeyError:
+            return None
+
+    def getVersionsBetween(self, productName, flavor, key, lower=None, upper=None,
+                           includeLower=True, includeUpper=True):
+        """
+        return the versions declared for a product that sort between two 
+        versions (see ProductFamily.getVersionsBetween())
+        @param productName   the name of the product of interest
+        @param flavor        the flavor to search
+        @param key           a function mapping a version to a sort key 
+        """
+        try:
+            fam = self.lookup[flavor][productName]
+        except KeyError:
+            return []
+        return fam.getVersionsBetween(key, lower, upper, includeLower, includeUpper)
+
     def hasProduct(self, name, flavor=None, version=None):
         """
         return true if a desired product is registered.
@@ -208,6 +277,22 @@ class ProductStack(object):
         except KeyError:
             raise ProductNotFound(name, version, flavor)
 
+    def getIndex(self, flavor):
+        """
+        return a ProductIndex of the products of the given flavor.  The
+        index is reused until the stack is changed.
+        @throws KeyError  if the flavor is not supported by this stack
+        """
+        families = self.lookup[flavor]
+        if self._indexes.has_key(flavor):
+            index, lookup, generation = self._indexes[flavor]
+            if lookup is families and generation == self._generation:
+                return index
+
+        index = ProductIndex(families)
+        self._indexes[flavor] = (index, families, self._generation)
+        return index
+
     # @staticmethod   # requires python 2.4
     def persistFilename(flavor):
         return "%s.%s" % (flavor, ProductStack.persistFileExt)
@@ -231,16 +316,21 @@ class ProductStack(object):
             flavors = [flavors]
 
         outofsync = []
-        for flavor in flavors:
-            file = self._persistPath(flavor, dir)
-            if not self._cacheFileIsInSync(file):
-                # file was updated since we loaded from it last!
-                outofsync.append(file)
-                continue
-
-            self.persist(flavor, file)
-            if dir is None:
-                self.updated = filter(lambda x: x != flavor, self.updated)
+        # don't let anyone else rewrite the cache between our checking and saving it
+        locks = lock.takeWriteLock(os.path.dirname(self.dbpath))
+        try:
+            for flavor in flavors:
+                file = self._persistPath(flavor, dir)
+                if not self._cacheFileIsInSync(file):
+                    # file was updated since we loaded from it last!
+                    outofsync.append(file)
+                    continue
+
+                self.persist(flavor, file)
+                if dir is None:
+                    self.updated = filter(lambda x: x != flavor, self.updated)
+        finally:
+            lock.giveLocks(locks)
 
         if len(outofsync) > 0:
             raise CacheOutOfSync(outofsync)
@@ -288,15 +378,18 @@ class ProductStack(object):
             dir = self.persistDir
             if not dir:
                 dir = self.dbpath
-            file = os.path.join(dir, persistFilename(flavor))
+            file = os.path.join(dir, self.persistFilename(flavor))
 
         if not self.lookup.has_key(flavor):
             self.lookup[flavor] = {}
         flavorData = self.lookup[flavor]
 
-        fd = open(file, "w")
-        cPickle.dump(flavorData, fd)
-        fd.close()
+        if file.endswith(self.pickleFileExt):
+            fd = open(file, "w")
+            cPickle.dump(flavorData, fd)
+            fd.close()
+        else:
+            ProductCache.write(file, flavorData)
         self.modtimes[file] = os.stat(file).st_mtime
 
     def export(self):
@@ -329,13 +422,26 @@ class ProductStack(object):
                                  If None, the directory set at construction
                                  time will be used.  
         @param verbose         if > 0, print a message if reload is necessary
+
+        The cache files are not checked if they were checked recently 
+        enough (see syncInterval), so this is cheap to call before every 
+        lookup.
         """
+        if self._syncedAt is not None and \
+           self._syncedGeneration == _processGeneration and \
+           (self.syncInterval is None or time.time() - self._syncedAt < self.syncInterval):
+            return
+
         if not self.cacheIsInSync(flavors):
             if verbose > 0:
                 print >> sys.stderr, \
                     "Note: cache appears out-of-sync; updating..."
             self.reload(flavors, persistDir)
 
+        if not flavors and self.syncInterval != 0:
+            self._syncedAt = time.time()
+            self._syncedGeneration = _processGeneration
+
     def addFlavor(self, flavor): 
         """
         register a flavor without products.  
@@ -386,10 +492,15 @@ class ProductStack(object):
         self._flavorsUpdated(flavor)
         if self.autosave: self.save(flavor)
 
-    def _flavorsUpdated(self, flavors=None):
+    def _flavorsUpdated(self, flavors=None, tablesOnly=False):
         # this function is called whenever the stack is updated to add
         # the updated flavors to self.updated.  The value of self.updated,
         # therefore, indicates which flavors need to updated to disk.
+        # Loading a table (tablesOnly) doesn't change the declared products.
+        if not tablesOnly:
+            global _processGeneration
+            _processGeneration += 1
+            self._generation += 1
         if flavors is None:
             self.updated = self.getFlavors()
         elif isinstance(flavors, list):
@@ -572,7 +683,7 @@ class ProductStack(object):
                 table = prod.getTable()
 
             self.lookup[flavor][productName].loadTableFor(version, table)
-            self._flavorsUpdated(flavor)
+            self._flavorsUpdated(flavor, tablesOnly=True)
         except KeyError:
             raise ProductNotFound(productName, version, flavor)
 
@@ -606,13 +717,17 @@ class ProductStack(object):
                 except KeyError:
                     pass
 
-    def cacheIsUpToDate(self, flavor, cacheDir=None):
+    def cacheIsUpToDate(self, flavor, cacheDir=None, verify=False):
         """
         return True if there is a cache file on disk with product information
         for a given flavor which is newer than the information in the 
         product database.  False is returned if the file does not exist
         or otherwise appears out-of-date.
 
+        Normally only the databases' change journals are consulted; if 
+        verify is True, every product's files are examined instead (see 
+        Database.isNewerThan()).
+
         Note that this is different from cacheIsInSync()
         """
         if not cacheDir:
@@ -626,12 +741,12 @@ class ProductStack(object):
 
         # check for user tag updates
         if cacheDir != self.dbpath and \
-           Database(cacheDir).isNewerThan(cache_mtime):
+           Database(cacheDir).isNewerThan(cache_mtime, verify=verify):
             return False
 
         # this is slightly inaccurate: if data for any flavor in the database
         # is newer than this time, this isNewerThan() returns True
-        return not Database(self.dbpath).isNewerThan(cache_mtime)
+        return not Database(self.dbpath).isNewerThan(cache_mtime, verify=verify)
 
     def clearCache(self, flavors=None, cachedir=None, verbose=0):
         """
@@ -685,20 +800,27 @@ class ProductStack(object):
         for flavor in flavors:
             fileName = self._persistPath(flavor,persistDir)
             self.modtimes[fileName] = os.stat(fileName).st_mtime
-            fd = open(fileName)
-            lookup = cPickle.load(fd)
-            fd.close()
+            if fileName.endswith(self.pickleFileExt):
+                fd = open(fileName)
+                lookup = cPickle.load(fd)
+                fd.close()
+            else:
+                # products are only decoded as they are needed
+                lookup = ProductCache.read(fileName)
 
             self.lookup[flavor] = lookup
 
     # @staticmethod   # requires python 2.4
     def findCachedFlavors(dir):
 
+        # persistFileExt may have been changed to select the pickle format
+        persistFileRe = re.compile(r'^(\w\S*)\.%s$' % ProductStack.persistFileExt)
+
         # read comments from bottom to top
         return map(lambda a: a.group(1),  # extra flavor name
                    filter(lambda b: b,    # grab only cache files
                           # match file against cache file pattern
-                          map(lambda c: ProductStack.persistFileRe.match(c),
+                          map(lambda c: persistFileRe.match(c),
                               # list contents of directory
                               os.listdir(dir))))
 
@@ -753,7 +875,7 @@ class ProductStack(object):
 
     # @staticmethod   # requires python 2.4
     def fromCache(dbpath, flavors, persistDir=None, userTagDir=None, 
-                  updateCache=True, autosave=True, verbose=0):
+                  updateCache=True, autosave=True, verbose=0, lazy=False):
         """
         return a ProductStack that has all products loaded in from the 
         available caches.  If they are out of date (or non-existent), this 
@@ -780,6 +902,10 @@ class ProductStack(object):
                                appear out of date
         @param autosave     if true (default), all updates will be 
                                saved to disk.
+        @param lazy         if true, and a cache exists, only load 
+                               products from it (or the database) when they
+                               are first asked for; see LazyProductFamilies.
+                               The cache is not updated in this case.
         """
         if not flavors:
             raise RuntimeError("ProductStack.fromCache(): at least one flavor needed as input" +
@@ -789,6 +915,12 @@ class ProductStack(object):
 
         out = ProductStack(dbpath, persistDir, False)
 
+        if lazy:
+            if out._tryLazyCache(dbpath, persistDir, flavors, userTagDir) or \
+               out._tryLazyCache(dbpath, dbpath, flavors, userTagDir, addUserTags=True):
+                out.autosave = autosave
+                return out
+
         cacheOkay = out._tryCache(dbpath, persistDir, flavors, verbose=verbose)
         if not cacheOkay:
             cacheOkay = out._tryCache(dbpath, dbpath, flavors)
@@ -819,7 +951,13 @@ class ProductStack(object):
                 break
 
         if cacheOkay:
-            self.reload(flavors, cacheDir, verbose=verbose)
+            try:
+                self.reload(flavors, cacheDir, verbose=verbose)
+            except IOError, e:
+                if verbose > 1:
+                    print >> sys.stderr, "Regenerating unreadable cache: %s" % e
+                self.lookup = {}
+                return False
 
             # do a final consistency check; do we have the same products
             dbnames = Database(dbpath).findProductNames()
@@ -839,6 +977,207 @@ class ProductStack(object):
 
         return cacheOkay
 
+    def _tryLazyCache(self, dbpath, cacheDir, flavors, userTagDir=None, 
+                      addUserTags=False, verbose=0):
+        if not cacheDir or not os.path.exists(cacheDir):
+            return False
+
+        db = Database(dbpath, userTagDir)
+        lookup = {}
+        for flav in flavors:
+            fileName = self._persistPath(flav, cacheDir)
+            if not os.path.exists(fileName):
+                return False
+            try:
+                lookup[flav] = LazyProductFamilies(db, flav, fileName, addUserTags)
+            except IOError, e:
+                if verbose > 1:
+                    print >> sys.stderr, "Ignoring unreadable cache: %s" % e
+                return False
+
+        for flav in flavors:
+            self.lookup[flav] = lookup[flav]
+            self.modtimes[self._persistPath(flav, cacheDir)] = lookup[flav].cacheTime
+        return True
+
+class LazyProductFamilies(DictMixin):
+    """
+    a dictionary of the ProductFamily instances for one flavor of a stack, 
+    keyed by product name, that only loads a family when it is first asked
+    for.  The family is decoded from a cache file (see ProductCache) if 
+    the product's files have not changed since the cache was written; 
+    otherwise it is read from the database.  If the database's change 
+    journal shows that nothing has changed, the product's files are not 
+    even checked.  
+    """
+
+    def __init__(self, db, flavor, cacheFile, addUserTags=False):
+        """
+        @param db           the Database to read products from
+        @param flavor       the flavor of the products
+        @param cacheFile    a cache file written by ProductStack.persist()
+        @param addUserTags  if True, the cache does not include user tags,
+                              so they are read from the database
+        @throws IOError if the file is not a product cache
+        """
+        self._db = db
+        self._flavor = flavor
+        self._cache = ProductCache.ProductCache(cacheFile)
+        self.cacheTime = os.stat(cacheFile).st_mtime
+        self._addUserTags = addUserTags
+
+        # the database directories whose changes invalidate the cache
+        self._dbdirs = [db.dbpath]
+        userdb = db._getUserTagDb()
+        if userdb and os.path.isdir(userdb):
+            self._dbdirs.append(userdb)
+
+        self._allFresh = True
+        for dbdir in self._dbdirs:
+            changed = db.lastChanged(dbdir)
+            if changed is None or changed > self.cacheTime:
+                self._allFresh = False
+
+        # families loaded so far, or None if not declared for this flavor
+        self._loaded = {}
+
+        # the user tag assignments for this flavor, if needed and read:
+        # product name -> [(tag, version)]
+        self._userTags = None
+
+    def _isFresh(self, name):
+        if self._allFresh:
+            return True
+        for dbdir in self._dbdirs:
+            if dbdir != self._db.dbpath and \
+               not os.path.isdir(self._db._productDir(name, dbdir)):
+                continue                # no user tags for this product
+            if self._db.productIsNewerThan(name, self.cacheTime, dbdir):
+                return False
+        return True
+
+    def _load(self, name):
+        try:
+            return self._loaded[name]
+        except KeyError:
+            pass
+
+        if self._cache.has_key(name) and self._isFresh(name):
+            fam = self._cache.getFamily(name)
+            if self._addUserTags:
+                for tag, version, flavor in self._db.getTagAssignments(name, glob=False):
+                    if flavor == self._flavor and fam.hasVersion(version):
+                        fam.assignTag(tag, version)
+        elif self._allFresh:
+            fam = None                  # not declared when the cache was written
+        else:
+            fam = self._readFamily(name)
+
+        self._loaded[name] = fam
+        return fam
+
+    def _readFamily(self, name):
+        if not os.path.isdir(self._db._productDir(name)):
+            return None
+        products = self._db.findProducts(name, flavors=self._flavor)
+        if not products:
+            return None
+
+        fam = ProductFamily(name)
+        for prod in products:
+            prod = prod.clone().resolvePaths()
+            fam.addVersion(prod.version, prod.dir, prod.tablefile, prod._table)
+            for tag in prod.tags:
+                fam.assignTag(tag, prod.version)
+        return fam
+
+    def __getitem__(self, name):
+        fam = self._load(name)
+        if fam is None:
+            raise KeyError(name)
+        return fam
+
+    def __setitem__(self, name, family):
+        self._loaded[name] = family
+
+    def __delitem__(self, name):
+        if self._load(name) is None:
+            raise KeyError(name)
+        self._loaded[name] = None
+
+    def has_key(self, name):
+        return self._load(name) is not None
+
+    __contains__ = has_key
+
+    def keys(self):
+        if self._allFresh:
+            names = self._cache.names()
+        else:
+            names = self._db.findProductNames()
+        names.extend(self._loaded.keys())
+
+        out = []
+        seen = {}
+        for name in names:
+            if seen.has_key(name):
+                continue
+            seen[name] = True
+
+            if not self._loaded.has_key(name) and self._allFresh and \
+               self._cache.has_key(name):
+                out.append(name)        # no need to decode it
+            elif self._load(name) is not None:
+                out.append(name)
+        return out
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def getRecord(self, name):
+        """
+        return the still-encoded cache record for the named product if 
+        it is known to be up to date and has not been loaded, else None
+        """
+        if self._allFresh and not self._addUserTags and \
+           not self._loaded.has_key(name):
+            return self._cache.getRecord(name)
+        return None
+
+    def getSummary(self, name):
+        """
+        return a summary of the named product (see ProductCache.summarize())
+        without decoding it if it is known to be up to date and has not been
+        loaded, else None
+        """
+        if not self._allFresh or self._loaded.has_key(name):
+            return None
+        summary = self._cache.getSummary(name)
+        if summary is None or not self._addUserTags:
+            return summary
+
+        if self._userTags is None:
+            self._userTags = {}
+            for product, assignments in self._db.getAllTagAssignments(glob=False).items():
+                for tag, version, flavor in assignments:
+                    if flavor == self._flavor:
+                        self._userTags.setdefault(product, []).append((tag, version))
+
+        versions, tags = summary
+        if self._userTags.has_key(name):
+            tags = tags.copy()
+            for tag, version in self._userTags[name]:
+                if versions.has_key(version):
+                    tags[tag] = version
+        return (versions, tags)
+
+    def __reduce__(self):
+        # pickle as a plain dictionary
+        return (dict, (dict(self.items()),))
+
 def _uniquify(lis):
     for i in xrange(len(lis)):
         item = lis.pop(0)
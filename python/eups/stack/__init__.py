@@ -8,6 +8,11 @@ The major classes are:
                        to speed up recreation of a stack instance later.
    ProductFamily   a collection of different versions of product (installed 
                        for the same flavor).  
+   ProductCache    the indexed file format that a ProductStack uses to 
+                       persist the ProductFamily instances for a flavor.
+   ProductIndex    a column-oriented index of the products of a flavor,
+                       used to answer queries without creating Products.
 """
 from ProductFamily import ProductFamily
-from ProductStack import ProductStack, persistVersionName, CacheOutOfSync
+from ProductIndex import ProductIndex
+from ProductStack import ProductStack, persistVersionName, CacheOutOfSync, resetSync
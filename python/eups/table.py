@@ -6,6 +6,14 @@
 #
 import os
 import re, sys
+import threading
+from cStringIO import StringIO
+try:
+    import hashlib
+    _md5 = hashlib.md5
+except ImportError:                     # python < 2.5
+    import md5
+    _md5 = md5.new
 
 import eups
 from exceptions import BadTableContent, TableError, TableFileNotFound, ProductNotFound
@@ -15,6 +23,49 @@ from VersionParser import VersionParser
 import utils
 import hooks
 
+#
+# Patterns used to parse table files, compiled once.  _rewrite() classifies each
+# line with _keywordRe (the archaic File=, Product=, Action=, Qualifiers=, Flavor=
+# lines and the Group:/Common:/End: markers), and _parse() then recognises the
+# if/else structure with _conditionalRe and the actions with _actionRe.
+#
+_keywordRe = re.compile(r"^(?:(File|Product)\s*=\s*(\w+)|"
+                        r"(Action|Flavor)\s*=\s*([\w+.]+)|"
+                        r"(Qualifiers)\s*=\s*\"([^\"]*)\"|"
+                        r"(Group|Common|End):\s*$)", re.IGNORECASE)
+_synonymRe = re.compile(r"\${(PROD_DIR|UPS_PROD_DIR|UPS_PROD_FLAVOR|UPS_PROD_NAME|UPS_PROD_VERSION|"
+                        r"UPS_DB|UPS_UPS_DIR)}")
+_synonyms = {                           # older synonyms for eups variables in table files
+    "PROD_DIR"         : "${PRODUCT_DIR}",
+    "UPS_PROD_DIR"     : "${PRODUCT_DIR}",
+    "UPS_PROD_FLAVOR"  : "${PRODUCT_FLAVOR}",
+    "UPS_PROD_NAME"    : "${PRODUCT_NAME}",
+    "UPS_PROD_VERSION" : "${PRODUCT_VERSION}",
+    "UPS_DB"           : "${PRODUCTS}",
+    "UPS_UPS_DIR"      : "${UPS_DIR}",
+    }
+_conditionalRe = re.compile(r"^(?:if\s*\((.*)\)\s*{\s*|}\s*(?:(else(?:\s*if\s*\((.*)\))?)\s*{)?)$",
+                            re.IGNORECASE)
+_actionRe = re.compile(r'^(\w+)\s*\(([^)]*)\)')
+_spaceArgRe = re.compile(r',\s*"(\s)"')
+_quotedRe = re.compile(r'"[^"]+"')
+_argSepRe = re.compile(r"[, ]")
+_productDirRe = re.compile(r"(\$(\?)?{PRODUCT_DIR(_EXTRA)?})")
+_eupsPathRe = re.compile(r"\${EUPS_PATH\[(\d+)\]}")
+_eupsPathIndexRe = re.compile(r"\[(\d+)\]}$")
+_envVarRe = re.compile(r"\$(\?)?{([^-}]*)(?:-([^}]+))?}")
+_versionExprRe = re.compile(r"(?:(\S*)\s+)?\[([^\]]+)\]\s*")
+
+def _unquote(s):
+    """Remove a pair of enclosing double quotes from s"""
+    if len(s) > 1 and s[0] == '"' and s[-1] == '"':
+        return s[1:-1]
+    return s
+
+def _protectQuoted(mat):
+    """Protect the spaces and commas in a quoted string as \\001 and \\003"""
+    return mat.group(0).replace(" ", "\001").replace(",", "\003")
+
 class Table(object):
     """A class that represents a eups table file"""
 
@@ -36,11 +87,21 @@ class Table(object):
         self.topProduct = topProduct
         self.old = False
         self._actions = []
+        self._warnings = []             # (minimum verbosity, stream, message) issued by _parse
 
         if utils.isRealFilename(tableFile):
             self._read(tableFile, addDefaultProduct, verbose, topProduct)
 
-    def _rewrite(self, contents):
+    def _warn(self, verbose, minVerbose, strm, msg):
+        """
+        print a warning about the table file's contents to utils.strm if
+        verbose >= minVerbose, recording it so that the TableCache can repeat it
+        """
+        self._warnings.append((minVerbose, strm, msg))
+        if verbose >= minVerbose:
+            print >> getattr(utils, strm), msg
+
+    def _rewrite(self, contents, verbose=0):
         """Rewrite the contents of a tablefile to the canonical form; each
 line is returned as a tuple (lineNo, line)
 
@@ -56,102 +117,102 @@ but no other interpretation is applied
         for line in contents:
             lineNo += 1
 
-            line = re.sub(r"\n", "", line)
-            line = re.sub(r"^\s*", "", line)
-            line = re.sub(r"#.*$", "", line)
+            line = line.replace("\n", "").lstrip()
+            i = line.find("#")
+            if i >= 0:
+                line = line[:i]
 
             if not line:
                 continue
+
+            if "${" in line:
+                line = _synonymRe.sub(lambda mat: _synonyms[mat.group(1)], line)
             #
-            # Check for certain archaic forms:
+            # Classify the line; kw is the keyword (if any) that it starts with
             #
-            mat = re.search(r"^File\s*=\s*(\w+)", line, re.IGNORECASE)
+            mat = _keywordRe.search(line)
             if mat:
+                kw = (mat.group(1) or mat.group(3) or mat.group(5) or mat.group(7)).lower()
+                value = mat.group(2) or mat.group(4) or mat.group(6)
+            else:
+                kw, value = None, None
+            #
+            # Check for certain archaic forms:
+            #
+            if kw == "file":
                 self.old = True
 
-                if mat.group(1).lower() != "table":
-                    msg = "Expected \"File = Table\"; saw \"%s\" at %s:%d" % (line, self.versionFile, lineNo)
+                if value.lower() != "table":
+                    msg = "Expected \"File = Table\"; saw \"%s\" at %s:%d" % (line, self.file, lineNo)
                     raise BadTableContent(self.file, msg=msg)
                 continue
-            elif self.old:
-                if re.search(r"^Product\s*=\s*(\w+)", line, re.IGNORECASE):
+            elif kw == "product":
+                if self.old:
                     continue
-            # Older synonyms for eups variables in table files
-            line = re.sub(r"\${PROD_DIR}", "${PRODUCT_DIR}", line)
-            line = re.sub(r"\${UPS_PROD_DIR}", "${PRODUCT_DIR}", line)
-            line = re.sub(r"\${UPS_PROD_FLAVOR}", "${PRODUCT_FLAVOR}", line)
-            line = re.sub(r"\${UPS_PROD_NAME}", "${PRODUCT_NAME}", line)
-            line = re.sub(r"\${UPS_PROD_VERSION}", "${PRODUCT_VERSION}", line)
-            line = re.sub(r"\${UPS_DB}", "${PRODUCTS}", line)
-            line = re.sub(r"\${UPS_UPS_DIR}", "${UPS_DIR}", line)
+                kw = None
             #
             # Check for lines that we think are always the same (and can thus be ignored)
             #
-            mat = re.search(r"^Action\s*=\s*([\w+.]+)", line, re.IGNORECASE)
-            if mat:
-                if not re.search(r"setup", mat.group(1), re.IGNORECASE):
-                    msg = "Unsupported action \"%s\" at %s:%d" % (mat.group(1), self.file, lineNo)
+            if kw == "action":
+                if "setup" not in value.lower():
+                    msg = "Unsupported action \"%s\" at %s:%d" % (value, self.file, lineNo)
                     raise BadTableContent(self.file, msg=msg)
                 continue
 
-            mat = re.search(r"^Qualifiers\s*=\s*\"([^\"]*)\"", line, re.IGNORECASE)
-            if mat:
-                if mat.group(1):
+            if kw == "qualifiers":
+                if value:
                     if False:
-                        msg = "Unsupported qualifiers \"%s\" at %s:%d" % (mat.group(1), self.file, lineNo)
+                        msg = "Unsupported qualifiers \"%s\" at %s:%d" % (value, self.file, lineNo)
                         raise BadTableContent(self.file, msg=msg)
                     else:
-                        print >> utils.stdwarn, "Ignoring qualifiers \"%s\" at %s:%d" % (mat.group(1), self.file, lineNo)
+                        self._warn(verbose, 0, "stdwarn",
+                                   "Ignoring qualifiers \"%s\" at %s:%d" % (value, self.file, lineNo))
                 continue
             #
             # Parse Group...Common...End, replacing by a proper If statement
             #
-            if re.search(r"^Group:\s*$", line, re.IGNORECASE):
+            if kw == "group":
                 inGroup = True
                 conditional = ""
                 continue
 
             if inGroup:
-                if re.search(r"^Common:\s*$", line, re.IGNORECASE):
+                if kw == "common":
                     ncontents += [(lineNo, "if (" + conditional + ") {")]
                     continue
 
-                if re.search(r"^End:\s*$", line, re.IGNORECASE):
+                if kw == "end":
                     inGroup = False
                     ncontents += [(lineNo, "}")]
                     continue
 
-                mat = re.search(r"^Flavor\s*=\s*([\w+.]+)", line, re.IGNORECASE)
-                if mat:
+                if kw == "flavor":
                     if conditional:
                         conditional += " || "
 
-                    flavor = mat.group(1)
-                    if flavor.lower() == "any":
+                    if value.lower() == "any":
                         conditional += "FLAVOR =~ .*"
                     else:
-                        conditional += "FLAVOR == %s" % flavor
+                        conditional += "FLAVOR == %s" % value
                     continue
             #
             # New style blocks (a bad design by RHL) begin with one or more Flavor=XXX
             # lines, and continue to the next Flavor=YYY line
             #
             if inNewGroup == "inFlavors": # we're reading a set of FLAVOR=XXX lines
-                mat = re.search(r"^Flavor\s*=\s*([\w+.]+)", line, re.IGNORECASE)
-                if mat:                 # and we've found another
-                    conditional += " || FLAVOR == %s" % mat.group(1)
+                if kw == "flavor":      # and we've found another
+                    conditional += " || FLAVOR == %s" % value
                     continue
                 else:                   # not FLAVOR=XXX; start of the block's body
                     ncontents += [(lineNo, "if (" + conditional + ") {")]
                     inNewGroup = True
             else:                       # Not reading FLAVOR=XXX, so a FLAVOR=XXX starts a new block
-                mat = re.search(r"^Flavor\s*=\s*([\w+.]+)", line, re.IGNORECASE)
-                if mat:
+                if kw == "flavor":
                     if inNewGroup:
                         ncontents += [(lineNo, "}")]
 
                     inNewGroup = "inFlavors"
-                    conditional = "FLAVOR == %s" % mat.group(1)
+                    conditional = "FLAVOR == %s" % value
                     continue
 
             ncontents += [(lineNo, line)]
@@ -164,6 +225,10 @@ but no other interpretation is applied
     def expandEupsVariables(self, product, quiet=False):
         """Expand eups-related variables such as $PRODUCT_DIR"""
 
+        root = product.stackRoot()
+        productDirVar = "${%s}" % utils.dirEnvNameFor(product.name) # e.g. ${FOO_DIR}
+        upsDir = os.path.dirname(self.file)
+
         for actions in self._actions: 
             for logicalOrBlock in actions:
                 if not isinstance(logicalOrBlock, list): # a logical expression as a string
@@ -172,15 +237,16 @@ but no other interpretation is applied
                 for a in logicalOrBlock:
                     for i in range(len(a.args)):
                         value = a.args[i]
+                        if "$" not in value: # nothing to expand
+                            continue
 
-                        root = product.stackRoot()
                         if root:
-                            value = re.sub(r"\${PRODUCTS}", root, value)
-                        elif re.search(r"\${PRODUCTS}", value):
+                            value = value.replace("${PRODUCTS}", root)
+                        elif "${PRODUCTS}" in value:
                             if not quiet:
                                 print >> utils.stderr, "Unable to expand PRODUCTS in %s" % self.file
 
-                        mat = re.search(r"(\$(\?)?{PRODUCT_DIR(_EXTRA)?})", value)
+                        mat = _productDirRe.search(value)
                         if mat:
                             var = mat.group(1)
                             optional = mat.group(2)
@@ -195,45 +261,44 @@ but no other interpretation is applied
                                     newValue = None
 
                             if newValue:
-                                value = re.sub(re.sub(r"([$?.])", r"\\\1", var), newValue, value)
+                                value = value.replace(var, newValue)
                             else:
                                 if not optional and not quiet:
                                     print >> utils.stderr, "Unable to expand %s in %s" % (var, self.file)
                         #
                         # Be nice; they should say PRODUCT_DIR but sometimes PRODUCT is spelled out, e.g. EUPS_DIR
                         #
-                        regexp = r"\${%s}" % utils.dirEnvNameFor(product.name)
-                        if re.search(regexp, value):
+                        if productDirVar in value:
                             if product.dir:
-                                value = re.sub(regexp, product.dir, value)
+                                value = value.replace(productDirVar, product.dir)
                             else:
                                 if not quiet:
                                     print >> utils.stdwarn, "Unable to expand %s in %s" % \
                                           (self.file, utils.dirEnvNameFor(product.name))
 
                         if product.flavor:
-                            value = re.sub(r"\${PRODUCT_FLAVOR}", product.flavor, value)
-                        elif re.search(r"\${PRODUCT_FLAVOR}", value):
+                            value = value.replace("${PRODUCT_FLAVOR}", product.flavor)
+                        elif "${PRODUCT_FLAVOR}" in value:
                             if not quiet:
                                 print >> utils.stdwarn, "Unable to expand PRODUCT_FLAVOR in %s" % self.file
 
-                        value = re.sub(r"\${PRODUCT_NAME}", product.name, value)
-                        if re.search(r"\${PRODUCT_VERSION}", value):
+                        value = value.replace("${PRODUCT_NAME}", product.name)
+                        if "${PRODUCT_VERSION}" in value:
                             if product.version:
-                                value = re.sub(r"\${PRODUCT_VERSION}", product.version, value)
+                                value = value.replace("${PRODUCT_VERSION}", product.version)
                             else:
                                 if not quiet:
                                     print >> utils.stdwarn, "Unable to expand PRODUCT_VERSION in %s" % self.file
 
-                        value = re.sub(r"\${UPS_DIR}", os.path.dirname(self.file), value)
+                        value = value.replace("${UPS_DIR}", upsDir)
                         #
                         # EUPS_PATH is really an environment variable, but handle it here
                         # if the user chose to subscript it, e.g. ${EUPS_PATH[0]}
                         #
-                        mat = re.search(r"\${EUPS_PATH\[(\d+)\]}", value)
+                        mat = _eupsPathRe.search(value)
                         if mat:
                             ind = int(mat.group(1))
-                            value = re.sub(r"\[(\d+)\]}$", "", value) + "}"
+                            value = _eupsPathIndexRe.sub("", value) + "}"
 
                             if not os.environ.has_key("EUPS_PATH"):
                                 if not quiet:
@@ -257,13 +322,58 @@ but no other interpretation is applied
         if not tableFile:               # nothing to do
             return
 
-        try:
-            fd = file(tableFile)
-        except IOError, e:
-            raise TableError(tableFile, msg=str(e))
+        productName = None
+        if topProduct:
+            productName = topProduct.name
+
+        tableCache = TableCache.get()
+        cached = None
+        if tableCache:
+            cached = tableCache.lookup(tableFile, productName)
+
+        if cached:
+            self.old, self._actions, self._warnings = cached
+            self._actions = _decodeActions(self._actions, tableFile, topProduct)
+            for minVerbose, strm, msg in self._warnings:
+                if verbose >= minVerbose:
+                    print >> getattr(utils, strm), msg
+        else:
+            self._parse(tableFile, verbose, topProduct)
+            if tableCache:
+                tableCache.save(tableFile, productName, self.old, _encodeActions(self._actions),
+                                self._warnings)
+        #
+        # Setup the default product, usually "toolchain"
+        #
+        if addDefaultProduct is not False and hooks.config.Eups.defaultProduct["name"]:
+            args = [hooks.config.Eups.defaultProduct["name"]]
+            if hooks.config.Eups.defaultProduct["version"]:
+                args.append(hooks.config.Eups.defaultProduct["version"])
+            if hooks.config.Eups.defaultProduct["tag"]:
+                args.append("--tag")
+                args.append(hooks.config.Eups.defaultProduct["tag"])
+
+            self._actions += [('True',
+                               [Action("implicit", "setupRequired", args,
+                                       {"optional": True, "silent" : True})],
+                               [])]
+
+    def _parse(self, tableFile, verbose=0, topProduct=None):
+        """Parse a table file, setting _actions (without the default product)"""
+
+        contents = None
+        prefetcher = TablePrefetcher.get()
+        if prefetcher:
+            contents = prefetcher.readlines(tableFile)
 
-        contents = fd.readlines()
-        contents = self._rewrite(contents)
+        if contents is None:
+            try:
+                fd = file(tableFile)
+            except IOError, e:
+                raise TableError(tableFile, msg=str(e))
+
+            contents = fd.readlines()
+        contents = self._rewrite(contents, verbose)
 
         logical = "True"                # logical condition required to execute block
         block = []
@@ -281,8 +391,7 @@ but no other interpretation is applied
             #
             # Is this the start of a logical condition?
             #
-            mat = re.search(r"^(?:if\s*\((.*)\)\s*{\s*|}\s*(?:(else(?:\s*if\s*\((.*)\))?)\s*{)?)$", \
-                                line, re.IGNORECASE)
+            mat = _conditionalRe.search(line)
             if mat:
                 if block:
                     if mat.group(2) == "else": # i.e. we saw an } else {
@@ -321,58 +430,32 @@ but no other interpretation is applied
             #
             # Is line of the form action(...)?
             #
-            mat = re.search(r'^(\w+)\s*\(([^)]*)\)', line, re.IGNORECASE)
+            mat = _actionRe.search(line)
             if mat:
                 cmd = mat.group(1).lower()
-                args = re.sub(r'^"(.*)"$', r'\1', mat.group(2))
+                args = _unquote(mat.group(2))
                 #
                 # Protect \" by replacing it with "\002"
                 #
-                args = args.replace(r'\"', r'%c' % 2)
+                args = args.replace(r'\"', "\002")
                 #
                 # Special case cmd(..., " ") by protecting " " as "\001"
                 #
-                args = re.sub(r',\s*"(\s)"', r'\1"%c"' % 1, args)
+                args = _spaceArgRe.sub(r'\1"\001"', args)
                 #
-                # Replace " " within quoted strings with \1 too
+                # Replace " " and , within quoted strings with "\001" and "\003"
                 #
-                args = re.sub(r"(\"[^\"]+\")", lambda s: re.sub(" ", "\1", s.group(0)), args)
+                args = _quotedRe.sub(_protectQuoted, args)
                 #
-                # Replace , within quoted strings with "\003"
+                # Split, remove quotes, and reinstate \001 as a space, \002 as ", and \003 as ,
                 #
-                args = re.sub(r"(\"[^\"]+\")", lambda s: re.sub(",", "%c" % 3, s.group(0)), args)
-
-                args = filter(lambda s: s, re.split("[, ]", args))
-                args = map(lambda s: re.sub(r'^"(.*)"$', r'\1', s), args) # remove quotes
-                args = map(lambda s: re.sub(r'%c' % 1, r' ', s), args) # reinstate \001 as a space
-                args = map(lambda s: re.sub(r'%c' % 2, r'"', s), args) # reinstate \002 as "
-                args = map(lambda s: re.sub(r'%c' % 3, r',', s), args) # reinstate \003 as ,
+                args = [_unquote(a).replace("\001", " ").replace("\002", '"').replace("\003", ",")
+                        for a in _argSepRe.split(args) if a]
 
                 try:
-                    cmd = {
-                        "addalias" : Action.addAlias,
-                        "declareoptions" : Action.declareOptions, 
-                        "envappend" : Action.envAppend,
-                        "envprepend" : Action.envPrepend,
-                        "envset" : Action.envSet,
-                        "envunset" : Action.envUnset,
-                        "pathappend" : Action.envAppend,
-                        "pathprepend" : Action.envPrepend,
-                        "pathremove" : Action.envUnset,
-                        "pathset" : Action.envSet,
-                        "print" : Action.doPrint,
-                        "proddir" : Action.prodDir,
-                        "setupenv" : Action.setupEnv,
-                        "setenv" : Action.envSet,
-                        "unsetenv" : Action.envUnset,
-                        "setuprequired" : Action.setupRequired,
-                        "setupoptional" : Action.setupOptional,
-                        "sourcerequired" : Action.sourceRequired,
-                        "unsetuprequired" : Action.unsetupRequired,
-                        "unsetupoptional" : Action.unsetupOptional,
-                        }[cmd]
+                    cmd = _actionCommands[cmd]
                 except KeyError:
-                    print >> utils.stderr, "Unexpected line in %s:%d: %s" % (tableFile, lineNo, line)
+                    self._warn(verbose, 0, "stderr", "Unexpected line in %s:%d: %s" % (tableFile, lineNo, line))
                     continue
             else:
                 cmd = line; args = []
@@ -431,16 +514,18 @@ but no other interpretation is applied
                     args[0] = pdirVar
                     
                 if args[0] != pdirVar:  # only allow the unsetting of this one variable
-                    if pdirVar and verbose > 0:
-                        print >> utils.stdwarn, "Attempt to unset $%s at %s:%d" % (args[0], self.file, lineNo)
+                    if pdirVar:
+                        self._warn(verbose, 1, "stdwarn",
+                                   "Attempt to unset $%s at %s:%d" % (args[0], self.file, lineNo))
                     continue                
             elif cmd == Action.sourceRequired:
-                print >> utils.stderr, "Ignoring unsupported directive %s at %s:%d" % (line, self.file, lineNo)
+                self._warn(verbose, 0, "stderr",
+                           "Ignoring unsupported directive %s at %s:%d" % (line, self.file, lineNo))
                 continue
             elif cmd == Action.doPrint:
                 pass
             else:
-                print >> utils.stderr, "Unrecognized line: %s at %s:%d" % (line, self.file, lineNo)
+                self._warn(verbose, 0, "stderr", "Unrecognized line: %s at %s:%d" % (line, self.file, lineNo))
                 continue
 
             block += [Action(tableFile, cmd, args, extra, topProduct=topProduct)]
@@ -451,21 +536,6 @@ but no other interpretation is applied
             self._actions.append(logicalBlocks)
         if block:
             self._actions += [(logical, block, [])]
-        #
-        # Setup the default product, usually "toolchain"
-        #
-        if addDefaultProduct is not False and hooks.config.Eups.defaultProduct["name"]:
-            args = [hooks.config.Eups.defaultProduct["name"]]
-            if hooks.config.Eups.defaultProduct["version"]:
-                args.append(hooks.config.Eups.defaultProduct["version"])
-            if hooks.config.Eups.defaultProduct["tag"]:
-                args.append("--tag")
-                args.append(hooks.config.Eups.defaultProduct["tag"])
-
-            self._actions += [('True',
-                               [Action("implicit", "setupRequired", args,
-                                       {"optional": True, "silent" : True})],
-                               [])]
 
     def actions(self, flavor, setupType=[], verbose=0):
         """Return a list of actions for the specified flavor"""
@@ -499,6 +569,25 @@ but no other interpretation is applied
             print >> utils.stdinfo, msg
         return actions
 
+    def productNames(self):
+        """
+        Return the names of all the products that this table's setupRequired
+        and setupOptional lines refer to, whatever the flavor and setup type
+        (so including those in blocks that aren't used) and whether or not
+        the products exist
+        """
+        names = []
+        for LBB in self._actions:
+            for block in LBB[1:]:
+                if isinstance(block, str): # a Logical
+                    continue
+                for a in block:
+                    if a.cmd == Action.setupRequired:
+                        name = a.productName()
+                        if name and name not in names:
+                            names.append(name)
+        return names
+
     def __str__(self):
         s = ""
         for logical, ifBlock, elseBlock in self._actions:
@@ -561,8 +650,14 @@ but no other interpretation is applied
                self.topProduct and self.topProduct.name == hooks.config.Eups.defaultProduct["name"]:
             addDefaultProduct = False
 
+        actions = self.actions(Eups.flavor, setupType=setupType)
+        if recursive:
+            prefetcher = TablePrefetcher.get()
+            if prefetcher:
+                prefetcher.prefetchDependencies(Eups, actions, requiredVersions)
+
         deps = []
-        for a in self.actions(Eups.flavor, setupType=setupType):
+        for a in actions:
             if a.cmd == Action.unsetupRequired:
                 if True:
                     optional = a.extra["optional"]
@@ -687,6 +782,330 @@ but no other interpretation is applied
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
+class TableCache(utils.FileCache):
+    """
+    An on-disk cache of parsed table files.
+
+    An entry records the logical blocks and actions of a table file as they
+    are before eups variables such as $PRODUCT_DIR are expanded, so it may be
+    used for any product that uses the table file, together with the warnings
+    issued while parsing it, which are repeated when the entry is used.  An
+    entry is only used if the table file's size and modification time are
+    unchanged.  Entries that have been read or written are also kept in
+    memory for the life of the process.  When the cache grows beyond
+    hooks.config.Eups.tableCacheSize megabytes, the entries written longest
+    ago are removed.
+    """
+
+    # the format of the cache entries; bump this if the parser's output changes
+    formatVersion = 2
+
+    def __init__(self, cacheDir, maxSize=None):
+        """
+        @param cacheDir   the directory to hold the cache entries
+        @param maxSize    the maximum total size of the entries, in bytes 
+                            (None: no limit)
+        """
+        super(TableCache, self).__init__(cacheDir, maxSize)
+        self._entries = {}              # entries held in memory, keyed by entry file
+        self._pruned = False            # have we pruned the cache?
+
+    # @staticmethod   # requires python 2.4
+    def get():
+        """
+        return the TableCache for the user's data directory, or None if 
+        caching is disabled (see hooks.config.Eups.cacheTables)
+        """
+        if not hooks.config.Eups.cacheTables:
+            return None
+
+        cacheDir = utils.userTableCacheDir()
+        if not cacheDir:
+            return None
+
+        maxSize = hooks.config.Eups.tableCacheSize
+        if maxSize:
+            maxSize = int(maxSize*1024*1024)
+        else:
+            maxSize = None
+
+        return TableCache._getInstance(cacheDir, maxSize)
+    get = staticmethod(get)
+
+    def _entryFile(self, tableFile, productName):
+        key = "%s\0%s" % (os.path.abspath(tableFile), productName)
+        return os.path.join(self.cacheDir, _md5(key).hexdigest())
+
+    def _signature(self, tableFile, productName):
+        st = os.stat(tableFile)
+        return (self.formatVersion, os.path.abspath(tableFile), productName, st.st_size, st.st_mtime)
+
+    def lookup(self, tableFile, productName=None):
+        """
+        return the cached (old, actions, warnings) for a table file, where
+        actions is as returned by _encodeActions() and warnings is as 
+        recorded by Table._warn(), or None if there is no valid entry
+        @param tableFile     the table file
+        @param productName   the name of the product that owns the table
+        """
+        try:
+            sig = self._signature(tableFile, productName)
+        except OSError:
+            return None
+
+        entry = self._entryFile(tableFile, productName)
+        if self._entries.has_key(entry) and self._entries[entry][0] == sig:
+            return self._entries[entry][1:]
+
+        cached = self._readEntry(entry)
+        if not cached or cached[0] != sig:
+            return None
+
+        self._entries[entry] = cached
+        return cached[1:]
+
+    def save(self, tableFile, productName, old, actions, warnings=[]):
+        """
+        save the parsed contents of a table file.  Failure to do so is 
+        silently ignored.  The first time that an entry is saved, the cache 
+        is pruned to its maximum size.
+        @param tableFile     the table file
+        @param productName   the name of the product that owns the table
+        @param old           True if the table file is in the old format
+        @param actions       the actions, as returned by _encodeActions()
+        @param warnings      the warnings issued while parsing the table
+        """
+        try:
+            sig = self._signature(tableFile, productName)
+            entry = self._entryFile(tableFile, productName)
+            self._entries[entry] = (sig, old, actions, warnings)
+
+            self._writeEntry(entry, (sig, old, actions, warnings))
+
+            if not self._pruned:
+                self._pruned = True
+                self.prune()
+        except (IOError, OSError):
+            pass
+
+    def clear(self):
+        """
+        remove all entries from the cache
+        """
+        self.forget()
+        super(TableCache, self).clear()
+
+    def forget(self):
+        """
+        drop the entries held in memory (but not those on disk)
+        """
+        self._entries = {}
+
+class TablePrefetcher(object):
+    """
+    Read table files in a few background threads before they are needed.
+
+    When the actions of a table are known, the products required by its
+    setupRequired actions are looked up and their table files are queued
+    for reading (see prefetchDependencies()).  The lookups are only hints:
+    the table files are still loaded, in order, by the code that resolves
+    the dependencies, which simply finds the contents already read (or the
+    TableCache entry already loaded).  Reading ahead means that the
+    latency of reading one table file at a time from a remote filesystem
+    overlaps with the work of resolving the dependencies.
+    """
+
+    _instance = None
+
+    def __init__(self, nthread):
+        """
+        @param nthread   the maximum number of table files to read at once
+        """
+        self.nthread = nthread
+        self._lock = threading.Lock()
+        self._pending = []              # (tableFile, productName, tableCache) waiting to be read
+        self._requested = {}            # table files that have been queued, and not yet used
+        self._contents = {}             # (signature, lines) read from table files, keyed by table file
+        self._running = 0               # the number of threads reading files
+
+    # @staticmethod   # requires python 2.4
+    def get():
+        """
+        return the TablePrefetcher, or None if prefetching is disabled 
+        (see hooks.config.Eups.prefetchTables)
+        """
+        nthread = hooks.config.Eups.prefetchTables
+        if not nthread or nthread < 1:
+            return None
+
+        if not TablePrefetcher._instance or TablePrefetcher._instance.nthread != nthread:
+            TablePrefetcher._instance = TablePrefetcher(nthread)
+
+        return TablePrefetcher._instance
+    get = staticmethod(get)
+
+    def prefetch(self, tables):
+        """
+        queue table files to be read.  Files that have already been queued
+        are ignored.
+        @param tables   a list of (tableFile, productName), where productName
+                          is the name of the product that owns the table
+        """
+        tableCache = TableCache.get()
+
+        self._lock.acquire()
+        try:
+            for tableFile, productName in tables:
+                if not self._requested.has_key(tableFile):
+                    self._requested[tableFile] = True
+                    self._pending.append((tableFile, productName, tableCache))
+
+            while self._running < min(self.nthread, len(self._pending)):
+                self._running += 1
+                t = threading.Thread(target=self._fetch)
+                t.setDaemon(True)
+                t.start()
+        finally:
+            self._lock.release()
+
+    def _fetch(self):
+        # read queued table files until there are none left
+        while True:
+            self._lock.acquire()
+            try:
+                if not self._pending:
+                    self._running -= 1
+                    return
+                tableFile, productName, tableCache = self._pending.pop(0)
+            finally:
+                self._lock.release()
+
+            contents = None
+            try:
+                if not (tableCache and tableCache.lookup(tableFile, productName)):
+                    fd = open(tableFile)
+                    try:
+                        st = os.fstat(fd.fileno())
+                        contents = ((st.st_size, st.st_mtime), fd.readlines())
+                    finally:
+                        fd.close()
+            except Exception:
+                pass                    # errors are reported when the table is read for real
+
+            self._lock.acquire()
+            try:
+                if contents:
+                    self._contents[tableFile] = contents
+                else:                   # nothing to keep (e.g. it's in the TableCache's memory)
+                    del self._requested[tableFile]
+            finally:
+                self._lock.release()
+
+    def readlines(self, tableFile):
+        """
+        return the lines of a table file that has been read ahead (and 
+        forget them), or None if it hasn't been or it has since changed
+        """
+        self._lock.acquire()
+        try:
+            if not self._contents.has_key(tableFile):
+                return None
+            sig, contents = self._contents.pop(tableFile)
+            del self._requested[tableFile]
+        finally:
+            self._lock.release()
+
+        try:
+            st = os.stat(tableFile)
+        except OSError:
+            return None
+        if (st.st_size, st.st_mtime) != sig:
+            return None
+
+        return contents
+
+    def prefetchDependencies(self, Eups, actions, requiredVersions=None):
+        """
+        queue the table files of the products required by a table's
+        setupRequired actions.  The products are looked up as 
+        Table.dependencies() does, but messages are suppressed and errors
+        ignored;  the products that are actually used are looked up again
+        by the caller.
+        @param Eups              the Eups instance to use to locate products
+        @param actions           the table's actions (see Table.actions())
+        @param requiredVersions  dict of the versions required for products
+        """
+        streams = [utils.stderr, utils.stdinfo, utils.stdwarn, utils.stdok]
+        fileObjs0 = [s._fileObj for s in streams]
+        stdout0, stderr0 = sys.stdout, sys.stderr
+
+        tables = []
+        q = utils.Quiet(Eups)
+        try:
+            sink = StringIO()
+            sys.stdout, sys.stderr = sink, sink
+            for s in streams:
+                s._fileObj = sink
+
+            for a in actions:
+                if a.cmd != Action.setupRequired:
+                    continue
+
+                try:
+                    requestedVRO, productName, productDir, vers, versExpr, noRecursion = a.processArgs(Eups)
+                    if productDir:
+                        continue
+
+                    Eups.pushStack("vro", requestedVRO)
+                    try:
+                        if requiredVersions and productName in requiredVersions:
+                            product = Eups.findProduct(productName, requiredVersions[productName])
+                        else:
+                            product = Eups.findProductFromVRO(productName, vers, versExpr)[0]
+                    finally:
+                        Eups.popStack("vro")
+
+                    if product and not product._table:
+                        tableFile = product.tableFileName()
+                        if tableFile:
+                            tables.append((tableFile, productName))
+                except Exception:
+                    pass
+        finally:
+            sys.stdout, sys.stderr = stdout0, stderr0
+            for s, fileObj in zip(streams, fileObjs0):
+                s._fileObj = fileObj
+            del q
+
+        self.prefetch(tables)
+
+def _encodeActions(actions):
+    """
+    convert a Table's _actions into a form that can be cached, with each 
+    Action represented by its (cmd, args, extra)
+    """
+    out = []
+    for LBB in actions:
+        out.append([isinstance(b, list) and [(a.cmd, list(a.args), dict(a.extra)) for a in b] or b
+                    for b in LBB])
+    return out
+
+def _decodeActions(actions, tableFile, topProduct=None):
+    """
+    the inverse of _encodeActions()
+    """
+    out = []
+    for LBB in actions:
+        out.append([isinstance(b, list) and [_makeAction(tableFile, a, topProduct) for a in b] or b
+                    for b in LBB])
+    return out
+
+def _makeAction(tableFile, encoded, topProduct):
+    cmd, args, extra = encoded
+    action = Action(tableFile, cmd, [], dict(extra), topProduct=topProduct)
+    action.args = list(args)            # don't process them again, but they may be expanded in place
+    return action
+
 class Action(object):
     """
     An action in a table file
@@ -772,6 +1191,22 @@ class Action(object):
         else:
             print >> utils.stderr, "Unimplemented action", self.cmd
 
+    def productName(self):
+        """
+        Return the name of the product that a setupRequired command refers to,
+        without looking it up, or None if it doesn't name one
+        """
+        i = 0
+        while i < len(self.args):
+            if self.args[i] in ("-f", "--flavor", "-r", "-T", "-t", "--tag", "--vro"):
+                i += 2              # skip the option and its argument
+            elif self.args[i].startswith("-"):
+                i += 1
+            else:
+                return self.args[i]
+
+        return None
+
     def processArgs(self, Eups, fwd=True):
         """Process the arguments in a setup command found in a table file"""
 
@@ -783,7 +1218,7 @@ class Action(object):
         ignoredOpts = []
         while i < len(_args) - 1:
             i += 1
-            if re.search(r"^-", _args[i]):
+            if _args[i].startswith("-"):
                 if _args[i] in ("-f", "--flavor"): # a flavor specification
                     requestedFlavor = _args[i + 1]
                     i += 1              # skip the argument
@@ -853,7 +1288,7 @@ class Action(object):
         versExpr = None                 # relational expression for version
         if vers:  
             # see if a version of the form "exact [logical]"
-            mat = re.search(r"(?:(\S*)\s+)?\[([^\]]+)\]\s*", vers)
+            mat = _versionExprRe.search(vers)
             if mat:
                 vers, versExpr = mat.groups()
 
@@ -926,17 +1361,16 @@ class Action(object):
         # look for values that are optional environment variables: ${XXX} or $?{XXX}
         # If desired, specify a default value as e.g. ${XXX-value}
         # if they don't exist, ignore the entire line if marked optional; raise an error otherwise
-        varRE = r"\$(\?)?{([^-}]*)(?:-([^}]+))?}"
-        mat = re.search(varRE, value)
+        mat = _envVarRe.search(value)
         if not mat:
             return value
         
         optional, key, default = mat.groups()
 
         if os.environ.has_key(key):
-            return re.sub(varRE, os.environ[key], value)
+            return _envVarRe.sub(os.environ[key], value)
         elif default:
-            return re.sub(varRE, default, value)
+            return _envVarRe.sub(default, value)
 
         if optional:
             if verbose > 0:
@@ -1191,15 +1625,38 @@ class Action(object):
 
         key = self.args[0]
 
-        try:
-            del os.environ[key]
-        except KeyError:
-            pass
+        Eups.unsetEnv(key)
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 #
 # Expand a table file
 #
+#
+# The commands that may appear in a table file, mapped to their Actions
+#
+_actionCommands = {
+    "addalias" : Action.addAlias,
+    "declareoptions" : Action.declareOptions,
+    "envappend" : Action.envAppend,
+    "envprepend" : Action.envPrepend,
+    "envset" : Action.envSet,
+    "envunset" : Action.envUnset,
+    "pathappend" : Action.envAppend,
+    "pathprepend" : Action.envPrepend,
+    "pathremove" : Action.envUnset,
+    "pathset" : Action.envSet,
+    "print" : Action.doPrint,
+    "proddir" : Action.prodDir,
+    "setupenv" : Action.setupEnv,
+    "setenv" : Action.envSet,
+    "unsetenv" : Action.envUnset,
+    "setuprequired" : Action.setupRequired,
+    "setupoptional" : Action.setupOptional,
+    "sourcerequired" : Action.sourceRequired,
+    "unsetuprequired" : Action.unsetupRequired,
+    "unsetupoptional" : Action.unsetupOptional,
+    }
+
 def expandTableFile(Eups, ofd, ifd, productList, versionRegexp=None, force=False,
                     expandVersions=True, addExactBlock=True, toplevelName=None,
                     recurse=True):
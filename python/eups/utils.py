@@ -2,6 +2,7 @@
 Utility functions used across EUPS classes.
 """
 import time, os, sys, glob, re, shutil, tempfile
+import cPickle, thread
 from cStringIO import StringIO
 
 def _svnRevision(file=None, lastChanged=False):
@@ -146,6 +147,69 @@ def userStackCacheFor(eupsPathDir, userDataDir=None):
 
     return os.path.join(userDataDir,"_caches_", eupsPathDir[1:])
 
+def userTableCacheDir(userDataDir=None):
+    """
+    return the directory in the user's data directory where parsed table
+    files are cached.  None is returned if a directory cannot be determined
+    @param userDataDir   the user's personal data directory.  If not given,
+                            it is set to the value returned by 
+                            defaultUserDataDir() (by default ~/.eups).
+    """
+    if not userDataDir:
+        userDataDir = defaultUserDataDir()
+    if not userDataDir:
+        return None
+
+    return os.path.join(userDataDir, "_tables_")
+
+def userSetupPlanDir(userDataDir=None):
+    """
+    return the directory in the user's data directory where the results of
+    setting up products are cached.  None is returned if a directory cannot
+    be determined
+    @param userDataDir   the user's personal data directory.  If not given,
+                            it is set to the value returned by 
+                            defaultUserDataDir() (by default ~/.eups).
+    """
+    if not userDataDir:
+        userDataDir = defaultUserDataDir()
+    if not userDataDir:
+        return None
+
+    return os.path.join(userDataDir, "_plans_")
+
+def userServerCacheDir(userDataDir=None):
+    """
+    return the directory in the user's data directory where information 
+    retrieved from distribution servers is cached.  None is returned if a 
+    directory cannot be determined
+    @param userDataDir   the user's personal data directory.  If not given,
+                            it is set to the value returned by 
+                            defaultUserDataDir() (by default ~/.eups).
+    """
+    if not userDataDir:
+        userDataDir = defaultUserDataDir()
+    if not userDataDir:
+        return None
+
+    return os.path.join(userDataDir, "_servers_")
+
+def userDownloadCacheDir(userDataDir=None):
+    """
+    return the directory in the user's data directory where files retrieved
+    from distribution servers are cached.  None is returned if a directory
+    cannot be determined
+    @param userDataDir   the user's personal data directory.  If not given,
+                            it is set to the value returned by 
+                            defaultUserDataDir() (by default ~/.eups).
+    """
+    if not userDataDir:
+        userDataDir = defaultUserDataDir()
+    if not userDataDir:
+        return None
+
+    return os.path.join(userDataDir, "_downloads_")
+
 def defaultUserDataDir(user=""):
     """
     return the default user data directory.  This will be the value of 
@@ -405,6 +469,187 @@ class ConfigProperty(object):
     def __str__(self):
         return str(self._props())
 
+class LRUCache(object):
+    """
+    A dictionary-like cache holding at most a given number of items; when
+    it is full, adding an item discards the item that was least recently
+    used.
+    """
+    def __init__(self, maxsize=256):
+        """
+        @param maxsize    the maximum number of items to hold
+        """
+        self.maxsize = maxsize
+        self._items = {}                # key -> [value, time of last use]
+        self._clock = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def has_key(self, key):
+        return self._items.has_key(key)
+
+    def get(self, key, default=None):
+        """
+        return the value cached for key, or default if there isn't one
+        """
+        try:
+            item = self._items[key]
+        except KeyError:
+            return default
+
+        self._clock += 1
+        item[1] = self._clock
+        return item[0]
+
+    def set(self, key, value):
+        """
+        cache a value for key, discarding the least recently used item if
+        the cache is full
+        """
+        if not self._items.has_key(key) and len(self._items) >= self.maxsize:
+            oldest = None
+            for k, item in self._items.items():
+                if oldest is None or item[1] < self._items[oldest][1]:
+                    oldest = k
+            if oldest is not None:
+                del self._items[oldest]
+
+        self._clock += 1
+        self._items[key] = [value, self._clock]
+
+    def clear(self):
+        self._items = {}
+
+class FileCache(object):
+    """
+    A cache whose entries are held in files in a directory (and its
+    subdirectories), such as the TableCache, SetupPlanCache and
+    DownloadCache.  Subclasses provide a get() that returns the instance in
+    use (see _getInstance()), and may set a maximum size; prune() then
+    removes the least recently used entries, judged by the modification
+    times of their files.
+    """
+
+    _instance = None                    # the instance returned by _getInstance()
+
+    def __init__(self, cacheDir, maxSize=None):
+        """
+        @param cacheDir   the directory to hold the cache entries
+        @param maxSize    the maximum total size of the entries, in bytes 
+                            (None: no limit)
+        """
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+
+    # @classmethod   # requires python 2.4
+    def _getInstance(cls, *args):
+        """
+        return the instance of cls created with the given arguments, creating
+        a new one if there isn't one or the arguments have changed
+        """
+        instance = cls._instance
+        if instance is None or instance.__class__ is not cls or instance._args != args:
+            instance = cls(*args)
+            instance._args = args
+            cls._instance = instance
+
+        return instance
+    _getInstance = classmethod(_getInstance)
+
+    def _readEntry(self, entry):
+        """
+        return the object pickled in an entry's file, or None if it cannot
+        be read
+        """
+        try:
+            fd = open(entry, "rb")
+            try:
+                return cPickle.load(fd)
+            finally:
+                fd.close()
+        except Exception:
+            return None
+
+    def _writeEntry(self, entry, obj):
+        """
+        pickle an object into an entry's file.  The object is written to a
+        temporary file that is then renamed, so a reader never sees a partly
+        written entry.
+        @throws IOError, OSError   if the entry cannot be written
+        """
+        dir = os.path.dirname(entry)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+
+        tmpfile = "%s.tmp%d.%d" % (entry, os.getpid(), thread.get_ident())
+        try:
+            fd = open(tmpfile, "wb")
+            try:
+                cPickle.dump(obj, fd, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+            os.rename(tmpfile, entry)
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    def _listEntries(self):
+        """
+        return a list of (time last used, size, files) for the entries in the
+        cache.  By default every file is an entry, last used when it was 
+        last modified.
+        """
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.cacheDir):
+            for f in filenames:
+                f = os.path.join(dirpath, f)
+                try:
+                    st = os.stat(f)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, [f]))
+
+        return entries
+
+    def _removeEntry(self, files):
+        """
+        remove the files that hold an entry
+        """
+        for f in files:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+    def prune(self):
+        """
+        remove the least recently used entries until the cache is no larger
+        than its maximum size
+        """
+        if self.maxSize is None:
+            return
+
+        entries = self._listEntries()
+        total = 0
+        for used, size, files in entries:
+            total += size
+
+        entries.sort()
+        for used, size, files in entries:
+            if total <= self.maxSize:
+                break
+
+            self._removeEntry(files)
+            total -= size
+
+    def clear(self):
+        """
+        remove all entries from the cache
+        """
+        for used, size, files in self._listEntries():
+            self._removeEntry(files)
+
 def canPickle():
     """
     run a pickling test to see if python is late enough to allow EUPS to
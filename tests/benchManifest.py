@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Time reading synthetic manifests, and looking up each of their products as
+the recursive install and create code does.  Run as
+
+   python tests/benchManifest.py [-n repeat] [nentry ...]
+
+The default is to time manifests of 1000, 3000, and 10000 entries.
+"""
+
+import os
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+import testCommon
+
+from eups.Eups import Eups
+from eups.distrib.server import Manifest
+
+def writeSyntheticManifest(fd, nentry):
+    """
+    write a manifest listing nentry products to the open file fd
+    """
+    print >> fd, "EUPS distribution manifest for top (1.0). Version 1.0"
+    print >> fd, "#"
+    print >> fd, "# pkg           flavor       version    tablefile                 installation_directory         installID"
+    print >> fd, "#---------------------------------------------------------------------------------------------------------"
+    for i in range(nentry):
+        print >> fd, "%-15s %-12s %-10s %-25s %-30s %s" % \
+            ("prod%d" % i, "Linux", "1.%d" % i, "prod%d.table" % i, "prod%d/1.%d" % (i, i),
+             "tarball:prod%d-1.%d@Linux.tar.gz" % (i, i))
+
+def timeManifest(filename, repeat, eupsenv):
+    """
+    return the times taken to read a manifest, and to look up each of its
+    products by name and version, averaged over repeat trials
+    """
+    tread = tlookup = 0.0
+    for i in range(repeat):
+        t0 = time.time()
+        man = Manifest(eupsenv=eupsenv)
+        man.read(filename)
+        t1 = time.time()
+        for p in man.getProducts():
+            man.getDependency(p.product, p.version)
+        t2 = time.time()
+
+        tread += t1 - t0
+        tlookup += t2 - t1
+
+    return tread/repeat, tlookup/repeat
+
+def main(argv=sys.argv[1:]):
+    parser = OptionParser(usage="%prog [options] [nentry ...]")
+    parser.add_option("-n", "--repeat", type="int", default=5,
+                      help="number of times to time each manifest")
+    (opts, sizes) = parser.parse_args(argv)
+
+    if sizes:
+        sizes = [int(n) for n in sizes]
+    else:
+        sizes = [1000, 3000, 10000]
+
+    os.environ["EUPS_PATH"] = testCommon.testEupsStack
+    eupsenv = Eups()
+
+    print "%-10s %12s %12s" % ("entries", "read", "lookups")
+    for nentry in sizes:
+        fd, filename = tempfile.mkstemp(suffix=".manifest")
+        try:
+            fd = os.fdopen(fd, "w")
+            writeSyntheticManifest(fd, nentry)
+            fd.close()
+
+            tread, tlookup = timeManifest(filename, opts.repeat, eupsenv)
+            print "%-10d %9.3f ms %9.3f ms" % (nentry, 1e3*tread, 1e3*tlookup)
+        finally:
+            os.remove(filename)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Time the parsing of table files: each of the tables in the tests directory
+and a large synthetic table that exercises all of the table syntax.  Run as
+
+   python tests/benchTable.py [-n repeat] [-l lines] [table ...]
+
+The table cache is disabled so that every table is really parsed.
+"""
+
+import os
+import sys
+import glob
+import tempfile
+import time
+from optparse import OptionParser
+import testCommon
+
+from eups import hooks
+from eups.table import Table
+
+def defaultTables():
+    """
+    return the table files found in the tests directory
+    """
+    return glob.glob(os.path.join(testCommon.testEupsStack, "*.table")) + \
+        glob.glob(os.path.join(testCommon.testEupsStack, "ups", "*.table"))
+
+def writeSyntheticTable(fd, nline):
+    """
+    write a table file of (at least) nline lines to the open file fd,
+    using both the old and new forms of conditional
+    """
+    block = [
+        "# a comment",
+        "setupRequired(python)",
+        "setupOptional(\"foo%(i)d 1.%(i)d [>= 1.0]\")",
+        "envPrepend(PATH, ${PRODUCT_DIR}/bin)       # a trailing comment",
+        "envAppend(LD_LIBRARY_PATH, ${UPS_PROD_DIR}/lib, \" \")",
+        "envSet(VAR%(i)d, \"a value, with a comma\")",
+        "addAlias(ls%(i)d, ls -l)",
+        "if (type == build) {",
+        "    setupRequired(doxygen 1.5.9 [>= 1.5.7.1])",
+        "} else if (FLAVOR == Linux) {",
+        "    envUnset(PRODUCT_DIR)",
+        "} else {",
+        "    setupRequired(\"bar -j\")",
+        "}",
+        ]
+
+    i = 0
+    while i*len(block) < nline:
+        for line in block:
+            print >> fd, line % {"i" : i}
+        i += 1
+
+def timeParse(tableFile, repeat):
+    """
+    return the time taken to parse tableFile, averaged over repeat parses
+    """
+    t0 = time.time()
+    for i in range(repeat):
+        Table(tableFile)
+    return (time.time() - t0)/repeat
+
+def main(argv=sys.argv[1:]):
+    parser = OptionParser(usage="%prog [options] [table ...]")
+    parser.add_option("-n", "--repeat", type="int", default=20,
+                      help="number of times to parse each table")
+    parser.add_option("-l", "--lines", type="int", default=10000,
+                      help="number of lines in the synthetic table")
+    (opts, tables) = parser.parse_args(argv)
+
+    hooks.config.Eups.cacheTables = False
+
+    if not tables:
+        tables = defaultTables()
+
+    total = 0.0
+    for tableFile in tables:
+        t = timeParse(tableFile, opts.repeat)
+        total += t
+        print "%-40s %8.3f ms" % (os.path.basename(tableFile), 1e3*t)
+    print "%-40s %8.3f ms" % ("(all tables)", 1e3*total)
+
+    fd, synthetic = tempfile.mkstemp(suffix=".table")
+    try:
+        fd = os.fdopen(fd, "w")
+        writeSyntheticTable(fd, opts.lines)
+        fd.close()
+
+        t = timeParse(synthetic, max(1, opts.repeat//10))
+        print "%-40s %8.3f ms" % ("(synthetic, %d lines)" % opts.lines, 1e3*t)
+    finally:
+        os.remove(synthetic)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Time finding the latest version of a product, and the versions that satisfy
+a version expression, in a product with many (e.g. nightly) versions, both
+by examining every version and by using ProductFamily's sorted versions.
+Run as
+
+   python tests/benchVersions.py [-n repeat] [-e expr] [nversion ...]
+
+The default is to time products with 1000, 3000, and 10000 versions.
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+import testCommon
+
+from eups.Eups import Eups
+from eups.Product import Product
+from eups.stack import ProductStack
+from eups.VersionCompare import versionSortKey
+
+def makeSyntheticStack(nversion, flavor="Linux"):
+    """
+    return a ProductStack declaring nversion versions of the product "nightly"
+    """
+    stack = ProductStack(os.path.join(testCommon.testEupsStack, "ups_db"), autosave=False)
+    for i in range(nversion):
+        version = "1.%d.%d" % (i//100, i%100)
+        stack.addProduct(Product("nightly", version, flavor, "/opt/nightly/%s" % version, "none"))
+
+    return stack
+
+def timeVersions(eupsenv, root, expr, repeat, flavor="Linux"):
+    """
+    return the times taken to find the latest version and the versions matching expr,
+    first by examining every version and then by bisection, averaged over repeat trials
+    """
+    stack = eupsenv.versions[root]
+    versionKey = versionSortKey(eupsenv.version_cmp)
+
+    tsort = tlatest = tfilter = texpr = 0.0
+    for i in range(repeat):
+        t0 = time.time()
+        vers = stack.getVersions("nightly", flavor)
+        vers.sort(key=versionKey)
+        latest = vers[-1]
+        t1 = time.time()
+        prod = eupsenv._findLatestProduct("nightly", [root], flavor)
+        t2 = time.time()
+        matched = filter(lambda v: eupsenv.version_match(v, expr), stack.getVersions("nightly", flavor))
+        t3 = time.time()
+        prods = eupsenv._findProductsByExpr("nightly", expr, [root], flavor, False)
+        t4 = time.time()
+
+        assert prod.version == latest
+        assert len(prods) == len(matched)
+
+        tsort += t1 - t0
+        tlatest += t2 - t1
+        tfilter += t3 - t2
+        texpr += t4 - t3
+
+    return tsort/repeat, tlatest/repeat, tfilter/repeat, texpr/repeat
+
+def main(argv=sys.argv[1:]):
+    parser = OptionParser(usage="%prog [options] [nversion ...]")
+    parser.add_option("-n", "--repeat", type="int", default=5,
+                      help="number of times to time each product")
+    parser.add_option("-e", "--expr", default=">= 1.5.0 && < 1.6.0",
+                      help="the version expression to match")
+    (opts, sizes) = parser.parse_args(argv)
+
+    if sizes:
+        sizes = [int(n) for n in sizes]
+    else:
+        sizes = [1000, 3000, 10000]
+
+    os.environ["EUPS_PATH"] = testCommon.testEupsStack
+    eupsenv = Eups()
+    root = "synthetic"
+
+    print "%-10s %12s %12s %12s %12s" % ("versions", "sort", "latest", "filter", "expr")
+    for nversion in sizes:
+        eupsenv.versions[root] = makeSyntheticStack(nversion)
+        tsort, tlatest, tfilter, texpr = timeVersions(eupsenv, root, opts.expr, opts.repeat)
+        print "%-10d %9.3f ms %9.3f ms %9.3f ms %9.3f ms" % \
+            (nversion, 1e3*tsort, 1e3*tlatest, 1e3*tfilter, 1e3*texpr)
+
+if __name__ == "__main__":
+    main()
@@ -9,9 +9,11 @@ tests = []
 for t in [
     "testApp",
     "testCmd",
+    "testDaemon",
     "testDeprecated",
     "testDb",
     "testEups",
+    "testLock",
     "testMisc",
     "testProduct",
     "testStack",
@@ -54,6 +54,143 @@ class AppTestCase(unittest.TestCase):
         version = eups.getSetupVersion("python")
         self.assertEquals(version, "2.5.2")
 
+class SetupPlanTestCase(unittest.TestCase):
+    """
+    Tests for caching the results of app.setup() (see eups.SetupPlan)
+    """
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_PATH"] = testEupsStack
+        os.environ["EUPS_FLAVOR"] = "Linux"
+        os.environ["EUPS_USERDATA"] = os.path.join(testEupsStack, "_userdata_")
+        for k in ("SETUP_PYTHON", "PYTHON_DIR"):
+            if os.environ.has_key(k):
+                del os.environ[k]
+
+        self.dbpath = os.path.join(testEupsStack, "ups_db")
+        self.journal = os.path.join(self.dbpath, "_journal_")
+        self.hadJournal = os.path.exists(self.journal)
+        if not self.hadJournal:
+            eups.db.Database(self.dbpath)._recordChange("test", "python", "2.5.2")
+
+        self.cacheSetupPlans = eups.hooks.config.Eups.cacheSetupPlans
+        eups.hooks.config.Eups.cacheSetupPlans = True
+        self.planDir = eups.utils.userSetupPlanDir()
+
+    def tearDown(self):
+        eups.hooks.config.Eups.cacheSetupPlans = self.cacheSetupPlans
+        if os.path.exists(self.planDir):
+            shutil.rmtree(self.planDir)
+        if not self.hadJournal and os.path.exists(self.journal):
+            os.remove(self.journal)
+        os.environ = self.environ0
+
+    def setupPython(self):
+        environ = os.environ.copy()
+        try:
+            Eups = eups.Eups(quiet=1)
+            cmds = eups.setup("python", "2.5.2", eupsenv=Eups)
+            return cmds, os.environ.get("PYTHON_DIR")
+        finally:
+            os.environ = environ
+
+    def testReplay(self):
+        cmds, pdir = self.setupPython()
+        self.assert_(pdir)
+        self.assertEquals(len(os.listdir(self.planDir)), 1)
+
+        plan = eups.SetupPlan.SetupPlanCache.get().lookup(os.listdir(self.planDir)[0], eups.Eups(quiet=1))
+        self.assertEquals(plan.products[0], ("python", "2.5.2", pdir))
+
+        self.assertEquals(self.setupPython(), (cmds, pdir))
+        self.assertEquals(len(os.listdir(self.planDir)), 1)
+
+    def testReplaySetupProducts(self):
+        def alreadySetup():
+            environ = os.environ.copy()
+            try:
+                Eups = eups.Eups(quiet=1)
+                eups.setup("python", "2.5.2", eupsenv=Eups)
+                return dict([(name, (p.name, p.version, p.dir, vroReason))
+                             for name, (p, vroReason) in Eups.alreadySetupProducts.items()])
+            finally:
+                os.environ = environ
+
+        products = alreadySetup()
+        self.assert_(products.has_key("python"))
+        self.assertEquals(len(os.listdir(self.planDir)), 1)
+        self.assertEquals(alreadySetup(), products)
+
+    def testReplayUsesPlan(self):
+        self.setupPython()
+
+        _setup = eups.Eups._setup
+        def noSetup(*args):
+            raise AssertionError("plan was not replayed")
+        eups.Eups._setup = noSetup
+        try:
+            self.assert_(self.setupPython()[1])
+        finally:
+            eups.Eups._setup = _setup
+
+    def testUnrelatedEnviron(self):
+        cmds, pdir = self.setupPython()
+        key = os.listdir(self.planDir)[0]
+        #
+        # Variables that setup doesn't use don't change the key
+        #
+        os.environ["PWD"] = "/somewhere/else"
+        os.environ["JOB_ID"] = "12345"
+        self.assertEquals(self.setupPython(), (cmds, pdir))
+        self.assertEquals(os.listdir(self.planDir), [key])
+        #
+        # but the plan is only used while the variables that it changed are unchanged
+        #
+        plan = eups.SetupPlan.SetupPlanCache.get().lookup(key, eups.Eups(quiet=1))
+        self.assert_(plan.environ.has_key("PYTHON_DIR"))
+        plan.environ["JOB_ID"] = "12345"
+        self.assert_(plan.isValid())
+        os.environ["JOB_ID"] = "54321"
+        self.assert_(not plan.isValid())
+
+    def testPrune(self):
+        self.setupPython()
+        key = os.listdir(self.planDir)[0]
+        entry = os.path.join(self.planDir, key)
+        size = os.stat(entry).st_size
+
+        cache = eups.SetupPlan.SetupPlanCache(self.planDir, size)
+        plan = cache.lookup(key, eups.Eups(quiet=1))
+        os.utime(entry, (0, 0))         # the least recently used plan
+        cache.save("another", plan)
+        self.assertEquals(os.listdir(self.planDir), ["another"])
+
+        cache.maxSize = 1
+        cache.save(key, plan)
+        self.assertEquals(os.listdir(self.planDir), [])
+
+    def testInvalidate(self):
+        cmds, pdir = self.setupPython()
+        key = os.listdir(self.planDir)[0]
+
+        cache = eups.SetupPlan.SetupPlanCache.get()
+        self.assert_(cache.lookup(key, eups.Eups(quiet=1)))
+        #
+        # A change to the database makes the plan stale
+        #
+        os.utime(self.journal, (time.time() + 10, time.time() + 10))
+        self.assert_(cache.lookup(key, eups.Eups(quiet=1)) is None)
+
+        self.assertEquals(self.setupPython(), (cmds, pdir))
+        self.assert_(cache.lookup(key, eups.Eups(quiet=1)))
+
+    def testNoJournal(self):
+        if self.hadJournal:
+            return
+        os.remove(self.journal)
+        self.setupPython()
+        self.assert_(not os.path.exists(self.planDir) or not os.listdir(self.planDir))
+
 class TagSetupTestCase(unittest.TestCase):
     """
     Tests use cases for selecting tagged versions via app.setup()
@@ -351,7 +488,7 @@ setupRequired(python 2.5.2 [>= 2.5])
 def suite(makeSuite=True):
     """Return a test suite"""
 
-    return testCommon.makeSuite([AppTestCase], makeSuite)
+    return testCommon.makeSuite([AppTestCase, SetupPlanTestCase], makeSuite)
 
 def run(shouldExit=False):
     """Run the tests"""
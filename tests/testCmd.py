@@ -320,6 +320,72 @@ tcltk                 8.5a4      \tcurrent
         prod = myeups.findProduct("newprod", Tag("current"))
         self.assert_(prod is None, "Failed to undeclare product")
 
+    def testDeclareFromFile(self):
+        pdir = os.path.join(testEupsStack, "Linux", "newprod")
+        pdir10 = os.path.join(pdir, "1.0")
+        pdir20 = os.path.join(pdir, "2.0")
+        shutil.copytree(pdir10, pdir20)
+        table = os.path.join(pdir10, "ups", "newprod.table")
+        newprod = os.path.join(self.dbpath,"newprod")
+        listfile = os.path.join(testEupsStack, "newprod.declare")
+
+        try:
+            # a failure part way through leaves nothing declared
+            fd = open(listfile, "w")
+            print >> fd, "-r %s -M %s newprod 1.0" % (pdir10, table)
+            print >> fd, "newprod 3.0 -r %s" % os.path.join(pdir, "3.0")
+            fd.close()
+
+            cmd = "declare --from-file %s" % listfile
+            cmd = eups.cmd.EupsCmd(args=cmd.split(), toolname=prog)
+            self.assertRaises(eups.EupsException, cmd.run)
+            self.assert_(re.search(r"newprod.declare:2: failed", self.err.getvalue()))
+
+            myeups = eups.Eups()
+            self.assert_(myeups.findProduct("newprod") is None, "Failed to roll back declaration")
+            self.assert_(not os.path.isdir(newprod))
+            # including the copy of the table file
+            extraDir = os.path.join(self.dbpath, eups.utils.extraDirPath("Linux", "newprod", "1.0"))
+            self.assert_(not os.path.exists(extraDir), "Failed to roll back copying the table file")
+
+            # only options describing the declaration may be given on a line
+            self._resetOut()
+            fd = open(listfile, "w")
+            print >> fd, "-r %s -m %s newprod 1.0" % (pdir10, table)
+            print >> fd, "--force newprod 2.0 -r %s" % pdir20
+            fd.close()
+
+            cmd = "declare --from-file %s" % listfile
+            cmd = eups.cmd.EupsCmd(args=cmd.split(), toolname=prog)
+            self.assertNotEqual(cmd.run(), 0)
+            self.assert_(re.search(r"newprod.declare:2: --force may not be used", self.err.getvalue()))
+            self.assert_(eups.Eups().findProduct("newprod") is None, "Failed to roll back declaration")
+
+            self._resetOut()
+            fd = open(listfile, "w")
+            print >> fd, "# declare two versions"
+            print >> fd, "-r %s -m %s newprod 1.0" % (pdir10, table)
+            print >> fd, ""
+            print >> fd, "newprod 2.0 -r %s -t stable" % pdir20
+            fd.close()
+
+            cmd = "declare --from-file %s" % listfile
+            cmd = eups.cmd.EupsCmd(args=cmd.split(), toolname=prog)
+            self.assertEqual(cmd.run(), 0)
+            self.assertEquals(self.err.getvalue(), "")
+            self.assertEquals(self.out.getvalue(), "")
+
+            myeups = eups.Eups()
+            prod = myeups.findProduct("newprod", "1.0")
+            self.assert_(prod is not None, "Failed to declare product")
+            self.assertEquals(prod.tags, ["current"])
+            prod = myeups.findProduct("newprod", "2.0")
+            self.assert_(prod is not None, "Failed to declare product")
+            self.assertEquals(prod.tags, ["stable"])
+        finally:
+            if os.path.exists(listfile):
+                os.remove(listfile)
+
     def testRemove(self):
         pdir = os.path.join(testEupsStack, "Linux", "newprod")
         pdir10 = os.path.join(pdir, "1.0")
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Tests for eups.daemon
+"""
+
+import os
+import sys
+import unittest
+import testCommon
+from testCommon import testEupsStack
+
+import time
+from eups import daemon
+from eups.db import Database
+from eups.tags import Tags
+import eups.utils
+
+class DaemonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_PATH"] = testEupsStack
+        os.environ["EUPS_FLAVOR"] = "Linux"
+        os.environ["EUPS_USERDATA"] = os.path.join(testEupsStack, "_userdata_")
+        for k in ("SETUP_PYTHON", "PYTHON_DIR"):
+            if os.environ.has_key(k):
+                del os.environ[k]
+
+        self.path = daemon.socketPath()
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+        # run the server in a child process, as setup uses signals (for locking)
+        server = daemon.SetupServer(self.path, timeout=60)
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                server.serve()
+            finally:
+                os._exit(0)
+        server.socket.close()
+
+    def tearDown(self):
+        daemon.sendRequest({"command" : "stop"}, self.path)
+        os.waitpid(self.pid, 0)
+        os.environ = self.environ0
+
+    def request(self, argv, environ=None):
+        if environ is None:
+            environ = dict(os.environ)
+        return daemon.sendRequest({"argv" : argv, "environ" : environ, "cwd" : os.getcwd()},
+                                  self.path)
+
+    def testSetup(self):
+        reply = self.request(["python", "2.5.2"])
+        self.assertEquals(reply["status"], 0)
+        self.assert_("SETUP_PYTHON" in reply["stdout"])
+
+        reply = self.request(["-h"])
+        self.assertEquals(reply["status"], 0)
+        self.assert_("usage" in reply["stderr"].lower())
+
+        reply = self.request(["noSuchProduct"])
+        self.assertEquals(reply["stdout"].strip(), "false")
+        self.assert_("noSuchProduct" in reply["stderr"])
+
+        status = daemon.sendRequest({"command" : "status"}, self.path)
+        self.assertEquals(status["pid"], self.pid)
+        self.assertEquals(status["nrequest"], 3)
+
+    def testDecline(self):
+        environ = dict(os.environ)
+        environ["EUPS_PATH"] = "/no/such/stack"
+        self.assertEquals(self.request(["python"], environ)["status"], None)
+
+        self.assertEquals(self.request(["-Z", testEupsStack, "python"])["status"], None)
+
+    def testStackCache(self):
+        # the product stacks are kept between requests until the database changes
+        server = daemon.SetupServer(self.path + "2", timeout=60)
+        def request():
+            reply = server.processRequest({"argv" : ["python", "2.5.2"], "environ" : dict(os.environ),
+                                           "cwd" : os.getcwd()})
+            self.assertEquals(reply["status"], 0)
+            self.assert_("SETUP_PYTHON" in reply["stdout"])
+            return dict(server._stackCache)
+
+        def assertKept(stacks, kept):
+            self.assertEquals(sorted(kept.keys()), sorted(stacks.keys()))
+            for key, stack in stacks.items():
+                self.assert_(kept[key] is stack)
+
+        def assertDropped(stacks, kept):
+            self.assert_(kept)
+            for key, stack in kept.items():
+                self.assert_(stacks.has_key(key) and stacks[key] is not stack)
+
+        touched = []
+        def touch(filename):            # change a file, making sure that its mtime changes
+            fd = open(filename, "a")
+            fd.close()
+            touched.append(filename)
+            t = time.time() + 10*len(touched)
+            os.utime(filename, (t, t))
+
+        db = Database(os.path.join(testEupsStack, "ups_db"))
+        journal = db._journalFile()
+        userDir = eups.utils.userStackCacheFor(testEupsStack)
+        userJournal = db._journalFile(userDir)
+        userTags = os.path.join(userDir, Tags.persistFilename("user"))
+        try:
+            #
+            # Without a journal, the stacks are reloaded for every request
+            #
+            if os.path.exists(journal):
+                os.remove(journal)
+            request()
+            stacks = request()
+            assertDropped(stacks, request())
+
+            db._recordChange("test", "-", "-")
+            server._dbChanged = server._databaseTimes()
+            request()                   # the first request also loads the fallback flavors
+            stacks = request()
+            self.assert_(stacks)
+            kept = request()
+            assertKept(stacks, kept)
+
+            touch(journal)
+            stacks, kept = kept, request()
+            assertDropped(stacks, kept)
+            #
+            # as are changes to the user's tags
+            #
+            if not os.path.isdir(userDir):
+                os.makedirs(userDir)
+            stacks, kept = kept, request()
+            assertKept(stacks, kept)
+
+            touch(userJournal)
+            stacks, kept = kept, request()
+            assertDropped(stacks, kept)
+
+            touch(userTags)
+            stacks, kept = kept, request()
+            assertDropped(stacks, kept)
+            assertKept(kept, request())
+        finally:
+            server.server_close()
+            for f in (journal, userJournal, userTags):
+                if os.path.exists(f):
+                    os.remove(f)
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite(makeSuite=True):
+    """Return a test suite"""
+
+    return testCommon.makeSuite([
+        DaemonTestCase,
+        ], makeSuite)
+
+def run(shouldExit=False):
+    """Run the tests"""
+    testCommon.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
@@ -15,6 +15,27 @@ from testCommon import testEupsStack
 from eups.Product import ProductNotFound, Product
 from eups.db import VersionFile
 
+def otherGroup():
+    """return a group other than our own that we may give our files to, or None"""
+    if os.geteuid() == 0:
+        return os.getegid() + 1
+    for gid in os.getgroups():
+        if gid != os.getegid():
+            return gid
+    return None
+
+def checkRewriteKeepsGroup(testCase, file, write):
+    """check that rewriting a file with write() keeps its group and permissions"""
+    gid = otherGroup()
+    if gid is None:
+        return
+    os.chown(file, -1, gid)
+    os.chmod(file, 0640)
+    write()
+    st = os.stat(file)
+    testCase.assertEquals(st.st_gid, gid)
+    testCase.assertEquals(st.st_mode & 07777, 0640)
+
 class VersionFileTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -134,6 +155,8 @@ class VersionFileTestCase(unittest.TestCase):
         self.assert_("Darwin" in flavors)
         self.assert_("Linux:rhel" in flavors)
 
+        checkRewriteKeepsGroup(self, file, lambda: self.vf.write(file=file))
+
 class MacroSubstitutionTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -470,8 +493,12 @@ class ChainFileTestCase(unittest.TestCase):
 
         self.assert_("Linux:rhel" in flavors)
 
+        checkRewriteKeepsGroup(self, file, lambda: self.cf.write(file))
+
 
 from eups.db import Database
+from eups.db.TagRegistry import TagRegistry
+from eups.db import Transaction
 
 class DatabaseTestCase(unittest.TestCase):
 
@@ -719,6 +746,80 @@ class DatabaseTestCase(unittest.TestCase):
 
         os.rename(self.pycur+".bak", self.pycur)
 
+    def testJournal(self):
+        journal = self.db._journalFile()
+        if os.path.exists(journal):  os.remove(journal)
+        self.assert_(self.db.lastChanged() is None)
+        self.assert_(not self.db.isNewerThan(time.time() + 10))
+
+        tfile = self.db._tagFile("python", "stable")
+        if os.path.exists(tfile):  os.remove(tfile)
+        try:
+            self.db.assignTag("stable", "python", "2.6")
+            changed = self.db.lastChanged()
+            self.assert_(changed is not None)
+            self.assert_(self.db.isNewerThan(changed - 1))
+            self.assert_(not self.db.isNewerThan(changed))
+
+            self.db.unassignTag("stable", "python")
+            self.assert_(not os.path.exists(tfile))
+            lines = open(journal).readlines()
+            self.assertEquals(len(lines), 2)
+            self.assertEquals(lines[0].split()[1:4], ["assignTag", "python", "stable"])
+            self.assertEquals(lines[1].split()[1:4], ["unassignTag", "python", "stable"])
+
+            # a user tag is journaled in the user's database
+            self.db.assignTag("user:my", "python", "2.5.2")
+            self.assert_(self.db.lastChanged(self.userdb) is not None)
+            self.db.unassignTag("user:my", "python")
+
+            # the full scan is still available
+            self.assert_(not self.db.isNewerThan(time.time() + 10, verify=True))
+        finally:
+            if os.path.exists(tfile):  os.remove(tfile)
+            if os.path.exists(journal):  os.remove(journal)
+
+    def testTagRegistry(self):
+        journal = self.db._journalFile()
+        tfile = self.db._tagFile("python", "stable")
+        if os.path.exists(tfile):  os.remove(tfile)
+        readAll = TagRegistry.readAll
+        try:
+            self.db.assignTag("stable", "python", "2.6")
+            self.db.assignTag("user:my", "python", "2.5.2")
+
+            tags = self.db.getAllTagAssignments()
+            self.assert_(("stable", "2.6", "Linux") in tags["python"])
+            self.assert_(("user:my", "2.5.2", "Linux") in tags["python"])
+            self.assertEquals(tags["doxygen"], [("current", "1.5.7.1", "Linux")])
+            self.assert_(os.path.exists(os.path.join(self.userdb, "_tags_.pickle")))
+            #
+            # Our own changes are made to the registry, without reading all the chain files
+            #
+            def noReadAll(dbroot):
+                self.fail("Read all the chain files in %s" % dbroot)
+            TagRegistry.readAll = staticmethod(noReadAll)
+
+            self.db.unassignTag("stable", "python")
+            tags = self.db.getAllTagAssignments()
+            self.assert_(("stable", "2.6", "Linux") not in tags["python"])
+            self.assert_(("user:my", "2.5.2", "Linux") in tags["python"])
+            self.assertEquals(self.db.getAllTagAssignments(glob=False).keys(), ["python"])
+
+            TagRegistry.readAll = staticmethod(readAll)
+            #
+            # but other changes are noticed
+            #
+            os.remove(os.path.join(self.userdb, "python", "my.chain"))
+            fd = open(self.db._journalFile(self.userdb), "a")
+            print >> fd, "%d unassignTag python my someoneElse" % time.time()
+            fd.close()
+            self.assertEquals(self.db.getAllTagAssignments(glob=False), {})
+        finally:
+            TagRegistry.readAll = staticmethod(readAll)
+            if os.path.exists(tfile):  os.remove(tfile)
+            if os.path.exists(journal):  os.remove(journal)
+
     def testDeclare(self):
         pdir = self.db._productDir("base")
         if os.path.isdir(pdir):  
@@ -789,6 +890,50 @@ class DatabaseTestCase(unittest.TestCase):
                                os.listdir(pdir))))
                 os.removedirs(pdir)
             raise
+
+    def testTransaction(self):
+        pdir = self.db._productDir("base")
+        if os.path.isdir(pdir):
+            shutil.rmtree(pdir)
+        pycur = open(self.pycur).read()
+        journal = self.db._journalFile()
+        baseidir = os.path.join(testEupsStack,"Linux/base/1.0")
+        base = Product("base", "1.0", "Linux", baseidir, 
+                       os.path.join(baseidir, "ups/base.table"), tags=["current"])
+
+        transaction = Transaction.begin()
+        try:
+            self.assert_(Transaction.current() is transaction)
+            self.assertRaises(RuntimeError, Transaction.begin)
+
+            self.db.declare(base)
+            self.db.assignTag("current", "python", "2.6")
+            self.db.assignTag("user:my", "python", "2.5.2")
+            self.assertEquals(self.db.getTaggedVersion("current", "python", "Linux"), "2.6")
+            self.assert_(os.path.isfile(os.path.join(pdir,"current.chain")))
+
+            transaction.rollback()
+            self.assert_(Transaction.current() is None)
+
+            self.assert_(not os.path.exists(pdir))
+            self.assertEquals(open(self.pycur).read(), pycur)
+            self.assert_(not os.path.exists(os.path.join(self.userdb, "python")))
+            self.assertEquals(open(journal).readlines()[-1].split()[1:3], ["rollback", "python"])
+            #
+            # Committed changes stay
+            #
+            transaction = Transaction.begin()
+            self.db.declare(base)
+            transaction.commit()
+            self.assert_(Transaction.current() is None)
+            self.assertEquals(self.db.getTaggedVersion("current", "base", "Linux"), "1.0")
+        finally:
+            if Transaction.current():
+                Transaction.current().rollback()
+            if os.path.isdir(pdir):
+                shutil.rmtree(pdir)
+            fd = open(self.pycur, "w"); fd.write(pycur); fd.close()
+            if os.path.exists(journal):  os.remove(journal)
                            
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
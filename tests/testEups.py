@@ -12,7 +12,8 @@ from cStringIO import StringIO
 import testCommon
 from testCommon import testEupsStack
 
-from eups import TagNotRecognized, Product, ProductNotFound, EupsException
+from eups import TagNotRecognized, ProductNotFound, EupsException
+from eups.Product import Product
 from eups.Eups import Eups
 from eups.stack import ProductStack
 from eups.utils import Quiet
@@ -479,6 +480,29 @@ class EupsTestCase(unittest.TestCase):
         self.assert_(not os.environ.has_key("TCLTK_DIR"))
         self.assert_(not os.environ.has_key("SETUP_TCLTK"))
 
+    def testSetupState(self):
+        # test that the snapshot of the setup products follows the environment
+
+        self.eups.setup("python")
+        self.assertEquals(sorted([p.name for p in self.eups.getSetupProducts()]), ["python", "tcltk"])
+        self.assertEquals(self.eups.findSetupProduct("python").version, "2.5.2")
+        self.assert_(self.eups.isSetup("python", "2.5.2"))
+
+        setupPython = os.environ["SETUP_PYTHON"]
+        self.eups.unsetEnv("SETUP_PYTHON")
+        self.assertEquals([p.name for p in self.eups.getSetupProducts()], ["tcltk"])
+        self.assertEquals(self.eups.findSetupProduct("python"), None)
+        self.assert_(not self.eups.isSetup("python"))
+
+        self.eups.setEnv("setup_python", setupPython)
+        self.assertEquals(self.eups._envarSetupName("python"), "setup_python")
+        self.assertEquals(self.eups.findSetupProduct("python").version, "2.5.2")
+        self.eups.unsetEnv("setup_python")
+
+        os.environ = os.environ.copy()  # as done by popStack()
+        os.environ["SETUP_PYTHON"] = setupPython
+        self.assertEquals(sorted([p.name for p in self.eups.getSetupProducts()]), ["python", "tcltk"])
+
     def testRemove(self):
         os.environ = self.environ0
 
@@ -499,6 +523,97 @@ class EupsTestCase(unittest.TestCase):
 
         # need to test for recursion
 
+    def testVersionExprRanges(self):
+        self.assertEquals(self.eups._versionExprRanges(">= 2.5 && < 2.6"), [("2.5", True, "2.6", False)])
+        self.assertEquals(self.eups._versionExprRanges("2.5.2 || > 3"),
+                          [("2.5.2", True, "2.5.2", True), ("3", False, None, True)])
+        self.assertEquals(self.eups._versionExprRanges("> 3 && < 2"), [])
+        self.assert_(self.eups._versionExprRanges("2.5 2.6") is None)
+
+        findByExpr = lambda expr: sorted([p.version for p in
+                                          self.eups._findProductsByExpr("python", expr, self.eups.path,
+                                                                        "Linux", False)])
+        self.assertEquals(findByExpr(">= 2.5 && < 2.6"), ["2.5.2"])
+        self.assertEquals(findByExpr("< 2.6 || >= 2.6"), ["2.5.2", "2.6"])
+        self.assertEquals(findByExpr("> 2.5.2 && <= 2.6"), ["2.6"])
+        self.assertEquals(findByExpr("== 2.6"), ["2.6"])
+        #
+        # A relational operator must be followed by a version
+        #
+        self.assert_(self.eups._versionExprRanges(">= 2.5 && <") is None)
+        self.assertRaises(EupsException, self.eups.version_match, "2.6", ">= 2.5 && <")
+        self.assertRaises(EupsException, findByExpr, ">=")
+        #
+        # Versions such as 3.0rc1 can't be found by bisection
+        #
+        self.assert_(self.eups._versionExprRanges(">= 3.0rc1") is None)
+
+        root = "synthetic"
+        stack = ProductStack(os.path.join(testEupsStack, "ups_db"), autosave=False)
+        versions = "2.9 3.0rc1 3.1 3.10a 3.2".split()
+        for v in versions:
+            stack.addProduct(Product("rcprod", v, "Linux", "/opt/rcprod/" + v, "none"))
+        self.eups.versions[root] = stack
+        try:
+            for expr in (">= 3.0rc1", ">= 3.0", "< 3.2", "> 2.9 && < 3.2", "== 3.0rc1"):
+                self.assertEquals(sorted(self.eups._versionsMatching(stack, "rcprod", "Linux", expr)),
+                                  sorted([v for v in versions if self.eups.version_match(v, expr)]),
+                                  expr)
+            self.assertEquals(self.eups._findLatestProduct("rcprod", [root], "Linux").version, "3.2")
+        finally:
+            del self.eups.versions[root]
+
+    def testUsesIndex(self):
+        # the saved dependencies are only trusted if the databases have journals
+        journals = []
+        for d in self.eups.path:
+            db = self.eups._databaseFor(d)
+            journals.append(db._journalFile())
+            db._recordChange("test", "-", "-")
+        tablefile = os.path.join(testEupsStack, "goob.table")
+
+        try:
+            users = [(p, v, props.version) for p, v, props in self.eups.uses("tcltk")]
+            self.assertEquals(users, [("python", "2.5.2", "8.5a4")])
+
+            index = self.eups._getUsesIndex(testEupsStack, self.eups._usesDatabases())
+            python = self.eups.findProduct("python", "2.5.2")
+            deps = index.get(python)
+            self.assert_(deps is not None, "dependencies of python were not saved")
+            self.assertEquals([d[:2] for d in deps if d[0] == "tcltk"], [("tcltk", "8.5a4")])
+            #
+            # A change to one of its dependencies invalidates the entry, but not others
+            #
+            db = self.eups._databaseFor(testEupsStack)
+            db._recordChange("test", "tcltk", "-")
+            index = self.eups._getUsesIndex(testEupsStack, self.eups._usesDatabases())
+            self.assert_(index.get(python) is None)
+            self.assert_(index.get(self.eups.findProduct("doxygen", "1.5.7.1")) is not None)
+
+            self.assertEquals([(p, v) for p, v, props in self.eups.uses("tcltk")], [("python", "2.5.2")])
+            index = self.eups._getUsesIndex(testEupsStack, self.eups._usesDatabases())
+            self.assert_(index.get(python) is not None)
+            #
+            # So does declaring a product that a table asks for but which wasn't found
+            #
+            fd = open(tablefile, "w")
+            print >> fd, "setupOptional(-t current newprod)"
+            fd.close()
+            goob = Product("goob", "1.0", "Linux", testEupsStack, tablefile)
+            index.set(goob, [])
+            self.assert_(index.get(goob) is not None)
+
+            db._recordChange("test", "newprod", "-")
+            index.update(self.eups._usesDatabases())
+            self.assert_(index.get(goob) is None)
+            self.assert_(index.get(python) is not None)
+        finally:
+            for journal in journals:
+                if os.path.exists(journal):
+                    os.remove(journal)
+            if os.path.exists(tablefile):
+                os.remove(tablefile)
+
 class EupsCacheTestCase(unittest.TestCase):
     def setUp(self):
         self.environ0 = os.environ.copy()
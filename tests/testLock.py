@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+Tests for eups.lock
+"""
+
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+import testCommon
+
+import eups
+import eups.lock as lock
+
+class LockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        self.stack = tempfile.mkdtemp(prefix="eupsLock")
+        self.lockDir = os.path.join(self.stack, lock._lockDir)
+        self.locks = []
+        self.children = []
+
+    def tearDown(self):
+        for child in self.children:
+            if child.poll() is None:
+                os.kill(child.pid, 9)
+                child.wait()
+        lock.giveLocks(self.locks)
+        os.environ = self.environ0
+        shutil.rmtree(self.stack)
+
+    def lockInChild(self, lockType, products=None, writeLock=False):
+        """
+        Take a lock (and if writeLock is true, the stack's write lock) in a separate process,
+        which prints "locked" once it has the lock
+        """
+        env = os.environ.copy()
+        if env.has_key("EUPS_LOCK_PID"):
+            del env["EUPS_LOCK_PID"]
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(eups.__file__)))
+
+        script = "import sys, eups.lock as lock; " + \
+                 "lock.takeLocks('test', [%r], %d, products=%r); " % (self.stack, lockType, products)
+        if writeLock:
+            script += "lock.takeWriteLock(%r); " % self.stack
+        script += "print 'locked'; sys.stdout.flush()"
+        child = subprocess.Popen([sys.executable, "-c", script], env=env,
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.children.append(child)
+        return child
+
+    def isBlocked(self, child, wait=1.0):
+        t0 = time.time()
+        while time.time() - t0 < wait:
+            if child.poll() is not None:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def testShared(self):
+        self.locks = lock.takeLocks("test", [self.stack], lock.LOCK_SH)
+        self.assertEquals(len(self.locks), 1)
+        self.assertEquals(len(lock.listLockers(self.lockDir)), 1)
+
+        child = self.lockInChild(lock.LOCK_SH)
+        self.assert_(not self.isBlocked(child))
+        self.assertEquals(child.stdout.read().strip(), "locked")
+
+        # the same process can take the lock again
+        locks = lock.takeLocks("test", [self.stack], lock.LOCK_SH)
+        lock.giveLocks(locks)
+        self.assert_(os.path.isdir(self.lockDir))
+
+        lock.giveLocks(self.locks)
+        self.assert_(not os.path.exists(self.lockDir), "Failed to tidy up lock directory")
+
+    def testExclusive(self):
+        self.locks = lock.takeLocks("test", [self.stack], lock.LOCK_EX)
+
+        child = self.lockInChild(lock.LOCK_SH)
+        self.assert_(self.isBlocked(child))
+
+        lock.giveLocks(self.locks)
+        self.assert_(not self.isBlocked(child, 5))
+        output = child.stdout.read()
+        self.assert_(output.startswith("Waiting for shared lock on %s" % self.stack))
+        self.assertEquals(output.split("\n")[-2], "locked")
+
+    def testProducts(self):
+        self.locks = lock.takeLocks("test", [self.stack], lock.LOCK_EX, products=["foo"])
+        self.assertEquals(len(self.locks), 2)
+        self.assertEquals(len(lock.listLockers(os.path.join(self.lockDir, "foo"))), 1)
+        #
+        # Readers, and writers of other products, aren't blocked
+        #
+        child = self.lockInChild(lock.LOCK_SH)
+        self.assert_(not self.isBlocked(child))
+        child = self.lockInChild(lock.LOCK_EX, ["bar"])
+        self.assert_(not self.isBlocked(child))
+        #
+        # but writers of the same product, or the whole stack, are
+        #
+        childFoo = self.lockInChild(lock.LOCK_EX, ["foo"])
+        childAll = self.lockInChild(lock.LOCK_EX)
+        self.assert_(self.isBlocked(childFoo))
+        self.assert_(self.isBlocked(childAll, 0.1))
+
+        lock.giveLocks(self.locks)
+        self.assert_(not self.isBlocked(childFoo, 5))
+        self.assert_(not self.isBlocked(childAll, 5))
+
+    def testWriteLock(self):
+        # rewrites of the stack's files are serialised, even between holders of shared locks
+        self.assertEquals(lock.takeWriteLock(self.stack), [])
+
+        self.locks = lock.takeLocks("test", [self.stack], lock.LOCK_SH)
+        locks = lock.takeWriteLock(self.stack)
+        self.assertEquals(len(locks), 1)
+
+        child = self.lockInChild(lock.LOCK_SH)
+        self.assert_(not self.isBlocked(child))
+        child = self.lockInChild(lock.LOCK_SH, writeLock=True)
+        self.assert_(self.isBlocked(child))
+
+        lock.giveLocks(locks)
+        self.assert_(not self.isBlocked(child, 5))
+        self.assertEquals(child.stdout.read().split("\n")[-2], "locked")
+
+    def testParent(self):
+        # a command run by the holder of a lock isn't blocked by it
+        self.locks = lock.takeLocks("test", [self.stack], lock.LOCK_EX)
+        os.environ["EUPS_LOCK_PID"] = "%d" % os.getpid()
+
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(eups.__file__)))
+        script = "import eups.lock as lock; print lock.takeLocks('test', [%r], %d)" % \
+                 (self.stack, lock.LOCK_EX)
+        child = subprocess.Popen([sys.executable, "-c", script], env=env, stdout=subprocess.PIPE)
+        self.children.append(child)
+        self.assert_(not self.isBlocked(child))
+        self.assertEquals(child.stdout.read().strip(), "[]")
+
+    def testParentWithStaleHolder(self):
+        # a holder file left by a process that was killed doesn't stop us using our parent's lock
+        self.locks = lock.takeLocks("test", [self.stack], lock.LOCK_EX)
+        os.environ["EUPS_LOCK_PID"] = "%d" % os.getpid()
+
+        dead = subprocess.Popen([sys.executable, "-c", "pass"])
+        dead.wait()
+        open(os.path.join(self.lockDir, "shared-nobody.%d" % dead.pid), "w").close()
+        self.assertEquals(len(lock.listLockers(self.lockDir)), 2)
+
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(eups.__file__)))
+        script = "import eups.lock as lock; print lock.takeLocks('test', [%r], %d)" % \
+                 (self.stack, lock.LOCK_EX)
+        child = subprocess.Popen([sys.executable, "-c", script], env=env, stdout=subprocess.PIPE)
+        self.children.append(child)
+        self.assert_(not self.isBlocked(child))
+        self.assertEquals(child.stdout.read().strip(), "[]")
+
+    def testProductLocksNeedStackLock(self):
+        self.assertEquals(lock.takeProductLocks(self.stack, ["foo"]), [])
+
+        self.locks = lock.takeLocks("test", [self.stack], lock.LOCK_SH)
+        locks = lock.takeProductLocks(self.stack, ["foo"])
+        self.assertEquals(len(locks), 1)
+        lock.giveLocks(locks)
+        self.assert_(not os.path.exists(os.path.join(self.lockDir, "foo")))
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite(makeSuite=True):
+    """Return a test suite"""
+
+    return testCommon.makeSuite([LockTestCase], makeSuite)
+
+def run(shouldExit=False):
+    """Run the tests"""
+    testCommon.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
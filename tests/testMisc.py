@@ -9,10 +9,13 @@ import shutil
 import re
 import unittest
 import time
+import random
 import testCommon
 from testCommon import testEupsStack
 
 import eups
+from eups.VersionCompare import VersionCompare, versionSortKey
+from eups.VersionParser import VersionParser
 
 class MiscTestCase(unittest.TestCase):
 
@@ -25,6 +28,123 @@ class MiscTestCase(unittest.TestCase):
     def testNothing(self):
         pass
 
+class VersionCompareTestCase(unittest.TestCase):
+    """test the key-based ordering of versions"""
+
+    def setUp(self):
+        self.vc = VersionCompare()
+        self.rand = random.Random(12345)
+
+    def randomVersion(self):
+        """return a random version written in canonical form"""
+        def component():
+            r = self.rand.random()
+            if r < 0.6:
+                return str(self.rand.randint(0, 12))
+            elif r < 0.8:
+                return self.rand.choice(["a", "b", "rc", "svn"]) + str(self.rand.randint(0, 12))
+            else:
+                return self.rand.choice(["a", "b", "rc", "svn", "master"])
+
+        def components(n):
+            return [component() for i in range(self.rand.randint(1, n))]
+
+        version = ".".join(components(4))
+        r = self.rand.random()
+        if r < 0.1:                     # m# and p# are only recognised without + or -
+            version += self.rand.choice(["m", "p"]) + str(self.rand.randint(0, 5))
+        else:
+            if r < 0.3:
+                version += "-" + ".".join(components(2))
+            if self.rand.random() < 0.2:
+                version += "+" + ".".join(components(2))
+
+        return version
+
+    def testSortKey(self):
+        versions = [self.randomVersion() for i in range(200)]
+        versions += ["1.2-rc1", "1.2", "1.2-rc2", "1.2.3", "1.2+h1", "1.2-rc1+h1",
+                     "1.2.3+svn666", "1.2.3-svn666", "1.2.3+svn100", "1.2.3+svn1000",
+                     "1.2.3+rvn1000", "1.2.3+tvn666", "1.2.3m1", "1.2.3p1"]
+
+        for v1 in versions:
+            self.assert_(self.vc.hasExactSortKey(v1), v1)
+            for v2 in versions:
+                self.assertEquals(cmp(self.vc.sortKey(v1), self.vc.sortKey(v2)),
+                                  self.vc.stdCompare(v1, v2),
+                                  "%s %s" % (v1, v2))
+        #
+        # Components that start with a digit but aren't numbers
+        #
+        versions = ["3.0rc1", "3.0rc2", "3.0", "3.1", "2.9", "1.5a", "1.5", "1.6", "1.5b",
+                    "1.2.2a", "1.2.2", "1.2.3", "1.2.2a-1", "1.2.2a+h1", "3.0rc1.1"]
+        for v1 in versions:
+            for v2 in versions:
+                self.assertEquals(cmp(self.vc.sortKey(v1), self.vc.sortKey(v2)),
+                                  self.vc.stdCompare(v1, v2),
+                                  "%s %s" % (v1, v2))
+
+    def testHasExactSortKey(self):
+        for v in ["1.2.3", "1.2.rc1", "1.2-b2+svn123", "master", "1.2.3m1", "0.10"]:
+            self.assert_(self.vc.hasExactSortKey(v), v)
+        for v in ["3.0rc1", "1.5a", "1.2-2a", "1.2+h01", "1.02", "1_2", "rel-0-8-2", "1.2rc1x"]:
+            self.assert_(not self.vc.hasExactSortKey(v), v)
+
+    def testSortKeyFor(self):
+        self.assert_(versionSortKey(self.vc) == self.vc.sortKey)
+
+        class ReverseCompare(VersionCompare):
+            def compare(self, v1, v2, mustReturnInt=True):
+                return -self.stdCompare(v1, v2)
+
+        versions = ["1.2", "1.10", "1.2-rc1", "1.2+h1"]
+        versions.sort(key=versionSortKey(ReverseCompare()))
+        self.assertEquals(versions, ["1.10", "1.2+h1", "1.2", "1.2-rc1"])
+
+class VersionParserTestCase(unittest.TestCase):
+    """test the evaluation of logical expressions"""
+
+    def eval(self, expr, **symbols):
+        parser = VersionParser(expr)
+        for k, v in symbols.items():
+            parser.define(k, v)
+        return parser.eval()
+
+    def testEval(self):
+        self.assertEquals(self.eval(""), False)
+        self.assertEquals(self.eval("True"), True)
+        self.assertEquals(self.eval("depth <= 2", depth=1), True)
+        self.assertEquals(self.eval("depth <= 2", depth=3), False)
+        self.assertEquals(self.eval("FLAVOR == Linux", flavor="Linux"), True)
+        self.assertEquals(self.eval("type == build", type=["build", "exact"]), True)
+        self.assertEquals(self.eval("type != build", type=["exact"]), True)
+        self.assert_(self.eval("flavor =~ ^Lin", flavor="Linux"))
+        # ! applies to the rest of the expression
+        self.assertEquals(self.eval("!(flavor == Linux) || depth < 2", flavor="Linux", depth=1), False)
+        self.assertEquals(self.eval("(depth == 1 || depth == 2) && x", depth=0), False)
+        self.assertEquals(self.eval("depth == 1 || depth == 2", depth=2), True)
+
+    def testShortCircuit(self):
+        # a short circuit stops the evaluation of the whole expression
+        self.assertEquals(self.eval("depth > 0 || x && depth > 5", depth=1), True)
+        self.assertEquals(self.eval("depth > 0 || x && depth > 5", depth=0), False)
+        self.assertEquals(self.eval("1 || ${EUPS_NO_SUCH_VARIABLE:-x}"), 1)
+        self.assertRaises(RuntimeError, self.eval, "(flavor == Linux || x)", flavor="Linux")
+        self.assertRaises(RuntimeError, self.eval, "(depth == 1", depth=1)
+
+    def testCompiledOnce(self):
+        expr = "depth < 3 && depth != 1"
+        p1 = VersionParser(expr)
+        p2 = VersionParser(expr)
+        self.assert_(p1._program is p2._program)
+
+        p1.define("depth", 0)
+        p2.define("depth", 1)
+        self.assertEquals(p1.eval(), True)
+        self.assertEquals(p2.eval(), False)
+        p1.define("depth", 2)           # a parser may be evaluated more than once
+        self.assertEquals(p1.eval(), True)
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
@@ -32,6 +152,8 @@ def suite(makeSuite=True):
 
     return testCommon.makeSuite([
         MiscTestCase,
+        VersionCompareTestCase,
+        VersionParserTestCase,
         ], makeSuite)
 
 def run(shouldExit=False):
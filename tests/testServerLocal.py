@@ -9,6 +9,7 @@ import sys
 import shutil
 import unittest
 import time
+import zlib
 from testCommon import testEupsStack
 
 from eups.distrib.server import Transporter, LocalTransporter
@@ -319,9 +320,607 @@ class LocalRepositoriesTestCase(unittest.TestCase):
         self.assertEquals(pkg[2], "generic")
         self.assertEquals(pkg[3], self.pkgroot)
 
+from eups.distrib.server import PackageIndex, TaggedProductList
+from eups.distrib.Distrib import DefaultDistrib
 
+class PackageIndexTestCase(unittest.TestCase):
+    """
+    Test the index of the packages on a server
+    """
 
-__all__ = "LocalTransporterTestCase LocalConfigFileTestCase LocalServerConfTestCase LocalDistribServerTestCase LocalRepositoryTestCase LocalRepositoriesTestCase".split()        
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_PATH"] = testEupsStack
+        os.environ["EUPS_USERDATA"] = os.path.join(testEupsStack, "_indexuserdata_")
+
+        self.pkgroot = os.path.join(testEupsStack, "_indexserver_")
+        if os.path.exists(self.pkgroot):
+            shutil.rmtree(self.pkgroot)
+        shutil.copytree(os.path.join(testEupsStack, "testserver", "s2"), self.pkgroot)
+
+        self.distrib = DefaultDistrib(Eups(), None, "generic")
+
+    def tearDown(self):
+        for d in (self.pkgroot, os.environ["EUPS_USERDATA"]):
+            if os.path.exists(d):
+                shutil.rmtree(d)
+        os.environ = self.environ0
+
+    def testCreateIndex(self):
+        index = self.distrib.getPackageIndex(self.pkgroot)
+        self.assertEquals(index.getProducts(), [["doxygen", "1.5.8", "generic"]])
+        distId, checksum, tags = index.getPackageInfo("doxygen", "1.5.8")
+        self.assertEquals(distId, "external/doxygen/1.5.8/Linux/doxygen-1.5.8-Linux.tar.gz")
+        self.assertEquals(checksum, PackageIndex.checksum(os.path.join(self.pkgroot, "manifests",
+                                                                       "doxygen-1.5.8.manifest")))
+        self.assertEquals(tags, [])
+
+        pl = TaggedProductList("stable")
+        pl.addProduct("doxygen", "1.5.8")
+        self.distrib.writeTaggedRelease(self.pkgroot, "stable", pl, None, True)
+
+        index = PackageIndex.fromFile(os.path.join(self.pkgroot, "packages.index"))
+        self.assertEquals(index.getProducts(tag="stable"), [["doxygen", "1.5.8", "generic"]])
+        self.assertEquals(index.getProducts(tag="current"), [])
+        self.assertEquals(index.getProducts("doxy*", flavor="Linux"), [])
+
+    def testListFromIndex(self):
+        self.distrib.writePackageIndex(self.pkgroot, self.distrib.getPackageIndex(self.pkgroot))
+        # the manifests are only needed to create the index
+        shutil.rmtree(os.path.join(self.pkgroot, "manifests"))
+
+        ds = ServerConf.makeServer(self.pkgroot, False)
+        self.assertEquals(ds.listAvailableProducts(), [["doxygen", "1.5.8", "generic"]])
+        self.assertEquals(ds.listAvailableProducts("doxygen", "1.5.10"), [])
+
+        repos = Repository(Eups(), self.pkgroot)
+        self.assertEquals(repos.listPackages("doxygen"), [("doxygen", "1.5.8", "generic")])
+
+    def testUpdateFile(self):
+        src = os.path.join(self.pkgroot, "config.txt")
+        localfile = os.path.join(self.pkgroot, "config-copy.txt")
+
+        trx = LocalTransporter(src)
+        self.assert_(trx.updateFile(localfile))
+        self.assert_(not trx.updateFile(localfile))
+
+        mtime = os.stat(src).st_mtime + 10
+        os.utime(src, (mtime, mtime))
+        self.assert_(trx.updateFile(localfile))
+
+from eups.distrib.server import DownloadCache
+import eups.hooks as hooks
+
+class DownloadCacheTestCase(unittest.TestCase):
+    """
+    Test the cache of files retrieved from servers
+    """
+
+    def setUp(self):
+        os.environ["EUPS_PATH"] = testEupsStack
+        self.site0 = (hooks.config.site.downloadCacheDir, hooks.config.site.downloadCacheSize)
+        hooks.config.site.downloadCacheDir = os.path.join(testEupsStack, "_downloads_")
+        hooks.config.site.downloadCacheSize = 1
+
+        self.pkgroot = os.path.join(testEupsStack, "_cacheserver_")
+        if os.path.exists(self.pkgroot):
+            shutil.rmtree(self.pkgroot)
+        shutil.copytree(os.path.join(testEupsStack, "testserver", "s2"), self.pkgroot)
+
+        self.cache = DownloadCache.get()
+        self.localfile = os.path.join(self.pkgroot, "copy.txt")
+
+    def tearDown(self):
+        hooks.config.site.downloadCacheDir, hooks.config.site.downloadCacheSize = self.site0
+        for d in (self.pkgroot, self.cache.cacheDir):
+            if os.path.exists(d):
+                shutil.rmtree(d)
+
+    def testCache(self):
+        src = os.path.join(self.pkgroot, "config.txt")
+        self.assert_(self.cache.cacheToFile(LocalTransporter(src), self.localfile))
+        self.assert_(not self.cache.cacheToFile(LocalTransporter(src), self.localfile))
+        self.assertEquals(open(self.localfile).read(), open(src).read())
+
+        fd = open(src, "a")
+        print >> fd, "# a change"
+        fd.close()
+        self.assert_(self.cache.cacheToFile(LocalTransporter(src), self.localfile))
+        self.assertEquals(open(self.localfile).read(), open(src).read())
+
+        # servers use the cache
+        ds = ServerConf.makeServer(self.pkgroot, False)
+        ds.getFile("config.txt", filename=self.localfile)
+        self.assertEquals(open(self.localfile).read(), open(src).read())
+        self.assert_(not self.cache.cacheToFile(LocalTransporter(src), self.localfile))
+
+        self.cache.clear(["/no/such/server"])
+        self.assert_(not self.cache.cacheToFile(LocalTransporter(src), self.localfile))
+        self.cache.clear([self.pkgroot])
+        self.assert_(self.cache.cacheToFile(LocalTransporter(src), self.localfile))
+
+    def testEvict(self):
+        cache = DownloadCache(self.cache.cacheDir, 100)
+        files = []
+        for i in range(3):
+            files.append(os.path.join(self.pkgroot, "file%d" % i))
+            fd = open(files[-1], "w")
+            fd.write(60*"x")
+            fd.close()
+
+        for f in files:
+            self.assert_(cache.cacheToFile(LocalTransporter(f), self.localfile))
+            time.sleep(0.01)
+        self.assert_(not cache.cacheToFile(LocalTransporter(files[2]), self.localfile))
+        self.assert_(cache.cacheToFile(LocalTransporter(files[0]), self.localfile))
+
+from eups.distrib import tarball
+
+class TarballTestCase(unittest.TestCase):
+    """
+    Test creating and installing tarballs
+    """
+
+    def setUp(self):
+        os.environ["EUPS_PATH"] = testEupsStack
+        self.pkgroot = os.path.join(testEupsStack, "_tarballserver_")
+        self.root = os.path.join(testEupsStack, "_tarballroot_")
+        for d in (self.pkgroot, self.root):
+            if os.path.exists(d):
+                shutil.rmtree(d)
+            os.makedirs(d)
+
+        self.srcdir = os.path.join(self.root, "src")
+        os.makedirs(os.path.join(self.srcdir, "foo", "1.0", "ups"))
+        fd = open(os.path.join(self.srcdir, "foo", "1.0", "ups", "foo.table"), "w")
+        print >> fd, "envPrepend(PATH, ${PRODUCT_DIR}/bin)"
+        fd.close()
+
+        self.ds = ConfigurableDistribServer(self.pkgroot)
+
+    def tearDown(self):
+        for d in (self.pkgroot, self.root):
+            if os.path.exists(d):
+                shutil.rmtree(d)
+
+    def testParseDistID(self):
+        self.assertEquals(tarball.Distrib.parseDistID("foo-1.0@Linux.tar.zst"), "foo-1.0@Linux.tar.zst")
+        self.assertEquals(tarball.Distrib.parseDistID("foo-1.0@Linux.tar"), None)
+        self.assertEquals(tarball.compressionFor("foo-1.0@Linux.tar.xz"), "xz")
+
+    def testCreateAndInstall(self):
+        for compression in sorted(tarball.compressors.keys()):
+            try:
+                tarball.findCompressor(compression)
+            except RuntimeError:
+                continue                # not available on this machine
+
+            distrib = tarball.Distrib(Eups(), self.ds, None, options={"compression": compression})
+            tb = distrib.getDistIdForPackage("foo", "1.0")
+            self.assertEquals(tarball.compressionFor(tb), compression)
+
+            distrib.writeTarball(self.srcdir, os.path.join("foo", "1.0"), os.path.join(self.pkgroot, tb))
+            self.assert_(os.path.exists(os.path.join(self.pkgroot, tb)))
+
+            productRoot = os.path.join(self.root, compression)
+            distrib.installPackage(tb, "foo", "1.0", productRoot, os.path.join("foo", "1.0"),
+                                   buildDir=os.path.join(self.root, "build"))
+            self.assert_(os.path.exists(os.path.join(productRoot, distrib.Eups.flavor,
+                                                     "foo", "1.0", "ups", "foo.table")))
+
+    def testFailedInstall(self):
+        fd = open(os.path.join(self.srcdir, "foo", "1.0", "data"), "wb")
+        fd.write(os.urandom(1 << 20))   # so that some of a truncated tarball can be unpacked
+        fd.close()
+
+        distrib = tarball.Distrib(Eups(), self.ds, None, options={"compression": "gzip"})
+        tb = distrib.getDistIdForPackage("foo", "1.0")
+        distrib.writeTarball(self.srcdir, os.path.join("foo", "1.0"), os.path.join(self.pkgroot, tb))
+
+        productRoot = os.path.join(self.root, "inst")
+        unpackDir = os.path.join(productRoot, distrib.Eups.flavor)
+        os.makedirs(os.path.join(unpackDir, "foo", "0.9"))
+        distrib.installPackage(tb, "foo", "1.0", productRoot, os.path.join("foo", "1.0"),
+                               buildDir=os.path.join(self.root, "build"))
+        self.assertEquals(sorted(os.listdir(os.path.join(unpackDir, "foo"))), ["0.9", "1.0"])
+        #
+        # A truncated tarball leaves nothing behind
+        #
+        shutil.rmtree(os.path.join(unpackDir, "foo", "1.0"))
+        data = open(os.path.join(self.pkgroot, tb), "rb").read()
+        fd = open(os.path.join(self.pkgroot, tb), "wb")
+        fd.write(data[:len(data)//2])
+        fd.close()
+
+        self.assertRaises(RuntimeError, distrib.installPackage, tb, "foo", "1.0", productRoot,
+                          os.path.join("foo", "1.0"), buildDir=os.path.join(self.root, "build"))
+        self.assertEquals(os.listdir(unpackDir), ["foo"])
+        self.assertEquals(os.listdir(os.path.join(unpackDir, "foo")), ["0.9"])
+
+from eups.distrib import chunked
+
+class ChunkedTestCase(unittest.TestCase):
+    """
+    Test creating and installing chunked packages
+    """
+
+    def setUp(self):
+        os.environ["EUPS_PATH"] = testEupsStack
+        self.pkgroot = os.path.join(testEupsStack, "_chunkedserver_")
+        self.root = os.path.join(testEupsStack, "_chunkedroot_")
+        for d in (self.pkgroot, self.root):
+            if os.path.exists(d):
+                shutil.rmtree(d)
+            os.makedirs(d)
+
+        self.srcdir = os.path.join(self.root, "src")
+        for v in ("1.0", "1.1"):
+            os.makedirs(os.path.join(self.srcdir, "foo", v, "ups"))
+            fd = open(os.path.join(self.srcdir, "foo", v, "ups", "foo.table"), "w")
+            print >> fd, "envPrepend(PATH, ${PRODUCT_DIR}/bin)"
+            fd.close()
+
+            fd = open(os.path.join(self.srcdir, "foo", v, "data"), "wb")
+            fd.write("x"*(2*chunked.chunkSize) + v)
+            fd.close()
+            os.symlink("data", os.path.join(self.srcdir, "foo", v, "data.lnk"))
+
+        self.ds = ConfigurableDistribServer(self.pkgroot)
+        self.distrib = chunked.Distrib(Eups(), self.ds, None)
+
+    def tearDown(self):
+        for d in (self.pkgroot, self.root):
+            if os.path.exists(d):
+                shutil.rmtree(d)
+
+    def install(self, version, productRoot):
+        distId = self.distrib.getDistIdForPackage("foo", version)
+        self.distrib.installPackage(self.distrib.parseDistID(distId), "foo", version, productRoot,
+                                    os.path.join("foo", version), buildDir=os.path.join(self.root, "build"))
+        return os.path.join(productRoot, self.distrib.Eups.flavor, "foo", version)
+
+    def testParseDistID(self):
+        distId = self.distrib.getDistIdForPackage("foo", "1.0", "Linux")
+        self.assertEquals(distId, "chunked:filelists/foo-1.0@Linux.files")
+        self.assertEquals(chunked.Distrib.parseDistID(distId), "filelists/foo-1.0@Linux.files")
+        self.assertEquals(chunked.Distrib.parseDistID("foo-1.0@Linux.tar.gz"), None)
+
+    def testCreateAndInstall(self):
+        for v, nnew in (("1.0", 3), ("1.1", 1)):
+            location = self.distrib.parseDistID(self.distrib.getDistIdForPackage("foo", v))
+            self.assertEquals(self.distrib.writeFileList(self.srcdir, os.path.join("foo", v),
+                                                         self.pkgroot, location), nnew)
+
+        productRoot = os.path.join(self.root, "inst")
+        fetched = []
+        fetchChunk = self.distrib.fetchChunk
+        def countingFetchChunk(chunk, product, version, tmpfile):
+            fetched.append(chunk)
+            return fetchChunk(chunk, product, version, tmpfile)
+        self.distrib.fetchChunk = countingFetchChunk
+
+        dir10 = self.install("1.0", productRoot)
+        self.assertEquals(len(fetched), 3)
+        self.assertEquals(open(os.path.join(dir10, "data"), "rb").read()[-3:], "1.0")
+        self.assertEquals(os.readlink(os.path.join(dir10, "data.lnk")), "data")
+
+        dir11 = self.install("1.1", productRoot)
+        self.assertEquals(len(fetched), 4) # only the last chunk of data has changed
+        self.assertEquals(open(os.path.join(dir11, "data"), "rb").read()[-3:], "1.1")
+        self.assertEquals(os.stat(os.path.join(dir10, "ups", "foo.table")).st_ino,
+                          os.stat(os.path.join(dir11, "ups", "foo.table")).st_ino)
+        # the shared files can't be changed (and so change the other versions) by accident
+        self.assertEquals(os.stat(os.path.join(dir11, "ups", "foo.table")).st_mode & 0222, 0)
+
+    def testRemoveProduct(self):
+        for v in ("1.0", "1.1"):
+            location = self.distrib.parseDistID(self.distrib.getDistIdForPackage("foo", v))
+            self.distrib.writeFileList(self.srcdir, os.path.join("foo", v), self.pkgroot, location)
+
+        productRoot = os.path.join(self.root, "inst")
+        flavor = self.distrib.Eups.flavor
+        store = chunked.FileStore(os.path.join(productRoot, flavor, "_chunked_"))
+        def storeFiles():
+            out = []
+            for dirpath, dirnames, filenames in os.walk(os.path.join(store.storeDir, "files")):
+                out += filenames
+            return out
+
+        dir10 = self.install("1.0", productRoot)
+        dir11 = self.install("1.1", productRoot)
+        self.assertEquals(len(storeFiles()), 3) # foo.table and the two data files
+        files = chunked.FileList.fromFile(os.path.join(self.pkgroot, self.distrib.parseDistID(
+            self.distrib.getDistIdForPackage("foo", "1.0"))))
+        data10 = [e[3][-1] for e in files.entries if e[0] == "f" and e[4].endswith("/data")][0]
+        self.assert_(store.findChunks("foo").has_key(data10))
+        #
+        # Removing a version frees the files that only it used, and its chunks are no longer offered
+        #
+        shutil.rmtree(dir10)
+        self.assertEquals(chunked.removeProduct(productRoot, flavor, "foo", "1.0"), 1)
+        self.assertEquals(len(storeFiles()), 2)
+        self.assert_(not store.findChunks("foo").has_key(data10))
+        self.assertEquals(open(os.path.join(dir11, "data"), "rb").read()[-3:], "1.1")
+        #
+        # A file that's no longer linked from an installed product goes too
+        #
+        os.unlink(os.path.join(dir11, "data"))
+        self.assertEquals(store.prune(), 1)
+        self.assertEquals(len(storeFiles()), 1)
+
+        shutil.rmtree(dir11)
+        self.assertEquals(chunked.removeProduct(productRoot, flavor, "foo", "1.1"), 1)
+        self.assertEquals(storeFiles(), [])
+        self.assertEquals(os.listdir(os.path.join(store.storeDir, "lists")), [])
+
+        self.assertEquals(chunked.removeProduct(self.root, flavor, "foo", "1.1"), 0) # no store
+
+    def testCorruptChunk(self):
+        location = self.distrib.parseDistID(self.distrib.getDistIdForPackage("foo", "1.0"))
+        self.distrib.writeFileList(self.srcdir, os.path.join("foo", "1.0"), self.pkgroot, location)
+
+        files = chunked.FileList.fromFile(os.path.join(self.pkgroot, location))
+        chunk = files.getChunks()[0]
+        fd = open(os.path.join(self.pkgroot, chunked.Distrib.getChunkPath(chunk)), "wb")
+        fd.write(zlib.compress("corrupted"))
+        fd.close()
+
+        self.assertRaises(RuntimeError, self.install, "1.0", os.path.join(self.root, "inst"))
+
+    def testUnsafePaths(self):
+        unpackDir = os.path.join(self.root, "inst")
+        outside = os.path.join(self.root, "outside")
+        os.makedirs(outside)
+        store = chunked.FileStore(os.path.join(self.root, "_chunked_"))
+        buildDir = os.path.join(self.root, "build")
+
+        for path in ("../evil", os.path.join(outside, "evil"), "foo/../../evil"):
+            files = chunked.FileList()
+            files.addFile(path, 0644, 0, [])
+            self.assertRaises(RuntimeError, self.distrib.installFiles,
+                              files, store, unpackDir, "foo", "1.0", buildDir)
+
+        files = chunked.FileList()
+        files.addDir("foo", 0755)
+        files.addLink("foo/out", outside)
+        files.addFile("foo/out/evil", 0644, 0, [])
+        self.assertRaises(RuntimeError, self.distrib.installFiles,
+                          files, store, unpackDir, "foo", "1.0", buildDir)
+        self.assertEquals(os.listdir(outside), [])
+
+        files = chunked.FileList()
+        files.addDir("foo/out", 0755)
+        self.assertRaises(RuntimeError, self.distrib.installFiles,
+                          files, store, unpackDir, "foo", "1.0", buildDir)
+        #
+        # but the link itself may point anywhere, and may be replaced
+        #
+        self.assertEquals(os.readlink(os.path.join(unpackDir, "foo", "out")), outside)
+        files = chunked.FileList()
+        files.addFile("foo/out", 0644, 0, [])
+        self.distrib.installFiles(files, store, unpackDir, "foo", "1.0", buildDir)
+        self.assert_(os.path.isfile(os.path.join(unpackDir, "foo", "out")))
+        self.assertEquals(os.listdir(outside), [])
+
+from eups.distrib.server import Manifest, Dependency
+
+class ManifestTestCase(unittest.TestCase):
+    """
+    Test reading and searching Manifests
+    """
+
+    def setUp(self):
+        os.environ["EUPS_PATH"] = testEupsStack
+        self.file = os.path.join(testEupsStack, "_manifest_.manifest")
+        fd = open(self.file, "w")
+        print >> fd, "EUPS distribution manifest for foo (1.0). Version 1.0"
+        print >> fd, "#"
+        print >> fd, "bar     Linux   2.0  bar.table  bar/2.0  search"
+        print >> fd, "   # an indented comment"
+        print >> fd, ""
+        print >> fd, "goo     Linux   1.1  none       none     tarball:goo.tar.gz  OPT  F  extra"
+        print >> fd, "foo     Linux   1.0  foo.table  foo/1.0  tarball:foo.tar.gz  REQ  T"
+        fd.close()
+
+    def tearDown(self):
+        os.remove(self.file)
+
+    def testRead(self):
+        man = Manifest.fromFile(self.file, Eups())
+        self.assertEquals((man.product, man.version), ("foo", "1.0"))
+        self.assertEquals([p.product for p in man.getProducts()], ["bar", "goo", "foo"])
+
+        bar, goo, foo = man.getProducts()
+        self.assertEquals(bar.distId, None)
+        self.assert_(not bar.isOpt and not bar.shouldRecurse)
+        self.assert_(goo.isOpt and not goo.shouldRecurse)
+        self.assertEquals(goo.extra, ["extra"])
+        self.assert_(not foo.isOpt and foo.shouldRecurse)
+
+    def testGetDependency(self):
+        man = Manifest.fromFile(self.file, Eups())
+        self.assertEquals(man.getDependency("goo").version, "1.1")
+        self.assertEquals(man.getDependency("goo", "1.2"), None)
+        self.assertEquals(man.getDependency("goo", flavor="Darwin"), None)
+
+        man.addDependency("goo", "1.2", "Linux", None, None, None)
+        self.assertEquals(man.getDependency("goo").version, "1.2")
+        self.assertEquals(man.getDependency("goo", which=0).version, "1.1")
+        self.assertEquals(man.getDependency("goo", "1.1").version, "1.1")
+
+        man.roll(-1)
+        self.assertEquals(man.getProducts()[0].version, "1.2")
+        self.assertEquals(man.getDependency("goo", which=0).version, "1.2")
+        man.roll(1)
+        man.reverse()
+        self.assertEquals(man.getDependency("goo").version, "1.1")
+        #
+        # The product list may be modified directly
+        #
+        man.getProducts().append(Dependency("hoo", "1.0", None, None, None, None))
+        self.assertEquals(man.getDependency("hoo").version, "1.0")
+        man.getProducts()[-1] = Dependency("hoo", "2.0", None, None, None, None)
+        self.assertEquals(man.getDependency("hoo").version, "2.0")
+        man.getProducts()[-1].flavor = "Linux"
+        self.assertEquals(man.getDependency("hoo", flavor="Linux").version, "2.0")
+
+import threading
+import BaseHTTPServer, SimpleHTTPServer, SocketServer
+from eups.distrib import server
+
+class _QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"       # so that connections are kept alive
+    connections = []
+
+    def setup(self):
+        SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+        self.connections.append(self.client_address)
+
+    def log_message(self, *args):
+        pass
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class LocalWebTransporterTestCase(unittest.TestCase):
+    """
+    Test the WebTransporter against a web server on this machine
+    """
+
+    def setUp(self):
+        if not os.environ.has_key("EUPS_DIR"):
+            os.environ["EUPS_DIR"] = os.path.dirname(testEupsStack)
+        os.environ["EUPS_PATH"] = testEupsStack
+        self.cwd = os.getcwd()
+        os.chdir(os.path.join(testEupsStack, "testserver"))
+
+        _QuietHandler.connections = []
+        self.httpd = _HTTPServer(("127.0.0.1", 0), _QuietHandler)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.base = "http://127.0.0.1:%d" % self.httpd.server_address[1]
+
+        self.localfile = "/tmp/eupstest-config.txt"
+        if os.path.exists(self.localfile):
+            os.remove(self.localfile)
+
+    def tearDown(self):
+        self.stopServer()
+        os.chdir(self.cwd)
+        if os.path.exists(self.localfile):
+            os.remove(self.localfile)
+
+    def stopServer(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+        server._connectionPool.clear()
+
+    def testCacheToFile(self):
+        trx = server.WebTransporter(self.base + "/s1/config.txt")
+        self.assertRaises(RemoteFileNotFound, trx.cacheToFile, self.localfile)
+        self.assert_(not os.path.exists(self.localfile))
+
+        _QuietHandler.connections = [] # the server closes the connection after an error
+        for i in range(3):
+            trx = server.WebTransporter(self.base + "/s2/config.txt")
+            trx.cacheToFile(self.localfile)
+        self.assertEquals(open(self.localfile).read(),
+                          open(os.path.join("s2", "config.txt")).read())
+        self.assertEquals(len(_QuietHandler.connections), 1) # the connection was reused
+
+    def testUpdateFile(self):
+        trx = server.WebTransporter(self.base + "/s2/config.txt")
+        self.assert_(trx.updateFile(self.localfile))
+        self.assert_(not trx.updateFile(self.localfile))
+        self.assertEquals(open(self.localfile).read(),
+                          open(os.path.join("s2", "config.txt")).read())
+
+    def testCacheToFileIfChanged(self):
+        trx = server.WebTransporter(self.base + "/s2/config.txt")
+        validators, updated = trx.cacheToFileIfChanged(self.localfile)
+        self.assert_(updated)
+        self.assert_(validators.has_key("lastModified"))
+        self.assertEquals(trx.cacheToFileIfChanged(self.localfile, validators), (validators, False))
+
+    def testPrefetch(self):
+        ds = ConfigurableDistribServer(self.base + "/s2")
+        ds.prefetch([("", "doxygen", "1.5.8", "generic", "manifest"),
+                     ("", "doxygen", "0.0", "generic", "manifest")], 2)
+        self.stopServer()               # so we must use the prefetched files
+
+        man = ds.getManifest("doxygen", "1.5.8", "generic")
+        self.assertEquals(man.product, "doxygen")
+        # we also remember which files weren't found
+        self.assertRaises(RemoteFileNotFound, ds.cacheFile, self.localfile,
+                          self.base + "/s2/manifests/doxygen-0.0.manifest")
+
+        ds.clearPrefetched()
+        self.assertRaises(server.ServerNotResponding, ds.getManifest, "doxygen", "1.5.8", "generic")
+
+from eups.distrib.Repositories import runJobs
+
+class RunJobsTestCase(unittest.TestCase):
+    """
+    Test the scheduling of parallel builds (eups distrib install --jobs)
+    """
+
+    def setUp(self):
+        self.outdir = os.path.join(testEupsStack, "_jobs_")
+        if not os.path.exists(self.outdir):
+            os.makedirs(self.outdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def build(self, name):
+        if name.startswith("bad"):
+            raise RuntimeError("failed to build %s" % name)
+        time.sleep(0.1)
+        open(os.path.join(self.outdir, name), "w").close()
+
+    def testRunJobs(self):
+        jobs = [("a", []), ("b", ["a", "external"]), ("c", []), ("d", ["b", "c"]), ("e", [])]
+        finished = []
+        def finish(name):
+            self.assert_(os.path.exists(os.path.join(self.outdir, name)))
+            finished.append(name)
+
+        t0 = time.time()
+        self.assertEquals(runJobs(jobs, 3, self.build, finish), ([], []))
+        self.assert_(time.time() - t0 < 0.45) # 3 rounds of builds, not 5
+
+        self.assertEquals(sorted(finished), ["a", "b", "c", "d", "e"])
+        for name, deps in jobs:
+            for d in deps:
+                if d != "external":
+                    self.assert_(finished.index(d) < finished.index(name))
+
+    def testFailure(self):
+        jobs = [("bad", []), ("b", ["bad"]), ("c", [])]
+        finished = []
+        failed, notStarted = runJobs(jobs, 2, self.build, finished.append)
+
+        self.assertEquals(failed, ["bad"])
+        self.assertEquals(notStarted, ["b"])
+        self.assertEquals(finished, ["c"])
+
+    def testConnectionPool(self):
+        # children don't share the parent's idle connections
+        pool = server._connectionPool
+        pool._idle["example.com:80"] = ["parent's connection"]
+        def build(name):
+            if server._connectionPool is pool or server._connectionPool._idle:
+                raise RuntimeError("inherited the parent's connections")
+        try:
+            self.assertEquals(runJobs([("a", [])], 1, build, lambda name: None), ([], []))
+        finally:
+            pool._idle = {}
+        self.assert_(server._connectionPool is pool)
+
+__all__ = "LocalTransporterTestCase LocalConfigFileTestCase LocalServerConfTestCase LocalDistribServerTestCase LocalRepositoryTestCase LocalRepositoriesTestCase PackageIndexTestCase DownloadCacheTestCase TarballTestCase ChunkedTestCase ManifestTestCase LocalWebTransporterTestCase RunJobsTestCase".split()        
 
 if __name__ == "__main__":
     unittest.main()
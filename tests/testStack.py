@@ -5,6 +5,8 @@ Tests for eups.stack
 
 import os
 import sys
+import shutil
+import cPickle
 import unittest
 import time
 import testCommon
@@ -12,6 +14,7 @@ from testCommon import testEupsStack
 from eups.Product import ProductNotFound, Product
 
 from eups.stack import ProductFamily
+from eups.VersionCompare import VersionCompare
 
 class ProductFamilyTestCase(unittest.TestCase):
 
@@ -34,6 +37,58 @@ class ProductFamilyTestCase(unittest.TestCase):
         self.assert_(not self.fam.hasVersion("3.1"))
         self.assert_(self.fam.removeVersion("3.2"))
 
+    def testSortedVersions(self):
+        key = VersionCompare().sortKey
+        for v in "3.10 3.2 3.1 4.0-rc1".split():
+            self.fam.addVersion(v, "/opt/LInux/magnum/" + v)
+
+        self.assertEquals(self.fam.getSortedVersions(key), "3.1 3.2 3.10 4.0-rc1".split())
+        self.assertEquals(self.fam.getLatestVersion(key), "4.0-rc1")
+        self.assertEquals(self.fam.getLatestVersion(key, "4.0"), None)
+        self.assertEquals(self.fam.getVersionsBetween(key, "3.2", "3.10"), ["3.2", "3.10"])
+        self.assertEquals(self.fam.getVersionsBetween(key, "3.2", "3.10", includeLower=False), ["3.10"])
+        self.assertEquals(self.fam.getVersionsBetween(key, upper="3.10", includeUpper=False), ["3.1", "3.2"])
+        self.assertEquals(self.fam.getVersionsBetween(key, "3.3"), ["3.10", "4.0-rc1"])
+        #
+        # The order is maintained as versions are added and removed
+        #
+        self.fam.addVersion("4.0", "/opt/LInux/magnum/4.0")
+        self.fam.addVersion("3.3", "/opt/LInux/magnum/3.3")
+        self.fam.removeVersion("3.1")
+        self.assertEquals(self.fam.getSortedVersions(key), "3.2 3.3 3.10 4.0-rc1 4.0".split())
+        self.assertEquals(self.fam.getLatestVersion(key, "4.0"), "4.0")
+
+        # but isn't pickled
+        fam = cPickle.loads(cPickle.dumps(self.fam, cPickle.HIGHEST_PROTOCOL))
+        self.assert_(fam._sorted is None)
+        self.assertEquals(fam.getSortedVersions(key), self.fam.getSortedVersions(key))
+
+    def testInexactVersions(self):
+        vc = VersionCompare()
+        key = vc.sortKey
+        for v in "2.9 3.0rc1 3.1 3.10a".split():
+            self.fam.addVersion(v, "/opt/LInux/magnum/" + v)
+
+        self.assertEquals(self.fam.getLatestVersion(key), "3.10a")
+        self.assertEquals(self.fam.getLatestVersion(key, "3.1"), "3.10a")
+        self.assertEquals(self.fam.getLatestVersion(key, "3.2"), None)
+        self.assertEquals(self.fam.getSortedVersions(key)[:3], "2.9 3.0rc1 3.1".split())
+        #
+        # 3.10a sorts after 3.2 by its key, but stdCompare puts it before; versions
+        # like it are always returned
+        #
+        self.assert_(vc.stdCompare("3.10a", "3.2") < 0)
+        self.assertEquals(self.fam.getVersionsBetween(key, upper="3.2"), "2.9 3.0rc1 3.1 3.10a".split())
+        self.assertEquals(self.fam.getVersionsBetween(key, "3.0", "3.0"), ["3.0rc1", "3.10a"])
+        self.assertEquals(self.fam.getVersionsBetween(key, "3.0rc1"), self.fam.getSortedVersions(key))
+
+        self.fam.removeVersion("3.10a")
+        self.fam.removeVersion("3.0rc1")
+        self.assertEquals(self.fam.getVersionsBetween(key, "3.0", "3.0"), [])
+        self.fam.addVersion("3.0rc1", "/opt/LInux/magnum/3.0rc1")
+        self.assertEquals(self.fam.getVersionsBetween(key, "3.0", "3.0"), ["3.0rc1"])
+        self.assertEquals(self.fam.getLatestVersion(key), "3.1")
+
     def testGetProduct(self):
         self.fam.addVersion("3.1", "/opt/LInux/magnum/3.1")
         p = self.fam.getProduct("3.1")
@@ -135,10 +190,41 @@ class ProductStackTestCase(unittest.TestCase):
 
     def testMisc(self):
         self.assertEquals(ProductStack.persistFilename("Linux"),
-                          "Linux.pickleDB1_3_0")
+                          "Linux.cacheDB1_5_8")
         self.assertEquals(self.stack.getDbPath(), 
                           os.path.join(testEupsStack, "ups_db"))
 
+    def testIndex(self):
+        self.stack.addProduct(Product("afw", "1.2", "Darwin", 
+                                      "/opt/sw/Darwin/afw/1.2", "none"))
+        self.stack.addProduct(Product("fw", "1.3", "Darwin", 
+                                      "/opt/sw/Darwin/fw/1.3", "none"))
+        self.stack.assignTag("current", "fw", "1.3")
+
+        index = self.stack.getIndex("Darwin")
+        self.assertEquals(len(index), 3)
+        self.assert_(self.stack.getIndex("Darwin") is index)
+        self.assertEquals(index.getProductNames(), ["afw", "fw"])
+        self.assertEquals(index.getProductNames("fw"), ["fw"])
+        self.assertEquals(index.getProductNames("f*"), ["fw"])
+        self.assertEquals(index.getProductNames("*fw"), ["afw", "fw"])
+        self.assertEquals(index.getProductNames("goo*"), [])
+        self.assertEquals(index.getVersions("fw"), ["1.2", "1.3"])
+        self.assertEquals(index.getVersions("goober"), [])
+        self.assertEquals(index.getTagNames(), ["current"])
+        self.assertEquals(index.getTaggedNames(["current"]).keys(), ["fw"])
+        self.assertEquals(index.getTaggedVersions("fw", ["current"]), ["1.3"])
+        self.assertEquals(list(index.select(version="1.2")),
+                          [("afw", "1.2", "/opt/sw/Darwin/afw/1.2", ()),
+                           ("fw", "1.2", "/opt/sw/Darwin/fw/1.2", ())])
+        self.assertEquals([r[:2] for r in index.select(tags=["current"])], [("fw", "1.3")])
+
+        # a changed stack gets a new index
+        self.stack.removeProduct("afw", "Darwin", "1.2")
+        index = self.stack.getIndex("Darwin")
+        self.assertEquals(index.getProductNames(), ["fw"])
+        self.assertRaises(KeyError, self.stack.getIndex, "Linux")
+
     def testGetProductNames(self):
         prods = self.stack.getProductNames()
         self.assertEquals(len(prods), 1)
@@ -424,7 +510,9 @@ class ProductStackTestCase(unittest.TestCase):
 
 
 
-from eups.stack import CacheOutOfSync
+from eups.stack import CacheOutOfSync, resetSync
+from eups.stack.ProductStack import LazyProductFamilies
+from eups.db import Database
 
 class CacheTestCase(unittest.TestCase):
 
@@ -468,6 +556,174 @@ class CacheTestCase(unittest.TestCase):
         ps2.addProduct(Product("fw", "1.2", "Linux", 
                                "/opt/sw/Darwin/fw/1.2", "none"))
         self.assertRaises(CacheOutOfSync, ps2.save)
+
+    def testSyncInterval(self):
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                    updateCache=True, verbose=False)
+        ps.syncInterval = None
+        ps.ensureInSync()
+        #
+        # Simulate another process updating the cache
+        #
+        mtime = os.stat(self.cache).st_mtime + 10
+        os.utime(self.cache, (mtime, mtime))
+        self.assert_(not ps.cacheIsInSync())
+        ps.ensureInSync()               # already checked, so nothing is done
+        self.assert_(not ps.cacheIsInSync())
+        #
+        # A change to any stack in this process means that it's checked again
+        #
+        ps2 = ProductStack(self.dbpath, autosave=False)
+        ps2.addProduct(Product("afw", "1.2", "Linux", "/opt/sw/Linux/afw/1.2", "none"))
+        ps.ensureInSync()
+        self.assert_(ps.cacheIsInSync())
+        #
+        # as it is after a subprocess that may have changed the database
+        #
+        mtime += 10
+        os.utime(self.cache, (mtime, mtime))
+        ps.ensureInSync()
+        self.assert_(not ps.cacheIsInSync())
+        resetSync()
+        ps.ensureInSync()
+        self.assert_(ps.cacheIsInSync())
+
+        # as is one with a syncInterval of 0
+        mtime += 10
+        os.utime(self.cache, (mtime, mtime))
+        ps.syncInterval = 0
+        ps.ensureInSync()
+        self.assert_(ps.cacheIsInSync())
+
+    def testLazyReload(self):
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                    updateCache=True, verbose=False)
+        ps.reload("Linux")
+        lookup = ps.lookup["Linux"]
+        self.assertEquals(len(lookup._loaded), 0)
+
+        names = ps.getProductNames("Linux")
+        names.sort()
+        self.assertEquals(names, "cfitsio doxygen eigen mpich2 python tcltk".split())
+        self.assertEquals(len(lookup._loaded), 0)
+
+        prod = ps.getProduct("python", "2.5.2", "Linux")
+        self.assertEquals(prod.name, "python")
+        self.assertEquals(ps.getTaggedProduct("python", "Linux", "current").version, "2.5.2")
+        self.assertEquals(lookup._loaded.keys(), ["python"])
+        self.assert_(not ps.hasProduct("afw", "Linux"))
+
+        # updates to decoded and undecoded products are both saved
+        ps.addProduct(Product("afw", "1.2", "Linux", "/opt/sw/Linux/afw/1.2", "none"))
+        ps.removeProduct("cfitsio", "Linux", "3006.2")
+        ps.assignTag("beta", "python", "2.5.2", "Linux")
+        ps.save()
+        ps.reload("Linux")
+
+        names = ps.getProductNames("Linux")
+        self.assert_("afw" in names)
+        self.assert_("cfitsio" not in names)
+        self.assertEquals(len(names), 6)
+        self.assertEquals(ps.getTaggedProduct("python", "Linux", "beta").version, "2.5.2")
+        self.assertEquals(ps.getVersions("doxygen", "Linux"), ["1.5.7.1"])
+
+    def testLazyLoad(self):
+        ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                               updateCache=True, verbose=False)
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                    updateCache=True, verbose=False, lazy=True)
+        lookup = ps.lookup["Linux"]
+        self.assert_(isinstance(lookup, LazyProductFamilies))
+
+        prod = ps.getProduct("python", "2.5.2", "Linux")
+        self.assertEquals(prod.dir, os.path.join(testEupsStack, "Linux/python/2.5.2"))
+        self.assertEquals(lookup._loaded.keys(), ["python"])
+        self.assert_(not ps.hasProduct("afw", "Linux"))
+        names = ps.getProductNames("Linux")
+        names.sort()
+        self.assertEquals(names, "cfitsio doxygen eigen mpich2 python tcltk".split())
+
+        # a product changed since the cache was written is read from the database
+        db = Database(self.dbpath)
+        tfile = db._tagFile("python", "beta")
+        journal = db._journalFile()
+        time.sleep(1)
+        try:
+            db.assignTag("beta", "python", "2.6")
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                        updateCache=True, verbose=False, lazy=True)
+            self.assertEquals(ps.getTaggedProduct("python", "Linux", "beta").version, "2.6")
+            self.assertEquals(ps.getTaggedProduct("python", "Linux", "current").version, "2.5.2")
+            self.assertEquals(ps.getVersions("cfitsio", "Linux"), ["3006.2"])
+        finally:
+            if os.path.exists(tfile):  os.remove(tfile)
+            if os.path.exists(journal):  os.remove(journal)
+
+    def testLazyNewProduct(self):
+        ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                               updateCache=True, verbose=False)
+        # a product declared after the cache was written is listed once
+        db = Database(self.dbpath)
+        journal = db._journalFile()
+        time.sleep(1)
+        try:
+            db.declare(Product("newprod", "1.0", "Linux", "/opt/sw/Linux/newprod/1.0", "none"))
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                        updateCache=True, verbose=False, lazy=True)
+            ps.getProduct("newprod", "1.0", "Linux")
+
+            names = "cfitsio doxygen eigen mpich2 newprod python tcltk".split()
+            self.assertEquals(sorted(ps.getProductNames("Linux")), names)
+            self.assertEquals(ps.getIndex("Linux").getProductNames(), names)
+        finally:
+            shutil.rmtree(os.path.join(self.dbpath, "newprod"), True)
+            if os.path.exists(journal):  os.remove(journal)
+
+    def testIndexFromCache(self):
+        # the cache is only trusted wholesale if the database has a journal
+        db = Database(self.dbpath)
+        journal = db._journalFile()
+        db._recordChange("test", "python", "-")
+        try:
+            ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                   updateCache=True, verbose=False)
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                        updateCache=True, verbose=False, lazy=True)
+            lookup = ps.lookup["Linux"]
+
+            # the index is made from the summaries in the cache file
+            index = ps.getIndex("Linux")
+            self.assertEquals(len(lookup._loaded), 0)
+            self.assertEquals(index.getProductNames(), 
+                              "cfitsio doxygen eigen mpich2 python tcltk".split())
+            self.assertEquals(index.getVersions("python"), ps.getVersions("python", "Linux"))
+            self.assertEquals(index.getTaggedVersions("python", ["current"]), ["2.5.2"])
+
+            ps.assignTag("beta", "python", "2.5.2", "Linux")
+            index = ps.getIndex("Linux")
+            self.assertEquals(index.getTaggedNames(["beta"]).keys(), ["python"])
+        finally:
+            if os.path.exists(journal):  os.remove(journal)
+
+    def testPickleFormat(self):
+        persistFileExt = ProductStack.persistFileExt
+        try:
+            ProductStack.persistFileExt = ProductStack.pickleFileExt
+            cache = os.path.join(self.dbpath, ProductStack.persistFilename("Linux"))
+            self.assert_(cache.endswith(".pickleDB1_3_0"))
+            try:
+                ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                            updateCache=True, verbose=False)
+                self.assert_(os.path.exists(cache))
+                self.assert_("Linux" in ProductStack.findCachedFlavors(self.dbpath))
+                ps.reload("Linux")
+                self.assert_(isinstance(ps.lookup["Linux"], dict))
+                self.assertEquals(len(ps.getProductNames("Linux")), 6)
+            finally:
+                for flavor in ProductStack.findCachedFlavors(self.dbpath):
+                    os.remove(os.path.join(self.dbpath, ProductStack.persistFilename(flavor)))
+        finally:
+            ProductStack.persistFileExt = persistFileExt
         
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
@@ -6,14 +6,18 @@ Tests for eups.product
 import pdb                              # we may want to say pdb.set_trace()
 import os
 import sys
+import shutil
 import unittest
 import time
+from cStringIO import StringIO
 import testCommon
 from testCommon import testEupsStack
 
 from eups.Product import Product, TableFileNotFound
-from eups.table import Table, BadTableContent
+from eups.table import Table, BadTableContent, TableCache, TablePrefetcher
 from eups.Eups import Eups
+import eups.hooks
+import eups.utils
 
 class TableTestCase1(unittest.TestCase):
     """test the Table class"""
@@ -31,6 +35,27 @@ class TableTestCase1(unittest.TestCase):
         self.assertEquals(len(self.table.actions("Linux+2.1.2")), 14)
         self.assertEquals(len(self.table.actions("DarwinX86")), 14)
 
+    def testArgs(self):
+        """check the splitting of an action's arguments"""
+        tablefile = os.path.join(testEupsStack, "args.table")
+        fd = open(tablefile, "w")
+        print >> fd, """
+envSet(A, "a b, c")             # a comment
+envSet(Q, "say \\"hi\\"")
+envAppend(P, ${PROD_DIR}/bin, " ")
+setupRequired("foo 1.0 [>= 0.9]")
+"""
+        fd.close()
+
+        try:
+            actions = Table(tablefile, addDefaultProduct=False).actions("Linux")
+        finally:
+            os.remove(tablefile)
+
+        self.assertEquals([a.args for a in actions],
+                          [["A", "a b, c"], ["Q", 'say "hi"'], ["P", "${PRODUCT_DIR}/bin", " "],
+                           ["foo", "1.0", "[>=", "0.9]"]])
+
 class TableTestCase2(unittest.TestCase):
     """test the Table class"""
 
@@ -49,6 +74,9 @@ class TableTestCase2(unittest.TestCase):
     def tearDown(self):
         os.environ = self.environ0
 
+    def testProductNames(self):
+        self.assertEquals(self.table.productNames(), ["python", "cfitsio", "eigen", "doxygen", "implicitProducts"])
+
     def testNoSetup(self):
         actions = self.table.actions("Linux")
         for action in actions:
@@ -170,6 +198,160 @@ class IfElseTestCase(unittest.TestCase):
             self.assertEqual(os.environ["FOO"].lower(), t)
                 
 
+class TableCacheTestCase(unittest.TestCase):
+    """test the caching of parsed table files"""
+
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_USERDATA"] = os.path.join(testEupsStack, "_userdata_")
+        self.cache = TableCache.get()
+        self.cache.clear()
+
+        if not os.path.isdir(os.environ["EUPS_USERDATA"]):
+            os.makedirs(os.environ["EUPS_USERDATA"])
+        self.tablefile = os.path.join(os.environ["EUPS_USERDATA"], "cached.table")
+        shutil.copyfile(os.path.join(testEupsStack, "mwi.table"), self.tablefile)
+
+    def tearDown(self):
+        os.remove(self.tablefile)
+        self.cache.clear()
+        os.environ = self.environ0
+
+    def testCache(self):
+        self.assert_(self.cache.lookup(self.tablefile) is None)
+        table = Table(self.tablefile)
+        self.assert_(self.cache.lookup(self.tablefile) is not None)
+
+        cached = Table(self.tablefile)
+        self.assertEquals(str(cached), str(table))
+        for flavor in ("Darwin", "Linux", "Linux+2.1.2"):
+            self.assertEquals(map(str, cached.actions(flavor)), map(str, table.actions(flavor)))
+            for a in cached.actions(flavor):
+                self.assert_(a.tableFile in (self.tablefile, "implicit"))
+
+        # the entry is not used once the table file has changed
+        fd = open(self.tablefile, "a")
+        print >> fd, "envSet(CACHED, yes)"
+        fd.close()
+        self.assert_("CACHED" in str(Table(self.tablefile)))
+
+    def readWarnings(self, verbose=0):
+        """return the warnings printed while reading the table file"""
+        err = StringIO()
+        fileObjs0 = (eups.utils.stderr._fileObj, eups.utils.stdwarn._fileObj)
+        eups.utils.stderr._fileObj = eups.utils.stdwarn._fileObj = err
+        try:
+            Table(self.tablefile, topProduct=Product("cached", "1.0"), verbose=verbose)
+        finally:
+            eups.utils.stderr._fileObj, eups.utils.stdwarn._fileObj = fileObjs0
+
+        return err.getvalue()
+
+    def testWarnings(self):
+        fd = open(self.tablefile, "a")
+        print >> fd, "sourceRequired(foo)"
+        print >> fd, "envUnset(HOME)"
+        fd.close()
+
+        warnings = self.readWarnings()
+        self.assert_("Ignoring unsupported directive" in warnings)
+        self.assert_("Attempt to unset" not in warnings)
+        self.assert_(self.cache.lookup(self.tablefile, "cached") is not None)
+
+        # the warnings are repeated when the cached entry is used
+        self.assertEquals(self.readWarnings(), warnings)
+        self.cache.forget()
+        self.assertEquals(self.readWarnings(), warnings)
+        self.assert_("Attempt to unset" in self.readWarnings(verbose=1))
+
+    def testPrune(self):
+        cache = TableCache(self.cache.cacheDir)
+        for i in range(3):
+            tablefile = os.path.join(os.environ["EUPS_USERDATA"], "cached%d.table" % i)
+            shutil.copyfile(self.tablefile, tablefile)
+            cache.save(tablefile, None, False, [], [])
+            os.utime(cache._entryFile(tablefile, None), (i, i))
+            os.remove(tablefile)
+
+        size = os.stat(cache._entryFile(tablefile, None)).st_size
+        cache.maxSize = 2*size
+        cache.prune()
+        self.assertEquals(len(os.listdir(cache.cacheDir)), 2)
+        self.assert_(not os.path.exists(cache._entryFile(os.path.join(os.environ["EUPS_USERDATA"],
+                                                                     "cached0.table"), None)))
+
+        # a new cache prunes itself the first time that it saves an entry
+        cache = TableCache(self.cache.cacheDir, size)
+        cache.save(self.tablefile, None, False, [], [])
+        self.assertEquals(os.listdir(cache.cacheDir), [os.path.basename(cache._entryFile(self.tablefile, None))])
+
+class TablePrefetcherTestCase(unittest.TestCase):
+    """test reading table files ahead of need"""
+
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_PATH"] = testEupsStack
+        os.environ["EUPS_FLAVOR"] = "Linux"
+        os.environ["EUPS_USERDATA"] = os.path.join(testEupsStack, "_userdata_")
+        self.cacheTables0 = eups.hooks.config.Eups.cacheTables
+        eups.hooks.config.Eups.cacheTables = False
+
+        if not os.path.isdir(os.environ["EUPS_USERDATA"]):
+            os.makedirs(os.environ["EUPS_USERDATA"])
+        self.tablefile = os.path.join(os.environ["EUPS_USERDATA"], "prefetched.table")
+        shutil.copyfile(os.path.join(testEupsStack, "mwi.table"), self.tablefile)
+
+    def tearDown(self):
+        os.remove(self.tablefile)
+        eups.hooks.config.Eups.cacheTables = self.cacheTables0
+        eups.hooks.config.Eups.prefetchTables = 0
+        os.environ = self.environ0
+
+    def waitFor(self, prefetcher):
+        t0 = time.time()
+        while prefetcher._running and time.time() - t0 < 10:
+            time.sleep(0.01)
+        self.assertEquals(prefetcher._running, 0)
+
+    def testPrefetch(self):
+        prefetcher = TablePrefetcher(2)
+        prefetcher.prefetch([(self.tablefile, "mwi")])
+        self.waitFor(prefetcher)
+
+        fd = open(self.tablefile)
+        self.assertEquals(prefetcher.readlines(self.tablefile), fd.readlines())
+        fd.close()
+        self.assert_(prefetcher.readlines(self.tablefile) is None)
+
+        # contents are not used once the table file has changed
+        prefetcher.prefetch([(self.tablefile, "mwi")])
+        self.waitFor(prefetcher)
+        fd = open(self.tablefile, "a")
+        print >> fd, "envSet(PREFETCHED, yes)"
+        fd.close()
+        self.assert_(prefetcher.readlines(self.tablefile) is None)
+
+    def testDependencies(self):
+        def dependencies():
+            product = Eups().findProduct("python")
+            return [(p.name, p.version, optional, depth) for p, optional, depth in
+                    product.getTable().dependencies(recursive=True)]
+
+        deps = dependencies()
+        eups.hooks.config.Eups.prefetchTables = 4
+        prefetcher = TablePrefetcher.get()
+        self.assert_(prefetcher is not None)
+
+        requested = []
+        prefetch = prefetcher.prefetch
+        def recordPrefetch(tables):
+            requested.extend([productName for tableFile, productName in tables])
+            prefetch(tables)
+        prefetcher.prefetch = recordPrefetch
+
+        self.assertEquals(dependencies(), deps)
+        self.assert_("tcltk" in requested)
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
@@ -180,6 +362,8 @@ def suite(makeSuite=True):
         TableTestCase1,
         TableTestCase2,
         IfElseTestCase,
+        TableCacheTestCase,
+        TablePrefetcherTestCase,
         ], makeSuite)
 
 def run(shouldExit=False):
@@ -34,6 +34,18 @@ class UtilsTestCase(unittest.TestCase):
         msg += "gen.beta.zeta: No such property name defined\n"
         self.assertEquals(err.getvalue(), msg)
 
+    def testLRUCache(self):
+        cache = utils.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEquals(cache.get("a"), 1)
+        cache.set("c", 3)               # "b" is the least recently used
+        self.assertEquals(len(cache), 2)
+        self.assert_(not cache.has_key("b"))
+        self.assertEquals(cache.get("b", 0), 0)
+        self.assertEquals(cache.get("a"), 1)
+        self.assertEquals(cache.get("c"), 3)
+
 
 __all__ = "UtilsTestCase".split()        
 